@@ -1,19 +1,25 @@
-from crewai import Agent, Task
+from crewai import Agent, Task, Crew
 from crewai import Process
-from langchain_openai import ChatOpenAI
 from agentes.herramientas import (
     ConsultarDoctoresTool,
     CrearCitaTool,
     ObtenerEstadisticasTool,
-    ConsultarDisponibilidadTool
+    ConsultarDisponibilidadTool,
+    BuscarProximosHuecosTool
 )
 import re
 import sqlite3
+import threading
 from agentes.bd import db
+from agentes.llm_simulado import crear_llm
+from agentes.salidas import (
+    CAMPOS_REQUERIDOS, SALIDA_POR_ETAPA, SalidaCita, SalidaTriaje, contexto_desde_salida,
+    instrucciones_salida, metricas_salidas, salida_estructurada
+)
 
 
-# Configurar el modelo GPT-4o mini
-llm = ChatOpenAI(
+# Configurar el modelo GPT-4o mini (o el simulado / grabador según BACKEND_LLM)
+llm = crear_llm(
     model="gpt-4o-mini",
     temperature=0.7
 )
@@ -22,34 +28,181 @@ consultar_doctores_tool = ConsultarDoctoresTool()
 crear_cita_tool = CrearCitaTool()
 obtener_estadisticas_tool = ObtenerEstadisticasTool()
 consultar_disponibilidad_tool = ConsultarDisponibilidadTool()
+buscar_proximos_huecos_tool = BuscarProximosHuecosTool()
+
+# Prompts estáticos: idénticos en todas las peticiones para que el proveedor reutilice el
+# prefijo en caché. Los datos del paciente van siempre al final de cada tarea (ver _datos).
+BACKSTORY_TRIAJE = """Eres un enfermero de triaje con 10 años de experiencia. Evalúas los síntomas, determinas la urgencia y recomiendas una especialidad.
+URGENCIA:
+- ALTA: riesgo vital (dolor en el pecho, dificultad respiratoria severa, pérdida de conciencia)
+- MEDIA: requiere atención pronta (fiebre alta, dolor intenso, síntomas neurológicos)
+- BAJA: puede esperar consulta regular (síntomas leves, consultas preventivas)
+ESPECIALIDADES: recibirás las candidatas del directorio con sus doctores disponibles, ordenadas por afinidad; elige una de ellas salvo que los síntomas indiquen claramente otra. Menores de 18 años: Pediatría. Síntomas generales o inespecíficos: Medicina General.
+Indica el doctor disponible de la especialidad elegida tal como aparece en las candidatas y pregunta si desea agendar una cita con él."""
+
+BACKSTORY_BD = """Eres el administrador del sistema de citas del hospital y trabajas solo con las herramientas de base de datos.
+PROCESO:
+1. Para sugerir una cita usa buscar_proximos_huecos con el doctor indicado; nunca propongas fechas pasadas.
+2. Si el usuario acepta, usa crear_cita.
+3. Si pide otra fecha, verifica con consultar_disponibilidad y, si no es posible, sugiere alternativas con buscar_proximos_huecos.
+4. Confirma la cita y muestra sus detalles."""
 
-def crear_agentes():
-    # Agente de Triaje (sin herramientas, usará delegation)
+def crear_agentes(llm_agentes=None):
+    """Construir los agentes de triaje y de base de datos (costoso: usar registro_agentes por petición)"""
+    llm_agentes = llm_agentes or llm
+    # Agente de Triaje (sin herramientas: recibe las especialidades candidatas en la tarea)
     agente_triaje = Agent(
         role='Especialista en Triaje Médico',
-        goal='Evaluar síntomas de pacientes, determinar nivel de urgencia y recomendar especialidad médica apropiada. Sugerir doctor disponible y preguntar si desea agendar cita.',
-        backstory="""Eres un enfermero especializado en triaje médico con 10 años de experiencia. \
-        Tu trabajo es evaluar los síntomas que presentan los pacientes, determinar el nivel de urgencia \
-        (ALTA, MEDIA, BAJA) y recomendar qué tipo de especialista médico necesitan.\n\n        CRITERIOS DE URGENCIA:\n        - ALTA: Síntomas que ponen en riesgo la vida (dolor en pecho, dificultad respiratoria severa, pérdida de conciencia)\n        - MEDIA: Síntomas que requieren atención pronta (fiebre alta, dolor intenso, síntomas neurológicos)\n        - BAJA: Síntomas que pueden esperar consulta regular (síntomas leves, consultas preventivas)\n\n        ESPECIALIDADES DISPONIBLES:\n        - Cardiología: problemas cardíacos, dolor en pecho, arritmias, hipertensión\n        - Neurología: problemas neurológicos, dolores de cabeza severos, mareos, convulsiones\n        - Pediatría: todos los pacientes menores de 18 años\n        - Medicina General: síntomas generales, primera consulta, síntomas no específicos\n\n        Cuando termines tu análisis, consulta al agente de base de datos para obtener el doctor disponible en la especialidad recomendada y pregunta al usuario si desea agendar una cita con ese doctor.""",
+        goal='Evaluar síntomas, determinar la urgencia, recomendar especialidad y doctor disponible, y preguntar si desea agendar cita.',
+        backstory=BACKSTORY_TRIAJE,
         verbose=True,
-        allow_delegation=True,
-        llm=llm
+        allow_delegation=False,
+        llm=llm_agentes
     )
     
     # Agente de Base de Datos con herramientas reales
     agente_bd = Agent(
         role='Administrador de Base de Datos Médica',
-        goal='Gestionar información de doctores, consultar disponibilidad y crear citas médicas usando herramientas de base de datos real. Sugerir alternativas si no hay disponibilidad.',
-        backstory="""Eres un administrador de sistemas médicos experto en gestión de bases de datos SQLite. \
-        Tu trabajo es manejar toda la información usando herramientas reales de base de datos.\n\n        HERRAMIENTAS DISPONIBLES:\n        - consultar_doctores: Para buscar doctores disponibles por especialidad\n        - consultar_disponibilidad: Para verificar si un doctor está disponible en una fecha/hora\n        - crear_cita: Para crear citas médicas reales\n        - obtener_estadisticas: Para consultar estadísticas del sistema\n\n        IMPORTANTE: Todas las citas deben ser agendadas únicamente a partir del 26 de julio de 2025 en adelante. Nunca sugieras fechas anteriores a esa.\n\n        PROCESO RECOMENDADO:\n        1. Usa consultar_doctores para obtener el doctor disponible en la especialidad recomendada\n        2. Usa consultar_disponibilidad para sugerir la fecha/hora más próxima según urgencia (pero siempre igual o posterior al 26 de julio de 2025)\n        3. Si el usuario acepta, usa crear_cita\n        4. Si el usuario pide otra fecha, verifica disponibilidad y responde si es posible o sugiere alternativas.\n        5. Confirma la cita y muestra detalles.\n        """,
+        goal='Consultar disponibilidad, crear citas médicas y sugerir alternativas usando la base de datos real.',
+        backstory=BACKSTORY_BD,
         verbose=True,
         allow_delegation=False,
-        tools=[consultar_doctores_tool, consultar_disponibilidad_tool, crear_cita_tool, obtener_estadisticas_tool],
-        llm=llm
+        tools=[consultar_doctores_tool, consultar_disponibilidad_tool, buscar_proximos_huecos_tool, crear_cita_tool, obtener_estadisticas_tool],
+        llm=llm_agentes
     )
     
     return agente_triaje, agente_bd
 
+def _contadores_propios(llm_agente):
+    """
+    Los LLM nativos de CrewAI acumulan el uso de tokens en la propia instancia y la crew suma
+    el de cada agente: cada agente de cada petición recibe una copia con los contadores a cero
+    """
+    if not hasattr(llm_agente, '_token_usage'):
+        return llm_agente
+    copia = llm_agente.model_copy()
+    copia._token_usage = dict.fromkeys(llm_agente._token_usage, 0)
+    return copia
+
+class RegistroAgentes:
+    """
+    Agentes plantilla construidos una sola vez por proceso. Cada petición recibe copias
+    superficiales propias (model_copy, sin volver a validar prompts ni herramientas):
+    comparten la configuración del LLM y el texto de los prompts, pero no la lista de
+    herramientas, el ejecutor, la crew asignada ni los contadores de uso.
+    """
+    
+    def __init__(self, fabrica=None):
+        self._fabrica = fabrica or crear_agentes
+        self._plantillas = None
+        self._lock = threading.Lock()
+    
+    def precalentar(self):
+        """Construir las plantillas si aún no existen (llamar al arrancar el worker)"""
+        if self._plantillas is None:
+            with self._lock:
+                if self._plantillas is None:
+                    # El índice de especialidades lo usa cada tarea de triaje
+                    db.directorio().indice_especialidades
+                    self._plantillas = self._fabrica()
+        return self._plantillas
+    
+    def agentes(self, llm_peticion=None):
+        """Devolver (agente_triaje, agente_bd) nuevos para una petición (opcionalmente con otro LLM)"""
+        agentes = []
+        for plantilla in self.precalentar():
+            cambios = {'tools': [herramienta.model_copy() for herramienta in plantilla.tools]}
+            cambios['llm'] = _contadores_propios(llm_peticion or plantilla.llm)
+            agentes.append(plantilla.model_copy(update=cambios))
+        return tuple(agentes)
+
+def crear_crew(agente_triaje, agente_bd, tareas, flujo=None):
+    """Crew secuencial de una petición con sus propios agentes y tareas"""
+    opciones = {}
+    if flujo is not None:
+        # El flujo necesita saber cuándo empieza la última tarea para retransmitir su respuesta
+        flujo.preparar(len(tareas))
+        opciones['task_callback'] = flujo.tarea_completada
+    return Crew(
+        agents=[agente_triaje, agente_bd],
+        tasks=tareas,
+        process=Process.sequential,
+        verbose=False,
+        **opciones
+    )
+
+# Registro global de agentes del proceso
+registro_agentes = RegistroAgentes()
+
+def candidatas_triaje(datos_paciente, k=3):
+    """Especialidades candidatas para los síntomas (índice local) con sus doctores disponibles"""
+    directorio = db.directorio()
+    candidatas = directorio.indice_especialidades.buscar(datos_paciente.get('sintomas') or '', k=k)
+    try:
+        menor = int(datos_paciente.get('edad')) < 18
+    except (TypeError, ValueError):
+        menor = False
+    if menor and not any(c['especialidad'] == 'Pediatría' for c in candidatas):
+        doctores = [(fila[0], fila[1]) for fila in directorio.por_especialidad.get('Pediatría', ())]
+        candidatas.insert(0, {'especialidad': 'Pediatría', 'puntuacion': None, 'doctores': doctores})
+    if not any(c['especialidad'] == 'Medicina General' for c in candidatas):
+        doctores = [(fila[0], fila[1]) for fila in directorio.por_especialidad.get('Medicina General', ())]
+        candidatas.append({'especialidad': 'Medicina General', 'puntuacion': None, 'doctores': doctores})
+    return [c for c in candidatas if c['doctores']]
+
+def _formatear_candidatas(candidatas):
+    return '; '.join(
+        f"{c['especialidad']}: " + ', '.join(f"{nombre} (ID {doctor_id})" for doctor_id, nombre in c['doctores'])
+        for c in candidatas
+    )
+
+def _datos(**campos):
+    """Sufijo variable de una tarea: una línea compacta por dato, siempre después del texto estático"""
+    return 'DATOS:\n' + '\n'.join(f"{campo}: {valor}" for campo, valor in campos.items())
+
+# Instrucciones estáticas de cada etapa (prefijo cacheable de la descripción de la tarea)
+INSTRUCCIONES_TAREA = {
+    'triaje': (
+        "Analiza los síntomas del paciente: nivel de urgencia (ALTA, MEDIA, BAJA), especialidad "
+        "recomendada y justificación. Elige la especialidad entre las candidatas y usa su doctor "
+        "disponible tal como aparece; no hace falta consultar a otro agente. Responde de forma "
+        "conversacional, por ejemplo: \"Según los síntomas que describes, tu nivel de urgencia es "
+        "{urgencia} y te recomiendo acudir a la especialidad de {especialidad}. El doctor disponible "
+        "es {doctor}. ¿Te gustaría agendar una cita con él?\"\n" + instrucciones_salida(SalidaTriaje)
+    ),
+    'sugerir_cita': (
+        "Consulta con buscar_proximos_huecos la fecha y hora libre más próxima del doctor indicado, "
+        "según la urgencia, y pregunta si desea agendarla. Ejemplo: \"La cita más próxima disponible "
+        "con el Dr. {doctor} es el {fecha} a las {hora}. ¿Te gustaría agendarla?\"\n"
+        + instrucciones_salida(SalidaCita)
+    ),
+    'confirmar_cita': (
+        "Registra con crear_cita la cita del paciente con el doctor, fecha y hora indicados. "
+        "Confirma al usuario que quedó agendada y muestra los detalles.\n" + instrucciones_salida(SalidaCita)
+    ),
+    'negociar_fecha': (
+        "Verifica si el doctor está disponible en la fecha y hora deseadas. Si lo está, propón "
+        "agendarla y pregunta si desea confirmarla; si no, usa buscar_proximos_huecos desde esa "
+        "fecha para sugerir la siguiente fecha/hora libre y pregunta si desea agendarla.\n"
+        + instrucciones_salida(SalidaCita)
+    ),
+}
+
+RESULTADO_ESPERADO = {
+    'triaje': "Recomendación conversacional con urgencia, especialidad, doctor y pregunta de agendar cita, más esos campos.",
+    'sugerir_cita': "Sugerencia de fecha/hora disponible con pregunta de confirmación, más la fecha y hora como campos.",
+    'confirmar_cita': "Confirmación de la cita agendada con sus detalles.",
+    'negociar_fecha': "Respuesta sobre disponibilidad con alternativa si hace falta, más la fecha y hora propuestas como campos.",
+}
+
+# Herramientas que necesita cada etapa: solo sus esquemas viajan en el prompt de la tarea
+HERRAMIENTAS_POR_ETAPA = {
+    'triaje': (),
+    'sugerir_cita': ('buscar_proximos_huecos',),
+    'confirmar_cita': ('crear_cita',),
+    'negociar_fecha': ('consultar_disponibilidad', 'buscar_proximos_huecos'),
+}
+
 def crear_tareas(agente_triaje, agente_bd, datos_paciente, etapa, contexto=None):
     """
     Crea las tareas para los agentes según la etapa conversacional.
@@ -58,65 +211,86 @@ def crear_tareas(agente_triaje, agente_bd, datos_paciente, etapa, contexto=None)
     """
     tareas = []
     if etapa == 'triaje':
-        tarea_triaje = Task(
-            description=(
-                f"""
-                Analiza los síntomas del paciente y determina:
-                - Nivel de urgencia (ALTA, MEDIA, BAJA)
-                - Especialidad médica recomendada
-                - Justificación médica
-                Luego, consulta al agente de base de datos para obtener el doctor disponible en la especialidad recomendada.
-                Finalmente, responde al usuario de forma conversacional:
-                Ejemplo de respuesta:
-                Según los síntomas que describes, tu nivel de urgencia es {{urgencia}} y te recomiendo acudir a la especialidad de {{especialidad}}. El doctor disponible es {{doctor}}. ¿Te gustaría agendar una cita con él?"
-                DATOS DEL PACIENTE:
-                - Nombre: {datos_paciente['nombre']}
-                - Edad: {datos_paciente['edad']} años
-                - Síntomas: {datos_paciente['sintomas']}
-                """
-            ),
-            expected_output="Recomendación médica conversacional con especialidad, doctor y pregunta de agendar cita.",
-            agent=agente_triaje
+        datos = _datos(
+            candidatas=_formatear_candidatas(candidatas_triaje(datos_paciente)),
+            nombre=datos_paciente['nombre'],
+            edad=datos_paciente['edad'],
+            sintomas=datos_paciente['sintomas']
         )
-        tareas.append(tarea_triaje)
+        agente = agente_triaje
     elif etapa == 'sugerir_cita':
         # contexto debe incluir: especialidad, doctor_id, doctor_nombre, urgencia
-        print(contexto)
-        tarea_sugerir = Task(
-            description=f"""
-            Usando las herramientas de base de datos, consulta la disponibilidad del doctor {contexto['doctor_nombre']} (ID: {contexto['doctor_id']}) para la fecha y hora más próxima posible según la urgencia ({contexto['urgencia']}).
-            Sugiere al usuario la fecha/hora disponible y pregunta si desea agendar la cita.
-            Ejemplo de respuesta:
-            "La cita más próxima disponible con el Dr. {contexto['doctor_nombre']} es el {{fecha}} a las {{hora}}. ¿Te gustaría agendarla?"
-            """,
-            expected_output="Sugerencia de fecha/hora disponible y pregunta de confirmación de cita.",
-            agent=agente_bd
+        datos = _datos(
+            doctor=f"{contexto['doctor_nombre']} (ID {contexto['doctor_id']})",
+            urgencia=contexto['urgencia']
         )
-        tareas.append(tarea_sugerir)
+        agente = agente_bd
     elif etapa == 'confirmar_cita':
         # contexto debe incluir: doctor_id, doctor_nombre, paciente_id, fecha, hora, motivo
-        tarea_confirmar = Task(
-            description=f"""
-            Registra la cita médica entre el paciente (ID: {contexto.get('paciente_id', datos_paciente.get('id_paciente', 'NO_ID'))}) y el doctor {contexto['doctor_nombre']} (ID: {contexto['doctor_id']}) para el {contexto['fecha']} a las {contexto['hora']}.
-            Confirma al usuario que la cita ha sido agendada exitosamente y muestra los detalles.
-            """,
-            expected_output="Confirmación de cita agendada con detalles.",
-            agent=agente_bd
+        datos = _datos(
+            paciente_id=contexto.get('paciente_id', datos_paciente.get('id_paciente', 'NO_ID')),
+            doctor=f"{contexto['doctor_nombre']} (ID {contexto['doctor_id']})",
+            fecha=contexto['fecha'],
+            hora=contexto['hora']
         )
-        tareas.append(tarea_confirmar)
+        agente = agente_bd
     elif etapa == 'negociar_fecha':
         # contexto debe incluir: doctor_id, doctor_nombre, fecha_deseada, hora_deseada
-        tarea_negociar = Task(
-            description=f"""
-            Verifica si el doctor {contexto['doctor_nombre']} (ID: {contexto['doctor_id']}) está disponible el {contexto['fecha_deseada']} a las {contexto['hora_deseada']}.
-            Si está disponible, sugiere agendar la cita y pregunta al usuario si desea confirmarla.
-            Si no está disponible, sugiere la siguiente fecha/hora disponible y pregunta si desea agendarla.
-            """,
-            expected_output="Respuesta sobre disponibilidad y sugerencia alternativa si es necesario.",
-            agent=agente_bd
+        datos = _datos(
+            doctor=f"{contexto['doctor_nombre']} (ID {contexto['doctor_id']})",
+            fecha_deseada=contexto['fecha_deseada'],
+            hora_deseada=contexto['hora_deseada']
         )
-        tareas.append(tarea_negociar)
-    return tareas 
+        agente = agente_bd
+    else:
+        return tareas
+    opciones = {}
+    if HERRAMIENTAS_POR_ETAPA[etapa]:
+        opciones['tools'] = [h for h in agente.tools if h.name in HERRAMIENTAS_POR_ETAPA[etapa]]
+    tareas.append(Task(
+        description=f"{INSTRUCCIONES_TAREA[etapa]}\n{datos}",
+        expected_output=RESULTADO_ESPERADO[etapa],
+        output_pydantic=SALIDA_POR_ETAPA[etapa],
+        agent=agente,
+        **opciones
+    ))
+    return tareas
+
+def doctor_valido(contexto):
+    """
+    El doctor_id del contexto (si hay) existe en el directorio en memoria y, si también hay
+    especialidad, es de esa especialidad
+    """
+    if contexto.get('doctor_id') is None:
+        return True
+    try:
+        doctor = db.directorio().por_id.get(int(contexto['doctor_id']))
+    except (TypeError, ValueError):
+        return False
+    return doctor is not None and (not contexto.get('especialidad') or doctor[2] == contexto['especialidad'])
+
+def extraer_contexto(resultado, etapa):
+    """
+    Contexto de la última tarea de una crew. Se leen los campos de la salida estructurada
+    (sin expresiones regulares ni consultas); si el modelo no respetó el esquema se recurre
+    a extraer_contexto_triaje sobre el texto. Un doctor_id que no está en el directorio o no
+    es de la especialidad elegida se descarta. El origen queda registrado en metricas_salidas.
+    """
+    tareas = getattr(resultado, 'tasks_output', None) or []
+    salida = salida_estructurada(tareas[-1], SALIDA_POR_ETAPA[etapa]) if tareas else None
+    if salida is not None:
+        contexto, origen = contexto_desde_salida(salida), 'estructurada'
+    else:
+        texto = (getattr(tareas[-1], 'raw', None) if tareas else None) or getattr(resultado, 'raw', None) or str(resultado)
+        contexto = extraer_contexto_triaje(texto)
+        completo = all(contexto.get(campo) for campo in CAMPOS_REQUERIDOS[etapa])
+        origen = 'texto' if completo else 'fallida'
+    if not doctor_valido(contexto):
+        # ID inventado por el modelo: no pasa a las etapas siguientes ni a la caché de triaje
+        contexto = dict(contexto, doctor_id=None, doctor_nombre=None)
+        origen = 'fallida'
+    metricas_salidas.registrar(etapa, origen)
+    return contexto
 
 def extraer_contexto_triaje(output):
     import re
@@ -137,8 +311,6 @@ def extraer_contexto_triaje(output):
     if match_doctor:
         doctor_nombre = match_doctor.group(1) or match_doctor.group(2)
         doctor_nombre = doctor_nombre.strip()
-    else:
-        print("no match_doctor")
 
     # Buscar urgencia
     match_urgencia = re.search(r'nivel de urgencia es ([A-ZÁÉÍÓÚ]+)', output, re.IGNORECASE)
@@ -157,26 +329,19 @@ def extraer_contexto_triaje(output):
     if match_hora:
         hora = match_hora.group(1).strip()
 
-    # Buscar doctor_id en la base de datos si tenemos nombre
+    # Resolver especialidad y doctor contra el índice en memoria (sin tildes ni títulos)
+    indice = db.directorio().indice
+    if especialidad:
+        especialidad = indice.resolver_especialidad(especialidad) or especialidad
     if doctor_nombre:
-        import sqlite3
-        from agentes.bd import db
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        if especialidad:
-            cursor.execute(
-                """SELECT id FROM doctores WHERE nombre LIKE ? AND especialidad LIKE ? AND disponible = 1 LIMIT 1""",
-                (f'%{doctor_nombre}%', f'%{especialidad}%')
-            )
-        else:
-            cursor.execute(
-                """SELECT id FROM doctores WHERE nombre LIKE ? AND disponible = 1 LIMIT 1""",
-                (f'%{doctor_nombre}%',)
-            )
-        row = cursor.fetchone()
-        if row:
-            doctor_id = row[0]
-        conn.close()
+        doctor_id, _ = indice.resolver(doctor_nombre, especialidad)
+    else:
+        # El modelo a veces omite el "Dr./Dra.": buscar nombres completos en el texto
+        doctor_id = indice.encontrar_en_texto(output, especialidad)
+        if doctor_id is not None:
+            doctor_nombre = re.sub(r'^Dra?\.\s*', '', indice.doctores[doctor_id][1])
+    if doctor_id is not None and not especialidad:
+        especialidad = indice.doctores[doctor_id][2]
 
     return {
         'especialidad': especialidad,
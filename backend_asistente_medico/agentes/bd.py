@@ -1,125 +1,505 @@
+import os
+import random
+import re
 import sqlite3
 import hashlib
-from datetime import datetime
+import threading
+import time
+from datetime import date, datetime
 
-class BaseDatosMedica:
-    def __init__(self, db_path="sistema_medico.db"):
+from agentes.identificadores import generador_ids
+from agentes.indice_doctores import IndiceDoctores
+from agentes.indice_especialidades import IndiceEspecialidades
+from agentes.metricas import metricas, operacion_sql
+
+# Horario usado para los doctores sin filas en la tabla `horarios`: lunes a viernes
+HORARIO_POR_DEFECTO = {dia: ('08:00', '17:00') for dia in range(5)}
+DURACION_CITA_MIN = 30
+
+
+class CursorMedido(sqlite3.Cursor):
+    """Cursor que registra la duración de cada sentencia en el histograma 'sqlite'"""
+
+    def execute(self, sql, parametros=()):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            metricas.observar('sqlite', time.perf_counter() - inicio,
+                              base=self.connection.base, operacion=operacion_sql(sql))
+
+    def executemany(self, sql, parametros):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, parametros)
+        finally:
+            metricas.observar('sqlite', time.perf_counter() - inicio,
+                              base=self.connection.base, operacion=operacion_sql(sql))
+
+
+class ConexionMedida(sqlite3.Connection):
+    """Conexión cuyas sentencias (directas o por cursor) quedan medidas; `base` etiqueta el archivo"""
+    base = ''
+
+    def cursor(self, factory=CursorMedido):
+        return super().cursor(factory)
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self.cursor().executemany(sql, parametros)
+
+
+class GestorConexiones:
+    """
+    Mantiene una conexión SQLite reutilizable por hilo.
+    Cada conexión se abre una sola vez con WAL, synchronous=NORMAL, busy_timeout
+    y caché de sentencias preparadas, en lugar de abrir y cerrar en cada consulta.
+    """
+
+    def __init__(self, db_path, busy_timeout_ms=5000, sentencias_cacheadas=256):
         self.db_path = db_path
-        self.inicializar_bd()
-    
-    def inicializar_bd(self):
-        """Crear las tablas si no existen"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Tabla de doctores
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS doctores (
-                id INTEGER PRIMARY KEY,
-                nombre TEXT NOT NULL,
-                especialidad TEXT NOT NULL,
-                disponible BOOLEAN DEFAULT 1,
-                telefono TEXT,
-                email TEXT
-            )
-        ''')
-        
-        # Tabla de pacientes reformulada
+        self.busy_timeout_ms = busy_timeout_ms
+        self.sentencias_cacheadas = sentencias_cacheadas
+        self._local = threading.local()
+        self._abiertas = []
+        self._lock = threading.Lock()
+
+    def _abrir(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            cached_statements=self.sentencias_cacheadas,
+            check_same_thread=False,
+            factory=ConexionMedida
+        )
+        conn.base = os.path.basename(str(self.db_path))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        # Sin esto INSERT OR REPLACE no dispara los triggers de borrado y los contadores se desvían
+        conn.execute("PRAGMA recursive_triggers=ON")
+        with self._lock:
+            self._abiertas.append(conn)
+        return conn
+
+    def obtener(self):
+        """Devolver la conexión del hilo actual, abriéndola si no existe"""
+        conn = getattr(self._local, 'conn', None)
+        # Tras un fork (p. ej. gunicorn con preload) la conexión heredada no es válida
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._abrir()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def cerrar_todas(self):
+        """Cerrar todas las conexiones abiertas por este gestor"""
+        with self._lock:
+            abiertas, self._abiertas = self._abiertas, []
+        for conn in abiertas:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                pass
+        self._local = threading.local()
+
+
+def _migracion_esquema_inicial(cursor):
+    """Crear las tablas base y cargar los doctores de ejemplo si no existen"""
+    # Tabla de doctores
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS doctores (
+            id INTEGER PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            especialidad TEXT NOT NULL,
+            disponible BOOLEAN DEFAULT 1,
+            telefono TEXT,
+            email TEXT
+        )
+    ''')
+
+    # Tabla de pacientes reformulada
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pacientes (
+            id TEXT PRIMARY KEY,
+            nombres TEXT NOT NULL,
+            apellidos TEXT NOT NULL,
+            correo_electronico TEXT UNIQUE NOT NULL,
+            numero_telefono TEXT,
+            edad INTEGER NOT NULL,
+            contraseña TEXT NOT NULL,
+            fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Tabla de citas con campo urgencia añadido
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS citas (
+            id TEXT PRIMARY KEY,
+            paciente_id TEXT NOT NULL,
+            doctor_id INTEGER NOT NULL,
+            fecha TEXT NOT NULL,
+            hora TEXT NOT NULL,
+            motivo TEXT,
+            urgencia TEXT DEFAULT 'Normal',
+            estado TEXT DEFAULT 'Programada',
+            fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (paciente_id) REFERENCES pacientes (id),
+            FOREIGN KEY (doctor_id) REFERENCES doctores (id)
+        )
+    ''')
+
+    # Insertar doctores con más especialidades si no existen
+    cursor.execute("SELECT COUNT(*) FROM doctores")
+    if cursor.fetchone()[0] == 0:
+        doctores_ejemplo = [
+            # Medicina General y Familia
+            (1, "Dr. Carlos García", "Medicina General", True, "123-456-7890", "garcia@hospital.com"),
+            (2, "Dra. Ana López", "Medicina Familiar", True, "123-456-7891", "lopez@hospital.com"),
+
+            # Especialidades Cardiovasculares
+            (3, "Dr. Miguel Martínez", "Cardiología", True, "123-456-7892", "martinez@hospital.com"),
+            (4, "Dra. Elena Rodríguez", "Cardiología Intervencionista", True, "123-456-7893", "rodriguez@hospital.com"),
+
+            # Neurología y Psiquiatría
+            (5, "Dr. Jorge Hernández", "Neurología", True, "123-456-7894", "hernandez@hospital.com"),
+            (6, "Dra. María Fernández", "Psiquiatría", True, "123-456-7895", "fernandez@hospital.com"),
+            (7, "Dr. Luis Gómez", "Neurología Pediátrica", True, "123-456-7896", "gomez@hospital.com"),
+
+            # Especialidades Pediátricas
+            (8, "Dra. Carmen Jiménez", "Pediatría", True, "123-456-7897", "jimenez@hospital.com"),
+            (9, "Dr. Roberto Morales", "Neonatología", True, "123-456-7898", "morales@hospital.com"),
+
+            # Ginecología y Obstetricia
+            (10, "Dra. Isabel Torres", "Ginecología", True, "123-456-7899", "torres@hospital.com"),
+            (11, "Dr. Antonio Ruiz", "Obstetricia", True, "123-456-7800", "ruiz@hospital.com"),
+
+            # Especialidades Quirúrgicas
+            (12, "Dr. Fernando Castro", "Cirugía General", True, "123-456-7801", "castro@hospital.com"),
+            (13, "Dra. Patricia Vargas", "Cirugía Plástica", True, "123-456-7802", "vargas@hospital.com"),
+            (14, "Dr. Andrés Mendoza", "Traumatología", True, "123-456-7803", "mendoza@hospital.com"),
+            (15, "Dra. Sofía Ortega", "Neurocirugía", True, "123-456-7804", "ortega@hospital.com"),
+
+            # Especialidades de Diagnóstico
+            (16, "Dr. Ricardo Peña", "Radiología", True, "123-456-7805", "pena@hospital.com"),
+            (17, "Dra. Lucía Ramírez", "Patología", True, "123-456-7806", "ramirez@hospital.com"),
+
+            # Especialidades Internas
+            (18, "Dr. Eduardo Silva", "Gastroenterología", True, "123-456-7807", "silva@hospital.com"),
+            (19, "Dra. Gabriela Vega", "Endocrinología", True, "123-456-7808", "vega@hospital.com"),
+            (20, "Dr. Marcos Delgado", "Neumología", True, "123-456-7809", "delgado@hospital.com"),
+            (21, "Dra. Valeria Campos", "Nefrología", True, "123-456-7810", "campos@hospital.com"),
+            (22, "Dr. Héctor Ramos", "Hematología", True, "123-456-7811", "ramos@hospital.com"),
+
+            # Especialidades Sensoriales
+            (23, "Dra. Andrea Soto", "Oftalmología", True, "123-456-7812", "soto@hospital.com"),
+            (24, "Dr. Daniel Cruz", "Otorrinolaringología", True, "123-456-7813", "cruz@hospital.com"),
+
+            # Dermatología y Urología
+            (25, "Dra. Mónica Aguilar", "Dermatología", True, "123-456-7814", "aguilar@hospital.com"),
+            (26, "Dr. Pablo Guerrero", "Urología", True, "123-456-7815", "guerrero@hospital.com"),
+
+            # Especialidades de Emergencia
+            (27, "Dr. Javier Medina", "Medicina de Emergencia", True, "123-456-7816", "medina@hospital.com"),
+            (28, "Dra. Natalia Herrera", "Medicina Intensiva", True, "123-456-7817", "herrera@hospital.com"),
+
+            # Especialidades Complementarias
+            (29, "Dr. Oscar Moreno", "Anestesiología", True, "123-456-7818", "moreno@hospital.com"),
+            (30, "Dra. Carolina Núñez", "Medicina del Trabajo", True, "123-456-7819", "nunez@hospital.com")
+        ]
+        cursor.executemany(
+            "INSERT INTO doctores (id, nombre, especialidad, disponible, telefono, email) VALUES (?, ?, ?, ?, ?, ?)",
+            doctores_ejemplo
+        )
+
+
+def _migracion_indices(cursor):
+    """Índices para las consultas calientes y unicidad de (doctor_id, fecha, hora)"""
+    # Consulta de disponibilidad y reserva: citas WHERE doctor_id = ? AND fecha = ? AND hora = ?
+    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pacientes (
-                id TEXT PRIMARY KEY,
-                nombres TEXT NOT NULL,
-                apellidos TEXT NOT NULL,
-                correo_electronico TEXT UNIQUE NOT NULL,
-                numero_telefono TEXT,
-                edad INTEGER NOT NULL,
-                contraseña TEXT NOT NULL,
-                fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_citas_doctor_fecha_hora
+            ON citas (doctor_id, fecha, hora)
         ''')
-        
-        # Tabla de citas con campo urgencia añadido
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS citas (
-                id TEXT PRIMARY KEY,
-                paciente_id TEXT NOT NULL,
-                doctor_id INTEGER NOT NULL,
-                fecha TEXT NOT NULL,
-                hora TEXT NOT NULL,
-                motivo TEXT,
-                urgencia TEXT DEFAULT 'Normal',
-                estado TEXT DEFAULT 'Programada',
-                fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (paciente_id) REFERENCES pacientes (id),
-                FOREIGN KEY (doctor_id) REFERENCES doctores (id)
-            )
+    except sqlite3.IntegrityError:
+        raise RuntimeError(
+            "Existen citas duplicadas para el mismo doctor, fecha y hora. "
+            "Resuélvalas antes de aplicar la migración 2."
+        )
+
+    # mis_citas: WHERE paciente_id = ? ORDER BY fecha, hora
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_citas_paciente_fecha_hora
+        ON citas (paciente_id, fecha, hora)
+    ''')
+
+    # Filtros de doctores por disponibilidad (y especialidad); cubre también
+    # SELECT DISTINCT especialidad ... WHERE disponible = 1 ORDER BY especialidad
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_doctores_disponible_especialidad
+        ON doctores (disponible, especialidad)
+    ''')
+
+
+def _migracion_horarios(cursor):
+    """Horario laboral por doctor y día de la semana (0 = lunes)"""
+    # Los doctores sin filas aquí usan HORARIO_POR_DEFECTO
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS horarios (
+            doctor_id INTEGER NOT NULL,
+            dia_semana INTEGER NOT NULL CHECK (dia_semana BETWEEN 0 AND 6),
+            hora_inicio TEXT NOT NULL,
+            hora_fin TEXT NOT NULL,
+            PRIMARY KEY (doctor_id, dia_semana),
+            FOREIGN KEY (doctor_id) REFERENCES doctores (id)
+        )
+    ''')
+
+
+def _migracion_versiones_datos(cursor):
+    """Contador data_version por tabla, incrementado por triggers en cada escritura"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS versiones_datos (
+            tabla TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO versiones_datos (tabla, version) VALUES ('doctores', 0)")
+    for operacion in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_doctores_version_{operacion.lower()}
+            AFTER {operacion} ON doctores
+            BEGIN
+                UPDATE versiones_datos SET version = version + 1 WHERE tabla = 'doctores';
+            END
         ''')
+
+
+def _sumar_estadistica(categoria, clave, delta):
+    """Sentencia UPSERT que suma `delta` al contador (categoria, clave); clave y delta son SQL"""
+    return f'''
+        INSERT INTO estadisticas (categoria, clave, cantidad) VALUES ('{categoria}', {clave}, {delta})
+        ON CONFLICT (categoria, clave) DO UPDATE SET cantidad = cantidad + excluded.cantidad;'''
+
+
+def _asegurar_columna(cursor, tabla, columna, definicion):
+    """Agregar la columna si la tabla viene de un esquema anterior que no la tenía"""
+    cursor.execute(f"PRAGMA table_info({tabla})")
+    if columna not in {fila[1] for fila in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+
+
+def _migracion_estadisticas(cursor):
+    """Contadores agregados mantenidos por triggers para no recorrer tablas completas"""
+    # Bases creadas antes de que citas tuviera urgencia/estado
+    _asegurar_columna(cursor, 'citas', 'urgencia', "TEXT DEFAULT 'Normal'")
+    _asegurar_columna(cursor, 'citas', 'estado', "TEXT DEFAULT 'Programada'")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS estadisticas (
+            categoria TEXT NOT NULL,
+            clave TEXT NOT NULL,
+            cantidad INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (categoria, clave)
+        ) WITHOUT ROWID
+    ''')
+
+    # Expresiones por fila; NULL se agrupa bajo la clave vacía
+    urgencia = "COALESCE({fila}.urgencia, '')"
+    estado = "COALESCE({fila}.estado, '')"
+    disponible = "(CASE WHEN {fila}.disponible THEN 1 ELSE 0 END)"
+
+    def citas(fila, signo):
+        return ''.join([
+            _sumar_estadistica('totales', "'citas'", signo),
+            _sumar_estadistica('citas_urgencia', urgencia.format(fila=fila), signo),
+            _sumar_estadistica('citas_estado', estado.format(fila=fila), signo),
+        ])
+
+    def doctores(fila, signo, contar_total=True):
+        sentencias = [_sumar_estadistica('totales', "'doctores'", signo)] if contar_total else []
+        delta = f"{signo} * {disponible.format(fila=fila)}"
+        sentencias += [
+            _sumar_estadistica('totales', "'doctores_disponibles'", delta),
+            _sumar_estadistica('doctores_especialidad', f"{fila}.especialidad", delta),
+        ]
+        return ''.join(sentencias)
+
+    triggers = {
+        'trg_pacientes_estadisticas_insert': (
+            'AFTER INSERT ON pacientes', _sumar_estadistica('totales', "'pacientes'", '1')),
+        'trg_pacientes_estadisticas_delete': (
+            'AFTER DELETE ON pacientes', _sumar_estadistica('totales', "'pacientes'", '-1')),
+        'trg_citas_estadisticas_insert': ('AFTER INSERT ON citas', citas('NEW', '1')),
+        'trg_citas_estadisticas_delete': ('AFTER DELETE ON citas', citas('OLD', '-1')),
+        'trg_citas_estadisticas_update': (
+            'AFTER UPDATE OF urgencia, estado ON citas', citas('OLD', '-1') + citas('NEW', '1')),
+        'trg_doctores_estadisticas_insert': ('AFTER INSERT ON doctores', doctores('NEW', '1')),
+        'trg_doctores_estadisticas_delete': ('AFTER DELETE ON doctores', doctores('OLD', '-1')),
+        'trg_doctores_estadisticas_update': (
+            'AFTER UPDATE OF disponible, especialidad ON doctores',
+            doctores('OLD', '-1', contar_total=False) + doctores('NEW', '1', contar_total=False)),
+    }
+    for nombre, (evento, cuerpo) in triggers.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {nombre} {evento} BEGIN {cuerpo} END")
+
+    # Carga inicial a partir de los datos existentes
+    cursor.execute("DELETE FROM estadisticas")
+    cursor.execute('''
+        INSERT INTO estadisticas (categoria, clave, cantidad)
+        SELECT 'totales', 'pacientes', COUNT(*) FROM pacientes
+        UNION ALL SELECT 'totales', 'citas', COUNT(*) FROM citas
+        UNION ALL SELECT 'totales', 'doctores', COUNT(*) FROM doctores
+        UNION ALL SELECT 'totales', 'doctores_disponibles', COUNT(*) FROM doctores WHERE disponible
+        UNION ALL SELECT 'citas_urgencia', COALESCE(urgencia, ''), COUNT(*) FROM citas GROUP BY 1, 2
+        UNION ALL SELECT 'citas_estado', COALESCE(estado, ''), COUNT(*) FROM citas GROUP BY 1, 2
+        UNION ALL SELECT 'doctores_especialidad', especialidad, COUNT(*) FROM doctores
+                  WHERE disponible GROUP BY 1, 2
+    ''')
+
+
+def _migracion_indice_paginacion_citas(cursor):
+    """Índice (paciente_id, fecha, hora, id) para paginar por clave; reemplaza al de (paciente_id, fecha, hora)"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_citas_paciente_fecha_hora_id
+        ON citas (paciente_id, fecha, hora, id)
+    ''')
+    cursor.execute("DROP INDEX IF EXISTS idx_citas_paciente_fecha_hora")
+
+
+# Migraciones versionadas con PRAGMA user_version. Nunca modificar una ya publicada:
+# los cambios de esquema se agregan como una nueva entrada al final.
+MIGRACIONES = [
+    (1, _migracion_esquema_inicial),
+    (2, _migracion_indices),
+    (3, _migracion_horarios),
+    (4, _migracion_versiones_datos),
+    (5, _migracion_estadisticas),
+    (6, _migracion_indice_paginacion_citas),
+]
+
+
+class ErrorReserva(Exception):
+    """No se pudo reservar la cita; `motivo` indica la causa para que cada capa la traduzca"""
+    DATOS_INVALIDOS = 'datos_invalidos'
+    PACIENTE_INEXISTENTE = 'paciente_inexistente'
+    DOCTOR_NO_DISPONIBLE = 'doctor_no_disponible'
+    HORARIO_OCUPADO = 'horario_ocupado'
+    FUERA_DE_HORARIO = 'fuera_de_horario'
+    FECHA_PASADA = 'fecha_pasada'
+
+    def __init__(self, motivo, mensaje):
+        super().__init__(mensaje)
+        self.motivo = motivo
+
+
+def _minutos_sql(columna):
+    """Expresión SQL con los minutos desde medianoche de una columna 'H:MM' o 'HH:MM'"""
+    return (f"(CAST(substr({columna}, 1, instr({columna}, ':') - 1) AS INTEGER) * 60"
+            f" + CAST(substr({columna}, instr({columna}, ':') + 1, 2) AS INTEGER))")
+
+
+def citas_solapadas(conn, duracion_min=DURACION_CITA_MIN):
+    """
+    Número de pares de citas del mismo doctor y día cuyas franjas se solapan
+    (no solo las de hora idéntica: 10:00 y 10:15 también cuentan)
+    """
+    return conn.execute(f'''
+        SELECT COUNT(*) FROM citas a
+        JOIN citas b ON a.doctor_id = b.doctor_id AND a.fecha = b.fecha AND a.id < b.id
+        WHERE abs({_minutos_sql('a.hora')} - {_minutos_sql('b.hora')}) < ?
+    ''', (duracion_min,)).fetchone()[0]
+
+
+def _es_bloqueo(error):
+    """True si el OperationalError corresponde a SQLITE_BUSY / SQLITE_LOCKED"""
+    mensaje = str(error).lower()
+    return 'locked' in mensaje or 'busy' in mensaje
+
+
+class DirectorioDoctores:
+    """
+    Instantánea inmutable de la tabla doctores, indexada por especialidad e ID.
+    Las filas conservan el orden de columnas de `SELECT * FROM doctores`.
+    """
+
+    def __init__(self, version, filas):
+        self.version = version
+        self.por_id = {fila[0]: fila for fila in filas}
+        self.disponibles = tuple(fila for fila in filas if fila[3])
+        self.por_especialidad = {}
+        for fila in self.disponibles:
+            self.por_especialidad.setdefault(fila[2], []).append(fila)
+        self.por_especialidad = {k: tuple(v) for k, v in self.por_especialidad.items()}
+        self.especialidades = sorted(self.por_especialidad)
+        self._indice = None
+        self._indice_especialidades = None
+
+    @property
+    def indice(self):
+        """Índice de nombres y especialidades de los doctores disponibles, construido una vez por versión"""
+        if self._indice is None:
+            self._indice = IndiceDoctores(self.disponibles)
+        return self._indice
+
+    @property
+    def indice_especialidades(self):
+        """Índice síntomas -> especialidades con doctores disponibles, construido una vez por versión"""
+        if self._indice_especialidades is None:
+            self._indice_especialidades = IndiceEspecialidades(self.por_especialidad)
+        return self._indice_especialidades
+
+    def buscar(self, especialidad=None):
+        """Doctores disponibles cuya especialidad contiene el texto dado (sin distinguir mayúsculas)"""
+        if not especialidad:
+            return list(self.disponibles)
+        buscada = especialidad.lower()
+        return [
+            fila
+            for nombre, filas in self.por_especialidad.items() if buscada in nombre.lower()
+            for fila in filas
+        ]
+
+
+class BaseDatosMedica:
+    def __init__(self, db_path="sistema_medico.db", comprobar_directorio_cada=1.0):
+        self.db_path = db_path
+        self.conexiones = GestorConexiones(db_path)
+        self.comprobar_directorio_cada = comprobar_directorio_cada
+        self._directorio = None
+        self._directorio_comprobado = float('-inf')
+        self.migrar()
+    
+    def conexion(self):
+        """
+        Prestar la conexión reutilizable del hilo actual.
+        No se debe cerrar; para escrituras usar `with db.conexion() as conn:`
+        que confirma o revierte la transacción al salir.
+        """
+        return self.conexiones.obtener()
+    
+    def migrar(self):
+        """Aplicar en orden las migraciones pendientes según PRAGMA user_version"""
+        conn = self.conexion()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
         
-        # Insertar doctores con más especialidades si no existen
-        cursor.execute("SELECT COUNT(*) FROM doctores")
-        if cursor.fetchone()[0] == 0:
-            doctores_ejemplo = [
-                # Medicina General y Familia
-                (1, "Dr. Carlos García", "Medicina General", True, "123-456-7890", "garcia@hospital.com"),
-                (2, "Dra. Ana López", "Medicina Familiar", True, "123-456-7891", "lopez@hospital.com"),
-                
-                # Especialidades Cardiovasculares
-                (3, "Dr. Miguel Martínez", "Cardiología", True, "123-456-7892", "martinez@hospital.com"),
-                (4, "Dra. Elena Rodríguez", "Cardiología Intervencionista", True, "123-456-7893", "rodriguez@hospital.com"),
-                
-                # Neurología y Psiquiatría
-                (5, "Dr. Jorge Hernández", "Neurología", True, "123-456-7894", "hernandez@hospital.com"),
-                (6, "Dra. María Fernández", "Psiquiatría", True, "123-456-7895", "fernandez@hospital.com"),
-                (7, "Dr. Luis Gómez", "Neurología Pediátrica", True, "123-456-7896", "gomez@hospital.com"),
-                
-                # Especialidades Pediátricas
-                (8, "Dra. Carmen Jiménez", "Pediatría", True, "123-456-7897", "jimenez@hospital.com"),
-                (9, "Dr. Roberto Morales", "Neonatología", True, "123-456-7898", "morales@hospital.com"),
-                
-                # Ginecología y Obstetricia
-                (10, "Dra. Isabel Torres", "Ginecología", True, "123-456-7899", "torres@hospital.com"),
-                (11, "Dr. Antonio Ruiz", "Obstetricia", True, "123-456-7800", "ruiz@hospital.com"),
-                
-                # Especialidades Quirúrgicas
-                (12, "Dr. Fernando Castro", "Cirugía General", True, "123-456-7801", "castro@hospital.com"),
-                (13, "Dra. Patricia Vargas", "Cirugía Plástica", True, "123-456-7802", "vargas@hospital.com"),
-                (14, "Dr. Andrés Mendoza", "Traumatología", True, "123-456-7803", "mendoza@hospital.com"),
-                (15, "Dra. Sofía Ortega", "Neurocirugía", True, "123-456-7804", "ortega@hospital.com"),
-                
-                # Especialidades de Diagnóstico
-                (16, "Dr. Ricardo Peña", "Radiología", True, "123-456-7805", "pena@hospital.com"),
-                (17, "Dra. Lucía Ramírez", "Patología", True, "123-456-7806", "ramirez@hospital.com"),
-                
-                # Especialidades Internas
-                (18, "Dr. Eduardo Silva", "Gastroenterología", True, "123-456-7807", "silva@hospital.com"),
-                (19, "Dra. Gabriela Vega", "Endocrinología", True, "123-456-7808", "vega@hospital.com"),
-                (20, "Dr. Marcos Delgado", "Neumología", True, "123-456-7809", "delgado@hospital.com"),
-                (21, "Dra. Valeria Campos", "Nefrología", True, "123-456-7810", "campos@hospital.com"),
-                (22, "Dr. Héctor Ramos", "Hematología", True, "123-456-7811", "ramos@hospital.com"),
-                
-                # Especialidades Sensoriales
-                (23, "Dra. Andrea Soto", "Oftalmología", True, "123-456-7812", "soto@hospital.com"),
-                (24, "Dr. Daniel Cruz", "Otorrinolaringología", True, "123-456-7813", "cruz@hospital.com"),
-                
-                # Dermatología y Urología
-                (25, "Dra. Mónica Aguilar", "Dermatología", True, "123-456-7814", "aguilar@hospital.com"),
-                (26, "Dr. Pablo Guerrero", "Urología", True, "123-456-7815", "guerrero@hospital.com"),
-                
-                # Especialidades de Emergencia
-                (27, "Dr. Javier Medina", "Medicina de Emergencia", True, "123-456-7816", "medina@hospital.com"),
-                (28, "Dra. Natalia Herrera", "Medicina Intensiva", True, "123-456-7817", "herrera@hospital.com"),
-                
-                # Especialidades Complementarias
-                (29, "Dr. Oscar Moreno", "Anestesiología", True, "123-456-7818", "moreno@hospital.com"),
-                (30, "Dra. Carolina Núñez", "Medicina del Trabajo", True, "123-456-7819", "nunez@hospital.com")
-            ]
-            cursor.executemany(
-                "INSERT INTO doctores (id, nombre, especialidad, disponible, telefono, email) VALUES (?, ?, ?, ?, ?, ?)",
-                doctores_ejemplo
-            )
-        
-        conn.commit()
-        conn.close()
+        for numero, migracion in MIGRACIONES:
+            if numero <= version:
+                continue
+            # BEGIN IMMEDIATE serializa a varios workers que arrancan a la vez
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if numero > version:
+                    migracion(conn.cursor())
+                    conn.execute(f"PRAGMA user_version = {numero}")
+                    version = numero
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return version
     
     def hash_password(self, password):
         """Función para hashear contraseñas"""
@@ -127,72 +507,244 @@ class BaseDatosMedica:
     
     def registrar_paciente(self, nombres, apellidos, correo_electronico, numero_telefono, edad, contraseña):
         """Registrar un nuevo paciente"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        conn = self.conexion()
         
         # Generar ID único para el paciente
-        paciente_id = f"PAC{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        paciente_id = generador_ids.nuevo('PAC')
         
         # Hashear la contraseña
         contraseña_hash = self.hash_password(contraseña)
         
         try:
-            cursor.execute('''
-                INSERT INTO pacientes (id, nombres, apellidos, correo_electronico, numero_telefono, edad, contraseña)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (paciente_id, nombres, apellidos, correo_electronico, numero_telefono, edad, contraseña_hash))
-            
-            conn.commit()
+            with conn:
+                conn.execute('''
+                    INSERT INTO pacientes (id, nombres, apellidos, correo_electronico, numero_telefono, edad, contraseña)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (paciente_id, nombres, apellidos, correo_electronico, numero_telefono, edad, contraseña_hash))
             return paciente_id
         except sqlite3.IntegrityError:
             return None  # El correo ya existe
-        finally:
-            conn.close()
+    
+    def directorio(self):
+        """
+        Devolver el directorio de doctores en memoria.
+        Como mucho cada `comprobar_directorio_cada` segundos se consulta el contador
+        data_version de la tabla (una lectura por clave primaria); si un trigger lo incrementó,
+        en este o en otro proceso, se recarga la instantánea. Un cambio en los doctores puede
+        tardar ese intervalo en verse (salvo tras invalidar_directorio).
+        """
+        ahora = time.monotonic()
+        if self._directorio is not None and ahora - self._directorio_comprobado < self.comprobar_directorio_cada:
+            return self._directorio
+        self._directorio_comprobado = ahora
+        cursor = self.conexion().cursor()
+        cursor.execute("SELECT version FROM versiones_datos WHERE tabla = 'doctores'")
+        version = cursor.fetchone()[0]
+        
+        directorio = self._directorio
+        if directorio is None or directorio.version != version:
+            # La versión se lee antes que las filas: en el peor caso se recarga de más, nunca de menos
+            cursor.execute("SELECT * FROM doctores ORDER BY id")
+            directorio = DirectorioDoctores(version, cursor.fetchall())
+            self._directorio = directorio
+        return directorio
+    
+    def invalidar_directorio(self):
+        """Forzar que la próxima lectura del directorio compruebe la versión en SQLite"""
+        self._directorio_comprobado = float('-inf')
     
     def obtener_doctores_por_especialidad(self, especialidad=None):
         """Obtener doctores filtrados por especialidad"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        directorio = self.directorio()
         
         if especialidad:
-            cursor.execute(
-                "SELECT * FROM doctores WHERE especialidad = ? AND disponible = 1",
-                (especialidad,)
-            )
-        else:
-            cursor.execute("SELECT * FROM doctores WHERE disponible = 1")
-        
-        doctores = cursor.fetchall()
-        conn.close()
-        return doctores
+            return list(directorio.por_especialidad.get(especialidad, ()))
+        return list(directorio.disponibles)
+    
+    def obtener_doctor(self, doctor_id):
+        """Obtener un doctor por ID (disponible o no), o None si no existe"""
+        return self.directorio().por_id.get(doctor_id)
     
     def obtener_especialidades(self):
         """Obtener todas las especialidades disponibles"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        return list(self.directorio().especialidades)
+    
+    def citas_paciente(self, paciente_id, periodo='todas', estado=None, despues_de=None, lote=500):
+        """
+        Iterar las citas de un paciente con paginación por clave (keyset) sobre (fecha, hora, id).
+        'proximas' se ordena de la más cercana a la más lejana; 'pasadas' y 'todas', de la más
+        reciente a la más antigua. `despues_de` es la clave (fecha, hora, id) de la última cita
+        ya entregada; la lectura se hace en lotes con fetchmany para no cargar todo en memoria.
+        """
+        if periodo not in ('todas', 'proximas', 'pasadas'):
+            raise ValueError(f"Periodo no válido: {periodo}")
+        
+        condiciones = ["c.paciente_id = ?"]
+        parametros = [paciente_id]
+        ahora = datetime.now()
+        if periodo == 'proximas':
+            condiciones.append("(c.fecha, c.hora) >= (?, ?)")
+            parametros += [ahora.strftime('%Y-%m-%d'), ahora.strftime('%H:%M')]
+        elif periodo == 'pasadas':
+            condiciones.append("(c.fecha, c.hora) < (?, ?)")
+            parametros += [ahora.strftime('%Y-%m-%d'), ahora.strftime('%H:%M')]
+        if estado:
+            condiciones.append("c.estado = ?")
+            parametros.append(estado)
         
-        cursor.execute("SELECT DISTINCT especialidad FROM doctores WHERE disponible = 1 ORDER BY especialidad")
-        especialidades = [row[0] for row in cursor.fetchall()]
+        ascendente = periodo == 'proximas'
+        if despues_de:
+            condiciones.append(f"(c.fecha, c.hora, c.id) {'>' if ascendente else '<'} (?, ?, ?)")
+            parametros += list(despues_de)
+        orden = 'ASC' if ascendente else 'DESC'
         
-        conn.close()
-        return especialidades
+        cursor = self.conexion().cursor()
+        cursor.execute(f'''
+            SELECT c.id, c.fecha, c.hora, c.motivo, c.urgencia, c.estado,
+                   d.nombre, d.especialidad, c.fecha_creacion
+            FROM citas c
+            JOIN doctores d ON c.doctor_id = d.id
+            WHERE {' AND '.join(condiciones)}
+            ORDER BY c.fecha {orden}, c.hora {orden}, c.id {orden}
+        ''', parametros)
+        
+        while True:
+            filas = cursor.fetchmany(lote)
+            if not filas:
+                break
+            for cita in filas:
+                yield {
+                    'id': cita[0],
+                    'fecha': cita[1],
+                    'hora': cita[2],
+                    'motivo': cita[3],
+                    'urgencia': cita[4],
+                    'estado': cita[5],
+                    'doctor_nombre': cita[6],
+                    'doctor_especialidad': cita[7],
+                    'fecha_creacion': cita[8]
+                }
     
-    def crear_cita(self, paciente_id, doctor_id, fecha, hora, motivo, urgencia="Normal"):
-        """Crear una nueva cita médica"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def estadisticas(self):
+        """Leer los contadores agregados que mantienen los triggers (sin recorrer las tablas)"""
+        cursor = self.conexion().cursor()
+        cursor.execute("SELECT categoria, clave, cantidad FROM estadisticas WHERE cantidad <> 0")
         
-        # Generar ID único para la cita
-        cita_id = f"CITA{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        categorias = {}
+        for categoria, clave, cantidad in cursor.fetchall():
+            categorias.setdefault(categoria, {})[clave] = cantidad
+        totales = categorias.get('totales', {})
+        return {
+            'total_pacientes': totales.get('pacientes', 0),
+            'total_citas': totales.get('citas', 0),
+            'total_doctores': totales.get('doctores', 0),
+            'doctores_disponibles': totales.get('doctores_disponibles', 0),
+            'citas_por_urgencia': categorias.get('citas_urgencia', {}),
+            'citas_por_estado': categorias.get('citas_estado', {}),
+            'doctores_por_especialidad': categorias.get('doctores_especialidad', {}),
+        }
+    
+    def reservar_cita(self, paciente_id, doctor_id, fecha, hora, motivo,
+                      urgencia="Normal", estado="Programada", intentos=5):
+        """
+        Reservar una cita de forma atómica y devolver sus datos.
+        Las verificaciones y el INSERT se hacen dentro de BEGIN IMMEDIATE: la hora debe empezar
+        una franja de DURACION_CITA_MIN minutos dentro del horario del doctor (o del horario por
+        defecto) y no estar en el pasado, así dos citas del mismo doctor solo pueden solaparse
+        si tienen la misma hora, que el índice único (doctor_id, fecha, hora) impide. Si la base está
+        ocupada (SQLITE_BUSY) se reintenta hasta `intentos` veces con espera exponencial.
+        Lanza ErrorReserva si los datos no son válidos o la franja ya está ocupada.
+        """
+        try:
+            doctor_id = int(doctor_id)
+            fecha = date.fromisoformat(str(fecha).strip()).isoformat()
+        except (TypeError, ValueError):
+            raise ErrorReserva(ErrorReserva.DATOS_INVALIDOS, f"Doctor o fecha no válidos: {doctor_id}, {fecha}")
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})(?::\d{2})?', str(hora).strip())
+        if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+            raise ErrorReserva(ErrorReserva.DATOS_INVALIDOS, f"Hora no válida: {hora}. Usa el formato HH:MM")
+        hora = f"{int(match.group(1)):02d}:{match.group(2)}"
         
-        cursor.execute('''
-            INSERT INTO citas (id, paciente_id, doctor_id, fecha, hora, motivo, urgencia)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (cita_id, paciente_id, doctor_id, fecha, hora, motivo, urgencia))
+        conn = self.conexion()
+        for intento in range(intentos):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                if not _es_bloqueo(e) or intento == intentos - 1:
+                    raise
+                time.sleep(random.uniform(0, 0.05 * 2 ** intento))
+                continue
+            
+            try:
+                paciente = conn.execute(
+                    "SELECT nombres, apellidos FROM pacientes WHERE id = ?", (paciente_id,)
+                ).fetchone()
+                if not paciente:
+                    raise ErrorReserva(ErrorReserva.PACIENTE_INEXISTENTE, f"No existe paciente con ID {paciente_id}")
+                
+                doctor = self.obtener_doctor(doctor_id)
+                if not doctor or not doctor[3]:
+                    raise ErrorReserva(
+                        ErrorReserva.DOCTOR_NO_DISPONIBLE,
+                        f"Doctor con ID {doctor_id} no existe o no está disponible"
+                    )
+                self._comprobar_franja(conn, doctor_id, fecha, hora)
+                
+                cita_id = generador_ids.nuevo('CITA')
+                conn.execute('''
+                    INSERT INTO citas (id, paciente_id, doctor_id, fecha, hora, motivo, urgencia, estado)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (cita_id, paciente_id, doctor_id, fecha, hora, motivo, urgencia, estado))
+                conn.commit()
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                raise ErrorReserva(
+                    ErrorReserva.HORARIO_OCUPADO,
+                    f"El doctor ya tiene una cita programada el {fecha} a las {hora}"
+                )
+            except BaseException:
+                conn.rollback()
+                raise
+            
+            return {
+                'id': cita_id,
+                'paciente_id': paciente_id,
+                'paciente_nombre': f"{paciente[0]} {paciente[1]}",
+                'doctor_id': doctor_id,
+                'doctor_nombre': doctor[1],
+                'especialidad': doctor[2],
+                'fecha': fecha,
+                'hora': hora,
+                'motivo': motivo,
+                'urgencia': urgencia,
+                'estado': estado
+            }
+
+    def _comprobar_franja(self, conn, doctor_id, fecha, hora):
+        """Lanzar ErrorReserva si fecha/hora no es una franja futura del horario del doctor"""
+        inicio = int(hora[:2]) * 60 + int(hora[3:])
+        if inicio % DURACION_CITA_MIN:
+            raise ErrorReserva(
+                ErrorReserva.FUERA_DE_HORARIO,
+                f"Las citas empiezan cada {DURACION_CITA_MIN} minutos; {hora} no es el inicio de una franja"
+            )
+        if datetime.fromisoformat(f"{fecha}T{hora}") < datetime.now():
+            raise ErrorReserva(ErrorReserva.FECHA_PASADA, f"El {fecha} a las {hora} ya pasó")
         
-        conn.commit()
-        conn.close()
-        return cita_id
+        horario = {
+            dia: (hora_inicio, hora_fin) for dia, hora_inicio, hora_fin in conn.execute(
+                "SELECT dia_semana, hora_inicio, hora_fin FROM horarios WHERE doctor_id = ?", (doctor_id,)
+            )
+        } or HORARIO_POR_DEFECTO
+        dia = date.fromisoformat(fecha).weekday()
+        if dia in horario:
+            hora_inicio, hora_fin = (int(h) * 60 + int(m) for h, m in (t.split(':')[:2] for t in horario[dia]))
+            if hora_inicio <= inicio and inicio + DURACION_CITA_MIN <= hora_fin:
+                return
+        raise ErrorReserva(
+            ErrorReserva.FUERA_DE_HORARIO,
+            f"El doctor con ID {doctor_id} no atiende el {fecha} a las {hora}"
+        )
 
 # Instancia global de la base de datos
-db = BaseDatosMedica()
\ No newline at end of file
+db = BaseDatosMedica(comprobar_directorio_cada=float(os.getenv('DIRECTORIO_COMPROBAR_CADA', 1.0)))
\ No newline at end of file
@@ -0,0 +1,257 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from agentes.bd import GestorConexiones, db
+from agentes.indice_doctores import normalizar
+from agentes.triaje_reglas import redactar_triaje
+
+# Palabras que no cambian el sentido de los síntomas; las negaciones ("no", "sin") se conservan
+PALABRAS_VACIAS = {
+    'a', 'al', 'con', 'de', 'del', 'el', 'en', 'la', 'las', 'lo', 'los', 'le', 'les', 'me', 'mi',
+    'mis', 'o', 'para', 'por', 'que', 'se', 'su', 'sus', 'te', 'tengo', 'tiene', 'un', 'una', 'unos',
+    'unas', 'y', 'e', 'es', 'estoy', 'esta', 'muy', 'mucho', 'mucha', 'siento', 'hola', 'doctor',
+    'doctora', 'creo', 'tambien', 'ya', 'poco', 'algo',
+}
+
+# Límites superiores (inclusive) de cada banda de edad; la pediátrica termina en 17
+BANDAS_EDAD = [(1, 'lactante'), (12, 'nino'), (17, 'adolescente'), (39, 'adulto_joven'), (64, 'adulto')]
+
+RESULTADOS = ('aciertos_memoria', 'aciertos_disco', 'fallos', 'escrituras')
+
+
+def banda_edad(edad):
+    try:
+        edad = int(edad)
+    except (TypeError, ValueError):
+        return 'desconocida'
+    for limite, banda in BANDAS_EDAD:
+        if edad <= limite:
+            return banda
+    return 'mayor'
+
+
+def clave_triaje(sintomas, edad):
+    """Clave canónica: banda de edad + tokens sin tildes ni palabras vacías, únicos y ordenados"""
+    tokens = sorted({t for t in normalizar(sintomas).split() if t not in PALABRAS_VACIAS})
+    if not tokens:
+        return None
+    return f"{banda_edad(edad)}|{' '.join(tokens)}"
+
+
+class CacheTriaje:
+    """
+    Caché del resultado del triaje (urgencia, especialidad y doctor; nunca la prosa del LLM).
+    Una LRU en memoria por proceso delante de un archivo SQLite compartido por los workers,
+    ambos con TTL. Vaciar la caché incrementa una generación en SQLite que cada worker
+    comprueba al consultar, de modo que también descarta su copia en memoria. Los
+    contadores se acumulan en memoria y se suman a SQLite como mucho cada `volcar_cada`
+    segundos (o con la siguiente escritura), nunca en cada consulta.
+    """
+
+    def __init__(self, ruta=None, ttl_segundos=24 * 3600, max_memoria=1024, volcar_cada=10.0):
+        self.ruta = ruta
+        self.ttl_segundos = ttl_segundos
+        self.max_memoria = max_memoria
+        self.volcar_cada = volcar_cada
+        self._memoria = OrderedDict()
+        self._generacion = None
+        self._contadores = dict.fromkeys(RESULTADOS, 0)
+        self._pendientes = dict.fromkeys(RESULTADOS, 0)
+        self._ultimo_volcado = time.monotonic()
+        self._lock = threading.Lock()
+        self.conexiones = GestorConexiones(ruta) if ruta else None
+        if self.conexiones:
+            self._crear_tablas()
+
+    def _crear_tablas(self):
+        with self.conexiones.obtener() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_triaje (
+                    clave TEXT PRIMARY KEY,
+                    contexto TEXT NOT NULL,
+                    expira REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_triaje_metricas (
+                    nombre TEXT PRIMARY KEY,
+                    valor INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.executemany(
+                "INSERT OR IGNORE INTO cache_triaje_metricas (nombre, valor) VALUES (?, 0)",
+                [(nombre,) for nombre in RESULTADOS + ('generacion',)]
+            )
+            self._generacion = conn.execute(
+                "SELECT valor FROM cache_triaje_metricas WHERE nombre = 'generacion'"
+            ).fetchone()[0]
+
+    def _contar(self, resultado):
+        with self._lock:
+            self._contadores[resultado] += 1
+            self._pendientes[resultado] += 1
+            volcar = self.conexiones and time.monotonic() - self._ultimo_volcado >= self.volcar_cada
+        if volcar:
+            with self.conexiones.obtener() as conn:
+                self._volcar(conn)
+
+    def _volcar(self, conn):
+        """Sumar en SQLite los contadores acumulados desde el último volcado"""
+        with self._lock:
+            pendientes = [(valor, nombre) for nombre, valor in self._pendientes.items() if valor]
+            self._pendientes = dict.fromkeys(RESULTADOS, 0)
+            self._ultimo_volcado = time.monotonic()
+        if pendientes:
+            conn.executemany("UPDATE cache_triaje_metricas SET valor = valor + ? WHERE nombre = ?", pendientes)
+
+    def _sincronizar_generacion(self, conn):
+        """Descartar la memoria local si otro proceso vació la caché compartida"""
+        generacion = conn.execute(
+            "SELECT valor FROM cache_triaje_metricas WHERE nombre = 'generacion'"
+        ).fetchone()[0]
+        with self._lock:
+            if generacion != self._generacion:
+                self._memoria.clear()
+                self._generacion = generacion
+
+    def _recordar(self, clave, expira, contexto):
+        with self._lock:
+            self._memoria[clave] = (expira, contexto)
+            self._memoria.move_to_end(clave)
+            while len(self._memoria) > self.max_memoria:
+                self._memoria.popitem(last=False)
+
+    def obtener_contexto(self, clave):
+        """Contexto guardado para la clave, o None si no existe o caducó"""
+        if clave is None:
+            return None
+        ahora = time.time()
+        conn = self.conexiones.obtener() if self.conexiones else None
+        if conn is not None:
+            self._sincronizar_generacion(conn)
+
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada and entrada[0] > ahora:
+                self._memoria.move_to_end(clave)
+            elif entrada:
+                del self._memoria[clave]
+                entrada = None
+        if entrada:
+            self._contar('aciertos_memoria')
+            return dict(entrada[1])
+
+        if conn is not None:
+            fila = conn.execute(
+                "SELECT contexto, expira FROM cache_triaje WHERE clave = ? AND expira > ?", (clave, ahora)
+            ).fetchone()
+            if fila:
+                contexto = json.loads(fila[0])
+                self._recordar(clave, fila[1], contexto)
+                self._contar('aciertos_disco')
+                return dict(contexto)
+        self._contar('fallos')
+        return None
+
+    def guardar_contexto(self, clave, contexto):
+        if clave is None:
+            return
+        expira = time.time() + self.ttl_segundos
+        self._recordar(clave, expira, dict(contexto))
+        with self._lock:
+            self._contadores['escrituras'] += 1
+            self._pendientes['escrituras'] += 1
+        if self.conexiones:
+            with self.conexiones.obtener() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_triaje (clave, contexto, expira) VALUES (?, ?, ?)",
+                    (clave, json.dumps(contexto, ensure_ascii=False), expira)
+                )
+                # Ya hay transacción de escritura: los contadores pendientes van en ella
+                self._volcar(conn)
+
+    def obtener(self, sintomas, edad):
+        """
+        Devolver (respuesta, contexto) para síntomas equivalentes ya triados, o None.
+        El doctor se vuelve a validar contra el directorio actual por si dejó de estar disponible.
+        """
+        guardado = self.obtener_contexto(clave_triaje(sintomas, edad))
+        if not guardado:
+            return None
+        directorio = db.directorio()
+        doctor = directorio.por_id.get(guardado.get('doctor_id'))
+        if not doctor or not doctor[3] or doctor[2] != guardado['especialidad']:
+            doctores = directorio.por_especialidad.get(guardado['especialidad'])
+            if not doctores:
+                return None
+            doctor = doctores[0]
+        return redactar_triaje(guardado['urgencia'], guardado['especialidad'], doctor)
+
+    def guardar(self, sintomas, edad, contexto):
+        """Guardar urgencia, especialidad y doctor extraídos por el agente (si están completos)"""
+        urgencia = (contexto.get('urgencia') or '').upper()
+        if urgencia not in ('ALTA', 'MEDIA', 'BAJA'):
+            return
+        if contexto.get('especialidad') not in db.directorio().por_especialidad:
+            return
+        self.guardar_contexto(clave_triaje(sintomas, edad), {
+            'urgencia': urgencia,
+            'especialidad': contexto['especialidad'],
+            'doctor_id': contexto.get('doctor_id'),
+        })
+
+    def estadisticas(self):
+        """Contadores y tasa de aciertos (de todos los workers si hay archivo SQLite)"""
+        if self.conexiones:
+            with self.conexiones.obtener() as conn:
+                self._volcar(conn)
+            filas = self.conexiones.obtener().execute("SELECT nombre, valor FROM cache_triaje_metricas").fetchall()
+            contadores = {nombre: valor for nombre, valor in filas if nombre in RESULTADOS}
+            entradas = self.conexiones.obtener().execute(
+                "SELECT COUNT(*) FROM cache_triaje WHERE expira > ?", (time.time(),)
+            ).fetchone()[0]
+        else:
+            with self._lock:
+                contadores = dict(self._contadores)
+            entradas = len(self._memoria)
+        consultas = contadores['aciertos_memoria'] + contadores['aciertos_disco'] + contadores['fallos']
+        aciertos = contadores['aciertos_memoria'] + contadores['aciertos_disco']
+        return {
+            **contadores,
+            'consultas': consultas,
+            'tasa_aciertos': round(aciertos / consultas, 4) if consultas else 0.0,
+            'entradas': entradas,
+            'entradas_memoria_proceso': len(self._memoria),
+        }
+
+    def vaciar(self, reiniciar_metricas=False):
+        """Borrar todas las entradas (y opcionalmente los contadores) en todos los workers"""
+        with self._lock:
+            self._memoria.clear()
+            if reiniciar_metricas:
+                self._contadores = dict.fromkeys(RESULTADOS, 0)
+                self._pendientes = dict.fromkeys(RESULTADOS, 0)
+        if self.conexiones:
+            with self.conexiones.obtener() as conn:
+                conn.execute("DELETE FROM cache_triaje")
+                conn.execute("UPDATE cache_triaje_metricas SET valor = valor + 1 WHERE nombre = 'generacion'")
+                if reiniciar_metricas:
+                    conn.execute("UPDATE cache_triaje_metricas SET valor = 0 WHERE nombre <> 'generacion'")
+
+    def purgar_expiradas(self):
+        """Eliminar del archivo las entradas caducadas; devuelve cuántas se borraron"""
+        if not self.conexiones:
+            return 0
+        with self.conexiones.obtener() as conn:
+            return conn.execute("DELETE FROM cache_triaje WHERE expira <= ?", (time.time(),)).rowcount
+
+
+# Instancia global; CACHE_TRIAJE_DB vacío deja solo la caché en memoria de cada proceso
+cache_triaje = CacheTriaje(
+    os.getenv('CACHE_TRIAJE_DB', 'cache_triaje.db') or None,
+    ttl_segundos=int(os.getenv('CACHE_TRIAJE_TTL', 24 * 3600)),
+    max_memoria=int(os.getenv('CACHE_TRIAJE_MAX_MEMORIA', 1024)),
+)
@@ -0,0 +1,251 @@
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+# Política por operación: plazo total (s), reintentos y cobertura (s hasta lanzar una
+# segunda petición idéntica si la primera no respondió; 0 la desactiva). Se pueden ajustar
+# con OPENAI_PLAZO_<OPERACION>, OPENAI_REINTENTOS_<OPERACION> y OPENAI_COBERTURA_<OPERACION>
+POLITICAS = {
+    'transcripcion': {'plazo': 20, 'reintentos': 2, 'cobertura': 2},
+    'voz': {'plazo': 30, 'reintentos': 1, 'cobertura': 0},
+    'chat': {'plazo': 60, 'reintentos': 2, 'cobertura': 0},
+}
+CONTADORES = ('llamadas', 'reintentos', 'coberturas', 'coberturas_ganadas', 'fallos', 'plazos_agotados', 'rechazadas')
+# Estados del circuito y su valor en la métrica
+ESTADOS_CIRCUITO = {'cerrado': 0, 'semiabierto': 1, 'abierto': 2}
+
+
+class OpenAINoDisponible(Exception):
+    """OpenAI no respondió a tiempo o falla de forma continuada: se responde 503 sin esperar más"""
+
+    def __init__(self, mensaje, reintentar_en):
+        super().__init__(mensaje)
+        self.reintentar_en = reintentar_en
+
+
+class CircuitoAbierto(OpenAINoDisponible):
+    pass
+
+
+class PlazoAgotado(OpenAINoDisponible):
+    pass
+
+
+class Politica:
+    def __init__(self, plazo, reintentos=0, cobertura=0, espera_base=0.25, espera_maxima=4.0):
+        self.plazo = plazo
+        self.reintentos = reintentos
+        self.cobertura = cobertura
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+
+    def espera(self, intento, aleatorio=random.random):
+        """Backoff exponencial con jitter completo: uniforme entre 0 y base * 2^intento (acotado)"""
+        return aleatorio() * min(self.espera_maxima, self.espera_base * 2 ** intento)
+
+
+def politica(operacion):
+    valores = POLITICAS[operacion]
+    prefijo = operacion.upper()
+    return Politica(
+        plazo=float(os.getenv(f'OPENAI_PLAZO_{prefijo}', valores['plazo'])),
+        reintentos=int(os.getenv(f'OPENAI_REINTENTOS_{prefijo}', valores['reintentos'])),
+        cobertura=float(os.getenv(f'OPENAI_COBERTURA_{prefijo}', valores['cobertura'])),
+    )
+
+
+def error_transitorio(error):
+    """Timeouts, errores de conexión, 408/409/429 y 5xx: vale la pena reintentar y cuentan para el circuito"""
+    vistos = set()
+    while error is not None and id(error) not in vistos:
+        vistos.add(id(error))
+        if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in (408, 409, 429) or error.status_code >= 500
+        # CrewAI y LangChain pueden envolver el error original (la cadena puede tener ciclos)
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class Circuito:
+    """
+    Cortacircuitos por operación: tras `umbral` fallos transitorios seguidos se abre y
+    rechaza al instante durante `enfriamiento` segundos; después deja pasar una sola
+    llamada de prueba (semiabierto) que lo cierra si sale bien o lo vuelve a abrir.
+    """
+
+    def __init__(self, umbral=5, enfriamiento=30.0, reloj=time.monotonic):
+        self.umbral = umbral
+        self.enfriamiento = enfriamiento
+        self.reloj = reloj
+        self.fallos_seguidos = 0
+        self.aperturas = 0
+        self._abierto_hasta = None
+        self._sondeando = False
+        self._lock = threading.Lock()
+
+    @property
+    def estado(self):
+        with self._lock:
+            if self._abierto_hasta is None:
+                return 'cerrado'
+            return 'semiabierto' if self._sondeando or self.reloj() >= self._abierto_hasta else 'abierto'
+
+    def permitir(self):
+        """Devuelve los segundos hasta poder reintentar si la llamada se rechaza, o None si puede pasar"""
+        with self._lock:
+            if self._abierto_hasta is None:
+                return None
+            if self._sondeando or self.reloj() < self._abierto_hasta:
+                return max(1, round(self._abierto_hasta - self.reloj()))
+            self._sondeando = True
+            return None
+
+    def exito(self):
+        with self._lock:
+            self.fallos_seguidos = 0
+            self._abierto_hasta = None
+            self._sondeando = False
+
+    def fallo(self):
+        with self._lock:
+            self.fallos_seguidos += 1
+            if self._sondeando or self.fallos_seguidos >= self.umbral:
+                if self._abierto_hasta is None or self._sondeando:
+                    self.aperturas += 1
+                self._abierto_hasta = self.reloj() + self.enfriamiento
+                self._sondeando = False
+
+
+class ClienteResiliente:
+    """
+    Capa común para las llamadas a OpenAI (Whisper, TTS y la crew): plazo total por
+    operación, reintentos con backoff y jitter solo ante errores transitorios, petición
+    de cobertura opcional para llamadas cortas e idempotentes (transcripción) y un
+    cortacircuitos por operación que falla al instante mientras OpenAI no responde.
+    Los contadores se exponen en /metrics.
+    """
+
+    def __init__(self, politicas=None, umbral_fallos=5, enfriamiento=30.0, hilos_cobertura=16):
+        self.politicas = politicas or {operacion: politica(operacion) for operacion in POLITICAS}
+        self.circuitos = {operacion: Circuito(umbral_fallos, enfriamiento) for operacion in self.politicas}
+        self._contadores = {operacion: dict.fromkeys(CONTADORES, 0) for operacion in self.politicas}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=hilos_cobertura, thread_name_prefix='cobertura')
+
+    def _contar(self, operacion, contador):
+        with self._lock:
+            self._contadores[operacion][contador] += 1
+
+    def _admitir(self, operacion):
+        reintentar_en = self.circuitos[operacion].permitir()
+        if reintentar_en is not None:
+            self._contar(operacion, 'rechazadas')
+            raise CircuitoAbierto('El servicio de OpenAI no está respondiendo; inténtalo de nuevo en unos segundos.',
+                                  reintentar_en)
+
+    def _intento(self, operacion, politica_op, funcion, restante):
+        """Una llamada con el plazo restante; con cobertura, se lanza otra igual si tarda demasiado"""
+        if not politica_op.cobertura or politica_op.cobertura >= restante:
+            return funcion(timeout=restante)
+        primera = self._pool.submit(contextvars.copy_context().run, funcion, timeout=restante)
+        if wait([primera], timeout=politica_op.cobertura).done:
+            return primera.result()
+        self._contar(operacion, 'coberturas')
+        segunda = self._pool.submit(contextvars.copy_context().run, funcion, timeout=restante - politica_op.cobertura)
+        pendientes, error = {primera, segunda}, None
+        while pendientes:
+            terminadas, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in terminadas:
+                if futuro.exception() is None:
+                    # La otra petición sigue en su hilo hasta su propio timeout; su resultado se descarta
+                    if futuro is segunda:
+                        self._contar(operacion, 'coberturas_ganadas')
+                    return futuro.result()
+                error = futuro.exception()
+        raise error
+
+    def llamar(self, operacion, funcion, *args, **kwargs):
+        """
+        Llamar a un método del SDK de OpenAI (p. ej. client.audio.speech.create) pasándole
+        timeout=<plazo restante>. Los argumentos deben poder reenviarse en cada reintento
+        (contenido en bytes, no archivos abiertos).
+        """
+        politica_op = self.politicas[operacion]
+        circuito = self.circuitos[operacion]
+        funcion = functools.partial(funcion, *args, **kwargs)
+        self._contar(operacion, 'llamadas')
+        self._admitir(operacion)
+        limite = time.monotonic() + politica_op.plazo
+        intento = 0
+        while True:
+            try:
+                resultado = self._intento(operacion, politica_op, funcion, limite - time.monotonic())
+            except Exception as e:
+                if not error_transitorio(e):
+                    # Error de la petición (400, 401...): OpenAI responde, el circuito no se abre
+                    circuito.exito()
+                    raise
+                circuito.fallo()
+                self._contar(operacion, 'fallos')
+                espera = politica_op.espera(intento)
+                if intento >= politica_op.reintentos or time.monotonic() + espera >= limite:
+                    self._contar(operacion, 'plazos_agotados')
+                    raise PlazoAgotado('OpenAI no respondió a tiempo; inténtalo de nuevo en unos segundos.',
+                                       max(1, round(espera))) from e
+                intento += 1
+                self._contar(operacion, 'reintentos')
+                time.sleep(espera)
+                # Si el circuito se abrió mientras tanto no se insiste
+                self._admitir(operacion)
+                continue
+            circuito.exito()
+            return resultado
+
+    def proteger(self, operacion):
+        """
+        Decorador para llamadas que hacen varias peticiones por dentro y no se pueden repetir
+        sin efectos (crew.kickoff, que puede haber reservado ya la cita): solo cortacircuitos;
+        el plazo y los reintentos de cada petición los aplica el propio LLM (ver crear_llm)
+        """
+        def decorador(funcion):
+            @functools.wraps(funcion)
+            def envoltura(*args, **kwargs):
+                self._contar(operacion, 'llamadas')
+                self._admitir(operacion)
+                try:
+                    resultado = funcion(*args, **kwargs)
+                except Exception as e:
+                    if error_transitorio(e):
+                        self.circuitos[operacion].fallo()
+                        self._contar(operacion, 'fallos')
+                    else:
+                        self.circuitos[operacion].exito()
+                    raise
+                self.circuitos[operacion].exito()
+                return resultado
+            return envoltura
+        return decorador
+
+    def resumen(self):
+        with self._lock:
+            copia = {operacion: dict(contadores) for operacion, contadores in self._contadores.items()}
+        for operacion, contadores in copia.items():
+            circuito = self.circuitos[operacion]
+            contadores['circuito'] = circuito.estado
+            contadores['aperturas'] = circuito.aperturas
+        return copia
+
+
+# Cliente global del proceso; el umbral y el enfriamiento del circuito se ajustan por entorno
+cliente_openai = ClienteResiliente(
+    umbral_fallos=int(os.getenv('OPENAI_CIRCUITO_FALLOS', 5)),
+    enfriamiento=float(os.getenv('OPENAI_CIRCUITO_ENFRIAMIENTO', 30)),
+)
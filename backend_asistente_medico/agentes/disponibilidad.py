@@ -0,0 +1,156 @@
+import re
+from datetime import datetime, timedelta
+
+from agentes.bd import DURACION_CITA_MIN, HORARIO_POR_DEFECTO, db
+
+HORIZONTE_DIAS = 90
+VENTANA_DIAS = 14
+
+_PATRON_HORA = re.compile(r'(\d{1,2}):(\d{2})')
+
+
+def _minutos(hora):
+    """Convertir 'HH:MM' en minutos desde medianoche (None si no se reconoce)"""
+    match = _PATRON_HORA.match(str(hora).strip())
+    if not match:
+        return None
+    return int(match.group(1)) * 60 + int(match.group(2))
+
+
+class MotorDisponibilidad:
+    """
+    Busca los próximos huecos libres de uno o varios doctores.
+    Cada día de cada doctor se representa como un bitmap (bit i = franja i del día):
+    se parte de las franjas del horario laboral y se apagan las ocupadas por `citas`,
+    que se leen con una sola consulta por ventana sobre idx_citas_doctor_fecha_hora.
+    """
+
+    def __init__(self, base, duracion_min=DURACION_CITA_MIN, horizonte_dias=HORIZONTE_DIAS):
+        self.base = base
+        self.duracion_min = duracion_min
+        self.horizonte_dias = horizonte_dias
+
+    def _mascara(self, hora_inicio, hora_fin):
+        inicio, fin = _minutos(hora_inicio), _minutos(hora_fin)
+        if inicio is None or fin is None or fin <= inicio:
+            return 0
+        primera = -(-inicio // self.duracion_min)  # primera franja completa
+        ultima = fin // self.duracion_min           # exclusiva
+        if ultima <= primera:
+            return 0
+        return ((1 << (ultima - primera)) - 1) << primera
+
+    def _mascaras_semanales(self, doctor_ids):
+        """Devolver {doctor_id: [mascara_lunes, ..., mascara_domingo]}"""
+        marcadores = ','.join('?' * len(doctor_ids))
+        cursor = self.base.conexion().cursor()
+        cursor.execute(
+            f"SELECT doctor_id, dia_semana, hora_inicio, hora_fin FROM horarios WHERE doctor_id IN ({marcadores})",
+            doctor_ids
+        )
+        propios = {}
+        for doctor_id, dia, inicio, fin in cursor.fetchall():
+            propios.setdefault(doctor_id, {})[dia] = (inicio, fin)
+
+        mascaras = {}
+        for doctor_id in doctor_ids:
+            horario = propios.get(doctor_id, HORARIO_POR_DEFECTO)
+            mascaras[doctor_id] = [
+                self._mascara(*horario[dia]) if dia in horario else 0
+                for dia in range(7)
+            ]
+        return mascaras
+
+    def _ocupadas(self, doctor_ids, fecha_inicio, fecha_fin):
+        """Devolver {(doctor_id, 'YYYY-MM-DD'): bitmap de franjas ocupadas}"""
+        marcadores = ','.join('?' * len(doctor_ids))
+        cursor = self.base.conexion().cursor()
+        cursor.execute(
+            f"""SELECT doctor_id, fecha, hora FROM citas
+                WHERE doctor_id IN ({marcadores}) AND fecha BETWEEN ? AND ?""",
+            (*doctor_ids, fecha_inicio.isoformat(), fecha_fin.isoformat())
+        )
+        ocupadas = {}
+        for doctor_id, fecha, hora in cursor.fetchall():
+            minutos = _minutos(hora)
+            if minutos is None:
+                continue
+            clave = (doctor_id, fecha)
+            ocupadas[clave] = ocupadas.get(clave, 0) | (1 << (minutos // self.duracion_min))
+        return ocupadas
+
+    def _doctores(self, doctor_id=None, especialidad=None):
+        doctores = self.base.obtener_doctores_por_especialidad()
+        if doctor_id is not None:
+            return [d for d in doctores if d[0] == int(doctor_id)]
+        if especialidad:
+            # Sin distinguir tildes, mayúsculas ni espacios ("cardiologia " -> "Cardiología")
+            canonica = self.base.directorio().indice.resolver_especialidad(especialidad)
+            return [d for d in doctores if d[2] == canonica]
+        return list(doctores)
+
+    def proximos_huecos(self, doctor_id=None, especialidad=None, desde=None, cantidad=5):
+        """
+        Devolver los `cantidad` huecos libres más próximos a partir de `desde`
+        (datetime, date o 'YYYY-MM-DD'; por defecto y como mínimo ahora), ordenados por
+        fecha, hora y doctor.
+        """
+        if isinstance(desde, str):
+            desde = datetime.fromisoformat(desde)
+        elif desde is None:
+            desde = datetime.now()
+        elif not isinstance(desde, datetime):
+            desde = datetime.combine(desde, datetime.min.time())
+        # Nunca se ofrecen franjas pasadas (reservar_cita las rechazaría)
+        desde = max(desde, datetime.now())
+
+        doctores = self._doctores(doctor_id, especialidad)
+        if not doctores or cantidad <= 0:
+            return []
+        por_id = {d[0]: d for d in doctores}
+        doctor_ids = list(por_id)
+        mascaras = self._mascaras_semanales(doctor_ids)
+
+        # Franjas del primer día que ya empezaron no se ofrecen
+        franja_actual = -(-(desde.hour * 60 + desde.minute) // self.duracion_min)
+        pasadas_hoy = (1 << franja_actual) - 1
+
+        huecos = []
+        dia_inicial = desde.date()
+        ultimo_dia = dia_inicial + timedelta(days=self.horizonte_dias)
+        ventana_inicio = dia_inicial
+        while ventana_inicio <= ultimo_dia and len(huecos) < cantidad:
+            ventana_fin = min(ventana_inicio + timedelta(days=VENTANA_DIAS - 1), ultimo_dia)
+            ocupadas = self._ocupadas(doctor_ids, ventana_inicio, ventana_fin)
+
+            dia = ventana_inicio
+            while dia <= ventana_fin and len(huecos) < cantidad:
+                fecha = dia.isoformat()
+                candidatos = []
+                for doc_id in doctor_ids:
+                    libres = mascaras[doc_id][dia.weekday()] & ~ocupadas.get((doc_id, fecha), 0)
+                    if dia == dia_inicial:
+                        libres &= ~pasadas_hoy
+                    tomados = 0
+                    while libres and tomados < cantidad:
+                        bit = libres & -libres
+                        candidatos.append((bit.bit_length() - 1, doc_id))
+                        libres ^= bit
+                        tomados += 1
+                for franja, doc_id in sorted(candidatos)[:cantidad - len(huecos)]:
+                    minutos = franja * self.duracion_min
+                    doctor = por_id[doc_id]
+                    huecos.append({
+                        'doctor_id': doc_id,
+                        'doctor_nombre': doctor[1],
+                        'especialidad': doctor[2],
+                        'fecha': fecha,
+                        'hora': f"{minutos // 60:02d}:{minutos % 60:02d}"
+                    })
+                dia += timedelta(days=1)
+            ventana_inicio = ventana_fin + timedelta(days=1)
+        return huecos
+
+
+# Instancia global del motor de disponibilidad
+motor_disponibilidad = MotorDisponibilidad(db)
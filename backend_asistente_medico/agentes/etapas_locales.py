@@ -0,0 +1,149 @@
+import re
+from datetime import date, datetime
+
+from agentes.bd import ErrorReserva, db
+from agentes.disponibilidad import motor_disponibilidad
+
+
+def _nombre_doctor(doctor_id, doctor_nombre=None):
+    """Nombre con título tal como figura en el directorio ('Dr. ...' / 'Dra. ...')"""
+    doctor = db.directorio().por_id.get(int(doctor_id))
+    if doctor:
+        return doctor[1]
+    return f"Dr. {doctor_nombre}" if doctor_nombre else f"el doctor {doctor_id}"
+
+
+def _contexto_hueco(hueco):
+    return {
+        'doctor_id': hueco['doctor_id'],
+        'doctor_nombre': re.sub(r'^Dra?\.\s*', '', hueco['doctor_nombre']),
+        'especialidad': hueco['especialidad'],
+        'fecha': hueco['fecha'],
+        'hora': hueco['hora'],
+    }
+
+
+def _proponer(hueco, introduccion=''):
+    respuesta = (
+        f"{introduccion}La cita más próxima disponible con {hueco['doctor_nombre']} es el "
+        f"{hueco['fecha']} a las {hueco['hora']}. ¿Te gustaría agendarla?"
+    )
+    return respuesta, _contexto_hueco(hueco), 'confirmar_cita'
+
+
+def _sin_huecos(doctor):
+    respuesta = (
+        f"No encontré huecos disponibles con {doctor} en los próximos "
+        f"{motor_disponibilidad.horizonte_dias} días. Si lo deseas, describe de nuevo tus "
+        f"síntomas para buscar otra opción."
+    )
+    return respuesta, {}, 'finalizado'
+
+
+def _desde(fecha, hora=None):
+    """Inicio de búsqueda a partir de la fecha/hora pedidas, nunca en el pasado"""
+    desde = datetime.fromisoformat(f"{date.fromisoformat(str(fecha).strip()).isoformat()} {hora or '00:00'}")
+    return max(desde, datetime.now())
+
+
+def sugerir_cita_local(contexto):
+    """Hueco más próximo del doctor elegido en el triaje"""
+    doctor_id = contexto.get('doctor_id')
+    if not doctor_id:
+        return None
+    huecos = motor_disponibilidad.proximos_huecos(doctor_id=doctor_id, cantidad=1)
+    if not huecos:
+        return _sin_huecos(_nombre_doctor(doctor_id, contexto.get('doctor_nombre')))
+    return _proponer(huecos[0])
+
+
+def negociar_fecha_local(contexto):
+    """
+    Comprobar la fecha (y hora, si se indicó) que pide el paciente y, si no está libre,
+    proponer el siguiente hueco del mismo doctor. None si falta la fecha o no se reconoce.
+    """
+    doctor_id = contexto.get('doctor_id')
+    fecha_deseada = contexto.get('fecha_deseada')
+    hora_deseada = contexto.get('hora_deseada')
+    if not doctor_id or not fecha_deseada:
+        return None
+    try:
+        desde = _desde(fecha_deseada, hora_deseada)
+    except ValueError:
+        return None
+    huecos = motor_disponibilidad.proximos_huecos(doctor_id=doctor_id, desde=desde, cantidad=1)
+    doctor = _nombre_doctor(doctor_id, contexto.get('doctor_nombre'))
+    if not huecos:
+        return _sin_huecos(doctor)
+    hueco = huecos[0]
+    pedido = (hueco['fecha'] == desde.date().isoformat()
+              and (not hora_deseada or hueco['hora'] == desde.strftime('%H:%M')))
+    if pedido:
+        respuesta = (
+            f"{doctor} está disponible el {hueco['fecha']} a las {hueco['hora']}. "
+            f"¿Quieres que confirme la cita?"
+        )
+        return respuesta, _contexto_hueco(hueco), 'confirmar_cita'
+    return _proponer(hueco, f"{doctor} no está disponible en la fecha que indicaste. ")
+
+
+def confirmar_cita_local(datos_paciente, contexto, paciente_id=None):
+    """
+    Reservar directamente la cita ya acordada para `paciente_id`, el paciente de la sesión
+    (nunca un ID enviado por el cliente); sin él no se reserva. Si la franja se ocupó
+    entretanto (o ya pasó o cae fuera de su horario) se propone el siguiente hueco del doctor; si el doctor dejó de estar
+    disponible, el de otro doctor de la misma especialidad.
+    """
+    if not paciente_id:
+        return "Inicia sesión o regístrate para agendar la cita y vuelve a confirmarla.", {}, 'confirmar_cita'
+    doctor = _nombre_doctor(contexto['doctor_id'], contexto.get('doctor_nombre'))
+    try:
+        cita = db.reservar_cita(
+            paciente_id=paciente_id,
+            doctor_id=contexto['doctor_id'],
+            fecha=contexto['fecha'],
+            hora=contexto['hora'],
+            motivo=datos_paciente.get('sintomas') or contexto.get('sintomas_originales') or 'Consulta médica',
+            urgencia=contexto.get('urgencia') or 'Normal'
+        )
+    except ErrorReserva as e:
+        if e.motivo in (ErrorReserva.HORARIO_OCUPADO, ErrorReserva.FUERA_DE_HORARIO, ErrorReserva.FECHA_PASADA):
+            huecos = motor_disponibilidad.proximos_huecos(doctor_id=contexto['doctor_id'], cantidad=1)
+            if huecos:
+                introduccion = "Esa franja acaba de ocuparse. " if e.motivo == ErrorReserva.HORARIO_OCUPADO else f"{e}. "
+                return _proponer(huecos[0], introduccion)
+            return _sin_huecos(doctor)
+        if e.motivo == ErrorReserva.DOCTOR_NO_DISPONIBLE and contexto.get('especialidad'):
+            huecos = motor_disponibilidad.proximos_huecos(especialidad=contexto['especialidad'], cantidad=1)
+            if huecos:
+                return _proponer(huecos[0], f"{doctor} ya no está disponible. ")
+            return _sin_huecos(f"otros doctores de {contexto['especialidad']}")
+        respuesta = f"No pude agendar la cita: {e}."
+        if e.motivo == ErrorReserva.PACIENTE_INEXISTENTE:
+            respuesta += " Inicia sesión o regístrate y vuelve a confirmarla."
+        return respuesta, {}, 'confirmar_cita'
+    respuesta = (
+        f"✅ Tu cita ha sido agendada exitosamente.\n"
+        f"- ID Cita: {cita['id']}\n"
+        f"- Doctor: {cita['doctor_nombre']} ({cita['especialidad']})\n"
+        f"- Fecha: {cita['fecha']} a las {cita['hora']}\n"
+        f"- Motivo: {cita['motivo']}"
+    )
+    contexto_cita = {'cita_id': cita['id'], 'fecha': cita['fecha'], 'hora': cita['hora']}
+    return respuesta, contexto_cita, 'finalizado'
+
+
+def etapa_local(etapa, datos_paciente, contexto, paciente_id=None):
+    """
+    Resolver sin LLM una etapa determinista (reserva o consulta de disponibilidad con
+    parámetros conocidos) llamando directamente a la base de datos y redactando la
+    respuesta con plantilla. Devuelve (respuesta, nuevo_contexto, siguiente_etapa) o
+    None si la etapa necesita razonamiento libre.
+    """
+    if etapa == 'sugerir_cita':
+        return sugerir_cita_local(contexto)
+    if etapa == 'negociar_fecha':
+        return negociar_fecha_local(contexto)
+    if etapa == 'confirmar_cita':
+        return confirmar_cita_local(datos_paciente, contexto, paciente_id)
+    return None
@@ -0,0 +1,156 @@
+import asyncio
+import contextlib
+import json
+import re
+import threading
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+try:
+    from crewai.events.stream_context import add_stream_sink, reset_stream_sinks
+    from crewai.events.types.llm_events import LLMStreamChunkEvent
+    from crewai.llms.base_llm import BaseLLM
+except ImportError:
+    # Versiones de CrewAI que solo aceptan modelos de LangChain: los tokens llegan por callbacks
+    BaseLLM = None
+
+# El agente (formato ReAct) antepone esta marca a la respuesta que ve el paciente
+MARCA_RESPUESTA_FINAL = 'Final Answer:'
+# Con salida estructurada la respuesta final es JSON y al paciente solo se le muestra este campo
+_PATRON_CAMPO_RESPUESTA = re.compile(r'"respuesta"\s*:\s*"')
+_ESCAPE_INCOMPLETO = re.compile(r'\\(u[0-9a-fA-F]{0,3})?$')
+
+
+def _cadena_parcial(texto):
+    """Decodificar el prefijo ya recibido de una cadena JSON (hasta la comilla de cierre, si llegó)"""
+    escapado = False
+    for i, caracter in enumerate(texto):
+        if escapado:
+            escapado = False
+        elif caracter == '\\':
+            escapado = True
+        elif caracter == '"':
+            texto = texto[:i]
+            break
+    else:
+        # Un escape a medio llegar (\ o \u12) se decodifica con el siguiente token
+        texto = _ESCAPE_INCOMPLETO.sub('', texto) if escapado or '\\u' in texto[-5:] else texto
+    try:
+        return json.loads(f'"{texto}"')
+    except ValueError:
+        return ''
+
+
+def respuesta_visible(texto):
+    """
+    Parte de la generación que ve el paciente: lo que sigue a 'Final Answer:' o, si es
+    JSON, el valor (quizá aún incompleto) de su campo 'respuesta'. None si aún no empezó.
+    Con salida estructurada nativa el modelo contesta directamente con el JSON, sin la marca.
+    """
+    posicion = texto.find(MARCA_RESPUESTA_FINAL)
+    if posicion >= 0:
+        cuerpo = texto[posicion + len(MARCA_RESPUESTA_FINAL):].lstrip()
+    elif texto.lstrip().startswith('{'):
+        cuerpo = texto.lstrip()
+    else:
+        return None
+    if not cuerpo or cuerpo[0] not in '{`':
+        return cuerpo
+    campo = _PATRON_CAMPO_RESPUESTA.search(cuerpo)
+    return _cadena_parcial(cuerpo[campo.end():]) if campo else ''
+
+
+class FlujoRespuestaFinal(BaseCallbackHandler):
+    """
+    Publica, a medida que el LLM los genera, los tokens de la respuesta final de la última
+    tarea de la crew. Los pensamientos, las llamadas a herramientas y las respuestas de
+    tareas anteriores se descartan; si la respuesta es el JSON de una salida estructurada se
+    retransmite solo su campo 'respuesta'. Con los LLM propios de CrewAI los tokens llegan
+    como LLMStreamChunkEvent a un sink de CrewAI instalado con escuchar(); con modelos de
+    LangChain, por el callback on_llm_new_token. Llegan desde el hilo que ejecuta
+    crew.kickoff() y se entregan en una asyncio.Queue del bucle de eventos que atiende la
+    petición. Tras cancelar() (el cliente se desconectó) se descartan sin acumularlos ni publicarlos.
+    """
+
+    def __init__(self, llm_base, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.cola = asyncio.Queue()
+        self.total_tareas = 1
+        self.completadas = 0
+        self.emitidos = 0
+        self._textos = {}
+        self._llamada_visible = None
+        self._longitud_visible = 0
+        self._lock = threading.Lock()
+        self._cancelado = threading.Event()
+        # Copia del LLM solo para esta petición: el compartido no emite tokens
+        if BaseLLM is not None and isinstance(llm_base, BaseLLM):
+            self.llm = llm_base.model_copy(update={'stream': True})
+        else:
+            self.llm = llm_base.model_copy(update={'streaming': True, 'callbacks': [self]})
+
+    @contextlib.contextmanager
+    def escuchar(self):
+        """
+        Recibir los fragmentos que emita CrewAI en este contexto; rodear con él la llamada que
+        lanza crew.kickoff() en otro hilo copiando el contexto (LimiteLLM.ejecutar lo hace)
+        """
+        if BaseLLM is None:
+            yield
+            return
+        token = add_stream_sink(self._evento_crewai)
+        try:
+            yield
+        finally:
+            reset_stream_sinks(token)
+
+    def _evento_crewai(self, source, event):
+        # Los fragmentos de argumentos de llamadas a herramientas no son texto para el paciente
+        if isinstance(event, LLMStreamChunkEvent) and event.tool_call is None:
+            self.on_llm_new_token(event.chunk, run_id=event.response_id or event.call_id)
+
+    def preparar(self, total_tareas):
+        """Llamar al construir la crew: solo se retransmite la respuesta de la última tarea"""
+        self.total_tareas = total_tareas
+        self.completadas = 0
+
+    def tarea_completada(self, salida):
+        """task_callback de la crew"""
+        with self._lock:
+            self.completadas += 1
+
+    def cancelar(self):
+        """Dejar de publicar: nadie va a leer la cola"""
+        self._cancelado.set()
+
+    @property
+    def cancelado(self):
+        return self._cancelado.is_set()
+
+    def _publicar(self, texto):
+        if self.cancelado:
+            return
+        self.emitidos += 1
+        try:
+            self.loop.call_soon_threadsafe(self.cola.put_nowait, texto)
+        except RuntimeError:
+            # El cliente se desconectó y el bucle ya se cerró: la crew termina igualmente
+            pass
+
+    def on_llm_new_token(self, token, *, run_id=None, **kwargs):
+        if self.cancelado or not isinstance(token, str) or self.completadas < self.total_tareas - 1:
+            return
+        with self._lock:
+            if self._llamada_visible not in (None, run_id):
+                # Ya se retransmite otra respuesta final (p. ej. la de un reintento de conversión)
+                return
+            texto = self._textos.get(run_id, '') + token
+            self._textos[run_id] = texto
+            visible = respuesta_visible(texto)
+            if visible is None:
+                return
+            self._llamada_visible = run_id
+            nuevo = visible[self._longitud_visible:]
+            self._longitud_visible = len(visible)
+        if nuevo:
+            self._publicar(nuevo)
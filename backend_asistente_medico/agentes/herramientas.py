@@ -3,7 +3,9 @@ import json
 from crewai.tools import BaseTool
 from pydantic import BaseModel, Field
 from typing import Optional, Type
-from agentes.bd import db
+from agentes.bd import db, ErrorReserva
+from agentes.disponibilidad import motor_disponibilidad
+from agentes.metricas import medir_herramienta
 
 # Modelos Pydantic para las herramientas
 class ConsultarDoctoresInput(BaseModel):
@@ -19,7 +21,6 @@ class RegistrarPacienteInput(BaseModel):
     email: Optional[str] = Field(default=None, description="Email del paciente")
 
 class CrearCitaInput(BaseModel):
-    id_cita: str = Field(description="ID único de la cita")
     paciente_id: str = Field(description="ID del paciente")
     doctor_id: int = Field(description="ID del doctor")
     fecha: str = Field(description="Fecha de la cita (YYYY-MM-DD)")
@@ -33,28 +34,21 @@ class ConsultarDisponibilidadInput(BaseModel):
     fecha: str = Field(description="Fecha deseada (YYYY-MM-DD)")
     hora: str = Field(description="Hora deseada (HH:MM)")
 
+class BuscarProximosHuecosInput(BaseModel):
+    doctor_id: Optional[int] = Field(default=None, description="ID del doctor (opcional si se indica especialidad)")
+    especialidad: Optional[str] = Field(default=None, description="Especialidad médica (opcional si se indica doctor_id)")
+    desde: Optional[str] = Field(default=None, description="Fecha desde la que buscar (YYYY-MM-DD). Por defecto, ahora")
+    cantidad: int = Field(default=5, description="Número de huecos a devolver")
+
 # Herramientas personalizadas usando CrewAI BaseTool
 class ConsultarDoctoresTool(BaseTool):
     name: str = "consultar_doctores"
     description: str = "Consulta doctores disponibles por especialidad. Puede filtrar por especialidad específica o mostrar todos los doctores disponibles."
     args_schema: Type[BaseModel] = ConsultarDoctoresInput
 
+    @medir_herramienta
     def _run(self, especialidad: Optional[str] = None) -> str:
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
-        if especialidad:
-            cursor.execute(
-                "SELECT id, nombre, especialidad, telefono FROM doctores WHERE especialidad LIKE ? AND disponible = 1",
-                (f"%{especialidad}%",)
-            )
-        else:
-            cursor.execute(
-                "SELECT id, nombre, especialidad, telefono FROM doctores WHERE disponible = 1"
-            )
-        
-        doctores = cursor.fetchall()
-        conn.close()
+        doctores = db.directorio().buscar(especialidad)
         
         if not doctores:
             return f"No se encontraron doctores disponibles" + (f" para la especialidad {especialidad}" if especialidad else "")
@@ -64,7 +58,7 @@ class ConsultarDoctoresTool(BaseTool):
                 "id": doc[0],
                 "nombre": doc[1],
                 "especialidad": doc[2],
-                "telefono": doc[3]
+                "telefono": doc[4]
             }
             for doc in doctores
         ]
@@ -76,20 +70,16 @@ class RegistrarPacienteTool(BaseTool):
     description: str = "Registra un nuevo paciente en la base de datos con toda su información médica y personal."
     args_schema: Type[BaseModel] = RegistrarPacienteInput
 
+    @medir_herramienta
     def _run(self, id_paciente: str, nombre: str, edad: int, sintomas: str, 
              urgencia: str, telefono: str = None, email: str = None) -> str:
         try:
-            conn = sqlite3.connect(db.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute(
-                """INSERT INTO pacientes (id, nombre, edad, telefono, email, sintomas, urgencia)
-                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                (id_paciente, nombre, edad, telefono, email, sintomas, urgencia)
-            )
-            
-            conn.commit()
-            conn.close()
+            with db.conexion() as conn:
+                conn.execute(
+                    """INSERT INTO pacientes (id, nombre, edad, telefono, email, sintomas, urgencia)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (id_paciente, nombre, edad, telefono, email, sintomas, urgencia)
+                )
             
             return f"✅ Paciente {nombre} registrado exitosamente con ID: {id_paciente}"
         except sqlite3.IntegrityError:
@@ -102,60 +92,66 @@ class ConsultarDisponibilidadTool(BaseTool):
     description: str = "Consulta si un doctor está disponible en una fecha y hora específicas. Devuelve True si está disponible, False si ya tiene una cita programada."
     args_schema: Type[BaseModel] = ConsultarDisponibilidadInput
 
+    @medir_herramienta
     def _run(self, doctor_id: int, fecha: str, hora: str) -> str:
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
+        cursor = db.conexion().cursor()
         cursor.execute(
             "SELECT COUNT(*) FROM citas WHERE doctor_id = ? AND fecha = ? AND hora = ?",
             (doctor_id, fecha, hora)
         )
         count = cursor.fetchone()[0]
-        conn.close()
         if count == 0:
             return "Disponible"
         else:
             return "No disponible"
 
+class BuscarProximosHuecosTool(BaseTool):
+    name: str = "buscar_proximos_huecos"
+    description: str = "Devuelve en una sola llamada los próximos huecos libres (fecha y hora) de un doctor o de todos los doctores de una especialidad, ordenados del más próximo al más lejano."
+    args_schema: Type[BaseModel] = BuscarProximosHuecosInput
+
+    @medir_herramienta
+    def _run(self, doctor_id: Optional[int] = None, especialidad: Optional[str] = None,
+             desde: Optional[str] = None, cantidad: int = 5) -> str:
+        if doctor_id is None and not especialidad:
+            return "❌ Error: Indica doctor_id o especialidad"
+        try:
+            huecos = motor_disponibilidad.proximos_huecos(
+                doctor_id=doctor_id,
+                especialidad=especialidad,
+                desde=desde,
+                cantidad=min(max(cantidad, 1), 20)
+            )
+        except ValueError:
+            return f"❌ Error: Fecha no válida: {desde}. Usa el formato YYYY-MM-DD"
+        
+        if not huecos:
+            return "No se encontraron huecos disponibles en los próximos días"
+        
+        return json.dumps(huecos, indent=2, ensure_ascii=False)
+
 class CrearCitaTool(BaseTool):
     name: str = "crear_cita"
-    description: str = "Crea una nueva cita médica entre un paciente registrado y un doctor disponible. Verifica disponibilidad antes de crear la cita."
+    description: str = "Crea una nueva cita médica entre un paciente registrado y un doctor disponible. Verifica disponibilidad y reserva la franja de forma atómica; el ID de la cita lo genera el sistema."
     args_schema: Type[BaseModel] = CrearCitaInput
 
-    def _run(self, id_cita: str, paciente_id: str, doctor_id: int, 
+    @medir_herramienta
+    def _run(self, paciente_id: str, doctor_id: int, 
              fecha: str, hora: str, motivo: str, urgencia: str = None, estado: str = None) -> str:
         try:
-            conn = sqlite3.connect(db.db_path)
-            cursor = conn.cursor()
-            # Verificar que el paciente existe
-            cursor.execute("SELECT nombres FROM pacientes WHERE id = ?", (paciente_id,))
-            paciente = cursor.fetchone()
-            if not paciente:
-                return f"❌ Error: No existe paciente con ID {paciente_id}"
-            # Verificar que el doctor existe y está disponible
-            cursor.execute("SELECT nombre, especialidad FROM doctores WHERE id = ? AND disponible = 1", (doctor_id,))
-            doctor = cursor.fetchone()
-            if not doctor:
-                return f"❌ Error: Doctor con ID {doctor_id} no existe o no está disponible"
-            # Verificar disponibilidad en fecha/hora
-            cursor.execute(
-                "SELECT COUNT(*) FROM citas WHERE doctor_id = ? AND fecha = ? AND hora = ?",
-                (doctor_id, fecha, hora)
+            # Reserva atómica: verificación e INSERT en una sola transacción
+            cita = db.reservar_cita(
+                paciente_id=paciente_id,
+                doctor_id=doctor_id,
+                fecha=fecha,
+                hora=hora,
+                motivo=motivo,
+                urgencia=urgencia or 'Normal',
+                estado=estado or 'Programada'
             )
-            count = cursor.fetchone()[0]
-            if count > 0:
-                conn.close()
-                return f"❌ Error: El doctor ya tiene una cita programada el {fecha} a las {hora}"
-            # Crear la cita (incluye urgencia y estado si existen en la tabla)
-            cursor.execute(
-                """INSERT INTO citas (id, paciente_id, doctor_id, fecha, hora, motivo, urgencia, estado)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                (id_cita, paciente_id, doctor_id, fecha, hora, motivo, urgencia, estado)
-            )
-            conn.commit()
-            conn.close()
-            return f"✅ Cita creada exitosamente:\n- ID Cita: {id_cita}\n- Paciente: {paciente[0]}\n- Doctor: {doctor[0]} ({doctor[1]})\n- Fecha: {fecha} a las {hora}\n- Motivo: {motivo}\n- Urgencia: {urgencia or '-'}\n- Estado: {estado or '-'}"
-        except sqlite3.IntegrityError:
-            return f"❌ Error: Ya existe una cita with ID {id_cita}"
+            return f"✅ Cita creada exitosamente:\n- ID Cita: {cita['id']}\n- Paciente: {cita['paciente_nombre']}\n- Doctor: {cita['doctor_nombre']} ({cita['especialidad']})\n- Fecha: {cita['fecha']} a las {cita['hora']}\n- Motivo: {motivo}\n- Urgencia: {cita['urgencia']}\n- Estado: {cita['estado']}"
+        except ErrorReserva as e:
+            return f"❌ Error: {str(e)}"
         except Exception as e:
             return f"❌ Error al crear cita: {str(e)}"
 
@@ -163,36 +159,24 @@ class ObtenerEstadisticasTool(BaseTool):
     name: str = "obtener_estadisticas"
     description: str = "Obtiene estadísticas actuales del sistema médico incluyendo totales y clasificaciones."
 
+    @medir_herramienta
     def _run(self) -> str:
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
-        # Contar pacientes
-        cursor.execute("SELECT COUNT(*) FROM pacientes")
-        total_pacientes = cursor.fetchone()[0]
-        
-        # Contar citas
-        cursor.execute("SELECT COUNT(*) FROM citas")
-        total_citas = cursor.fetchone()[0]
-        
-        # Contar doctores disponibles
-        cursor.execute("SELECT COUNT(*) FROM doctores WHERE disponible = 1")
-        doctores_disponibles = cursor.fetchone()[0]
-        
-        # Pacientes por urgencia
-        cursor.execute("SELECT urgencia, COUNT(*) FROM pacientes GROUP BY urgencia")
-        urgencias = cursor.fetchall()
-        
-        conn.close()
+        # Contadores mantenidos por triggers: lectura constante sin importar el tamaño de las tablas
+        datos = db.estadisticas()
         
         estadisticas = f"""📊 ESTADÍSTICAS DEL SISTEMA:
-- Total de pacientes: {total_pacientes}
-- Total de citas: {total_citas}
-- Doctores disponibles: {doctores_disponibles}
-
-Pacientes por urgencia:"""
+- Total de pacientes: {datos['total_pacientes']}
+- Total de citas: {datos['total_citas']}
+- Doctores disponibles: {datos['doctores_disponibles']}"""
         
-        for urgencia, cantidad in urgencias:
-            estadisticas += f"\n- {urgencia}: {cantidad}"
+        secciones = [
+            ("Citas por urgencia", datos['citas_por_urgencia']),
+            ("Citas por estado", datos['citas_por_estado']),
+            ("Doctores disponibles por especialidad", datos['doctores_por_especialidad']),
+        ]
+        for titulo, conteos in secciones:
+            estadisticas += f"\n\n{titulo}:"
+            for clave, cantidad in sorted(conteos.items()):
+                estadisticas += f"\n- {clave or 'Sin especificar'}: {cantidad}"
         
         return estadisticas 
\ No newline at end of file
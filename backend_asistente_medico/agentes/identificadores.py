@@ -0,0 +1,56 @@
+import itertools
+import os
+import secrets
+import time
+
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_MASCARA_SECUENCIA = (1 << 64) - 1
+
+
+def _codificar(valor, longitud=26):
+    """Codificar un entero de 128 bits en base32 Crockford de longitud fija (ordenable como texto)"""
+    caracteres = []
+    for _ in range(longitud):
+        caracteres.append(_CROCKFORD[valor & 31])
+        valor >>= 5
+    return ''.join(reversed(caracteres))
+
+
+class GeneradorIds:
+    """
+    Genera IDs de 128 bits al estilo ULID/Snowflake, sin locks:
+    48 bits de milisegundos | 16 bits de worker | 64 bits de secuencia.
+
+    - El tiempo se deriva de un reloj monótono anclado al reloj de pared al arrancar,
+      así que no retrocede aunque se ajuste la hora del sistema.
+    - La secuencia es un `itertools.count` (atómico bajo el GIL) que empieza en un
+      desplazamiento aleatorio por proceso; dos procesos con el mismo worker no chocan
+      salvo que coincidan en el mismo milisegundo y en rangos de secuencia solapados.
+    - El worker sale de la variable de entorno ID_WORKER (despliegues en varias
+      máquinas) o, por defecto, del PID. Tras un fork se reinicia todo el estado.
+    """
+
+    def __init__(self, worker_id=None):
+        self._worker_fijo = worker_id
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        worker = self._worker_fijo
+        if worker is None:
+            worker = int(os.getenv('ID_WORKER', os.getpid()))
+        self.worker_id = worker & 0xFFFF
+        self._secuencia = itertools.count(secrets.randbits(63))
+        self._base_ms = time.time_ns() // 1_000_000
+        self._base_monotono = time.monotonic_ns()
+
+    def nuevo(self, prefijo=''):
+        """Devolver un ID nuevo: prefijo + 26 caracteres ordenables por momento de creación"""
+        ms = self._base_ms + (time.monotonic_ns() - self._base_monotono) // 1_000_000
+        secuencia = next(self._secuencia) & _MASCARA_SECUENCIA
+        return prefijo + _codificar((ms << 80) | (self.worker_id << 64) | secuencia)
+
+
+# Instancia global del generador de IDs
+generador_ids = GeneradorIds()
@@ -0,0 +1,150 @@
+import re
+import unicodedata
+
+# Palabras que el modelo antepone o intercala en los nombres y no identifican al doctor
+_TITULOS = {'dr', 'dra', 'doctor', 'doctora', 'el', 'la', 'de', 'del', 'los', 'las'}
+
+# Sinónimos que no se pueden derivar del nombre de la especialidad con las reglas de sufijos
+SINONIMOS_ESPECIALIDAD = {
+    'Medicina General': ['medico general', 'medica general', 'medico de cabecera', 'medicina interna'],
+    'Medicina Familiar': ['medico familiar', 'medico de familia', 'medicina de familia'],
+    'Cardiología Intervencionista': ['cardiologo intervencionista', 'hemodinamia'],
+    'Neurología Pediátrica': ['neuropediatra', 'neuropediatria', 'neurologo pediatrico', 'neurologa pediatrica'],
+    'Obstetricia': ['obstetra', 'embarazo'],
+    'Cirugía General': ['cirujano', 'cirujana', 'cirujano general', 'cirujana general'],
+    'Cirugía Plástica': ['cirujano plastico', 'cirujana plastica', 'cirugia estetica'],
+    'Neurocirugía': ['neurocirujano', 'neurocirujana'],
+    'Otorrinolaringología': ['otorrino', 'otorrinolaringologo', 'otorrinolaringologa'],
+    'Medicina de Emergencia': ['emergencia', 'emergencias', 'urgencias', 'medico de urgencias'],
+    'Medicina Intensiva': ['intensivista', 'cuidados intensivos', 'uci'],
+    'Anestesiología': ['anestesista'],
+    'Medicina del Trabajo': ['medico laboral', 'medicina laboral', 'salud ocupacional'],
+}
+
+
+def normalizar(texto):
+    """Minúsculas, sin tildes ni signos de puntuación, con espacios simples"""
+    texto = unicodedata.normalize('NFKD', str(texto or ''))
+    texto = ''.join(c for c in texto if not unicodedata.combining(c)).lower()
+    return ' '.join(re.findall(r'[a-z0-9]+', texto))
+
+
+def _tokens_nombre(texto):
+    return [t for t in normalizar(texto).split() if t not in _TITULOS]
+
+
+def _trigramas(texto):
+    relleno = f"  {texto} "
+    return {relleno[i:i + 3] for i in range(len(relleno) - 2)}
+
+
+def _sinonimos_derivados(especialidad):
+    """Formas de profesional derivadas por sufijo: cardiología -> cardiólogo/a, pediatría -> pediatra"""
+    normalizada = normalizar(especialidad)
+    if ' ' in normalizada:
+        return []
+    if normalizada.endswith('logia'):
+        base = normalizada[:-len('logia')]
+        return [f'{base}logo', f'{base}loga', f'{base}logos', f'{base}logas']
+    if normalizada.endswith('iatria'):
+        profesional = normalizada[:-len('ia')] + 'a'
+        return [profesional, f'{profesional}s']
+    return []
+
+
+class IndiceDoctores:
+    """
+    Índice precalculado en memoria para resolver nombres de doctores y especialidades
+    escritos libremente por el modelo. Compara texto normalizado (sin tildes ni títulos)
+    por tokens exactos y por similitud de trigramas, de modo que "Dr. Martinez",
+    "Miguel Martínez" o "Dr Miguel Martines" llegan al mismo doctor.
+    """
+
+    def __init__(self, doctores):
+        self.doctores = {fila[0]: fila for fila in doctores}
+        self._tokens = {}
+        self._trigramas = {}
+        self._por_trigrama = {}
+        for doctor_id, fila in self.doctores.items():
+            tokens = _tokens_nombre(fila[1])
+            self._tokens[doctor_id] = set(tokens)
+            trigramas = _trigramas(' '.join(tokens))
+            self._trigramas[doctor_id] = trigramas
+            for trigrama in trigramas:
+                self._por_trigrama.setdefault(trigrama, set()).add(doctor_id)
+
+        # Cada forma normalizada (nombre, derivados y sinónimos) apunta a su especialidad canónica
+        self._formas_especialidad = {}
+        for especialidad in {fila[2] for fila in doctores}:
+            formas = [normalizar(especialidad)] + _sinonimos_derivados(especialidad)
+            formas += [normalizar(s) for s in SINONIMOS_ESPECIALIDAD.get(especialidad, [])]
+            for forma in formas:
+                self._formas_especialidad.setdefault(forma, especialidad)
+        self._patron_especialidad = self._compilar(self._formas_especialidad)
+
+        nombres = {' '.join(_tokens_nombre(fila[1])): doctor_id for doctor_id, fila in self.doctores.items()}
+        self._nombres = {nombre: doctor_id for nombre, doctor_id in nombres.items() if nombre}
+        self._patron_nombre = self._compilar(self._nombres)
+
+    @staticmethod
+    def _compilar(formas):
+        if not formas:
+            return None
+        # Las formas más largas primero: "cardiologia intervencionista" antes que "cardiologia"
+        alternativas = sorted(formas, key=len, reverse=True)
+        return re.compile(r'\b(' + '|'.join(re.escape(f) for f in alternativas) + r')\b')
+
+    def resolver_especialidad(self, texto):
+        """Devolver la especialidad canónica mencionada en el texto (la más específica), o None"""
+        if not texto or self._patron_especialidad is None:
+            return None
+        encontradas = self._patron_especialidad.findall(normalizar(texto))
+        if not encontradas:
+            return None
+        return self._formas_especialidad[max(encontradas, key=len)]
+
+    def buscar(self, nombre, especialidad=None, limite=5):
+        """
+        Devolver [(puntuación, fila)] ordenado de mayor a menor puntuación (0..1).
+        La puntuación combina la proporción de tokens del nombre buscado presentes en el del
+        doctor y la similitud de trigramas (coeficiente de Dice); la especialidad, si se
+        reconoce, añade una bonificación a los doctores que la tienen.
+        """
+        tokens = _tokens_nombre(nombre)
+        if not tokens:
+            return []
+        consulta = _trigramas(' '.join(tokens))
+        candidatos = set()
+        for trigrama in consulta:
+            candidatos |= self._por_trigrama.get(trigrama, set())
+
+        canonica = self.resolver_especialidad(especialidad) if especialidad else None
+        resultados = []
+        for doctor_id in candidatos:
+            trigramas = self._trigramas[doctor_id]
+            dice = 2 * len(consulta & trigramas) / (len(consulta) + len(trigramas))
+            cobertura = sum(1 for t in tokens if t in self._tokens[doctor_id]) / len(tokens)
+            puntuacion = max(dice, cobertura)
+            if canonica:
+                puntuacion = 0.85 * puntuacion + (0.15 if self.doctores[doctor_id][2] == canonica else 0)
+            resultados.append((round(puntuacion, 4), self.doctores[doctor_id]))
+        resultados.sort(key=lambda r: (-r[0], r[1][0]))
+        return resultados[:limite]
+
+    def resolver(self, nombre, especialidad=None, umbral=0.5):
+        """Devolver (doctor_id, puntuación) del mejor candidato, o (None, 0) si ninguno supera el umbral"""
+        resultados = self.buscar(nombre, especialidad, limite=1)
+        if resultados and resultados[0][0] >= umbral:
+            return resultados[0][1][0], resultados[0][0]
+        return None, 0
+
+    def encontrar_en_texto(self, texto, especialidad=None):
+        """Buscar el nombre completo de algún doctor dentro de un texto libre (con o sin "Dr./Dra.")"""
+        if not texto or self._patron_nombre is None:
+            return None
+        canonica = self.resolver_especialidad(especialidad) if especialidad else None
+        encontrados = [self._nombres[n] for n in self._patron_nombre.findall(normalizar(texto))]
+        for doctor_id in encontrados:
+            if canonica is None or self.doctores[doctor_id][2] == canonica:
+                return doctor_id
+        return encontrados[0] if encontrados else None
@@ -0,0 +1,134 @@
+import zlib
+
+import numpy as np
+
+from agentes.indice_doctores import SINONIMOS_ESPECIALIDAD, _sinonimos_derivados, normalizar
+
+DIMENSIONES = 1 << 14
+LONGITUD_RAIZ = 5
+
+# Palabras vacías que no aportan al parecido entre síntomas y especialidades
+PALABRAS_VACIAS = {
+    'a', 'al', 'con', 'de', 'del', 'el', 'en', 'la', 'las', 'lo', 'los', 'me', 'mi', 'mis', 'muy',
+    'o', 'para', 'por', 'que', 'se', 'su', 'sus', 'te', 'tengo', 'un', 'una', 'y', 'desde', 'hace',
+    'cuando', 'mucho', 'mucha', 'poco', 'siento', 'tiene', 'tuvo', 'duele', 'dolor', 'hay', 'es',
+    'esta', 'estoy', 'dias', 'semana', 'semanas', 'ayer', 'hoy',
+}
+
+# Síntomas y motivos de consulta típicos de cada especialidad, separados por comas
+DESCRIPCIONES_ESPECIALIDAD = {
+    'Medicina General': 'fiebre, gripe, resfriado, tos, malestar general, cansancio, chequeo, control, '
+                        'consulta preventiva, dolor de garganta, mocos, estornudos, infeccion, dolor en el cuerpo',
+    'Medicina Familiar': 'control de rutina, seguimiento familiar, enfermedades cronicas, vacunas, chequeo anual',
+    'Cardiología': 'corazon, dolor de pecho, opresion en el pecho, palpitaciones, arritmia, taquicardia, '
+                   'presion alta, hipertension, soplo, infarto, angina, colesterol, piernas hinchadas',
+    'Cardiología Intervencionista': 'cateterismo, angioplastia, stent, arterias coronarias obstruidas',
+    'Neurología': 'dolor de cabeza, migrana, jaqueca, mareo, vertigo, convulsiones, epilepsia, hormigueo, '
+                  'entumecimiento, temblor, perdida de memoria, desmayo, perdida del conocimiento, '
+                  'paralisis, cara torcida, no puedo hablar, no puedo mover, vision doble, debilidad',
+    'Psiquiatría': 'ansiedad, depresion, tristeza, insomnio, no duermo, ataques de panico, angustia, estres, '
+                   'suicidio, pensamientos suicidas, alucinaciones',
+    'Neurología Pediátrica': 'convulsiones febriles, retraso del desarrollo, hiperactividad, autismo, epilepsia infantil',
+    'Pediatría': 'nino, nina, bebe, hijo, hija, vacunas infantiles, crecimiento',
+    'Neonatología': 'recien nacido, neonato, prematuro, ictericia, lactancia',
+    'Ginecología': 'menstruacion, regla, periodo irregular, flujo vaginal, ovarios, utero, mamas, '
+                   'anticonceptivos, menopausia',
+    'Obstetricia': 'embarazo, embarazada, gestacion, parto, control prenatal, contracciones',
+    'Cirugía General': 'apendicitis, hernia, vesicula, calculos biliares, operacion, bulto en el abdomen',
+    'Cirugía Plástica': 'cicatriz, cirugia estetica, reconstruccion, secuelas de quemaduras',
+    'Traumatología': 'hueso, fractura, esguince, rodilla, tobillo, dolor de espalda, lumbar, columna, hombro, '
+                     'articulaciones, golpe, caida, lesion deportiva, muneca',
+    'Neurocirugía': 'hernia de disco, tumor cerebral, compresion nerviosa, traumatismo craneal',
+    'Radiología': 'radiografia, ecografia, tomografia, resonancia, estudio de imagen',
+    'Patología': 'biopsia, analisis de tejido',
+    'Gastroenterología': 'estomago, acidez, reflujo, gastritis, diarrea, estrenimiento, colon, intestino, '
+                         'nauseas, vomitos, digestion, higado, hinchazon abdominal',
+    'Endocrinología': 'diabetes, azucar alta, glucosa, tiroides, hormonas, obesidad, sed excesiva',
+    'Neumología': 'pulmones, asma, bronquitis, tos cronica, neumonia, silbido al respirar, flema, falta de aire',
+    'Nefrología': 'rinones, insuficiencia renal, dialisis, creatinina, orina espumosa',
+    'Hematología': 'anemia, plaquetas, moretones, coagulacion, leucemia, ganglios',
+    'Oftalmología': 'ojos, vista, vision borrosa, veo borroso, ojo rojo, lagrimeo, lentes, catarata',
+    'Otorrinolaringología': 'oido, oidos, sordera, zumbido, nariz, sinusitis, amigdalas, ronquera',
+    'Dermatología': 'piel, mancha en la piel, granos, acne, picazon, pica, sarpullido, lunar, eccema, '
+                    'caida de cabello, unas',
+    'Urología': 'orinar, ardor al orinar, prostata, vejiga, calculos renales, sangre en la orina',
+    'Medicina de Emergencia': 'emergencia, accidente, sangrado abundante, hemorragia, vomito con sangre, '
+                              'no puedo respirar, me ahogo, intoxicacion, reaccion alergica grave',
+    'Medicina Intensiva': 'cuidados intensivos, paciente critico, ventilacion mecanica',
+    'Anestesiología': 'anestesia, dolor cronico, valoracion preoperatoria',
+    'Medicina del Trabajo': 'certificado laboral, aptitud laboral, accidente laboral, ergonomia',
+}
+
+
+def _caracteristicas(texto):
+    """Tokens sin palabras vacías, sus raíces truncadas y bigramas consecutivos"""
+    tokens = [t for t in normalizar(texto).split() if t not in PALABRAS_VACIAS]
+    caracteristicas = list(tokens)
+    caracteristicas += [f'~{t[:LONGITUD_RAIZ]}' for t in tokens if len(t) > LONGITUD_RAIZ]
+    caracteristicas += [f'{a}_{b}' for a, b in zip(tokens, tokens[1:])]
+    return caracteristicas
+
+
+def _vector(caracteristicas, idf=None):
+    """Vector hasheado (crc32 estable entre procesos) con frecuencias y, si se da, pesos IDF"""
+    vector = np.zeros(DIMENSIONES, dtype=np.float32)
+    for caracteristica in caracteristicas:
+        vector[zlib.crc32(caracteristica.encode()) % DIMENSIONES] += 1.0
+    if idf is not None:
+        vector *= idf
+    norma = np.linalg.norm(vector)
+    return vector / norma if norma else vector
+
+
+def _frases(especialidad):
+    """Nombre, sinónimos derivados y síntomas típicos de una especialidad"""
+    frases = [especialidad] + _sinonimos_derivados(especialidad)
+    frases += SINONIMOS_ESPECIALIDAD.get(especialidad, [])
+    frases += [f.strip() for f in DESCRIPCIONES_ESPECIALIDAD.get(especialidad, '').split(',') if f.strip()]
+    return [f for f in (_caracteristicas(frase) for frase in frases) if f]
+
+
+class IndiceEspecialidades:
+    """
+    Índice TF-IDF con hashing de características sobre las especialidades del directorio.
+    Cada especialidad se describe con frases cortas (nombre, sinónimos derivados y síntomas
+    típicos); su vector es la suma de los vectores normalizados de sus frases, de modo que
+    la puntuación de una consulta es la suma de sus similitudes coseno con cada frase y las
+    especialidades con descripciones largas no quedan penalizadas. La consulta es un único
+    producto matriz-vector en NumPy.
+    """
+
+    def __init__(self, por_especialidad):
+        self.por_especialidad = por_especialidad
+        self.especialidades = sorted(por_especialidad)
+        frases = [_frases(especialidad) for especialidad in self.especialidades]
+
+        # IDF suavizado por frase: una característica presente en muchas frases pesa poco
+        total_frases = sum(len(f) for f in frases)
+        frecuencias = np.zeros(DIMENSIONES, dtype=np.float32)
+        for caracteristicas in (c for lista in frases for c in lista):
+            frecuencias[list({zlib.crc32(c.encode()) % DIMENSIONES for c in caracteristicas})] += 1
+        self.idf = np.log((1 + total_frases) / (1 + frecuencias)) + 1
+        self.matriz = np.zeros((len(self.especialidades), DIMENSIONES), dtype=np.float32)
+        for fila, lista in enumerate(frases):
+            for caracteristicas in lista:
+                self.matriz[fila] += _vector(caracteristicas, self.idf)
+
+    def buscar(self, sintomas, k=3, minimo=0.05):
+        """
+        Devolver hasta k especialidades [{'especialidad', 'puntuacion', 'doctores'}] ordenadas
+        por puntuación; `doctores` son los disponibles como (id, nombre).
+        """
+        if not self.especialidades:
+            return []
+        consulta = _vector(_caracteristicas(sintomas), self.idf)
+        puntuaciones = self.matriz @ consulta
+        mejores = np.argsort(-puntuaciones, kind='stable')[:k]
+        return [
+            {
+                'especialidad': self.especialidades[i],
+                'puntuacion': round(float(puntuaciones[i]), 3),
+                'doctores': [(fila[0], fila[1]) for fila in self.por_especialidad[self.especialidades[i]]],
+            }
+            for i in mejores if puntuaciones[i] >= minimo
+        ]
@@ -0,0 +1,372 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from agentes.uso_tokens import estimar_tokens
+
+try:
+    from crewai.llms.base_llm import BaseLLM
+except ImportError:
+    # Versiones de CrewAI que solo aceptan modelos de LangChain
+    BaseLLM = None
+
+MARCA_TAREA = 'Current Task:'
+# Una observación termina donde empieza el siguiente paso o el siguiente mensaje (separados por una línea en blanco)
+_PATRON_OBSERVACION = re.compile(r'Observation:\s*(.*?)(?=\n\n|\n(?:Thought:|Action:|Final Answer:)|\Z)', re.S)
+_PATRON_DOCTOR = re.compile(r'(.+?)\s*\(ID (\d+)\)')
+
+
+def texto_mensajes(mensajes):
+    """Texto plano de los mensajes (cadena, dicts de CrewAI o mensajes de LangChain)"""
+    if isinstance(mensajes, str):
+        return mensajes
+    partes = []
+    for mensaje in mensajes:
+        contenido = mensaje.get('content') if isinstance(mensaje, dict) else getattr(mensaje, 'content', mensaje)
+        partes.append(contenido if isinstance(contenido, str) else json.dumps(contenido, ensure_ascii=False))
+    return '\n\n'.join(partes)
+
+
+def clave_prompt(texto):
+    """Clave de una grabación: el prompt completo sin diferencias de espacios"""
+    return hashlib.sha256(' '.join(texto.split()).encode()).hexdigest()
+
+
+def observaciones(texto):
+    """Resultados de herramientas ya recibidos en esta tarea (el formato ReAct del system prompt no cuenta)"""
+    posicion = texto.find(MARCA_TAREA)
+    return [obs.strip() for obs in _PATRON_OBSERVACION.findall(texto[posicion:] if posicion >= 0 else texto)]
+
+
+def datos_tarea(texto):
+    """Campos del bloque 'DATOS:' con el que termina la descripción de cada tarea"""
+    posicion = texto.rfind('\nDATOS:\n')
+    datos = {}
+    if posicion < 0:
+        return datos
+    for linea in texto[posicion + len('\nDATOS:\n'):].split('\n'):
+        campo, separador, valor = linea.partition(': ')
+        if not separador or not campo.isidentifier():
+            break
+        datos[campo] = valor.strip()
+    return datos
+
+
+def _doctor(valor):
+    coincidencia = _PATRON_DOCTOR.match(valor or '')
+    if not coincidencia:
+        return None, valor
+    return int(coincidencia.group(2)), re.sub(r'^Dra?\.\s*', '', coincidencia.group(1).strip())
+
+
+def _accion(herramienta, argumentos):
+    return (f"Thought: Necesito consultar la base de datos\nAction: {herramienta}\n"
+            f"Action Input: {json.dumps(argumentos, ensure_ascii=False)}")
+
+
+def _final(salida):
+    return f"Thought: I now know the final answer\nFinal Answer: {json.dumps(salida, ensure_ascii=False)}"
+
+
+def _primer_hueco(observacion):
+    try:
+        huecos = json.loads(observacion)
+    except ValueError:
+        return None
+    return huecos[0] if isinstance(huecos, list) and huecos else None
+
+
+def _proponer_hueco(observacion, introduccion=''):
+    hueco = _primer_hueco(observacion)
+    if hueco is None:
+        return _final({'respuesta': 'No encontré huecos disponibles en los próximos días.'})
+    return _final({
+        'respuesta': (f"{introduccion}La cita más próxima disponible con {hueco['doctor_nombre']} es el "
+                      f"{hueco['fecha']} a las {hueco['hora']}. ¿Te gustaría agendarla?"),
+        'doctor_id': hueco['doctor_id'],
+        'doctor_nombre': hueco['doctor_nombre'],
+        'fecha': hueco['fecha'],
+        'hora': hueco['hora'],
+    })
+
+
+def _guion_triaje(datos, obs):
+    from agentes.triaje_reglas import clasificar_sintomas
+    especialidad, _, doctores = datos.get('candidatas', '').split('; ')[0].partition(': ')
+    doctor_id, doctor_nombre = _doctor(doctores.split(', ')[0])
+    # Sin reglas concluyentes el guion, como el agente, se decide por una urgencia media
+    urgencia = clasificar_sintomas(datos.get('sintomas'), datos.get('edad')).urgencia or 'MEDIA'
+    return _final({
+        'respuesta': (f"Según los síntomas que describes, tu nivel de urgencia es {urgencia} y te recomiendo "
+                      f"acudir a la especialidad de {especialidad}. El doctor disponible es {doctor_nombre}. "
+                      f"¿Te gustaría agendar una cita?"),
+        'urgencia': urgencia,
+        'especialidad': especialidad,
+        'doctor_id': doctor_id,
+        'doctor_nombre': doctor_nombre,
+    })
+
+
+def _guion_sugerir(datos, obs):
+    doctor_id, _ = _doctor(datos.get('doctor'))
+    if not obs:
+        return _accion('buscar_proximos_huecos', {'doctor_id': doctor_id, 'cantidad': 1})
+    return _proponer_hueco(obs[-1])
+
+
+def _guion_confirmar(datos, obs):
+    doctor_id, doctor_nombre = _doctor(datos.get('doctor'))
+    if not obs:
+        return _accion('crear_cita', {
+            'paciente_id': datos.get('paciente_id'), 'doctor_id': doctor_id,
+            'fecha': datos.get('fecha'), 'hora': datos.get('hora'), 'motivo': 'Consulta médica',
+        })
+    return _final({'respuesta': obs[-1], 'doctor_id': doctor_id, 'doctor_nombre': doctor_nombre,
+                   'fecha': datos.get('fecha'), 'hora': datos.get('hora')})
+
+
+def _guion_negociar(datos, obs):
+    doctor_id, doctor_nombre = _doctor(datos.get('doctor'))
+    fecha, hora = datos.get('fecha_deseada'), datos.get('hora_deseada')
+    if not obs:
+        return _accion('consultar_disponibilidad', {'doctor_id': doctor_id, 'fecha': fecha, 'hora': hora})
+    if len(obs) == 1 and obs[0] == 'Disponible':
+        return _final({
+            'respuesta': f"El doctor {doctor_nombre} está disponible el {fecha} a las {hora}. ¿Quieres confirmar la cita?",
+            'doctor_id': doctor_id, 'doctor_nombre': doctor_nombre, 'fecha': fecha, 'hora': hora,
+        })
+    if len(obs) == 1:
+        return _accion('buscar_proximos_huecos', {'doctor_id': doctor_id, 'desde': fecha, 'cantidad': 1})
+    return _proponer_hueco(obs[-1], 'Ese horario no está disponible. ')
+
+
+# Respuestas por defecto de cada etapa, incluidos los turnos de llamada a herramientas
+GUIONES = {
+    'triaje': _guion_triaje,
+    'sugerir_cita': _guion_sugerir,
+    'confirmar_cita': _guion_confirmar,
+    'negociar_fecha': _guion_negociar,
+}
+
+
+class GuionLLM:
+    """
+    Respuestas deterministas para sustituir al LLM en pruebas de carga y CI sin red.
+    Para cada prompt se busca, en este orden: una grabación con la misma clave, una regla
+    del archivo de guion cuyo texto aparezca en el prompt (y cuyo turno coincida con el
+    número de resultados de herramientas recibidos) y, por último, el guion por defecto de
+    la etapa, que llama a las herramientas reales igual que lo haría el agente.
+
+    El archivo es JSONL con líneas {"clave", "respuesta"} (grabaciones de GrabadorLLM)
+    o {"contiene", "turno" (opcional), "respuesta"} (reglas escritas a mano).
+    """
+
+    def __init__(self, ruta=None, latencia=0.0, latencia_token=0.0):
+        self.latencia = latencia
+        self.latencia_token = latencia_token
+        self.grabadas = {}
+        self.reglas = []
+        self.llamadas = 0
+        self._lock = threading.Lock()
+        if ruta and os.path.exists(ruta):
+            with open(ruta, encoding='utf-8') as archivo:
+                for linea in archivo:
+                    if not linea.strip():
+                        continue
+                    entrada = json.loads(linea)
+                    if 'clave' in entrada:
+                        self.grabadas[entrada['clave']] = entrada['respuesta']
+                    else:
+                        self.reglas.append((entrada['contiene'], entrada.get('turno'), entrada['respuesta']))
+
+    def etapa(self, texto):
+        from agentes.agentes import INSTRUCCIONES_TAREA
+        for etapa, instrucciones in INSTRUCCIONES_TAREA.items():
+            if instrucciones[:80] in texto:
+                return etapa
+        return None
+
+    def responder(self, mensajes):
+        """Texto de la respuesta (sin esperar la latencia simulada)"""
+        with self._lock:
+            self.llamadas += 1
+        texto = texto_mensajes(mensajes)
+        grabada = self.grabadas.get(clave_prompt(texto))
+        if grabada is not None:
+            return grabada
+        obs = observaciones(texto)
+        for contiene, turno, respuesta in self.reglas:
+            if contiene in texto and turno in (None, len(obs)):
+                return respuesta
+        etapa = self.etapa(texto)
+        if etapa is None:
+            return "Thought: I now know the final answer\nFinal Answer: Respuesta simulada."
+        return GUIONES[etapa](datos_tarea(texto), obs)
+
+    def esperar(self, respuesta):
+        """Latencia simulada de una respuesta completa (sin streaming)"""
+        time.sleep(self.latencia + self.latencia_token * estimar_tokens(respuesta))
+
+    def fragmentos(self, respuesta):
+        """Trocear la respuesta como tokens de streaming, esperando la latencia de cada uno"""
+        time.sleep(self.latencia)
+        for fragmento in re.findall(r'\s*\S+', respuesta):
+            time.sleep(self.latencia_token)
+            yield fragmento
+
+    def uso(self, mensajes, respuesta):
+        prompt = estimar_tokens(texto_mensajes(mensajes))
+        completion = estimar_tokens(respuesta)
+        return {'prompt_tokens': prompt, 'completion_tokens': completion, 'total_tokens': prompt + completion}
+
+
+def _cortar(respuesta, stop):
+    for palabra in stop or ():
+        if palabra and palabra in respuesta:
+            respuesta = respuesta[:respuesta.index(palabra)]
+    return respuesta
+
+
+class ChatSimulado(BaseChatModel):
+    """Sustituto de ChatOpenAI para CrewAI basado en LangChain (mismos callbacks y streaming)"""
+
+    guion: Any
+    model_name: str = 'simulado'
+    streaming: bool = False
+
+    @property
+    def _llm_type(self):
+        return 'simulado'
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.streaming:
+            fragmentos = list(self._stream(messages, stop, run_manager, **kwargs))
+            respuesta = ''.join(fragmento.message.content for fragmento in fragmentos)
+        else:
+            respuesta = _cortar(self.guion.responder(messages), stop)
+            self.guion.esperar(respuesta)
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=respuesta))],
+            llm_output={'token_usage': self.guion.uso(messages, respuesta), 'model_name': self.model_name}
+        )
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        respuesta = _cortar(self.guion.responder(messages), stop)
+        for fragmento in self.guion.fragmentos(respuesta):
+            trozo = ChatGenerationChunk(message=AIMessageChunk(content=fragmento))
+            if run_manager:
+                run_manager.on_llm_new_token(fragmento, chunk=trozo)
+            yield trozo
+
+
+if BaseLLM is not None:
+    class LLMSimulado(BaseLLM):
+        """Sustituto del LLM para CrewAI con LLMs propios (BaseLLM); mismo guion que ChatSimulado"""
+
+        guion: Any = None
+
+        def call(self, messages, tools=None, callbacks=None, available_functions=None,
+                 from_task=None, from_agent=None, **kwargs):
+            respuesta = _cortar(self.guion.responder(messages), self.stop)
+            if self.stream:
+                # Como los LLM nativos: un LLMStreamChunkEvent por fragmento, con el mismo response_id
+                response_id = uuid.uuid4().hex
+                for fragmento in self.guion.fragmentos(respuesta):
+                    self._emit_stream_chunk_event(chunk=fragmento, from_task=from_task, from_agent=from_agent,
+                                                  response_id=response_id)
+            else:
+                self.guion.esperar(respuesta)
+            if hasattr(self, '_track_token_usage_internal'):
+                self._track_token_usage_internal(self.guion.uso(messages, respuesta))
+            return respuesta
+
+        def supports_function_calling(self):
+            # Las llamadas a herramientas van en formato ReAct (Action / Action Input)
+            return False
+else:
+    LLMSimulado = None
+
+
+class GrabadorLLM(BaseCallbackHandler):
+    """
+    Guarda cada prompt enviado al LLM real y su respuesta para reproducirlos con GuionLLM.
+    Con los LLM propios de CrewAI escucha LLMCallCompletedEvent en su bus de eventos (CrewAI
+    no pasa callbacks de LangChain a esos LLM); con ChatOpenAI es un callback de LangChain.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._prompts = {}
+        self._lock = threading.Lock()
+
+    def _guardar(self, texto, respuesta):
+        linea = json.dumps({'clave': clave_prompt(texto), 'respuesta': respuesta}, ensure_ascii=False)
+        with self._lock, open(self.ruta, 'a', encoding='utf-8') as archivo:
+            archivo.write(linea + '\n')
+
+    def conectar(self):
+        """Grabar todas las llamadas a LLM de CrewAI del proceso"""
+        from crewai.events.event_bus import crewai_event_bus
+        from crewai.events.types.llm_events import LLMCallCompletedEvent
+        crewai_event_bus.on(LLMCallCompletedEvent)(self._llamada_completada)
+        return self
+
+    def _llamada_completada(self, source, event):
+        # Solo respuestas de texto (formato ReAct); las llamadas a funciones no se reproducen
+        if event.messages and isinstance(event.response, str):
+            self._guardar(texto_mensajes(event.messages), event.response)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id=None, **kwargs):
+        self._prompts[run_id] = texto_mensajes(messages[0])
+
+    def on_llm_end(self, response, *, run_id=None, **kwargs):
+        texto = self._prompts.pop(run_id, None)
+        if texto is None or not response.generations or not response.generations[0]:
+            return
+        self._guardar(texto, response.generations[0][0].text)
+
+
+def crear_llm(backend=None, **opciones):
+    """
+    LLM de los agentes según BACKEND_LLM: 'openai' (por defecto), 'simulado' (GuionLLM con
+    LLM_SIMULADO_GUION, LLM_SIMULADO_LATENCIA y LLM_SIMULADO_LATENCIA_TOKEN) o 'grabar'
+    (OpenAI real guardando cada respuesta en LLM_SIMULADO_GUION para reproducirla después)
+    """
+    backend = backend or os.getenv('BACKEND_LLM', 'openai')
+    ruta = os.getenv('LLM_SIMULADO_GUION', 'guion_llm.jsonl')
+    if backend == 'simulado':
+        guion = GuionLLM(
+            ruta,
+            latencia=float(os.getenv('LLM_SIMULADO_LATENCIA', 0)),
+            latencia_token=float(os.getenv('LLM_SIMULADO_LATENCIA_TOKEN', 0)),
+        )
+        if LLMSimulado is not None:
+            return LLMSimulado(model='simulado', guion=guion)
+        return ChatSimulado(guion=guion)
+    from agentes.cliente_openai import politica
+    # Plazo y reintentos por petición al modelo; el cortacircuitos envuelve crew.kickoff en las vistas
+    chat = politica('chat')
+    opciones.setdefault('timeout', chat.plazo)
+    opciones.setdefault('max_retries', chat.reintentos)
+    grabador = GrabadorLLM(ruta) if backend == 'grabar' else None
+    if BaseLLM is None:
+        from langchain_openai import ChatOpenAI
+        if grabador:
+            opciones['callbacks'] = [grabador]
+        return ChatOpenAI(**opciones)
+    # CrewAI solo copia modelo, temperatura y credenciales de un ChatOpenAI (y las versiones
+    # recientes lo rechazan): se construye su propio LLM con timeout y max_retries
+    from crewai import LLM
+    if grabador:
+        grabador.conectar()
+    return LLM(**opciones)
@@ -0,0 +1,160 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Límites superiores (segundos) de los buckets: de consultas SQLite a respuestas de la crew
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+# Etapa de la conversación que se está atendiendo; las herramientas y consultas SQLite la
+# heredan porque el contexto viaja a los hilos del límite LLM (ver LimiteLLM.ejecutar)
+etapa_actual = contextvars.ContextVar('etapa_actual', default='')
+# Segundos acumulados por tramo en la petición en curso (None fuera de una petición instrumentada)
+_desglose = contextvars.ContextVar('desglose', default=None)
+
+# Tramos medidos: ayuda y etiquetas propias (todos llevan además 'etapa')
+TRAMOS = {
+    'peticion': ('Petición completa a una vista del asistente', ('vista',)),
+    'whisper': ('Transcripción de audio con Whisper', ()),
+    'tts': ('Síntesis de voz con OpenAI TTS', ()),
+    'crew': ('Ejecución de crew.kickoff', ()),
+    'herramienta': ('Llamadas a herramientas de los agentes', ('herramienta',)),
+    'sqlite': ('Consultas SQLite', ('base', 'operacion')),
+}
+OPERACIONES_SQL = ('select', 'insert', 'update', 'delete', 'replace', 'with', 'begin', 'commit', 'rollback', 'pragma')
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _etiquetas(nombres, valores):
+    return ','.join(f'{nombre}="{_escapar(valor)}"' for nombre, valor in zip(nombres, valores))
+
+
+def _muestra(nombre, etiquetas, valor):
+    return f'{nombre}{{{etiquetas}}} {valor}' if etiquetas else f'{nombre} {valor}'
+
+
+class Histograma:
+    """Histograma acumulativo al estilo Prometheus, con una serie por combinación de etiquetas"""
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observar(self, valor, **etiquetas):
+        clave = tuple(str(etiquetas.get(nombre, '')) for nombre in self.etiquetas)
+        posicion = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                # [conteo por bucket..., +Inf, suma]
+                serie = self._series[clave] = [0] * (len(self.buckets) + 1) + [0.0]
+            serie[posicion] += 1
+            serie[-1] += valor
+
+    def series(self):
+        with self._lock:
+            return {clave: list(serie) for clave, serie in self._series.items()}
+
+    def exponer(self):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} histogram']
+        for clave, serie in sorted(self.series().items()):
+            base = _etiquetas(self.etiquetas, clave)
+            separador = ',' if base else ''
+            acumulado = 0
+            for limite, conteo in zip(self.buckets + ('+Inf',), serie[:-1]):
+                acumulado += conteo
+                lineas.append(f'{self.nombre}_bucket{{{base}{separador}le="{limite}"}} {acumulado}')
+            lineas.append(_muestra(f'{self.nombre}_sum', base, f'{serie[-1]:.6f}'))
+            lineas.append(_muestra(f'{self.nombre}_count', base, acumulado))
+        return lineas
+
+
+class Metricas:
+    """
+    Registro de métricas del proceso: un histograma de duración por tramo (Whisper, crew,
+    herramientas, SQLite, TTS...) etiquetado con la etapa en curso, y colectores que aportan
+    contadores de otros componentes en el momento de exponerlas en /metrics.
+    """
+
+    def __init__(self, prefijo='asistente'):
+        self.histogramas = {
+            tramo: Histograma(f'{prefijo}_{tramo}_segundos', ayuda, etiquetas + ('etapa',))
+            for tramo, (ayuda, etiquetas) in TRAMOS.items()
+        }
+        self._colectores = []
+
+    def observar(self, tramo, segundos, **etiquetas):
+        etiquetas.setdefault('etapa', etapa_actual.get())
+        self.histogramas[tramo].observar(segundos, **etiquetas)
+        desglose = _desglose.get()
+        if desglose is not None:
+            acumulado = desglose.setdefault(tramo, [0.0, 0])
+            acumulado[0] += segundos
+            acumulado[1] += 1
+
+    @contextmanager
+    def medir(self, tramo, **etiquetas):
+        """Medir un bloque (`with metricas.medir('crew'):`) o una función (`metricas.medir('crew')(f)`)"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(tramo, time.perf_counter() - inicio, **etiquetas)
+
+    @contextmanager
+    def desglose(self):
+        """Acumular los tramos de la petición en curso: {tramo: [segundos, llamadas]}"""
+        desglose = {}
+        token = _desglose.set(desglose)
+        try:
+            yield desglose
+        finally:
+            _desglose.reset(token)
+
+    def registrar_colector(self, colector):
+        """
+        `colector()` devuelve [(nombre, tipo, ayuda, [(etiquetas_dict, valor), ...]), ...]
+        con los valores actuales de otro componente (gauge o counter)
+        """
+        self._colectores.append(colector)
+
+    def exponer(self):
+        """Texto en formato de exposición de Prometheus (0.0.4)"""
+        lineas = []
+        for histograma in self.histogramas.values():
+            lineas += histograma.exponer()
+        for colector in self._colectores:
+            for nombre, tipo, ayuda, muestras in colector():
+                lineas += [f'# HELP {nombre} {ayuda}', f'# TYPE {nombre} {tipo}']
+                for etiquetas, valor in muestras:
+                    lineas.append(_muestra(nombre, _etiquetas(etiquetas.keys(), etiquetas.values()), valor))
+        return '\n'.join(lineas) + '\n'
+
+
+def operacion_sql(sql):
+    palabra = sql.lstrip()[:8].split(None, 1)
+    operacion = palabra[0].lower() if palabra else ''
+    return operacion if operacion in OPERACIONES_SQL else 'otra'
+
+
+def medir_herramienta(run):
+    """Decorador para BaseTool._run: mide cada llamada con la etiqueta del nombre de la herramienta"""
+    # CrewAI deduce el esquema de argumentos de la firma de _run: wraps la conserva en __wrapped__
+    @functools.wraps(run)
+    def envoltura(self, *args, **kwargs):
+        with metricas.medir('herramienta', herramienta=self.name):
+            return run(self, *args, **kwargs)
+    return envoltura
+
+
+# Registro global del proceso
+metricas = Metricas()
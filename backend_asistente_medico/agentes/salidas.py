@@ -0,0 +1,158 @@
+import json
+import re
+import threading
+from datetime import date
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field, ValidationError, field_validator
+
+# Campos del contexto conversacional que viajan entre etapas
+CAMPOS_CONTEXTO = ('especialidad', 'doctor_nombre', 'doctor_id', 'urgencia', 'fecha', 'hora')
+
+
+class SalidaTriaje(BaseModel):
+    """Salida estructurada de la tarea de triaje"""
+
+    respuesta: str = Field(description='Mensaje conversacional para el paciente, en español')
+    urgencia: Literal['ALTA', 'MEDIA', 'BAJA'] = Field(description='Nivel de urgencia')
+    especialidad: str = Field(description='Especialidad recomendada, tal como aparece en la lista de candidatas')
+    doctor_id: int = Field(description='ID del doctor disponible elegido')
+    doctor_nombre: str = Field(description='Nombre del doctor, sin "Dr." ni "Dra."')
+
+    @field_validator('urgencia', mode='before')
+    @classmethod
+    def _mayusculas(cls, valor):
+        return str(valor).strip().upper() if valor is not None else valor
+
+    @field_validator('doctor_nombre')
+    @classmethod
+    def _sin_titulo(cls, valor):
+        return re.sub(r'^Dra?\.\s*', '', valor.strip())
+
+
+class SalidaCita(BaseModel):
+    """Salida estructurada de las tareas del agente de base de datos (sugerir, negociar y confirmar citas)"""
+
+    respuesta: str = Field(description='Mensaje conversacional para el paciente, en español')
+    doctor_id: Optional[int] = Field(default=None, description='ID del doctor de la cita')
+    doctor_nombre: Optional[str] = Field(default=None, description='Nombre del doctor, sin "Dr." ni "Dra."')
+    fecha: Optional[str] = Field(default=None, description='Fecha propuesta o agendada en formato YYYY-MM-DD')
+    hora: Optional[str] = Field(default=None, description='Hora propuesta o agendada en formato HH:MM (24 h)')
+
+    @field_validator('fecha')
+    @classmethod
+    def _fecha_iso(cls, valor):
+        return date.fromisoformat(valor.strip()).isoformat() if valor else None
+
+    @field_validator('hora')
+    @classmethod
+    def _hora_hhmm(cls, valor):
+        if not valor:
+            return None
+        coincidencia = re.fullmatch(r'(\d{1,2}):(\d{2})(?::\d{2})?', valor.strip())
+        if not coincidencia or int(coincidencia.group(1)) > 23 or int(coincidencia.group(2)) > 59:
+            raise ValueError('La hora debe tener formato HH:MM')
+        return f'{int(coincidencia.group(1)):02d}:{coincidencia.group(2)}'
+
+    @field_validator('doctor_nombre')
+    @classmethod
+    def _sin_titulo(cls, valor):
+        return re.sub(r'^Dra?\.\s*', '', valor.strip()) if valor else None
+
+
+SALIDA_POR_ETAPA = {
+    'triaje': SalidaTriaje,
+    'sugerir_cita': SalidaCita,
+    'negociar_fecha': SalidaCita,
+    'confirmar_cita': SalidaCita,
+}
+
+# Campos sin los que la siguiente etapa no puede continuar
+CAMPOS_REQUERIDOS = {
+    'triaje': ('urgencia', 'especialidad', 'doctor_id'),
+    'sugerir_cita': ('fecha', 'hora'),
+    'negociar_fecha': ('fecha', 'hora'),
+    'confirmar_cita': (),
+}
+
+
+def datos_salida(salida_tarea):
+    """Campos de una salida estructurada como dict (sin validar contra un esquema concreto), o None"""
+    estructurada = getattr(salida_tarea, 'pydantic', None)
+    if isinstance(estructurada, BaseModel):
+        return estructurada.model_dump()
+    if isinstance(getattr(salida_tarea, 'json_dict', None), dict):
+        return salida_tarea.json_dict
+    crudo = (getattr(salida_tarea, 'raw', None) or '').strip()
+    inicio, fin = crudo.find('{'), crudo.rfind('}')
+    if inicio < 0 or fin < inicio:
+        return None
+    try:
+        datos = json.loads(crudo[inicio:fin + 1])
+    except ValueError:
+        return None
+    return datos if isinstance(datos, dict) else None
+
+
+def salida_estructurada(salida_tarea, modelo):
+    """
+    Modelo validado de la salida de una tarea: el `.pydantic` que rellenó CrewAI o, si no
+    llegó a convertirlo, el JSON del texto crudo validado contra el esquema. None si no hay.
+    """
+    estructurada = getattr(salida_tarea, 'pydantic', None)
+    if isinstance(estructurada, modelo):
+        return estructurada
+    datos = datos_salida(salida_tarea)
+    if datos is None:
+        return None
+    try:
+        return modelo.model_validate(datos)
+    except ValidationError:
+        return None
+
+
+def contexto_desde_salida(salida):
+    """Contexto conversacional leído directamente de los campos validados"""
+    return {campo: getattr(salida, campo, None) for campo in CAMPOS_CONTEXTO}
+
+
+class MetricasSalidas:
+    """
+    Contadores por etapa del origen del contexto: 'estructurada' (campos del esquema),
+    'texto' (recuperado del texto con expresiones regulares) o 'fallida' (faltan campos
+    requeridos para continuar). Son por proceso.
+    """
+
+    ORIGENES = ('estructurada', 'texto', 'fallida')
+
+    def __init__(self):
+        self._contadores = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, etapa, origen):
+        with self._lock:
+            contadores = self._contadores.setdefault(etapa, dict.fromkeys(self.ORIGENES, 0))
+            contadores[origen] += 1
+
+    def resumen(self):
+        with self._lock:
+            copia = {etapa: dict(contadores) for etapa, contadores in self._contadores.items()}
+        for contadores in copia.values():
+            total = sum(contadores.values())
+            contadores['total'] = total
+            contadores['tasa_estructurada'] = round(contadores['estructurada'] / total, 4) if total else 0.0
+        return copia
+
+    def reiniciar(self):
+        with self._lock:
+            self._contadores = {}
+
+
+def instrucciones_salida(modelo):
+    """Texto para la descripción de la tarea con los campos que debe rellenar el agente"""
+    campos = '\n'.join(f"- {nombre}: {campo.description}" for nombre, campo in modelo.model_fields.items())
+    return "Tu respuesta final debe ser un objeto JSON con estos campos (el mensaje para el paciente va en 'respuesta'):\n" + campos
+
+
+# Métricas globales del proceso
+metricas_salidas = MetricasSalidas()
@@ -0,0 +1,206 @@
+import json
+import os
+import re
+
+from agentes.bd import db
+from agentes.indice_doctores import normalizar
+
+URGENCIAS = ('BAJA', 'MEDIA', 'ALTA')
+
+# Casos etiquetados (síntomas, edad, urgencia y especialidad esperadas) para medir acuerdo
+RUTA_CORPUS = os.path.join(os.path.dirname(__file__), 'corpus_triaje.jsonl')
+
+# Confianza base según la urgencia más alta encontrada; solo las señales de alarma
+# superan el umbral y evitan la llamada al LLM
+CONFIANZA_POR_URGENCIA = {'ALTA': 0.95, 'MEDIA': 0.8, 'BAJA': 0.7}
+PENALIZACION_AMBIGUEDAD = 0.1
+UMBRAL_CORTOCIRCUITO = 0.9
+
+EDAD_PEDIATRICA = 18
+# Especialidades con equivalente pediátrico; el resto de menores va a Pediatría
+ESPECIALIDAD_PEDIATRICA = {'Neurología': 'Neurología Pediátrica'}
+# Las emergencias vitales no se derivan a consulta pediátrica
+ESPECIALIDADES_SIN_DERIVACION_PEDIATRICA = {'Medicina de Emergencia'}
+
+# (urgencia, especialidad, frases). Mismos criterios que el backstory del agente de triaje;
+# las frases se normalizan al compilar, así que pueden escribirse con tildes
+REGLAS = [
+    ('ALTA', 'Cardiología', [
+        'dolor en el pecho', 'dolor de pecho', 'dolor en mi pecho', 'dolor toracico',
+        'opresion en el pecho', 'presion en el pecho', 'me aprieta el pecho', 'infarto',
+        'ataque al corazon', 'dolor en el brazo izquierdo', 'me duele el pecho',
+    ]),
+    ('ALTA', 'Neurología', [
+        'perdida de conciencia', 'perdi el conocimiento', 'perdi la conciencia', 'me desmaye',
+        'se desmayo', 'desmayo', 'convulsion', 'convulsiones', 'convulsionando',
+        'no puedo mover', 'se me durmio la mitad', 'cara torcida', 'boca torcida',
+        'paralisis facial', 'no puedo hablar', 'habla arrastrada', 'derrame cerebral',
+        'el peor dolor de cabeza',
+    ]),
+    ('ALTA', 'Medicina de Emergencia', [
+        'no puedo respirar', 'dificultad para respirar', 'dificultad respiratoria',
+        'no puede respirar', 'me falta el aire', 'le falta el aire', 'me ahogo', 'se ahoga',
+        'me estoy ahogando', 'se esta ahogando', 'labios morados',
+        'sangrado abundante', 'hemorragia', 'vomito con sangre', 'vomitando sangre',
+        'toso sangre', 'reaccion alergica grave', 'se me cierra la garganta', 'anafilaxia',
+        'intoxicacion', 'envenenamiento', 'quemadura grave', 'no responde',
+    ]),
+    ('ALTA', 'Psiquiatría', [
+        'quiero suicidarme', 'pensamientos suicidas', 'quitarme la vida', 'hacerme dano',
+    ]),
+    ('MEDIA', 'Cardiología', [
+        'palpitaciones', 'arritmia', 'taquicardia', 'presion alta', 'hipertension',
+        'tension alta', 'piernas hinchadas',
+    ]),
+    ('MEDIA', 'Neurología', [
+        'dolor de cabeza fuerte', 'dolor de cabeza severo', 'dolor de cabeza intenso',
+        'migrana', 'migranas', 'mareos', 'mareo', 'vertigo', 'vision doble', 'hormigueo',
+        'entumecimiento',
+    ]),
+    ('MEDIA', 'Medicina General', [
+        'fiebre alta', 'fiebre de 39', 'fiebre de 40', 'fiebre muy alta', 'dolor intenso',
+        'dolor muy fuerte', 'vomitos', 'diarrea', 'deshidratacion', 'dolor abdominal fuerte',
+    ]),
+    ('BAJA', 'Medicina General', [
+        'resfriado', 'resfrio', 'gripe', 'tos leve', 'tos', 'dolor de garganta', 'mocos',
+        'congestion nasal', 'estornudos', 'dolor de cabeza leve', 'cansancio', 'chequeo',
+        'control', 'consulta preventiva', 'revision general', 'fiebre leve', 'malestar general',
+    ]),
+]
+
+NEGADORES = {'no', 'sin', 'nunca', 'niego', 'ni', 'tampoco', 'ningun', 'ninguna', 'ninguno', 'jamas'}
+# Palabras que cierran el alcance de una negación ("no tengo fiebre pero me falta el aire")
+FIN_NEGACION = {'pero', 'aunque', 'sino', 'y', 'e', 'excepto', 'salvo', 'ahora'}
+VENTANA_NEGACION = 4
+
+
+def _compilar_reglas(reglas):
+    """Un único patrón con todas las frases (las más largas primero) y su regla asociada"""
+    frases = {}
+    for prioridad, (urgencia, especialidad, lista) in enumerate(reglas):
+        for frase in lista:
+            frases.setdefault(normalizar(frase), (urgencia, especialidad, prioridad))
+    alternativas = sorted(frases, key=len, reverse=True)
+    patron = re.compile(r'\b(' + '|'.join(re.escape(f) for f in alternativas) + r')\b')
+    return patron, frases
+
+
+_PATRON, _FRASES = _compilar_reglas(REGLAS)
+
+
+def _negada(antes):
+    """True si alguno de los tokens previos (dentro de la ventana y de la cláusula) niega la frase"""
+    for token in reversed(antes.split()[-VENTANA_NEGACION:]):
+        if token in FIN_NEGACION:
+            return False
+        if token in NEGADORES:
+            return True
+    return False
+
+
+def _edad(edad):
+    try:
+        return int(edad)
+    except (TypeError, ValueError):
+        return None
+
+
+class ResultadoTriaje:
+    """Clasificación local de unos síntomas; `concluyente` indica si puede sustituir al LLM"""
+
+    def __init__(self, urgencia=None, especialidad=None, confianza=0.0, hallazgos=(), negados=()):
+        self.urgencia = urgencia
+        self.especialidad = especialidad
+        self.confianza = confianza
+        self.hallazgos = list(hallazgos)
+        self.negados = list(negados)
+
+    @property
+    def concluyente(self):
+        return self.urgencia is not None and self.confianza >= UMBRAL_CORTOCIRCUITO
+
+    def a_dict(self):
+        return {
+            'urgencia': self.urgencia,
+            'especialidad': self.especialidad,
+            'confianza': self.confianza,
+            'hallazgos': self.hallazgos,
+            'negados': self.negados,
+        }
+
+
+def clasificar_sintomas(sintomas, edad=None):
+    """Clasificar urgencia (ALTA/MEDIA/BAJA) y especialidad a partir de frases de alarma"""
+    hallazgos, negados = [], []
+    # La negación no cruza signos de puntuación: se analiza cláusula por cláusula
+    for clausula in re.split(r'[.;,:!?¿¡\n]+', str(sintomas or '')):
+        texto = normalizar(clausula)
+        for coincidencia in _PATRON.finditer(texto):
+            frase = coincidencia.group(1)
+            if _negada(texto[:coincidencia.start()]):
+                negados.append(frase)
+            else:
+                hallazgos.append(frase)
+
+    edad = _edad(edad)
+    pediatrico = edad is not None and edad < EDAD_PEDIATRICA
+    if not hallazgos:
+        # Sin señales claras: el LLM decide; a los menores se les orienta a Pediatría
+        return ResultadoTriaje(especialidad='Pediatría' if pediatrico else None, negados=negados)
+
+    reglas = [_FRASES[frase] for frase in hallazgos]
+    urgencia = max((r[0] for r in reglas), key=URGENCIAS.index)
+    candidatas = sorted({(r[2], r[1]) for r in reglas if r[0] == urgencia})
+    especialidad = candidatas[0][1]
+    confianza = CONFIANZA_POR_URGENCIA[urgencia] - PENALIZACION_AMBIGUEDAD * (len(candidatas) - 1)
+
+    if pediatrico and especialidad not in ESPECIALIDADES_SIN_DERIVACION_PEDIATRICA:
+        especialidad = ESPECIALIDAD_PEDIATRICA.get(especialidad, 'Pediatría')
+    return ResultadoTriaje(urgencia, especialidad, round(confianza, 2), hallazgos, negados)
+
+
+def cargar_corpus(ruta=RUTA_CORPUS):
+    """Leer el corpus etiquetado de triaje (una línea JSON por caso)"""
+    with open(ruta, encoding='utf-8') as archivo:
+        return [json.loads(linea) for linea in archivo if linea.strip()]
+
+
+def redactar_triaje(urgencia, especialidad, doctor):
+    """
+    Respuesta y contexto de triaje con el mismo formato que produce el agente, para una
+    urgencia y especialidad ya decididas y una fila de doctor del directorio.
+    """
+    respuesta = (
+        f"Según los síntomas que describes, tu nivel de urgencia es {urgencia} y te recomiendo "
+        f"acudir a la especialidad de {especialidad}. El doctor disponible es {doctor[1]}. "
+        f"¿Te gustaría agendar una cita con {'ella' if doctor[1].startswith('Dra.') else 'él'}?"
+    )
+    if urgencia == 'ALTA':
+        respuesta = (
+            "⚠️ Tus síntomas pueden indicar una emergencia: si son intensos o empeoran, acude de "
+            "inmediato a urgencias o llama al servicio de emergencias. " + respuesta
+        )
+    contexto = {
+        'especialidad': especialidad,
+        'doctor_nombre': re.sub(r'^Dra?\.\s*', '', doctor[1]),
+        'doctor_id': doctor[0],
+        'urgencia': urgencia,
+        'fecha': None,
+        'hora': None,
+    }
+    return respuesta, contexto
+
+
+def triaje_local(datos_paciente):
+    """
+    Resolver la etapa de triaje sin LLM cuando las reglas son concluyentes.
+    Devuelve (respuesta, contexto, triaje) con el mismo formato que produce el agente, o None.
+    """
+    triaje = clasificar_sintomas(datos_paciente.get('sintomas'), datos_paciente.get('edad'))
+    if not triaje.concluyente:
+        return None
+    doctores = db.directorio().por_especialidad.get(triaje.especialidad)
+    if not doctores:
+        return None
+    respuesta, contexto = redactar_triaje(triaje.urgencia, triaje.especialidad, doctores[0])
+    return respuesta, contexto, triaje
@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Tokens de prompt estimados por tarea (system + herramientas + tarea); las etapas con
+# herramientas repiten el prompt en cada iteración, así que el coste real es un múltiplo
+PRESUPUESTO_POR_ETAPA = {
+    'triaje': 700,
+    'sugerir_cita': 750,
+    'confirmar_cita': 750,
+    'negociar_fecha': 900,
+}
+CAMPOS_USO = ('prompt_tokens', 'cached_prompt_tokens', 'completion_tokens', 'total_tokens', 'successful_requests')
+
+try:
+    import tiktoken
+    _codificacion = tiktoken.get_encoding('o200k_base')
+except Exception:
+    # Sin tiktoken (o sin su caché de vocabularios) se aproxima con ~4 caracteres por token
+    _codificacion = None
+
+
+def estimar_tokens(texto):
+    if not texto:
+        return 0
+    if _codificacion is not None:
+        return len(_codificacion.encode(texto, disallowed_special=()))
+    return -(-len(texto) // 4)
+
+
+def presupuesto(etapa):
+    """Presupuesto de la etapa; se puede ajustar con PRESUPUESTO_TOKENS_<ETAPA> (p. ej. PRESUPUESTO_TOKENS_TRIAJE)"""
+    return int(os.getenv(f'PRESUPUESTO_TOKENS_{etapa.upper()}', PRESUPUESTO_POR_ETAPA.get(etapa, 1500)))
+
+
+def texto_prompt(tarea):
+    """Texto que la tarea envía al LLM: rol, objetivo y backstory del agente, herramientas y tarea"""
+    partes = [tarea.description, tarea.expected_output]
+    agente = tarea.agent
+    if agente is not None:
+        partes += [agente.role, agente.goal, agente.backstory]
+        # Si la tarea fija sus herramientas, solo esas se describen en el prompt
+        for herramienta in getattr(tarea, 'tools', None) or agente.tools or []:
+            esquema = herramienta.args_schema.model_json_schema() if herramienta.args_schema else {}
+            partes += [herramienta.name, herramienta.description, json.dumps(esquema, ensure_ascii=False)]
+    return '\n'.join(parte for parte in partes if parte)
+
+
+def _valor(uso, campo):
+    valor = uso.get(campo) if isinstance(uso, dict) else getattr(uso, campo, None)
+    return valor if isinstance(valor, int) else 0
+
+
+class UsoTokens:
+    """
+    Tokens de prompt y de respuesta acumulados por etapa a partir de resultado.token_usage,
+    y comprobación previa del tamaño del prompt frente al presupuesto de la etapa para
+    detectar regresiones de coste y latencia. Los contadores son por proceso.
+    """
+
+    def __init__(self):
+        self._etapas = {}
+        self._lock = threading.Lock()
+
+    def _etapa(self, etapa):
+        return self._etapas.setdefault(etapa, {
+            'ejecuciones': 0, **dict.fromkeys(CAMPOS_USO, 0),
+            'prompt_estimado_max': 0, 'presupuesto_excedido': 0,
+        })
+
+    def verificar(self, etapa, tareas):
+        """Estimar el prompt de las tareas antes de ejecutarlas; avisa en el log si supera el presupuesto"""
+        estimado = max((estimar_tokens(texto_prompt(tarea)) for tarea in tareas), default=0)
+        limite = presupuesto(etapa)
+        excedido = estimado > limite
+        with self._lock:
+            contadores = self._etapa(etapa)
+            contadores['prompt_estimado_max'] = max(contadores['prompt_estimado_max'], estimado)
+            contadores['presupuesto_excedido'] += excedido
+        if excedido:
+            logger.warning('Prompt de la etapa %s: ~%d tokens, presupuesto %d', etapa, estimado, limite)
+        return {'estimado': estimado, 'presupuesto': limite, 'excedido': excedido}
+
+    def registrar(self, etapa, resultado):
+        """Sumar el token_usage de una ejecución de la crew y devolverlo como dict"""
+        uso = getattr(resultado, 'token_usage', None)
+        consumo = {campo: _valor(uso, campo) for campo in CAMPOS_USO}
+        with self._lock:
+            contadores = self._etapa(etapa)
+            contadores['ejecuciones'] += 1
+            for campo, valor in consumo.items():
+                contadores[campo] += valor
+        return consumo
+
+    def resumen(self):
+        with self._lock:
+            copia = {etapa: dict(contadores) for etapa, contadores in self._etapas.items()}
+        for etapa, contadores in copia.items():
+            ejecuciones = contadores['ejecuciones']
+            contadores['presupuesto'] = presupuesto(etapa)
+            contadores['prompt_medio'] = round(contadores['prompt_tokens'] / ejecuciones, 1) if ejecuciones else 0.0
+            contadores['respuesta_media'] = round(contadores['completion_tokens'] / ejecuciones, 1) if ejecuciones else 0.0
+            contadores['tasa_cache'] = (
+                round(contadores['cached_prompt_tokens'] / contadores['prompt_tokens'], 4)
+                if contadores['prompt_tokens'] else 0.0
+            )
+        return copia
+
+    def reiniciar(self):
+        with self._lock:
+            self._etapas = {}
+
+
+# Contadores globales del proceso
+uso_tokens = UsoTokens()
@@ -0,0 +1,54 @@
+import gzip
+import io
+import sys
+
+from django.core.management.base import CommandError
+
+from agentes.bd import BaseDatosMedica, db
+
+# Columnas exportables/importables por tabla, en el orden del esquema
+COLUMNAS = {
+    'doctores': ['id', 'nombre', 'especialidad', 'disponible', 'telefono', 'email'],
+    'pacientes': ['id', 'nombres', 'apellidos', 'correo_electronico', 'numero_telefono', 'edad',
+                  'contraseña', 'fecha_registro'],
+    'citas': ['id', 'paciente_id', 'doctor_id', 'fecha', 'hora', 'motivo', 'urgencia', 'estado',
+              'fecha_creacion'],
+}
+
+# Prefijo de los IDs generados cuando el archivo no trae columna id
+PREFIJOS_ID = {'pacientes': 'PAC', 'citas': 'CITA'}
+
+
+def detectar_formato(archivo, formato):
+    """Devolver 'csv' o 'jsonl' a partir de --formato o de la extensión del archivo"""
+    if formato:
+        return formato
+    nombre = archivo[:-len('.gz')] if archivo.endswith('.gz') else archivo
+    if nombre.endswith('.csv'):
+        return 'csv'
+    if nombre.endswith('.jsonl') or nombre.endswith('.ndjson'):
+        return 'jsonl'
+    raise CommandError(f'No se puede deducir el formato de {archivo}; usa --formato csv|jsonl')
+
+
+def abrir(archivo, modo):
+    """Abrir un archivo de texto UTF-8 (comprimido si termina en .gz); '-' es stdin/stdout"""
+    if archivo == '-':
+        flujo = sys.stdin.buffer if modo == 'r' else sys.stdout.buffer
+        return io.TextIOWrapper(flujo, encoding='utf-8', newline='')
+    if archivo.endswith('.gz'):
+        return gzip.open(archivo, modo + 't', encoding='utf-8', newline='')
+    return open(archivo, modo, encoding='utf-8', newline='')
+
+
+def base_datos(ruta):
+    """Base de datos indicada con --db o la instancia global"""
+    return BaseDatosMedica(ruta) if ruta else db
+
+
+def agregar_argumentos_comunes(parser):
+    parser.add_argument('tabla', choices=sorted(COLUMNAS), help='Tabla a transferir')
+    parser.add_argument('archivo', help="Ruta del archivo .csv/.jsonl (opcionalmente .gz) o '-'")
+    parser.add_argument('--formato', choices=['csv', 'jsonl'], help='Formato si no se deduce de la extensión')
+    parser.add_argument('--lote', type=int, default=5000, help='Filas por lote de executemany/fetchmany')
+    parser.add_argument('--db', help='Ruta de una base de datos distinta de la configurada')
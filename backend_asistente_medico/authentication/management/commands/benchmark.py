@@ -0,0 +1,239 @@
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from agentes.bd import BaseDatosMedica, ErrorReserva, citas_solapadas
+from agentes.identificadores import generador_ids
+
+
+def _medir(funcion, iteraciones):
+    """Ejecutar `funcion` n veces y devolver (segundos totales, operaciones/segundo)"""
+    inicio = time.perf_counter()
+    for i in range(iteraciones):
+        funcion(i)
+    total = time.perf_counter() - inicio
+    return total, iteraciones / total if total else float('inf')
+
+
+def benchmark_conexiones(comando, iteraciones):
+    """Comparar abrir una conexión por consulta contra la conexión reutilizable del hilo"""
+    with tempfile.TemporaryDirectory() as directorio:
+        base = BaseDatosMedica(os.path.join(directorio, 'benchmark.db'))
+
+        def consulta_abriendo(i):
+            conn = sqlite3.connect(base.db_path)
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT COUNT(*) FROM citas WHERE doctor_id = ? AND fecha = ? AND hora = ?",
+                (i % 30 + 1, '2025-08-01', '09:00')
+            )
+            cursor.fetchone()
+            conn.close()
+
+        def consulta_reutilizando(i):
+            cursor = base.conexion().cursor()
+            cursor.execute(
+                "SELECT COUNT(*) FROM citas WHERE doctor_id = ? AND fecha = ? AND hora = ?",
+                (i % 30 + 1, '2025-08-01', '09:00')
+            )
+            cursor.fetchone()
+
+        resultados = [
+            ('abrir por consulta', _medir(consulta_abriendo, iteraciones)),
+            ('conexión reutilizada', _medir(consulta_reutilizando, iteraciones)),
+        ]
+        base.conexiones.cerrar_todas()
+
+    for nombre, (total, por_segundo) in resultados:
+        comando.stdout.write(
+            f"{nombre:<22} {total * 1e6 / iteraciones:10.1f} µs/consulta {por_segundo:12.0f} consultas/s"
+        )
+    aceleracion = resultados[0][1][0] / resultados[1][1][0]
+    comando.stdout.write(comando.style.SUCCESS(f"Aceleración: x{aceleracion:.1f}"))
+
+
+def benchmark_directorio(comando, iteraciones):
+    """Comparar la consulta SQL de doctores por especialidad contra el directorio en memoria"""
+    with tempfile.TemporaryDirectory() as directorio:
+        base = BaseDatosMedica(os.path.join(directorio, 'benchmark.db'))
+        especialidades = base.obtener_especialidades()
+
+        def consulta_sql(i):
+            cursor = base.conexion().cursor()
+            cursor.execute(
+                "SELECT * FROM doctores WHERE especialidad = ? AND disponible = 1",
+                (especialidades[i % len(especialidades)],)
+            )
+            cursor.fetchall()
+
+        def consulta_directorio(i):
+            base.obtener_doctores_por_especialidad(especialidades[i % len(especialidades)])
+
+        resultados = [
+            ('consulta SQL', _medir(consulta_sql, iteraciones)),
+            ('directorio en memoria', _medir(consulta_directorio, iteraciones)),
+        ]
+        base.conexiones.cerrar_todas()
+
+    for nombre, (total, por_segundo) in resultados:
+        comando.stdout.write(
+            f"{nombre:<22} {total * 1e6 / iteraciones:10.1f} µs/consulta {por_segundo:12.0f} consultas/s"
+        )
+
+
+def _generar_ids(cantidad):
+    return b''.join(generador_ids.nuevo().encode() for _ in range(cantidad))
+
+
+def benchmark_identificadores(comando, iteraciones):
+    """
+    Generar `iteraciones` IDs en cada uno de N procesos (al menos 4, así que por defecto
+    varios millones en total) y comprobar que no hay duplicados
+    """
+    procesos = max(os.cpu_count() or 1, 4)
+    metodo = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+    inicio = time.perf_counter()
+    # close/join en lugar de terminate: los hijos heredan manejadores de señales de terceros
+    pool = multiprocessing.get_context(metodo).Pool(procesos)
+    try:
+        bloques = pool.map(_generar_ids, [iteraciones] * procesos)
+    finally:
+        pool.close()
+        pool.join()
+    total_segundos = time.perf_counter() - inicio
+
+    vistos = set()
+    for bloque in bloques:
+        vistos.update(bloque[i:i + 26] for i in range(0, len(bloque), 26))
+    total = iteraciones * procesos
+    duplicados = total - len(vistos)
+
+    comando.stdout.write(f"{procesos} procesos x {iteraciones} IDs = {total} IDs en {total_segundos:.2f} s "
+                         f"({total / total_segundos:,.0f} IDs/s)")
+    if duplicados:
+        raise CommandError(f"Se generaron {duplicados} IDs duplicados")
+    comando.stdout.write(comando.style.SUCCESS("Sin duplicados"))
+
+
+def benchmark_reservas(comando, iteraciones, hilos=8):
+    """Reservar desde varios hilos franjas muy disputadas y comprobar que no hay dobles reservas"""
+    with tempfile.TemporaryDirectory() as directorio:
+        base = BaseDatosMedica(os.path.join(directorio, 'benchmark.db'))
+        pacientes = [
+            base.registrar_paciente('Paciente', str(i), f'paciente{i}@benchmark.com', None, 40, 'clave')
+            for i in range(hilos)
+        ]
+        # Pocas franjas para forzar conflictos: 3 doctores x 5 días (de la próxima semana) x 18 franjas
+        hoy = date.today()
+        lunes = hoy + timedelta(days=7 - hoy.weekday())
+        franjas = [
+            (doctor_id, (lunes + timedelta(days=dia)).isoformat(), f'{8 + franja // 2:02d}:{30 * (franja % 2):02d}')
+            for doctor_id in (1, 2, 3) for dia in range(5) for franja in range(18)
+        ]
+        contadores = {'reservadas': 0, 'ocupadas': 0, 'errores': 0}
+        lock = threading.Lock()
+
+        def trabajador(numero):
+            aleatorio = random.Random(numero)
+            for _ in range(iteraciones // hilos):
+                doctor_id, fecha, hora = aleatorio.choice(franjas)
+                try:
+                    base.reservar_cita(pacientes[numero], doctor_id, fecha, hora, 'Benchmark')
+                    resultado = 'reservadas'
+                except ErrorReserva:
+                    resultado = 'ocupadas'
+                except sqlite3.Error:
+                    resultado = 'errores'
+                with lock:
+                    contadores[resultado] += 1
+
+        inicio = time.perf_counter()
+        trabajadores = [threading.Thread(target=trabajador, args=(i,)) for i in range(hilos)]
+        for hilo in trabajadores:
+            hilo.start()
+        for hilo in trabajadores:
+            hilo.join()
+        total_segundos = time.perf_counter() - inicio
+
+        conn = base.conexion()
+        dobles = citas_solapadas(conn)
+        filas = conn.execute("SELECT COUNT(*) FROM citas").fetchone()[0]
+        base.conexiones.cerrar_todas()
+
+    intentos = sum(contadores.values())
+    comando.stdout.write(
+        f"{hilos} hilos, {intentos} intentos en {total_segundos:.2f} s ({intentos / total_segundos:,.0f} reservas/s): "
+        f"{contadores['reservadas']} reservadas, {contadores['ocupadas']} rechazadas por ocupación, "
+        f"{contadores['errores']} errores"
+    )
+    if dobles or filas != contadores['reservadas']:
+        raise CommandError(f"Dobles reservas detectadas: {dobles} pares de citas solapadas, {filas} filas")
+    comando.stdout.write(comando.style.SUCCESS("Sin dobles reservas"))
+
+
+def benchmark_agentes(comando, iteraciones):
+    """Coste por petición de preparar agentes y crew (LLM simulado): construirlos siempre vs. registro"""
+    # Importación diferida: agentes.agentes crea el cliente de OpenAI al importarse
+    from agentes.agentes import RegistroAgentes, crear_agentes, crear_crew, crear_tareas
+    from agentes.llm_simulado import crear_llm
+
+    llm_simulado = crear_llm('simulado')
+    registro = RegistroAgentes(lambda: crear_agentes(llm_simulado))
+    registro.precalentar()
+    datos_paciente = {'nombre': 'Paciente', 'edad': 40, 'sintomas': 'dolor de cabeza', 'telefono': None}
+
+    def construyendo(i):
+        agente_triaje, agente_bd = crear_agentes(llm_simulado)
+        crear_crew(agente_triaje, agente_bd, crear_tareas(agente_triaje, agente_bd, datos_paciente, 'triaje'))
+
+    def con_registro(i):
+        agente_triaje, agente_bd = registro.agentes()
+        crear_crew(agente_triaje, agente_bd, crear_tareas(agente_triaje, agente_bd, datos_paciente, 'triaje'))
+
+    resultados = [
+        ('crear_agentes()', _medir(construyendo, iteraciones)),
+        ('registro_agentes', _medir(con_registro, iteraciones)),
+    ]
+    for nombre, (total, por_segundo) in resultados:
+        comando.stdout.write(
+            f"{nombre:<22} {total * 1e3 / iteraciones:10.3f} ms/petición {por_segundo:12.0f} peticiones/s"
+        )
+    aceleracion = resultados[0][1][0] / resultados[1][1][0]
+    comando.stdout.write(comando.style.SUCCESS(f"Aceleración: x{aceleracion:.1f}"))
+
+
+ESCENARIOS = {
+    'agentes': benchmark_agentes,
+    'conexiones': benchmark_conexiones,
+    'directorio': benchmark_directorio,
+    'identificadores': benchmark_identificadores,
+    'reservas': benchmark_reservas,
+}
+
+# Identificadores: por proceso (al menos 4), así la comprobación de unicidad cubre millones de IDs
+ITERACIONES_POR_DEFECTO = {'identificadores': 500000}
+
+
+class Command(BaseCommand):
+    help = 'Ejecuta micro-benchmarks de la capa de datos y de los agentes'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('escenario', choices=sorted(ESCENARIOS), help='Escenario a medir')
+        parser.add_argument('--iteraciones', type=int,
+                            help='Por defecto 10000 (500000 por proceso en identificadores)')
+
+    def handle(self, *args, **options):
+        iteraciones = options['iteraciones']
+        if iteraciones is None:
+            iteraciones = ITERACIONES_POR_DEFECTO.get(options['escenario'], 10000)
+        if iteraciones <= 0:
+            raise CommandError('--iteraciones debe ser mayor que cero')
+        ESCENARIOS[options['escenario']](self, iteraciones)
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from agentes.cache_triaje import cache_triaje
+
+
+class Command(BaseCommand):
+    help = 'Muestra la tasa de aciertos de la caché de triaje, la vacía o purga las entradas caducadas'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('accion', nargs='?', default='estadisticas',
+                            choices=['estadisticas', 'vaciar', 'purgar'])
+        parser.add_argument('--reiniciar-metricas', action='store_true',
+                            help='Al vaciar, poner también a cero los contadores de aciertos y fallos')
+
+    def handle(self, *args, **options):
+        if options['accion'] == 'vaciar':
+            cache_triaje.vaciar(reiniciar_metricas=options['reiniciar_metricas'])
+            self.stdout.write(self.style.SUCCESS('Caché de triaje vaciada'))
+            return
+        if options['accion'] == 'purgar':
+            borradas = cache_triaje.purgar_expiradas()
+            self.stdout.write(self.style.SUCCESS(f'{borradas} entradas caducadas eliminadas'))
+            return
+
+        estadisticas = cache_triaje.estadisticas()
+        self.stdout.write(f"Archivo: {cache_triaje.ruta or '(solo memoria)'}")
+        self.stdout.write(f"Entradas vigentes: {estadisticas['entradas']}")
+        self.stdout.write(f"Consultas: {estadisticas['consultas']} "
+                          f"(memoria {estadisticas['aciertos_memoria']}, disco {estadisticas['aciertos_disco']}, "
+                          f"fallos {estadisticas['fallos']})")
+        self.stdout.write(f"Tasa de aciertos: {estadisticas['tasa_aciertos']:.1%}")
+        self.stdout.write(f"Escrituras: {estadisticas['escrituras']}")
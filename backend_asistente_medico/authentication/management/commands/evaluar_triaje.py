@@ -0,0 +1,67 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from agentes.triaje_reglas import RUTA_CORPUS, cargar_corpus, clasificar_sintomas
+
+
+def _triaje_llm(caso):
+    """Ejecutar la etapa de triaje completa con el LLM y extraer urgencia y especialidad"""
+    # Importación diferida: agentes.agentes crea el cliente de OpenAI al importarse
+    from agentes.agentes import crear_crew, crear_tareas, extraer_contexto, registro_agentes
+
+    agente_triaje, agente_bd = registro_agentes.agentes()
+    datos_paciente = {'nombre': 'Paciente', 'edad': caso['edad'], 'sintomas': caso['sintomas'], 'telefono': None}
+    resultado = crear_crew(agente_triaje, agente_bd, crear_tareas(agente_triaje, agente_bd, datos_paciente, 'triaje')).kickoff()
+    # El mismo extractor que usa el asistente (salida estructurada y, si falla, el texto)
+    contexto = extraer_contexto(resultado, 'triaje')
+    return (contexto.get('urgencia') or '').upper() or None, contexto.get('especialidad')
+
+
+class Command(BaseCommand):
+    help = 'Mide el acuerdo del triaje por reglas con el corpus etiquetado o con el LLM'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', default=RUTA_CORPUS, help='Archivo JSONL con los casos etiquetados')
+        parser.add_argument('--llm', action='store_true',
+                            help='Comparar contra respuestas reales del LLM en lugar de las etiquetas')
+
+    def handle(self, *args, **options):
+        casos = cargar_corpus(options['corpus'])
+        concluyentes = acuerdos_urgencia = acuerdos_especialidad = 0
+        alarmas = alarmas_detectadas = 0
+        segundos = 0.0
+
+        for caso in casos:
+            inicio = time.perf_counter()
+            resultado = clasificar_sintomas(caso['sintomas'], caso['edad'])
+            segundos += time.perf_counter() - inicio
+
+            if options['llm']:
+                urgencia, especialidad = _triaje_llm(caso)
+            else:
+                urgencia, especialidad = caso['urgencia'], caso['especialidad']
+
+            if urgencia == 'ALTA':
+                alarmas += 1
+                alarmas_detectadas += resultado.concluyente and resultado.urgencia == 'ALTA'
+            if not resultado.concluyente:
+                continue
+            concluyentes += 1
+            acuerdos_urgencia += resultado.urgencia == urgencia
+            acuerdos_especialidad += resultado.especialidad == especialidad
+            if (resultado.urgencia, resultado.especialidad) != (urgencia, especialidad):
+                self.stdout.write(self.style.WARNING(
+                    f"Desacuerdo: {caso['sintomas']!r} -> reglas {resultado.urgencia}/{resultado.especialidad}, "
+                    f"referencia {urgencia}/{especialidad}"
+                ))
+
+        referencia = 'LLM' if options['llm'] else 'etiquetas'
+        self.stdout.write(f"{len(casos)} casos, {concluyentes} resueltos por reglas "
+                          f"({concluyentes / max(len(casos), 1):.0%} de cobertura)")
+        self.stdout.write(f"Acuerdo con {referencia} en casos resueltos: urgencia "
+                          f"{acuerdos_urgencia / max(concluyentes, 1):.0%}, especialidad "
+                          f"{acuerdos_especialidad / max(concluyentes, 1):.0%}")
+        self.stdout.write(f"Alarmas (ALTA) detectadas por reglas: {alarmas_detectadas}/{alarmas}")
+        self.stdout.write(f"Latencia media de las reglas: {segundos * 1e6 / max(len(casos), 1):.1f} µs/caso")
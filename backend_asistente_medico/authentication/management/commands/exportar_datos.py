@@ -0,0 +1,61 @@
+import csv
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ._datos import COLUMNAS, abrir, agregar_argumentos_comunes, base_datos, detectar_formato
+
+
+class Command(BaseCommand):
+    help = 'Exporta doctores, pacientes o citas a CSV/JSONL en streaming, con memoria acotada'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        agregar_argumentos_comunes(parser)
+        parser.add_argument('--incluir-contrasenas', action='store_true',
+                            help='Exportar también los hashes de contraseña de pacientes')
+
+    def handle(self, *args, **options):
+        tabla = options['tabla']
+        lote = options['lote']
+        if lote <= 0:
+            raise CommandError('--lote debe ser mayor que cero')
+        formato = detectar_formato(options['archivo'], options['formato'])
+        base = base_datos(options['db'])
+
+        columnas = list(COLUMNAS[tabla])
+        if tabla == 'pacientes' and not options['incluir_contrasenas']:
+            columnas.remove('contraseña')
+
+        # Un único SELECT abierto lee una instantánea consistente (WAL) sin bloquear escritores
+        cursor = base.conexion().cursor()
+        cursor.execute(f"SELECT {', '.join(columnas)} FROM {tabla} ORDER BY rowid")
+
+        total = 0
+        inicio = time.perf_counter()
+        with abrir(options['archivo'], 'w') as salida:
+            escritor = csv.writer(salida) if formato == 'csv' else None
+            if escritor:
+                escritor.writerow(columnas)
+            while True:
+                filas = cursor.fetchmany(lote)
+                if not filas:
+                    break
+                if escritor:
+                    escritor.writerows(filas)
+                else:
+                    salida.writelines(
+                        json.dumps(dict(zip(columnas, fila)), ensure_ascii=False) + '\n' for fila in filas
+                    )
+                total += len(filas)
+                if options['verbosity'] >= 1 and options['archivo'] != '-':
+                    self.stderr.write(f'  {total} filas', ending='\r')
+
+        if options['archivo'] != '-':
+            if options['verbosity'] >= 1:
+                self.stderr.write('')
+            segundos = time.perf_counter() - inicio
+            self.stdout.write(self.style.SUCCESS(
+                f'{total} filas exportadas de {tabla} en {segundos:.1f} s'
+            ))
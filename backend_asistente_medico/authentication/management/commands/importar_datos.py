@@ -0,0 +1,119 @@
+import csv
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from agentes.identificadores import generador_ids
+
+from ._datos import COLUMNAS, PREFIJOS_ID, abrir, agregar_argumentos_comunes, base_datos, detectar_formato
+
+SENTENCIAS_CONFLICTO = {
+    'error': 'INSERT',
+    'ignorar': 'INSERT OR IGNORE',
+    'reemplazar': 'INSERT OR REPLACE',
+}
+
+
+class Command(BaseCommand):
+    help = 'Importa doctores, pacientes o citas desde CSV/JSONL en lotes, con memoria acotada'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        agregar_argumentos_comunes(parser)
+        parser.add_argument('--filas-por-transaccion', type=int, default=100000,
+                            help='Filas confirmadas por transacción')
+        parser.add_argument('--conflicto', choices=sorted(SENTENCIAS_CONFLICTO), default='error',
+                            help='Qué hacer con filas que violan claves únicas')
+        parser.add_argument('--hashear-contrasenas', action='store_true',
+                            help='La columna contraseña de pacientes viene en texto plano')
+
+    def _filas(self, archivo, formato):
+        """Generador de diccionarios leídos en streaming"""
+        with abrir(archivo, 'r') as entrada:
+            if formato == 'csv':
+                yield from csv.DictReader(entrada)
+            else:
+                for numero, linea in enumerate(entrada, start=1):
+                    if linea.strip():
+                        try:
+                            yield json.loads(linea)
+                        except json.JSONDecodeError as e:
+                            raise CommandError(f'Línea {numero} no es JSON válido: {e}')
+
+    def handle(self, *args, **options):
+        tabla = options['tabla']
+        lote = options['lote']
+        por_transaccion = max(options['filas_por_transaccion'], lote)
+        if lote <= 0:
+            raise CommandError('--lote debe ser mayor que cero')
+        formato = detectar_formato(options['archivo'], options['formato'])
+        base = base_datos(options['db'])
+
+        filas = self._filas(options['archivo'], formato)
+        primera = next(filas, None)
+        if primera is None:
+            self.stdout.write('El archivo no contiene filas')
+            return
+
+        # Solo se insertan las columnas presentes en el archivo; el resto toma su DEFAULT
+        columnas = [c for c in COLUMNAS[tabla] if c in primera]
+        desconocidas = set(primera) - set(COLUMNAS[tabla])
+        if desconocidas:
+            self.stderr.write(f"Se ignoran columnas desconocidas: {', '.join(sorted(desconocidas))}")
+        generar_id = 'id' not in columnas and tabla in PREFIJOS_ID
+        if generar_id:
+            columnas.insert(0, 'id')
+        sentencia = (
+            f"{SENTENCIAS_CONFLICTO[options['conflicto']]} INTO {tabla} ({', '.join(columnas)}) "
+            f"VALUES ({', '.join('?' * len(columnas))})"
+        )
+
+        def valores(fila):
+            if generar_id:
+                fila['id'] = generador_ids.nuevo(PREFIJOS_ID[tabla])
+            if options['hashear_contrasenas'] and fila.get('contraseña'):
+                fila['contraseña'] = base.hash_password(fila['contraseña'])
+            # En CSV las celdas vacías equivalen a NULL
+            return tuple(None if fila.get(c) == '' else fila.get(c) for c in columnas)
+
+        conn = base.conexion()
+        total = pendientes_commit = 0
+        inicio = time.perf_counter()
+        buffer = [valores(primera)]
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fila in filas:
+                buffer.append(valores(fila))
+                if len(buffer) >= lote:
+                    conn.executemany(sentencia, buffer)
+                    total += len(buffer)
+                    pendientes_commit += len(buffer)
+                    buffer.clear()
+                    if pendientes_commit >= por_transaccion:
+                        conn.commit()
+                        pendientes_commit = 0
+                        conn.execute("BEGIN IMMEDIATE")
+                    self._progreso(total, inicio, options['verbosity'])
+            if buffer:
+                conn.executemany(sentencia, buffer)
+                total += len(buffer)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            confirmadas = total - pendientes_commit
+            raise CommandError(
+                f'Importación interrumpida tras {confirmadas} filas confirmadas: {e}'
+            )
+
+        segundos = time.perf_counter() - inicio
+        if options['verbosity'] >= 1:
+            self.stderr.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f'{total} filas procesadas en {tabla} en {segundos:.1f} s ({total / max(segundos, 1e-9):,.0f} filas/s)'
+        ))
+
+    def _progreso(self, total, inicio, verbosidad):
+        if verbosidad >= 1:
+            segundos = time.perf_counter() - inicio
+            self.stderr.write(f'  {total} filas ({total / max(segundos, 1e-9):,.0f} filas/s)', ending='\r')
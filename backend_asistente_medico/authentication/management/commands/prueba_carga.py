@@ -0,0 +1,390 @@
+import http.cookiejar
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from agentes.bd import DURACION_CITA_MIN, citas_solapadas
+from agentes.triaje_reglas import cargar_corpus
+
+# Orden del informe: autenticación, etapas de la conversación y consulta de citas
+ETAPAS = ('registro', 'login', 'triaje', 'sugerir_cita', 'negociar_fecha', 'confirmar_cita', 'mis_citas')
+PERCENTILES = (50, 95, 99)
+
+
+def percentil(ordenados, p):
+    """Percentil por rango más cercano de una lista ya ordenada"""
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, max(0, math.ceil(p / 100 * len(ordenados)) - 1))]
+
+
+class Resultados:
+    """Latencias, errores y citas de todas las sesiones (compartido entre hilos)"""
+
+    def __init__(self):
+        self.latencias = {etapa: [] for etapa in ETAPAS}
+        self.errores = {etapa: Counter() for etapa in ETAPAS}
+        self.locales = Counter()
+        self.citas = []
+        self.conflictos = 0
+        self.sesiones_completas = 0
+        self._lock = threading.Lock()
+
+    def registrar(self, etapa, segundos, error=None, local=False):
+        with self._lock:
+            self.latencias[etapa].append(segundos)
+            if error:
+                self.errores[etapa][error] += 1
+            self.locales[etapa] += local
+
+    def error(self, etapa, error):
+        """Error de flujo detectado en una respuesta que ya se registró como correcta"""
+        with self._lock:
+            self.errores[etapa][error] += 1
+
+    def conflicto(self):
+        with self._lock:
+            self.conflictos += 1
+
+    def cita(self, cita):
+        with self._lock:
+            self.citas.append(cita)
+            self.sesiones_completas += 1
+
+    def dobles_reservas(self):
+        """Pares de citas confirmadas del mismo doctor y día cuyas franjas se solapan"""
+        por_dia = {}
+        for c in self.citas:
+            horas, minutos = c['hora'].split(':')[:2]
+            por_dia.setdefault((c['doctor_id'], c['fecha']), []).append(int(horas) * 60 + int(minutos))
+        dobles = []
+        for (doctor_id, fecha), inicios in por_dia.items():
+            inicios.sort()
+            for anterior, siguiente in zip(inicios, inicios[1:]):
+                if siguiente - anterior < DURACION_CITA_MIN:
+                    dobles.append((doctor_id, fecha, anterior, siguiente))
+        return dobles
+
+    def informe(self, segundos):
+        etapas = {}
+        for etapa in ETAPAS:
+            ordenados = sorted(self.latencias[etapa])
+            peticiones = len(ordenados)
+            errores = sum(self.errores[etapa].values())
+            etapas[etapa] = {
+                'peticiones': peticiones,
+                'errores': errores,
+                'tasa_error': round(errores / peticiones, 4) if peticiones else 0.0,
+                'por_segundo': round(peticiones / segundos, 2) if segundos else 0.0,
+                'tasa_local': round(self.locales[etapa] / peticiones, 4) if peticiones else 0.0,
+                **{f'p{p}_ms': round(percentil(ordenados, p) * 1000, 1) for p in PERCENTILES},
+                'detalle_errores': dict(self.errores[etapa]),
+            }
+        return {
+            'segundos': round(segundos, 2),
+            'sesiones_completas': self.sesiones_completas,
+            'citas': len(self.citas),
+            'conflictos': self.conflictos,
+            'dobles_reservas': len(self.dobles_reservas()),
+            'etapas': etapas,
+        }
+
+
+class SesionPaciente:
+    """
+    Un paciente simulado con su propia cookie de sesión: se registra, inicia sesión, recorre
+    triaje -> sugerir_cita -> (negociar_fecha) -> confirmar_cita y comprueba mis_citas. Tras
+    el triaje solo envía el ID de la conversación y su respuesta (el estado queda en el servidor)
+    """
+
+    def __init__(self, url, numero, ejecucion, sintomas, resultados, aleatorio,
+                 negociar=0.3, reintentos=3, timeout=60):
+        self.url = url.rstrip('/')
+        self.numero = numero
+        self.correo = f'carga-{ejecucion}-{numero}@prueba.local'
+        self.sintomas = sintomas
+        self.resultados = resultados
+        self.aleatorio = aleatorio
+        self.negociar = negociar
+        self.reintentos = reintentos
+        self.timeout = timeout
+        self.conversacion_id = None
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def peticion(self, etapa, ruta, datos=None):
+        """Devuelve el JSON de la respuesta o None si falló (el error queda registrado en la etapa)"""
+        cuerpo = json.dumps(datos).encode() if datos is not None else None
+        solicitud = urllib.request.Request(
+            self.url + ruta, data=cuerpo, headers={'Content-Type': 'application/json'} if cuerpo else {}
+        )
+        inicio = time.perf_counter()
+        try:
+            with self.opener.open(solicitud, timeout=self.timeout) as respuesta:
+                codigo, contenido = respuesta.status, respuesta.read()
+        except urllib.error.HTTPError as e:
+            codigo, contenido = e.code, e.read()
+        except OSError as e:
+            # Conexión rechazada, reiniciada o timeout
+            self.resultados.registrar(etapa, time.perf_counter() - inicio, type(e).__name__)
+            return None
+        segundos = time.perf_counter() - inicio
+        try:
+            respuesta = json.loads(contenido)
+        except ValueError:
+            respuesta = {}
+        error = None if codigo == 200 and respuesta.get('success') else f'HTTP {codigo}'
+        local = (respuesta.get('resultado') or {}).get('origen') == 'local'
+        self.resultados.registrar(etapa, segundos, error, local)
+        return None if error else respuesta
+
+    def atender(self, etapa, stage, **extra):
+        return self.peticion(etapa, '/asistente/atender/', {
+            'conversacion_id': self.conversacion_id, 'stage': stage, **extra
+        })
+
+    def ejecutar(self):
+        contraseña = 'clave-de-carga'
+        registro = self.peticion('registro', '/api/auth/register/', {
+            'nombres': 'Paciente', 'apellidos': f'Carga {self.numero}', 'correo_electronico': self.correo,
+            'edad': self.sintomas['edad'], 'contraseña': contraseña
+        })
+        if registro is None:
+            return
+        if self.peticion('login', '/api/auth/login/', {'correo_electronico': self.correo, 'contraseña': contraseña}) is None:
+            return
+
+        triaje = self.peticion('triaje', '/asistente/atender/', {
+            'nombre': 'Paciente', 'edad': self.sintomas['edad'], 'sintomas': self.sintomas['sintomas'],
+            'stage': 'triaje'
+        })
+        if triaje is None:
+            return
+        self.conversacion_id = triaje.get('conversacion_id')
+        if triaje.get('stage') != 'sugerir_cita' or not triaje.get('contexto', {}).get('doctor_id'):
+            return self.resultados.error('triaje', 'sin_doctor')
+        sugerencia = self.atender('sugerir_cita', 'sugerir_cita', respuesta_usuario='sí')
+        if sugerencia is None:
+            return
+        contexto = sugerencia.get('contexto') or {}
+        if sugerencia.get('stage') != 'confirmar_cita' or not contexto.get('fecha'):
+            return self.resultados.error('sugerir_cita', 'sin_propuesta')
+
+        if self.aleatorio.random() < self.negociar:
+            # El paciente pide otro día a la misma hora
+            deseada = date.fromisoformat(contexto['fecha']) + timedelta(days=self.aleatorio.randint(1, 7))
+            negociacion = self.atender('negociar_fecha', 'confirmar_cita', respuesta_usuario='prefiero otro día',
+                                       fecha_deseada=deseada.isoformat(), hora_deseada=contexto['hora'])
+            if negociacion is None:
+                return
+            contexto = negociacion.get('contexto') or {}
+            if negociacion.get('stage') != 'confirmar_cita' or not contexto.get('fecha'):
+                return self.resultados.error('negociar_fecha', 'sin_propuesta')
+
+        for _ in range(self.reintentos + 1):
+            propuesta = (contexto.get('doctor_id'), contexto.get('fecha'), contexto.get('hora'))
+            confirmacion = self.atender('confirmar_cita', 'confirmar_cita', respuesta_usuario='sí')
+            if confirmacion is None:
+                return
+            contexto = confirmacion.get('contexto') or {}
+            if confirmacion.get('stage') == 'finalizado' and contexto.get('cita_id'):
+                break
+            if (contexto.get('doctor_id'), contexto.get('fecha'), contexto.get('hora')) in (propuesta, (None, None, None)):
+                return self.resultados.error('confirmar_cita', 'rechazada')
+            # La franja se ocupó entre la propuesta y la confirmación: se confirma la nueva propuesta
+            self.resultados.conflicto()
+        else:
+            return self.resultados.error('confirmar_cita', 'sin_franja_tras_reintentos')
+
+        citas = self.peticion('mis_citas', '/api/medico/mis-citas/?periodo=proximas&limite=100')
+        if citas is None:
+            return
+        if contexto['cita_id'] not in {cita.get('id') for cita in citas.get('citas', [])}:
+            return self.resultados.error('mis_citas', 'cita_no_listada')
+        self.resultados.cita({'cita_id': contexto['cita_id'], 'doctor_id': contexto.get('doctor_id'),
+                              'fecha': contexto['fecha'], 'hora': contexto['hora']})
+
+
+def dobles_reservas_en_base(ruta):
+    """Pares de citas del mismo doctor con franjas solapadas en la base de datos del servidor"""
+    conn = sqlite3.connect(ruta)
+    try:
+        return citas_solapadas(conn)
+    finally:
+        conn.close()
+
+
+def _puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def servidor_local(workers, latencia_llm):
+    """
+    Arrancar uvicorn con el LLM y el audio simulados y bases de datos nuevas en un directorio
+    temporal. Devuelve (url, ruta de sistema_medico.db)
+    """
+    try:
+        import uvicorn  # noqa: F401
+    except ImportError:
+        raise CommandError('--arrancar necesita uvicorn; instálalo o arranca el servidor y usa --url')
+    directorio = tempfile.mkdtemp(prefix='prueba_carga_')
+    puerto = _puerto_libre()
+    entorno = dict(
+        os.environ,
+        BACKEND_LLM='simulado', BACKEND_AUDIO='simulado', LLM_SIMULADO_LATENCIA=str(latencia_llm),
+        COLA_TRABAJOS_DB=os.path.join(directorio, 'trabajos.db'),
+        CACHE_TRIAJE_DB=os.path.join(directorio, 'cache_triaje.db'),
+        CONVERSACIONES_DB=os.path.join(directorio, 'conversaciones.db'),
+        DJANGO_DB=os.path.join(directorio, 'db.sqlite3'),
+    )
+    # Sin telemetría de CrewAI: su exportación bloquea las crews si no hay red y falsea las latencias
+    entorno.setdefault('CREWAI_DISABLE_TELEMETRY', 'true')
+    entorno.setdefault('OTEL_SDK_DISABLED', 'true')
+    # Las sesiones de Django viven en su base de datos (DJANGO_DB, también temporal): necesita sus migraciones
+    subprocess.run([sys.executable, str(settings.BASE_DIR / 'manage.py'), 'migrate', '--noinput', '-v', '0'],
+                   check=True, env=entorno)
+    # sistema_medico.db se crea en el directorio de trabajo del servidor
+    proceso = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'backend_asistente_medico.asgi:application',
+         '--app-dir', str(settings.BASE_DIR), '--host', '127.0.0.1', '--port', str(puerto),
+         '--workers', str(workers), '--log-level', 'warning'],
+        cwd=directorio, env=entorno
+    )
+    try:
+        limite = time.monotonic() + 60
+        while True:
+            if proceso.poll() is not None:
+                raise CommandError(f'El servidor terminó al arrancar (código {proceso.returncode})')
+            try:
+                socket.create_connection(('127.0.0.1', puerto), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > limite:
+                    raise CommandError('El servidor no aceptó conexiones en 60 s')
+                time.sleep(0.2)
+        yield f'http://127.0.0.1:{puerto}', os.path.join(directorio, 'sistema_medico.db')
+    finally:
+        proceso.terminate()
+        try:
+            proceso.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proceso.kill()
+        shutil.rmtree(directorio, ignore_errors=True)
+
+
+def ejecutar_carga(url, sesiones, concurrencia, semilla=None, negociar=0.3, timeout=60):
+    """Lanzar `sesiones` pacientes con `concurrencia` a la vez y devolver (Resultados, segundos)"""
+    aleatorio = random.Random(semilla)
+    corpus = cargar_corpus()
+    ejecucion = uuid.uuid4().hex[:8]
+    resultados = Resultados()
+    pacientes = [
+        SesionPaciente(url, numero, ejecucion, aleatorio.choice(corpus), resultados,
+                       random.Random(aleatorio.random()), negociar=negociar, timeout=timeout)
+        for numero in range(sesiones)
+    ]
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+        list(ejecutor.map(SesionPaciente.ejecutar, pacientes))
+    return resultados, time.perf_counter() - inicio
+
+
+class Command(BaseCommand):
+    help = 'Prueba de carga HTTP del flujo completo de citas (registro, etapas del asistente y mis_citas)'
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000',
+                            help='Servidor ya arrancado (con BACKEND_LLM=simulado para no consumir la API)')
+        parser.add_argument('--arrancar', action='store_true',
+                            help='Arrancar un servidor uvicorn propio con LLM simulado y bases de datos temporales')
+        parser.add_argument('--workers', type=int, default=1, help='Workers de uvicorn con --arrancar')
+        parser.add_argument('--latencia-llm', type=float, default=0.5,
+                            help='Segundos por llamada del LLM simulado con --arrancar')
+        parser.add_argument('--sesiones', type=int, default=50)
+        parser.add_argument('--concurrencia', type=int, default=10)
+        parser.add_argument('--negociar', type=float, default=0.3,
+                            help='Fracción de sesiones que piden otra fecha antes de confirmar')
+        parser.add_argument('--semilla', type=int, default=None)
+        parser.add_argument('--timeout', type=float, default=60, help='Segundos por petición')
+        parser.add_argument('--base', help='sistema_medico.db del servidor, para comprobar dobles reservas en la base')
+        parser.add_argument('--max-tasa-error', type=float, default=None,
+                            help='Fallar si alguna etapa supera esta tasa de error (0-1)')
+        parser.add_argument('--max-p95-ms', type=float, default=None,
+                            help='Fallar si el p95 de alguna etapa supera estos milisegundos')
+        parser.add_argument('--salida', help='Guardar el informe en JSON (para comparar entre despliegues)')
+
+    def handle(self, *args, **options):
+        if options['sesiones'] <= 0 or options['concurrencia'] <= 0:
+            raise CommandError('--sesiones y --concurrencia deben ser mayores que cero')
+        if options['arrancar']:
+            with servidor_local(options['workers'], options['latencia_llm']) as (url, base):
+                informe = self.medir(url, base, options)
+        else:
+            informe = self.medir(options['url'], options['base'], options)
+        self.comprobar(informe, options)
+
+    def medir(self, url, base, options):
+        self.stdout.write(f"{options['sesiones']} sesiones, concurrencia {options['concurrencia']} contra {url}")
+        resultados, segundos = ejecutar_carga(url, options['sesiones'], options['concurrencia'],
+                                              options['semilla'], options['negociar'], options['timeout'])
+        informe = resultados.informe(segundos)
+        if base:
+            informe['dobles_reservas_base'] = dobles_reservas_en_base(base)
+
+        self.stdout.write(f"{'etapa':<15} {'peticiones':>10} {'errores':>8} {'% error':>8} {'p50 ms':>9} "
+                          f"{'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'% local':>8}")
+        for etapa, datos in informe['etapas'].items():
+            if not datos['peticiones']:
+                continue
+            self.stdout.write(
+                f"{etapa:<15} {datos['peticiones']:>10} {datos['errores']:>8} {datos['tasa_error']:>8.1%} "
+                f"{datos['p50_ms']:>9.1f} {datos['p95_ms']:>9.1f} {datos['p99_ms']:>9.1f} "
+                f"{datos['por_segundo']:>8.2f} {datos['tasa_local']:>8.0%}"
+            )
+            for error, veces in datos['detalle_errores'].items():
+                self.stdout.write(self.style.WARNING(f"  {error}: {veces}"))
+        self.stdout.write(
+            f"{informe['sesiones_completas']}/{options['sesiones']} sesiones completas en {informe['segundos']:.2f} s "
+            f"({informe['sesiones_completas'] / segundos:.2f} sesiones/s), {informe['citas']} citas, "
+            f"{informe['conflictos']} franjas ocupadas al confirmar"
+        )
+        if options['salida']:
+            with open(options['salida'], 'w', encoding='utf-8') as archivo:
+                json.dump(informe, archivo, ensure_ascii=False, indent=2)
+        return informe
+
+    def comprobar(self, informe, options):
+        fallos = []
+        if informe['dobles_reservas'] or informe.get('dobles_reservas_base'):
+            fallos.append(f"dobles reservas: {informe['dobles_reservas']} en respuestas, "
+                          f"{informe.get('dobles_reservas_base', 0)} en la base")
+        for etapa, datos in informe['etapas'].items():
+            if options['max_tasa_error'] is not None and datos['tasa_error'] > options['max_tasa_error']:
+                fallos.append(f"{etapa}: tasa de error {datos['tasa_error']:.1%}")
+            if options['max_p95_ms'] is not None and datos['p95_ms'] > options['max_p95_ms']:
+                fallos.append(f"{etapa}: p95 {datos['p95_ms']:.0f} ms")
+        if fallos:
+            raise CommandError('; '.join(fallos))
+        self.stdout.write(self.style.SUCCESS('Sin dobles reservas'))
@@ -1,3 +1,1615 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import AsyncClient, LiveServerTestCase, TestCase
+from django.urls import reverse
+
+from agentes.agentes import extraer_contexto
+from agentes.bd import BaseDatosMedica, ErrorReserva, MIGRACIONES, citas_solapadas
+from agentes.cache_triaje import CacheTriaje, clave_triaje
+from agentes.cliente_openai import (
+    Circuito, CircuitoAbierto, ClienteResiliente, PlazoAgotado, Politica, error_transitorio)
+from agentes.disponibilidad import MotorDisponibilidad
+from agentes.flujo_respuesta import FlujoRespuestaFinal, respuesta_visible
+from agentes.identificadores import GeneradorIds, generador_ids
+from agentes.salidas import SalidaCita, SalidaTriaje, metricas_salidas
+from agentes.indice_doctores import IndiceDoctores
+from agentes.llm_simulado import GuionLLM, clave_prompt, crear_llm, texto_mensajes
+from agentes.metricas import Histograma, etapa_actual, metricas
+from agentes.uso_tokens import uso_tokens
+from agentes.triaje_reglas import cargar_corpus, clasificar_sintomas, triaje_local
+from backend_asistente_medico.audio_simulado import ClienteAudioSimulado
+from backend_asistente_medico.cola_trabajos import ColaLlena, ColaTrabajos
+from backend_asistente_medico.concurrencia import LimiteLLM, SobrecargaLLM
+from backend_asistente_medico.conversaciones import (
+    AlmacenConversaciones, ConflictoConversacion, ConversacionNoEncontrada, TransicionInvalida)
+from backend_asistente_medico.views import flujo_eventos_trabajo, procesar_atencion, serializar_resultado_crew
+
+
+class BaseDatosTemporalMixin:
+    """Crea una BaseDatosMedica aislada en un directorio temporal por test"""
+
+    def setUp(self):
+        super().setUp()
+        self.directorio = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directorio.name, 'pruebas.db')
+        self.base = BaseDatosMedica(self.db_path)
+        # Un lunes futuro: no se reservan ni se ofrecen franjas pasadas
+        hoy = datetime.now().date()
+        self.lunes = (hoy + timedelta(days=7 - hoy.weekday())).isoformat()
+
+    def tearDown(self):
+        self.base.conexiones.cerrar_todas()
+        self.directorio.cleanup()
+        super().tearDown()
+
+    def plan(self, consulta, parametros=()):
+        cursor = self.base.conexion().cursor()
+        cursor.execute(f"EXPLAIN QUERY PLAN {consulta}", parametros)
+        return ' | '.join(fila[3] for fila in cursor.fetchall())
+
+
+class MigracionesTests(BaseDatosTemporalMixin, TestCase):
+    def test_version_final_y_reaplicacion_idempotente(self):
+        ultima = MIGRACIONES[-1][0]
+        self.assertEqual(self.base.conexion().execute("PRAGMA user_version").fetchone()[0], ultima)
+        self.assertEqual(self.base.migrar(), ultima)
+        total = self.base.conexion().execute("SELECT COUNT(*) FROM doctores").fetchone()[0]
+        self.assertEqual(total, 30)
+
+    def test_migra_una_base_anterior_sin_version(self):
+        ruta = os.path.join(self.directorio.name, 'antigua.db')
+        conn = sqlite3.connect(ruta)
+        conn.execute('''CREATE TABLE citas (id TEXT PRIMARY KEY, paciente_id TEXT NOT NULL,
+                        doctor_id INTEGER NOT NULL, fecha TEXT NOT NULL, hora TEXT NOT NULL)''')
+        conn.execute("INSERT INTO citas VALUES ('C1', 'P1', 1, '2025-08-01', '09:00')")
+        conn.commit()
+        conn.close()
+
+        antigua = BaseDatosMedica(ruta)
+        try:
+            self.assertEqual(antigua.conexion().execute("PRAGMA user_version").fetchone()[0], MIGRACIONES[-1][0])
+            self.assertEqual(antigua.conexion().execute("SELECT COUNT(*) FROM citas").fetchone()[0], 1)
+        finally:
+            antigua.conexiones.cerrar_todas()
+
+    def test_cita_duplicada_viola_restriccion_unica(self):
+        with self.base.conexion() as conn:
+            conn.execute(
+                "INSERT INTO citas (id, paciente_id, doctor_id, fecha, hora) VALUES ('UNA', 'P1', 1, '2025-08-01', '09:00')"
+            )
+        with self.assertRaises(sqlite3.IntegrityError):
+            with self.base.conexion() as conn:
+                conn.execute(
+                    "INSERT INTO citas (id, paciente_id, doctor_id, fecha, hora) VALUES ('OTRA', 'P2', 1, '2025-08-01', '09:00')"
+                )
+
+
+class PlanesDeConsultaTests(BaseDatosTemporalMixin, TestCase):
+    """Si alguna consulta caliente vuelve a recorrer la tabla completa, estos tests fallan"""
+
+    def assertSinRecorrido(self, plan):
+        self.assertNotRegex(plan, r'\bSCAN (c|d|citas|doctores)\b', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_disponibilidad_usa_indice_unico(self):
+        plan = self.plan(
+            "SELECT COUNT(*) FROM citas WHERE doctor_id = ? AND fecha = ? AND hora = ?",
+            (1, '2025-08-01', '09:00')
+        )
+        self.assertIn('idx_citas_doctor_fecha_hora', plan)
+        self.assertSinRecorrido(plan)
+
+    def test_mis_citas_pagina_por_clave_sin_ordenar_en_memoria(self):
+        plan = self.plan('''
+            SELECT c.id, c.fecha, c.hora, c.motivo, c.urgencia, c.estado,
+                   d.nombre, d.especialidad, c.fecha_creacion
+            FROM citas c
+            JOIN doctores d ON c.doctor_id = d.id
+            WHERE c.paciente_id = ? AND (c.fecha, c.hora, c.id) < (?, ?, ?)
+            ORDER BY c.fecha DESC, c.hora DESC, c.id DESC
+        ''', ('P1', '2025-08-01', '09:00', 'CITA1'))
+        self.assertIn('idx_citas_paciente_fecha_hora_id (paciente_id=? AND', plan)
+        self.assertSinRecorrido(plan)
+
+    def test_doctores_por_especialidad_usa_indice(self):
+        plan = self.plan(
+            "SELECT * FROM doctores WHERE especialidad = ? AND disponible = 1", ('Cardiología',)
+        )
+        self.assertIn('idx_doctores_disponible_especialidad (disponible=? AND especialidad=?)', plan)
+        self.assertSinRecorrido(plan)
+
+    def test_doctores_disponibles_usa_indice(self):
+        plan = self.plan("SELECT * FROM doctores WHERE disponible = 1")
+        self.assertIn('idx_doctores_disponible_especialidad', plan)
+        self.assertSinRecorrido(plan)
+
+    def test_especialidades_distintas_usa_indice_cubriente(self):
+        plan = self.plan(
+            "SELECT DISTINCT especialidad FROM doctores WHERE disponible = 1 ORDER BY especialidad"
+        )
+        self.assertIn('COVERING INDEX idx_doctores_disponible_especialidad', plan)
+        self.assertSinRecorrido(plan)
+
+
+class MotorDisponibilidadTests(BaseDatosTemporalMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.motor = MotorDisponibilidad(self.base)
+        self.inicio = datetime.fromisoformat(self.lunes).replace(hour=7)
+        self.lunes_siguiente = (self.inicio + timedelta(days=7)).date().isoformat()
+
+    def cita(self, cita_id, doctor_id, fecha, hora):
+        with self.base.conexion() as conn:
+            conn.execute(
+                "INSERT INTO citas (id, paciente_id, doctor_id, fecha, hora) VALUES (?, 'P1', ?, ?, ?)",
+                (cita_id, doctor_id, fecha, hora)
+            )
+
+    def test_salta_franjas_ocupadas(self):
+        self.cita('C1', 3, self.lunes, '08:00')
+        self.cita('C2', 3, self.lunes, '08:30')
+        huecos = self.motor.proximos_huecos(doctor_id=3, desde=self.inicio, cantidad=2)
+        self.assertEqual([(h['fecha'], h['hora']) for h in huecos], [(self.lunes, '09:00'), (self.lunes, '09:30')])
+
+    def test_pasa_al_siguiente_dia_laboral(self):
+        viernes_tarde = self.inicio + timedelta(days=4, hours=9, minutes=45)
+        huecos = self.motor.proximos_huecos(doctor_id=3, desde=viernes_tarde, cantidad=1)
+        self.assertEqual((huecos[0]['fecha'], huecos[0]['hora']), (self.lunes_siguiente, '08:00'))
+
+    def test_respeta_horario_propio_del_doctor(self):
+        with self.base.conexion() as conn:
+            conn.execute("INSERT INTO horarios VALUES (3, 0, '14:00', '15:00')")
+        huecos = self.motor.proximos_huecos(doctor_id=3, desde=self.inicio, cantidad=3)
+        self.assertEqual([(h['fecha'], h['hora']) for h in huecos][:2], [(self.lunes, '14:00'), (self.lunes, '14:30')])
+        self.assertEqual(huecos[2]['fecha'], self.lunes_siguiente)
+
+    def test_especialidad_combina_doctores_por_orden_de_hora(self):
+        self.cita('C1', 3, self.lunes, '08:00')
+        huecos = self.motor.proximos_huecos(especialidad='cardiología', desde=self.inicio, cantidad=3)
+        self.assertEqual([(h['doctor_id'], h['hora']) for h in huecos], [(3, '08:30'), (3, '09:00'), (3, '09:30')])
+
+    def test_especialidad_sin_tildes_ni_mayusculas(self):
+        for especialidad in ('Cardiologia', 'cardiología ', 'CARDIOLOGIA'):
+            huecos = self.motor.proximos_huecos(especialidad=especialidad, desde=self.inicio, cantidad=1)
+            self.assertEqual([h['doctor_id'] for h in huecos], [3], especialidad)
+        self.assertEqual(self.motor.proximos_huecos(especialidad='Astrología', desde=self.inicio), [])
+
+    def test_nunca_ofrece_franjas_pasadas(self):
+        for desde in ('2001-01-01', datetime(2001, 1, 1).date(), datetime(2001, 1, 1, 9, 0)):
+            huecos = self.motor.proximos_huecos(doctor_id=3, desde=desde, cantidad=3)
+            self.assertTrue(all(datetime.fromisoformat(f"{h['fecha']}T{h['hora']}") >= datetime.now() for h in huecos))
+            self.assertEqual(len(huecos), 3)
+
+
+class DirectorioDoctoresTests(BaseDatosTemporalMixin, TestCase):
+    def test_lecturas_coinciden_con_la_tabla(self):
+        cardiologos = self.base.obtener_doctores_por_especialidad('Cardiología')
+        self.assertEqual([d[0] for d in cardiologos], [3])
+        self.assertEqual(len(self.base.obtener_doctores_por_especialidad()), 30)
+        self.assertEqual(self.base.obtener_especialidades()[0], 'Anestesiología')
+        self.assertEqual([d[0] for d in self.base.directorio().buscar('cardio')], [3, 4])
+
+    def test_se_reutiliza_mientras_no_cambie_la_version(self):
+        self.assertIs(self.base.directorio(), self.base.directorio())
+
+    def test_escritura_desde_otro_proceso_invalida_la_cache(self):
+        anterior = self.base.directorio()
+        otro_worker = sqlite3.connect(self.db_path)
+        otro_worker.execute("UPDATE doctores SET disponible = 0 WHERE id = 3")
+        otro_worker.execute(
+            "INSERT INTO doctores (id, nombre, especialidad) VALUES (31, 'Dra. Paula Ríos', 'Cardiología')"
+        )
+        otro_worker.commit()
+        otro_worker.close()
+
+        # Dentro del intervalo de comprobación se sigue sirviendo la instantánea anterior
+        self.assertIs(self.base.directorio(), anterior)
+        with mock.patch('agentes.bd.time.monotonic', return_value=time.monotonic() + self.base.comprobar_directorio_cada):
+            self.assertEqual([d[0] for d in self.base.obtener_doctores_por_especialidad('Cardiología')], [31])
+        self.assertFalse(self.base.obtener_doctor(3)[3])
+
+
+class IndiceDoctoresTests(BaseDatosTemporalMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.indice = self.base.directorio().indice
+
+    def test_resuelve_nombres_sin_tildes_ni_titulo(self):
+        for nombre in ('Miguel Martinez', 'Dr. Martínez', 'martinez', 'Dr Miguel Martines'):
+            self.assertEqual(self.indice.resolver(nombre)[0], 3, nombre)
+        self.assertEqual(self.indice.resolver('Dra. Nunez')[0], 30)
+        self.assertEqual(self.indice.resolver('Dr. Inexistente Pérez'), (None, 0))
+
+    def test_resuelve_sinonimos_de_especialidad(self):
+        casos = {
+            'cardiólogo': 'Cardiología',
+            'cardiologia intervencionista': 'Cardiología Intervencionista',
+            'una pediatra': 'Pediatría',
+            'otorrino': 'Otorrinolaringología',
+            'Neurología pediátrica.': 'Neurología Pediátrica',
+            'psiquiatra': 'Psiquiatría',
+        }
+        for texto, esperada in casos.items():
+            self.assertEqual(self.indice.resolver_especialidad(texto), esperada, texto)
+
+    def test_especialidad_desempata_entre_apellidos_iguales(self):
+        doctores = list(self.base.obtener_doctores_por_especialidad())
+        doctores.append((31, 'Dra. Laura Martínez', 'Dermatología', 1, None, None))
+        indice = IndiceDoctores(doctores)
+        self.assertEqual(indice.resolver('Dra. Martinez', 'dermatóloga')[0], 31)
+        self.assertEqual(indice.resolver('Martinez', 'Cardiología')[0], 3)
+
+    def test_encuentra_nombre_completo_en_texto_libre(self):
+        texto = 'Te recomiendo a Carolina Nunez, que atiende mañana.'
+        self.assertEqual(self.indice.encontrar_en_texto(texto), 30)
+
+
+def _generar_ids(cantidad):
+    return [generador_ids.nuevo('CITA') for _ in range(cantidad)]
+
+
+class GeneradorIdsTests(TestCase):
+    def test_ids_ordenables_por_momento_de_creacion(self):
+        generador = GeneradorIds(worker_id=7)
+        primero = generador.nuevo('PAC')
+        time.sleep(0.002)
+        segundo = generador.nuevo('PAC')
+        self.assertTrue(primero.startswith('PAC'))
+        self.assertEqual(len(primero), len('PAC') + 26)
+        self.assertLess(primero, segundo)
+
+    def test_mismo_milisegundo_no_colisiona(self):
+        generador = GeneradorIds(worker_id=1)
+        ids = [generador.nuevo() for _ in range(100000)]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_varios_procesos_sin_duplicados(self):
+        # Con fork los hijos heredan el estado del padre: el generador debe reiniciarse
+        generador_ids.nuevo()
+        metodo = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+        pool = multiprocessing.get_context(metodo).Pool(4)
+        try:
+            bloques = pool.map(_generar_ids, [50000] * 8)
+        finally:
+            pool.close()
+            pool.join()
+        ids = [i for bloque in bloques for i in bloque]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_registros_en_el_mismo_segundo(self):
+        with tempfile.TemporaryDirectory() as directorio:
+            base = BaseDatosMedica(os.path.join(directorio, 'ids.db'))
+            try:
+                pacientes = [
+                    base.registrar_paciente('Ana', 'Ruiz', f'ana{i}@correo.com', None, 30, 'clave')
+                    for i in range(20)
+                ]
+                self.assertNotIn(None, pacientes)
+                self.assertEqual(len(set(pacientes)), 20)
+            finally:
+                base.conexiones.cerrar_todas()
+
+
+class ReservaCitasTests(BaseDatosTemporalMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.paciente_id = self.base.registrar_paciente('Ana', 'Ruiz', 'ana@correo.com', None, 30, 'clave')
+
+    def test_reserva_y_devuelve_los_datos_de_la_cita(self):
+        cita = self.base.reservar_cita(self.paciente_id, 3, self.lunes, '9:00', 'Control')
+        self.assertEqual((cita['doctor_nombre'], cita['fecha'], cita['hora']), ('Dr. Miguel Martínez', self.lunes, '09:00'))
+        self.assertEqual(cita['paciente_nombre'], 'Ana Ruiz')
+
+    def test_franja_ocupada_aunque_cambie_el_formato_de_hora(self):
+        self.base.reservar_cita(self.paciente_id, 3, self.lunes, '09:00', 'Control')
+        with self.assertRaises(ErrorReserva) as contexto:
+            self.base.reservar_cita(self.paciente_id, 3, self.lunes, '9:00', 'Otra')
+        self.assertEqual(contexto.exception.motivo, ErrorReserva.HORARIO_OCUPADO)
+
+    def test_rechaza_paciente_doctor_y_datos_invalidos(self):
+        casos = [
+            (('NO_ID', 3, self.lunes, '09:00'), ErrorReserva.PACIENTE_INEXISTENTE),
+            ((self.paciente_id, 999, self.lunes, '09:00'), ErrorReserva.DOCTOR_NO_DISPONIBLE),
+            ((self.paciente_id, 3, '4 de agosto', '09:00'), ErrorReserva.DATOS_INVALIDOS),
+            ((self.paciente_id, 3, self.lunes, 'mañana'), ErrorReserva.DATOS_INVALIDOS),
+        ]
+        for argumentos, motivo in casos:
+            with self.assertRaises(ErrorReserva) as contexto:
+                self.base.reservar_cita(*argumentos, motivo='Control')
+            self.assertEqual(contexto.exception.motivo, motivo)
+
+    def test_reservas_concurrentes_de_la_misma_franja(self):
+        resultados = []
+        barrera = threading.Barrier(8)
+
+        def reservar():
+            barrera.wait()
+            try:
+                resultados.append(self.base.reservar_cita(self.paciente_id, 3, self.lunes, '10:00', 'Control'))
+            except ErrorReserva as e:
+                resultados.append(e.motivo)
+
+        hilos = [threading.Thread(target=reservar) for _ in range(8)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+
+        self.assertEqual(sum(isinstance(r, dict) for r in resultados), 1)
+        self.assertEqual(resultados.count(ErrorReserva.HORARIO_OCUPADO), 7)
+
+    def test_rechaza_franjas_solapadas_fuera_de_horario_y_pasadas(self):
+        self.base.reservar_cita(self.paciente_id, 3, self.lunes, '10:00', 'Control')
+        self.base.reservar_cita(self.paciente_id, 3, self.lunes, '16:30', 'Control')
+        domingo = (datetime.fromisoformat(self.lunes) + timedelta(days=6)).date().isoformat()
+        casos = [
+            ((self.lunes, '10:15'), ErrorReserva.FUERA_DE_HORARIO),
+            ((self.lunes, '17:00'), ErrorReserva.FUERA_DE_HORARIO),
+            ((self.lunes, '03:00'), ErrorReserva.FUERA_DE_HORARIO),
+            ((domingo, '10:00'), ErrorReserva.FUERA_DE_HORARIO),
+            (('2001-01-01', '09:00'), ErrorReserva.FECHA_PASADA),
+        ]
+        for (fecha, hora), motivo in casos:
+            with self.assertRaises(ErrorReserva) as contexto:
+                self.base.reservar_cita(self.paciente_id, 3, fecha, hora, 'Control')
+            self.assertEqual(contexto.exception.motivo, motivo, (fecha, hora))
+        self.assertEqual(citas_solapadas(self.base.conexion()), 0)
+
+    def test_respeta_el_horario_propio_del_doctor(self):
+        with self.base.conexion() as conn:
+            conn.execute("INSERT INTO horarios VALUES (3, 0, '14:00', '15:00')")
+        self.assertEqual(self.base.reservar_cita(self.paciente_id, 3, self.lunes, '14:30', 'Control')['hora'], '14:30')
+        with self.assertRaises(ErrorReserva) as contexto:
+            self.base.reservar_cita(self.paciente_id, 3, self.lunes, '09:00', 'Control')
+        self.assertEqual(contexto.exception.motivo, ErrorReserva.FUERA_DE_HORARIO)
+
+    def test_cuenta_citas_solapadas_aunque_no_coincida_la_hora(self):
+        with self.base.conexion() as conn:
+            for cita_id, hora in (('C1', '10:00'), ('C2', '10:15'), ('C3', '9:45'), ('C4', '11:00')):
+                conn.execute("INSERT INTO citas (id, paciente_id, doctor_id, fecha, hora) VALUES (?, 'P1', 3, ?, ?)",
+                             (cita_id, self.lunes, hora))
+        # 9:45 se solapa con 10:00 y 10:00 con 10:15; 9:45 termina justo a las 10:15 y 11:00 queda libre
+        self.assertEqual(citas_solapadas(self.base.conexion()), 2)
+
+
+class ImportacionExportacionTests(BaseDatosTemporalMixin, TestCase):
+    def test_ida_y_vuelta_de_citas_en_lotes(self):
+        entrada = os.path.join(self.directorio.name, 'citas.csv')
+        with open(entrada, 'w', encoding='utf-8') as archivo:
+            archivo.write('paciente_id,doctor_id,fecha,hora,motivo,urgencia\n')
+            for i in range(250):
+                archivo.write(f'PAC{i},{i % 30 + 1},2025-09-{i % 28 + 1:02d},{8 + i // 60 % 9:02d}:{i % 2 * 30:02d},Control,\n')
+
+        salida = io.StringIO()
+        call_command('importar_datos', 'citas', entrada, '--db', self.db_path, '--lote', '40',
+                     '--filas-por-transaccion', '100', stdout=salida, stderr=io.StringIO())
+        self.assertIn('250 filas', salida.getvalue())
+        conn = self.base.conexion()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM citas").fetchone()[0], 250)
+        # Las celdas vacías toman NULL y las columnas ausentes su DEFAULT
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM citas WHERE estado = 'Programada'").fetchone()[0], 250)
+
+        exportado = os.path.join(self.directorio.name, 'citas.jsonl.gz')
+        call_command('exportar_datos', 'citas', exportado, '--db', self.db_path, '--lote', '64',
+                     stdout=io.StringIO(), stderr=io.StringIO())
+        with gzip.open(exportado, 'rt', encoding='utf-8') as archivo:
+            filas = [json.loads(linea) for linea in archivo]
+        self.assertEqual(len(filas), 250)
+        self.assertEqual(len({f['id'] for f in filas}), 250)
+
+        # Reimportar las mismas filas choca con las claves únicas salvo que se pida ignorarlas
+        with self.assertRaises(CommandError):
+            call_command('importar_datos', 'citas', exportado, '--db', self.db_path,
+                         stdout=io.StringIO(), stderr=io.StringIO())
+        call_command('importar_datos', 'citas', exportado, '--db', self.db_path, '--conflicto', 'ignorar',
+                     stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM citas").fetchone()[0], 250)
+
+    def test_exportar_pacientes_omite_contrasenas(self):
+        self.base.registrar_paciente('Ana', 'Pérez', 'ana@example.com', '999', 30, 'secreta')
+        exportado = os.path.join(self.directorio.name, 'pacientes.csv')
+        call_command('exportar_datos', 'pacientes', exportado, '--db', self.db_path,
+                     stdout=io.StringIO(), stderr=io.StringIO())
+        with open(exportado, encoding='utf-8') as archivo:
+            contenido = archivo.read()
+        self.assertNotIn('contraseña', contenido)
+        self.assertIn('Pérez', contenido)
+
+
+class EstadisticasTests(BaseDatosTemporalMixin, TestCase):
+    def recuento(self):
+        """Las mismas cifras calculadas recorriendo las tablas"""
+        conn = self.base.conexion()
+        urgencias = dict(conn.execute("SELECT COALESCE(urgencia, ''), COUNT(*) FROM citas GROUP BY 1").fetchall())
+        estados = dict(conn.execute("SELECT COALESCE(estado, ''), COUNT(*) FROM citas GROUP BY 1").fetchall())
+        especialidades = dict(conn.execute(
+            "SELECT especialidad, COUNT(*) FROM doctores WHERE disponible GROUP BY 1").fetchall())
+        return {
+            'total_pacientes': conn.execute("SELECT COUNT(*) FROM pacientes").fetchone()[0],
+            'total_citas': conn.execute("SELECT COUNT(*) FROM citas").fetchone()[0],
+            'total_doctores': conn.execute("SELECT COUNT(*) FROM doctores").fetchone()[0],
+            'doctores_disponibles': sum(especialidades.values()),
+            'citas_por_urgencia': urgencias,
+            'citas_por_estado': estados,
+            'doctores_por_especialidad': especialidades,
+        }
+
+    def test_contadores_coinciden_con_el_recuento_tras_cada_escritura(self):
+        self.assertEqual(self.base.estadisticas(), self.recuento())
+        paciente_id = self.base.registrar_paciente('Ana', 'Pérez', 'ana@example.com', '999', 30, 'secreta')
+        cita = self.base.reservar_cita(paciente_id, 3, self.lunes, '09:00', 'Control', urgencia='Alta')
+        self.base.reservar_cita(paciente_id, 4, self.lunes, '10:00', 'Control')
+
+        conn = self.base.conexion()
+        escrituras = [
+            ("UPDATE citas SET estado = 'Cancelada', urgencia = NULL WHERE id = ?", (cita['id'],)),
+            ("UPDATE doctores SET disponible = 0 WHERE id = 3", ()),
+            ("UPDATE doctores SET especialidad = 'Cardiología' WHERE id = 5", ()),
+            ("INSERT OR REPLACE INTO citas (id, paciente_id, doctor_id, fecha, hora, urgencia) "
+             "VALUES (?, ?, 4, '2025-08-05', '11:00', 'Baja')", (cita['id'], paciente_id)),
+            ("DELETE FROM doctores WHERE id = 7", ()),
+            ("DELETE FROM citas", ()),
+            ("DELETE FROM pacientes", ()),
+        ]
+        for sentencia, parametros in escrituras:
+            with conn:
+                conn.execute(sentencia, parametros)
+            self.assertEqual(self.base.estadisticas(), self.recuento(), sentencia)
+
+    def test_lectura_no_recorre_tablas(self):
+        self.assertNotIn('SCAN', self.plan("SELECT categoria, clave, cantidad FROM estadisticas WHERE cantidad <> 0")
+                         .replace('SCAN estadisticas', ''))
+
+
+class PaginacionCitasTests(BaseDatosTemporalMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.paciente_id = self.base.registrar_paciente('Ana', 'Pérez', 'ana@example.com', '999', 30, 'secreta')
+        hoy = datetime.now().date()
+        # 30 citas pasadas y 30 próximas, dos por día, una de ellas cancelada cada tres
+        # (se insertan directamente: reservar_cita no admite fechas pasadas ni horas fuera del horario)
+        with self.base.conexion() as conn:
+            for i in range(60):
+                fecha = hoy + timedelta(days=i // 2 - 15)
+                conn.execute(
+                    "INSERT INTO citas (id, paciente_id, doctor_id, fecha, hora, motivo, estado) "
+                    "VALUES (?, ?, ?, ?, ?, 'Control', ?)",
+                    (generador_ids.nuevo('CITA'), self.paciente_id, i % 2 + 1, fecha.isoformat(),
+                     '00:00' if i % 2 else '23:59', 'Cancelada' if i % 3 == 0 else 'Programada')
+                )
+        self.client.cookies.clear()
+        sesion = self.client.session
+        sesion.update({'is_authenticated': True, 'paciente_id': self.paciente_id})
+        sesion.save()
+
+    def recorrer(self, **parametros):
+        """Seguir los cursores hasta la última página y devolver todas las citas"""
+        citas, cursor = [], None
+        with mock.patch('authentication.views.db', self.base):
+            while True:
+                consulta = dict(parametros, **({'cursor': cursor} if cursor else {}))
+                datos = self.client.get('/api/medico/mis-citas/', consulta).json()
+                self.assertTrue(datos['success'], datos)
+                citas += datos['citas']
+                cursor = datos['siguiente_cursor']
+                if not datos['tiene_mas']:
+                    return citas
+
+    def test_las_paginas_recorren_todas_las_citas_en_orden_sin_repetir(self):
+        citas = self.recorrer(limite=7)
+        claves = [(c['fecha'], c['hora'], c['id']) for c in citas]
+        self.assertEqual(len(claves), 60)
+        self.assertEqual(claves, sorted(set(claves), reverse=True))
+
+    def test_filtros_por_periodo_y_estado(self):
+        ahora = datetime.now().strftime('%Y-%m-%d %H:%M')
+        proximas = self.recorrer(periodo='proximas', limite=4)
+        pasadas = self.recorrer(periodo='pasadas', estado='Cancelada', limite=4)
+        self.assertEqual(len(proximas) + len(self.recorrer(periodo='pasadas')), 60)
+        self.assertTrue(all(f"{c['fecha']} {c['hora']}" >= ahora for c in proximas))
+        self.assertEqual([c['fecha'] for c in proximas], sorted(c['fecha'] for c in proximas))
+        self.assertTrue(pasadas and all(c['estado'] == 'Cancelada' for c in pasadas))
+
+    def test_exportacion_en_streaming_y_parametros_invalidos(self):
+        with mock.patch('authentication.views.db', self.base):
+            respuesta = self.client.get('/api/medico/mis-citas/', {'formato': 'exportar'})
+            self.assertTrue(respuesta.streaming)
+            datos = json.loads(b''.join(respuesta.streaming_content))
+            self.assertEqual(len(datos['citas']), 60)
+            for parametros in ({'cursor': 'no-es-un-cursor'}, {'limite': 0}, {'periodo': 'ayer'}):
+                self.assertEqual(self.client.get('/api/medico/mis-citas/', parametros).status_code, 400)
+
+
+class RegistroAgentesTests(TestCase):
+    def setUp(self):
+        from agentes.agentes import RegistroAgentes, crear_agentes
+
+        self.construcciones = 0
+
+        def fabrica():
+            self.construcciones += 1
+            return crear_agentes(crear_llm('simulado'))
+
+        self.registro = RegistroAgentes(fabrica)
+
+    def test_plantillas_se_construyen_una_vez_y_cada_peticion_recibe_copias_propias(self):
+        primera = self.registro.agentes()
+        segunda = self.registro.agentes()
+        self.assertEqual(self.construcciones, 1)
+        plantillas = self.registro.precalentar()
+        for copia_a, copia_b, plantilla in zip(primera, segunda, plantillas):
+            self.assertIsNot(copia_a, copia_b)
+            self.assertIsNot(copia_a.tools, plantilla.tools)
+            self.assertEqual(copia_a.role, plantilla.role)
+            self.assertIsNot(copia_a.llm, plantilla.llm)
+            self.assertEqual(copia_a.llm.model, plantilla.llm.model)
+            for herramienta_a, herramienta_b in zip(copia_a.tools, copia_b.tools):
+                self.assertIsNot(herramienta_a, herramienta_b)
+        primera[1].tools.append(primera[1].tools[0])
+        self.assertEqual(len(segunda[1].tools), len(plantillas[1].tools))
+
+
+
+class PromptsTests(TestCase):
+    def setUp(self):
+        from agentes.agentes import crear_agentes
+
+        self.agentes = crear_agentes(crear_llm('simulado'))
+        self.contexto = {'doctor_id': 3, 'doctor_nombre': 'Miguel Martínez', 'urgencia': 'MEDIA',
+                         'fecha': '2026-10-19', 'hora': '09:00', 'fecha_deseada': '2026-10-20', 'hora_deseada': '10:00'}
+        uso_tokens.reiniciar()
+
+    def tarea(self, etapa, sintomas='dolor de pecho al subir escaleras', nombre='Ana'):
+        from agentes.agentes import crear_tareas
+        datos = {'nombre': nombre, 'edad': 40, 'sintomas': sintomas, 'telefono': None}
+        return crear_tareas(*self.agentes, datos, etapa, self.contexto)[0]
+
+    def test_prefijo_estatico_y_datos_al_final(self):
+        una = self.tarea('triaje').description
+        otra = self.tarea('triaje', sintomas='me pica la piel', nombre='Luis').description
+        prefijo = una.split('DATOS:')[0]
+        self.assertEqual(prefijo, otra.split('DATOS:')[0])
+        self.assertNotIn('pecho al subir', prefijo)
+        self.assertIn('sintomas: me pica la piel', otra)
+
+    def test_cada_etapa_cabe_en_su_presupuesto_y_solo_lleva_sus_herramientas(self):
+        for etapa in ('triaje', 'sugerir_cita', 'confirmar_cita', 'negociar_fecha'):
+            tarea = self.tarea(etapa)
+            verificacion = uso_tokens.verificar(etapa, [tarea])
+            self.assertFalse(verificacion['excedido'], (etapa, verificacion))
+        self.assertEqual([h.name for h in self.tarea('confirmar_cita').tools], ['crear_cita'])
+        with mock.patch.dict(os.environ, {'PRESUPUESTO_TOKENS_TRIAJE': '10'}):
+            self.assertTrue(uso_tokens.verificar('triaje', [self.tarea('triaje')])['excedido'])
+        self.assertEqual(uso_tokens.resumen()['triaje']['presupuesto_excedido'], 1)
+
+    def test_informe_de_uso_por_etapa(self):
+        from crewai.types.usage_metrics import UsageMetrics
+        uso = UsageMetrics(prompt_tokens=600, cached_prompt_tokens=150, completion_tokens=80,
+                           total_tokens=680, successful_requests=2)
+        uso_tokens.registrar('sugerir_cita', SimpleNamespace(token_usage=uso))
+        uso_tokens.registrar('sugerir_cita', SimpleNamespace(token_usage={'prompt_tokens': 400, 'completion_tokens': 40}))
+        resumen = uso_tokens.resumen()['sugerir_cita']
+        self.assertEqual((resumen['ejecuciones'], resumen['prompt_tokens'], resumen['completion_tokens']), (2, 1000, 120))
+        self.assertEqual((resumen['prompt_medio'], resumen['respuesta_media'], resumen['tasa_cache']), (500.0, 60.0, 0.15))
+
+class TriajeReglasTests(TestCase):
+    def test_acuerdo_con_el_corpus_etiquetado(self):
+        casos = cargar_corpus()
+        resultados = [(caso, clasificar_sintomas(caso['sintomas'], caso['edad'])) for caso in casos]
+        concluyentes = [(caso, r) for caso, r in resultados if r.concluyente]
+        # Lo que se resuelve sin LLM debe coincidir siempre con la referencia
+        for caso, r in concluyentes:
+            self.assertEqual((r.urgencia, r.especialidad), (caso['urgencia'], caso['especialidad']), caso['sintomas'])
+        # Toda señal de alarma del corpus se detecta localmente
+        alarmas = [caso for caso, r in resultados if caso['urgencia'] == 'ALTA']
+        self.assertEqual(len(alarmas), sum(1 for caso, r in concluyentes if caso['urgencia'] == 'ALTA'))
+        self.assertGreaterEqual(len(concluyentes) / len(casos), 0.3)
+
+    def test_negacion_acentos_y_derivacion_pediatrica(self):
+        self.assertFalse(clasificar_sintomas('No tengo dolor en el pecho ni dificultad para respirar').concluyente)
+        self.assertEqual(clasificar_sintomas('NO PUEDO RESPIRAR').urgencia, 'ALTA')
+        r = clasificar_sintomas('Sin fiebre, pero con opresión en el pecho', edad=40)
+        self.assertEqual((r.urgencia, r.especialidad, r.negados), ('ALTA', 'Cardiología', []))
+        self.assertEqual(clasificar_sintomas('Tuvo una convulsión', edad=7).especialidad, 'Neurología Pediátrica')
+        self.assertEqual(clasificar_sintomas('Me duele la rodilla', edad='12').especialidad, 'Pediatría')
+        # Dos especialidades de alarma distintas: ambiguo, lo decide el LLM
+        self.assertFalse(clasificar_sintomas('Dolor en el pecho y pensamientos suicidas').concluyente)
+
+    def test_triaje_local_devuelve_contexto_de_triaje(self):
+        respuesta, contexto, triaje = triaje_local({'nombre': 'Ana', 'edad': 60, 'sintomas': 'me falta el aire'})
+        self.assertEqual(contexto['urgencia'], 'ALTA')
+        self.assertEqual(contexto['especialidad'], 'Medicina de Emergencia')
+        self.assertEqual(contexto['doctor_id'], 27)
+        self.assertIn('nivel de urgencia es ALTA', respuesta)
+        self.assertIsNone(triaje_local({'nombre': 'Ana', 'edad': 30, 'sintomas': 'tengo tos'}))
+
+    def test_clasificacion_por_debajo_del_milisegundo(self):
+        casos = cargar_corpus()
+        inicio = time.perf_counter()
+        for caso in casos * 20:
+            clasificar_sintomas(caso['sintomas'], caso['edad'])
+        self.assertLess((time.perf_counter() - inicio) / (len(casos) * 20), 0.001)
+
+
+class IndiceEspecialidadesTests(BaseDatosTemporalMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.indice = self.base.directorio().indice_especialidades
+
+    def test_recupera_la_especialidad_del_corpus_entre_las_tres_primeras(self):
+        adultos = [caso for caso in cargar_corpus() if caso['edad'] >= 18]
+        aciertos = sum(
+            caso['especialidad'] in [c['especialidad'] for c in self.indice.buscar(caso['sintomas'], k=3)]
+            for caso in adultos
+        )
+        self.assertGreaterEqual(aciertos / len(adultos), 0.85)
+
+    def test_devuelve_doctores_disponibles_y_sigue_al_directorio(self):
+        primera = self.indice.buscar('me pica la piel y me salieron granos', k=1)[0]
+        self.assertEqual(primera['especialidad'], 'Dermatología')
+        self.assertEqual(primera['doctores'], [(25, 'Dra. Mónica Aguilar')])
+        with self.base.conexion() as conn:
+            conn.execute("UPDATE doctores SET disponible = 0 WHERE id = 25")
+        self.base.invalidar_directorio()
+        especialidades = [c['especialidad'] for c in self.base.directorio().indice_especialidades.buscar('acne')]
+        self.assertNotIn('Dermatología', especialidades)
+
+    def test_consulta_en_milisegundos(self):
+        inicio = time.perf_counter()
+        for _ in range(100):
+            self.indice.buscar('dolor de estómago con acidez después de comer')
+        self.assertLess((time.perf_counter() - inicio) / 100, 0.005)
+
+
+class CacheTriajeTests(BaseDatosTemporalMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.ruta_cache = os.path.join(self.directorio.name, 'cache.db')
+        self.caches = []
+        parche = mock.patch('agentes.cache_triaje.db', self.base)
+        parche.start()
+        self.addCleanup(parche.stop)
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.conexiones.cerrar_todas()
+        super().tearDown()
+
+    def cache(self, **opciones):
+        cache = CacheTriaje(self.ruta_cache, **opciones)
+        self.caches.append(cache)
+        return cache
+
+    def test_clave_normaliza_sintomas_y_agrupa_edades(self):
+        self.assertEqual(clave_triaje('Me pica la PIEL, y tengo granos!', 30), clave_triaje('granos piel pica', 35))
+        self.assertNotEqual(clave_triaje('granos piel pica', 30), clave_triaje('granos piel pica', 10))
+        self.assertNotEqual(clave_triaje('fiebre', 30), clave_triaje('no fiebre', 30))
+        self.assertIsNone(clave_triaje('tengo un', 30))
+
+    def test_acierto_compartido_entre_workers_revalida_el_doctor(self):
+        self.cache().guardar('me pica la piel', 30, {'urgencia': 'Baja', 'especialidad': 'Dermatología', 'doctor_id': 25})
+        # Sin especialidad reconocida no se guarda nada
+        self.cache().guardar('me duele algo', 30, {'urgencia': 'BAJA', 'especialidad': 'la piel', 'doctor_id': None})
+        otro_worker = self.cache()
+        respuesta, contexto = otro_worker.obtener('Piel: me pica', 33)
+        self.assertIn('nivel de urgencia es BAJA', respuesta)
+        self.assertEqual((contexto['doctor_id'], contexto['doctor_nombre']), (25, 'Mónica Aguilar'))
+        self.assertIsNotNone(otro_worker.obtener('me pica la piel', 30))
+        self.assertIsNone(otro_worker.obtener('me pica la piel', 70))
+        estadisticas = otro_worker.estadisticas()
+        self.assertEqual((estadisticas['aciertos_disco'], estadisticas['aciertos_memoria'], estadisticas['fallos']), (1, 1, 1))
+        self.assertEqual(estadisticas['escrituras'], 1)
+
+        with self.base.conexion() as conn:
+            conn.execute("UPDATE doctores SET disponible = 0 WHERE id = 25")
+        self.base.invalidar_directorio()
+        self.assertIsNone(otro_worker.obtener('me pica la piel', 30))
+
+    def test_las_consultas_no_escriben_en_sqlite(self):
+        worker = self.cache()
+        worker.guardar('me pica la piel', 30, {'urgencia': 'BAJA', 'especialidad': 'Dermatología', 'doctor_id': 25})
+        sentencias = []
+        conexion = worker.conexiones.obtener()
+        conexion.set_trace_callback(sentencias.append)
+        for _ in range(20):
+            worker.obtener('me pica la piel', 30)
+            worker.obtener('tos seca', 30)
+        self.assertTrue(sentencias)
+        self.assertFalse([s for s in sentencias if s.lstrip().upper().startswith(('UPDATE', 'INSERT'))])
+        # Los contadores pendientes se vuelcan al pedir las estadísticas
+        self.assertEqual((worker.estadisticas()['aciertos_memoria'], self.cache().estadisticas()['fallos']), (20, 20))
+        conexion.set_trace_callback(None)
+
+    def test_ttl_y_vaciado_desde_otro_proceso(self):
+        caducada = self.cache(ttl_segundos=0)
+        caducada.guardar('me pica la piel', 30, {'urgencia': 'BAJA', 'especialidad': 'Dermatología', 'doctor_id': 25})
+        self.assertIsNone(caducada.obtener('me pica la piel', 30))
+        self.assertEqual(caducada.purgar_expiradas(), 1)
+
+        worker = self.cache()
+        worker.guardar('me pica la piel', 30, {'urgencia': 'BAJA', 'especialidad': 'Dermatología', 'doctor_id': 25})
+        self.assertIsNotNone(worker.obtener('me pica la piel', 30))
+        salida = io.StringIO()
+        with mock.patch('authentication.management.commands.cache_triaje.cache_triaje', self.cache()):
+            call_command('cache_triaje', 'vaciar', stdout=salida)
+        # La memoria local del worker se descarta al ver la nueva generación
+        self.assertIsNone(worker.obtener('me pica la piel', 30))
+
+
+class LimiteLLMTests(TestCase):
+    def medir(self, limite, llamadas):
+        estado = {'activas': 0, 'maximo': 0}
+        lock = threading.Lock()
+
+        def llamada_lenta():
+            with lock:
+                estado['activas'] += 1
+                estado['maximo'] = max(estado['maximo'], estado['activas'])
+            time.sleep(0.1)
+            with lock:
+                estado['activas'] -= 1
+            return 'ok'
+
+        async def lanzar():
+            return await asyncio.gather(*(limite.ejecutar(llamada_lenta) for _ in range(llamadas)),
+                                        return_exceptions=True)
+        return asyncio.run(lanzar()), estado['maximo']
+
+    def test_rechaza_sin_encolar_cuando_no_hay_hueco(self):
+        limite = LimiteLLM(maximo=2, espera_maxima=0)
+        resultados, maximo = self.medir(limite, 5)
+        self.assertEqual(resultados.count('ok'), 2)
+        self.assertEqual(sum(isinstance(r, SobrecargaLLM) for r in resultados), 3)
+        self.assertEqual((maximo, limite.rechazadas, limite.en_curso), (2, 3, 0))
+
+    def test_espera_acotada_hasta_que_se_libera_un_hueco(self):
+        resultados, maximo = self.medir(LimiteLLM(maximo=2, espera_maxima=5), 6)
+        self.assertEqual(resultados, ['ok'] * 6)
+        self.assertEqual(maximo, 2)
+
+    def test_vista_responde_503_con_retry_after(self):
+        limite = LimiteLLM(maximo=1, espera_maxima=0, reintentar_en=7)
+        limite._semaforo.acquire()
+        with mock.patch('backend_asistente_medico.views.limite_llm', limite):
+            respuesta = self.client.post(reverse('generar_audio'), data=json.dumps({'texto': 'hola'}),
+                                         content_type='application/json')
+        self.assertEqual(respuesta.status_code, 503)
+        self.assertEqual(respuesta['Retry-After'], '7')
+        self.assertFalse(respuesta.json()['success'])
+
+    def test_cancelar_con_la_llamada_en_cola_libera_el_hueco(self):
+        limite = LimiteLLM(maximo=2, espera_maxima=0)
+        limite._executor = ThreadPoolExecutor(max_workers=1)
+        ocupado = threading.Event()
+        limite._executor.submit(ocupado.wait)
+
+        async def lanzar():
+            tarea = asyncio.ensure_future(limite.ejecutar(lambda: 'ok'))
+            await asyncio.sleep(0.05)
+            self.assertEqual(limite.en_curso, 1)
+            tarea.cancel()
+            await asyncio.gather(tarea, return_exceptions=True)
+
+        asyncio.run(lanzar())
+        ocupado.set()
+        limite._executor.shutdown(wait=True)
+        self.assertEqual(limite.en_curso, 0)
+        self.assertTrue(all(limite._semaforo.acquire(blocking=False) for _ in range(2)))
+
+    def test_sqlite_lento_no_bloquea_el_bucle_ni_ocupa_plazas_llm(self):
+        limite = LimiteLLM(maximo=1, espera_maxima=0)
+        limite._semaforo.acquire()
+
+        def reserva_lenta(*args):
+            time.sleep(0.3)
+            return 'Cita agendada', {}, 'finalizado'
+
+        async def lanzar():
+            latidos = 0
+
+            async def latir():
+                nonlocal latidos
+                while True:
+                    await asyncio.sleep(0.01)
+                    latidos += 1
+
+            latido = asyncio.ensure_future(latir())
+            cuerpo, codigo = await procesar_atencion({
+                'nombre': 'Ana', 'edad': 30, 'stage': 'negociar_fecha',
+                'contexto': {'doctor_id': 3, 'fecha_deseada': '2030-01-07'}})
+            latido.cancel()
+            return cuerpo, codigo, latidos
+
+        with mock.patch('backend_asistente_medico.views.limite_llm', limite), \
+                mock.patch('backend_asistente_medico.views.etapa_local', reserva_lenta):
+            cuerpo, codigo, latidos = asyncio.run(lanzar())
+        self.assertEqual((codigo, cuerpo['stage']), (200, 'finalizado'))
+        self.assertGreater(latidos, 10)
+
+
+class ColaTrabajosTests(TestCase):
+    def setUp(self):
+        self.directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directorio.cleanup)
+
+    def cola(self, **opciones):
+        cola = ColaTrabajos(os.path.join(self.directorio.name, 'trabajos.db'), intervalo=0.01, **opciones)
+        self.addCleanup(cola.conexiones.cerrar_todas)
+        self.addCleanup(cola.detener)
+        return cola
+
+    def esperar(self, cola, trabajo_id, segundos=5):
+        limite = time.monotonic() + segundos
+        while time.monotonic() < limite:
+            estado = cola.consultar(trabajo_id)
+            if estado['estado'] not in ('pendiente', 'en_curso'):
+                return estado
+            time.sleep(0.01)
+        self.fail(f'El trabajo {trabajo_id} no terminó')
+
+    def test_prioridad_por_urgencia_y_cancelacion(self):
+        cola = self.cola(hilos=1)
+        ids = {n: cola.encolar({'n': n}, prioridad) for n, prioridad in [('baja', 0), ('alta', 2), ('media', 1), ('otra', 0)]}
+        self.assertEqual(cola.consultar(ids['otra'])['posicion'], 4)
+        self.assertTrue(cola.cancelar(ids['otra']))
+        orden = []
+
+        def procesar(datos):
+            orden.append(datos['n'])
+            return {'success': True, 'n': datos['n']}, 200
+
+        cola.iniciar(procesar)
+        estado = self.esperar(cola, ids['baja'])
+        self.assertEqual(orden, ['alta', 'media', 'baja'])
+        self.assertEqual((estado['estado'], estado['resultado'], estado['codigo_http']),
+                         ('completado', {'success': True, 'n': 'baja'}, 200))
+        self.assertEqual(cola.consultar(ids['otra'])['estado'], 'cancelado')
+        self.assertFalse(cola.cancelar(ids['baja']))
+
+    def test_errores_de_sqlite_no_terminan_los_hilos(self):
+        cola = self.cola(hilos=2)
+        reclamar = cola._reclamar
+        fallos = iter([sqlite3.OperationalError('database is locked')] * 4)
+
+        def reclamar_con_fallos():
+            error = next(fallos, None)
+            if error:
+                raise error
+            return reclamar()
+
+        with mock.patch.object(cola, '_reclamar', reclamar_con_fallos), \
+                self.assertLogs('backend_asistente_medico.cola_trabajos', 'ERROR'):
+            cola.iniciar(lambda datos: ({'success': True}, 200))
+            trabajo_id = cola.encolar({'n': 1})
+            self.assertEqual(self.esperar(cola, trabajo_id)['estado'], 'completado')
+        cola.iniciar(lambda datos: ({'success': True}, 200))
+        self.assertEqual([w.is_alive() for w in cola._workers], [True, True])
+        # Si un hilo termina, iniciar solo repone ese
+        cola._workers[0] = threading.Thread(target=lambda: None)
+        cola._workers[0].start()
+        cola._workers[0].join()
+        superviviente = cola._workers[1]
+        cola.iniciar(lambda datos: ({'success': True}, 200))
+        self.assertIs(cola._workers[1], superviviente)
+        self.assertTrue(all(w.is_alive() for w in cola._workers))
+
+    def test_cola_llena_responde_503(self):
+        cola = self.cola(max_pendientes=1)
+        cola.encolar({'n': 1})
+        with self.assertRaises(ColaLlena):
+            cola.encolar({'n': 2})
+        datos = {'nombre': 'Ana', 'edad': 30, 'sintomas': 'tengo tos', 'asincrono': True}
+        with mock.patch('backend_asistente_medico.views.cola_trabajos', cola):
+            respuesta = self.client.post(reverse('atender_paciente'), data=json.dumps(datos), content_type='application/json')
+        self.assertEqual(respuesta.status_code, 503)
+        self.assertEqual(respuesta['Retry-After'], '10')
+
+    def test_atender_en_segundo_plano_con_sondeo_y_sse(self):
+        cola = self.cola(hilos=2)
+        resultado = {'success': True, 'stage': 'sugerir_cita', 'contexto': {}}
+        datos = {'nombre': 'Ana', 'edad': 30, 'sintomas': 'tengo tos y mocos', 'asincrono': True}
+        with mock.patch('backend_asistente_medico.views.cola_trabajos', cola), \
+                mock.patch('backend_asistente_medico.views.procesar_trabajo', return_value=(resultado, 200)) as procesar:
+            respuesta = self.client.post(reverse('atender_paciente'), data=json.dumps(datos), content_type='application/json')
+            self.assertEqual(respuesta.status_code, 202)
+            trabajo_id = respuesta.json()['trabajo_id']
+            self.esperar(cola, trabajo_id)
+            sondeo = self.client.get(respuesta.json()['url_estado']).json()
+
+            async def leer_eventos():
+                return [evento async for evento in flujo_eventos_trabajo(trabajo_id, intervalo=0.01)]
+            eventos = asyncio.run(leer_eventos())
+            cancelacion = self.client.delete(respuesta.json()['url_estado'])
+
+        self.assertFalse(procesar.call_args.args[0]['asincrono'])
+        self.assertEqual((sondeo['estado'], sondeo['resultado']), ('completado', resultado))
+        self.assertEqual(len(eventos), 1)
+        self.assertTrue(eventos[0].startswith('event: resultado\ndata: '))
+        self.assertEqual(json.loads(eventos[0].split('data: ', 1)[1])['resultado'], resultado)
+        self.assertEqual(cancelacion.status_code, 409)
+
+
+class FlujoRespuestaTests(TestCase):
+    def eventos(self, datos):
+        async def leer():
+            respuesta = await AsyncClient().post(reverse('atender_paciente_flujo'), data=json.dumps(datos),
+                                                 content_type='application/json')
+            self.assertEqual(respuesta['Content-Type'], 'text/event-stream')
+            return [fragmento.decode() async for fragmento in respuesta.streaming_content]
+        eventos = []
+        for evento in asyncio.run(leer()):
+            nombre, datos_evento = evento.strip().split('\n', 1)
+            eventos.append((nombre[len('event: '):], json.loads(datos_evento[len('data: '):])))
+        return eventos
+
+    def test_retransmite_solo_la_respuesta_final_de_la_ultima_tarea(self):
+        async def procesar_atencion(data, flujo=None, **opciones):
+            def kickoff():
+                flujo.preparar(2)
+                for token in ['Thought: es leve\nFinal', ' Answer: Tarea uno']:
+                    flujo.on_llm_new_token(token, run_id='tarea-1')
+                flujo.tarea_completada(None)
+                for token in ['Thought: busco doctor\nFin', 'al Answer:', ' Tu cita', ' es', ' el lunes']:
+                    flujo.on_llm_new_token(token, run_id='tarea-2')
+            await asyncio.get_running_loop().run_in_executor(None, kickoff)
+            return {'success': True, 'stage': 'confirmar_cita', 'contexto': {'fecha': '2026-10-19'}}, 200
+
+        with mock.patch('backend_asistente_medico.views.procesar_atencion', procesar_atencion):
+            eventos = self.eventos({'nombre': 'Ana', 'edad': 30, 'stage': 'sugerir_cita', 'respuesta_usuario': 'si'})
+        self.assertEqual(eventos[0], ('inicio', {'stage': 'sugerir_cita'}))
+        self.assertEqual(''.join(datos['texto'] for nombre, datos in eventos if nombre == 'token'), 'Tu cita es el lunes')
+        self.assertEqual(eventos[-1], ('contexto', {'success': True, 'stage': 'confirmar_cita',
+                                                   'contexto': {'fecha': '2026-10-19'}, 'codigo_http': 200}))
+
+    def test_llm_simulado_emite_fragmentos_como_los_nativos(self):
+        from agentes.agentes import RegistroAgentes, crear_agentes
+        llm = crear_llm('simulado')
+        with mock.patch('backend_asistente_medico.views.llm', llm), \
+                mock.patch('backend_asistente_medico.views.registro_agentes', RegistroAgentes(lambda: crear_agentes(llm))), \
+                mock.patch('backend_asistente_medico.views.triaje_sin_llm', lambda datos: None):
+            eventos = self.eventos({'nombre': 'Ana', 'edad': 30, 'sintomas': 'dolor de pecho'})
+        tokens = [datos['texto'] for nombre, datos in eventos if nombre == 'token']
+        self.assertGreater(len(tokens), 5)
+        self.assertEqual(''.join(tokens), eventos[-1][1]['resultado']['respuesta_completa'])
+
+    def test_tras_cancelar_no_se_publican_tokens(self):
+        async def comprobar():
+            flujo = FlujoRespuestaFinal(crear_llm('simulado'))
+            flujo.on_llm_new_token('Final Answer: Hola', run_id='tarea')
+            flujo.cancelar()
+            flujo.on_llm_new_token(' de nuevo', run_id='tarea')
+            await asyncio.sleep(0)
+            return [flujo.cola.get_nowait() for _ in range(flujo.cola.qsize())], flujo.emitidos
+        self.assertEqual(asyncio.run(comprobar()), (['Hola'], 1))
+
+    def test_triaje_local_se_envia_completo_sin_llm(self):
+        eventos = self.eventos({'nombre': 'Ana', 'edad': 60, 'sintomas': 'me falta el aire'})
+        self.assertEqual([nombre for nombre, _ in eventos], ['inicio', 'token', 'contexto'])
+        self.assertIn('nivel de urgencia es ALTA', eventos[1][1]['texto'])
+        self.assertEqual(eventos[2][1]['contexto']['especialidad'], 'Medicina de Emergencia')
+
+    def test_respuesta_json_retransmite_solo_el_campo_respuesta(self):
+        generado = 'Thought: listo\nFinal Answer: {"respuesta": "Cita con \\"Ana\\" el lunes\\u00e9", "fecha": "2026-10-19"}'
+        vistos = [respuesta_visible(generado[:i]) for i in range(1, len(generado) + 1)]
+        textos = [texto for texto in vistos if texto is not None]
+        for anterior, siguiente in zip(textos, textos[1:]):
+            self.assertTrue(siguiente.startswith(anterior))
+        self.assertEqual(textos[-1], 'Cita con "Ana" el lunesé')
+
+
+class SalidasEstructuradasTests(TestCase):
+    def setUp(self):
+        metricas_salidas.reiniciar()
+
+    def crew(self, tarea):
+        return SimpleNamespace(raw=tarea.raw, tasks_output=[tarea])
+
+    def test_contexto_desde_salida_pydantic(self):
+        salida = SalidaTriaje(respuesta='Te atiende la Dra. López', urgencia='media',
+                              especialidad='Cardiología', doctor_id=3, doctor_nombre='Dra. López')
+        contexto = extraer_contexto(self.crew(SimpleNamespace(raw='', pydantic=salida)), 'triaje')
+        self.assertEqual(contexto['urgencia'], 'MEDIA')
+        self.assertEqual((contexto['doctor_id'], contexto['doctor_nombre']), (3, 'López'))
+        self.assertEqual(metricas_salidas.resumen()['triaje']['estructurada'], 1)
+
+    def test_doctor_inexistente_o_de_otra_especialidad(self):
+        for doctor_id in (9999, 1):
+            salida = SalidaTriaje(respuesta='Te atiende el Dr. Nadie', urgencia='ALTA',
+                                  especialidad='Cardiología', doctor_id=doctor_id, doctor_nombre='Nadie')
+            contexto = extraer_contexto(self.crew(SimpleNamespace(raw='', pydantic=salida)), 'triaje')
+            self.assertEqual((contexto['especialidad'], contexto['doctor_id'], contexto['doctor_nombre']),
+                             ('Cardiología', None, None))
+        self.assertEqual(metricas_salidas.resumen()['triaje']['fallida'], 2)
+
+    def test_json_crudo_se_valida_contra_el_esquema(self):
+        crudo = '```json\n{"respuesta": "Te propongo el lunes", "fecha": "2026-10-19", "hora": "9:30"}\n```'
+        contexto = extraer_contexto(self.crew(SimpleNamespace(raw=crudo, pydantic=None)), 'sugerir_cita')
+        self.assertEqual((contexto['fecha'], contexto['hora']), ('2026-10-19', '09:30'))
+        with self.assertRaises(ValueError):
+            SalidaCita(respuesta='x', hora='25:00')
+
+    def test_texto_libre_recurre_a_expresiones_regulares(self):
+        contexto = extraer_contexto(self.crew(SimpleNamespace(
+            raw='Te propongo el 2026-10-19 a las 10:00', pydantic=None)), 'sugerir_cita')
+        extraer_contexto(self.crew(SimpleNamespace(raw='No hay horarios', pydantic=None)), 'negociar_fecha')
+        self.assertEqual((contexto['fecha'], contexto['hora']), ('2026-10-19', '10:00'))
+        resumen = metricas_salidas.resumen()
+        self.assertEqual(resumen['sugerir_cita']['texto'], 1)
+        self.assertEqual(resumen['negociar_fecha']['fallida'], 1)
+        self.assertEqual(resumen['sugerir_cita']['tasa_estructurada'], 0.0)
+
+    def test_serializar_usa_el_campo_respuesta(self):
+        tarea = SimpleNamespace(raw='{"respuesta": "Cita confirmada"}', pydantic=None,
+                                output='{"respuesta": "Cita confirmada"}', description='confirmar')
+        serializado = serializar_resultado_crew(self.crew(tarea))
+        self.assertEqual(serializado['respuesta_completa'], 'Cita confirmada')
+        self.assertEqual(serializado['tareas'][0]['output_completo'], 'Cita confirmada')
+
+
+class EtapasLocalesTests(BaseDatosTemporalMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.paciente_id = self.base.registrar_paciente('Ana', 'Ruiz', 'ana@correo.com', None, 30, 'clave')
+        self.motor = MotorDisponibilidad(self.base)
+        for objetivo, valor in [('agentes.etapas_locales.db', self.base),
+                                ('agentes.etapas_locales.motor_disponibilidad', self.motor),
+                                ('backend_asistente_medico.views.registro_agentes', None)]:
+            parche = mock.patch(objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def atender(self, **datos):
+        return asyncio.run(procesar_atencion({'nombre': 'Ana', 'edad': 30, 'sintomas': 'dolor de pecho', **datos}))
+
+    def contexto(self, **extra):
+        return {'doctor_id': 3, 'doctor_nombre': 'Miguel Martínez', 'especialidad': 'Cardiología',
+                'urgencia': 'MEDIA', **extra}
+
+    def test_confirmar_reserva_sin_agentes(self):
+        cuerpo, codigo = self.atender(stage='confirmar_cita', respuesta_usuario='sí', paciente_id=self.paciente_id,
+                                      contexto=self.contexto(fecha=self.lunes, hora='09:00'))
+        self.assertEqual((codigo, cuerpo['stage']), (200, 'finalizado'))
+        self.assertEqual(cuerpo['resultado']['origen'], 'local')
+        self.assertIn('agendada exitosamente', cuerpo['resultado']['respuesta_completa'])
+        cita = self.base.conexion().execute("SELECT doctor_id, fecha, hora, urgencia FROM citas").fetchone()
+        self.assertEqual(cita, (3, self.lunes, '09:00', 'MEDIA'))
+        self.assertEqual(cuerpo['contexto']['cita_id'][:4], 'CITA')
+
+    def test_franja_ocupada_propone_el_siguiente_hueco(self):
+        self.base.reservar_cita(self.paciente_id, 3, self.lunes, '08:00', 'Control')
+        cuerpo, _ = self.atender(stage='confirmar_cita', respuesta_usuario='ok', paciente_id=self.paciente_id,
+                                 contexto=self.contexto(fecha=self.lunes, hora='08:00'))
+        self.assertEqual(cuerpo['stage'], 'confirmar_cita')
+        self.assertEqual((cuerpo['contexto']['fecha'], cuerpo['contexto']['hora']), (self.lunes, '08:30'))
+        self.assertIn('acaba de ocuparse', cuerpo['resultado']['respuesta_completa'])
+
+    def test_negociar_fecha_comprueba_la_franja_pedida(self):
+        self.base.reservar_cita(self.paciente_id, 3, self.lunes, '10:00', 'Control')
+        libre, _ = self.atender(stage='negociar_fecha', contexto=self.contexto(
+            fecha_deseada=self.lunes, hora_deseada='11:00'))
+        ocupada, _ = self.atender(stage='negociar_fecha', contexto=self.contexto(
+            fecha_deseada=self.lunes, hora_deseada='10:00'))
+        self.assertIn('está disponible', libre['resultado']['respuesta_completa'])
+        self.assertEqual(libre['contexto']['hora'], '11:00')
+        self.assertIn('no está disponible', ocupada['resultado']['respuesta_completa'])
+        self.assertEqual(ocupada['contexto']['hora'], '10:30')
+
+    def test_solo_reserva_para_el_paciente_de_la_sesion(self):
+        datos = {'nombre': 'Ana', 'edad': 30, 'stage': 'confirmar_cita', 'respuesta_usuario': 'sí',
+                 'paciente_id': self.paciente_id,
+                 'contexto': self.contexto(fecha=self.lunes, hora='09:00', paciente_id=self.paciente_id)}
+        # Sin sesión, el paciente_id del cuerpo y del contexto se ignoran
+        respuesta = self.client.post(reverse('atender_paciente'), data=json.dumps(datos), content_type='application/json')
+        self.assertEqual(respuesta.json()['stage'], 'confirmar_cita')
+        self.assertIn('Inicia sesión', respuesta.json()['resultado']['respuesta_completa'])
+        self.assertEqual(self.base.conexion().execute("SELECT COUNT(*) FROM citas").fetchone()[0], 0)
+
+        otro_id = self.base.registrar_paciente('Luis', 'Gil', 'luis@correo.com', None, 40, 'clave')
+        sesion = self.client.session
+        sesion['paciente_id'] = otro_id
+        sesion.save()
+        respuesta = self.client.post(reverse('atender_paciente'), data=json.dumps(datos), content_type='application/json')
+        self.assertEqual(respuesta.json()['stage'], 'finalizado')
+        self.assertEqual(self.base.conexion().execute("SELECT paciente_id FROM citas").fetchone(), (otro_id,))
+
+    def test_sugerir_cita_y_paciente_inexistente(self):
+        cuerpo, _ = self.atender(stage='sugerir_cita', respuesta_usuario='si', contexto=self.contexto())
+        self.assertEqual(cuerpo['stage'], 'confirmar_cita')
+        self.assertIn('La cita más próxima disponible con Dr. Miguel Martínez', cuerpo['resultado']['respuesta_completa'])
+        sin_paciente, _ = self.atender(stage='confirmar_cita', respuesta_usuario='si',
+                                       contexto=self.contexto(fecha=self.lunes, hora='09:00'))
+        self.assertEqual(sin_paciente['stage'], 'confirmar_cita')
+        self.assertIn('Inicia sesión', sin_paciente['resultado']['respuesta_completa'])
+
+
+class ConversacionesTests(BaseDatosTemporalMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.paciente_id = self.base.registrar_paciente('Ana', 'Ruiz', 'ana@correo.com', None, 30, 'clave')
+        self.almacen = AlmacenConversaciones(os.path.join(self.directorio.name, 'conversaciones.db'))
+        for objetivo, valor in [('agentes.etapas_locales.db', self.base),
+                                ('agentes.etapas_locales.motor_disponibilidad', MotorDisponibilidad(self.base)),
+                                ('backend_asistente_medico.views.registro_agentes', None),
+                                ('backend_asistente_medico.views.cache_triaje', CacheTriaje(None)),
+                                ('backend_asistente_medico.views.conversaciones', self.almacen)]:
+            parche = mock.patch(objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def atender(self, **datos):
+        return asyncio.run(procesar_atencion(datos))
+
+    def test_flujo_completo_solo_con_el_id(self):
+        triaje, codigo = self.atender(nombre='Ana', edad=30, sintomas='dolor de pecho', paciente_id=self.paciente_id)
+        self.assertEqual((codigo, triaje['stage']), (200, 'sugerir_cita'))
+        conversacion_id = triaje['conversacion_id']
+        sugerencia, _ = self.atender(conversacion_id=conversacion_id, respuesta_usuario='sí')
+        self.assertEqual((sugerencia['stage'], sugerencia['conversacion_id']), ('confirmar_cita', conversacion_id))
+        confirmacion, _ = self.atender(conversacion_id=conversacion_id, stage='confirmar_cita', respuesta_usuario='sí')
+        self.assertEqual(confirmacion['stage'], 'finalizado')
+        cita = self.base.conexion().execute("SELECT paciente_id, fecha, hora FROM citas").fetchone()
+        self.assertEqual(cita, (self.paciente_id, sugerencia['contexto']['fecha'], sugerencia['contexto']['hora']))
+        guardada = self.almacen.obtener(conversacion_id)
+        self.assertEqual((guardada['etapa'], guardada['sintomas']), ('finalizado', 'dolor de pecho'))
+        self.assertEqual(guardada['paciente'], {'nombre': 'Ana', 'edad': 30, 'paciente_id': self.paciente_id})
+
+        # Una etapa que no es la guardada se rechaza sin ejecutar nada
+        repetida, codigo = self.atender(conversacion_id=conversacion_id, stage='confirmar_cita', respuesta_usuario='sí')
+        self.assertEqual((codigo, repetida['stage']), (409, 'triaje'))
+        self.assertEqual(self.base.conexion().execute("SELECT COUNT(*) FROM citas").fetchone()[0], 1)
+        desconocida, codigo = self.atender(conversacion_id='CNVinexistente', respuesta_usuario='sí')
+        self.assertEqual((codigo, desconocida['success']), (404, False))
+
+    def test_el_paciente_sale_de_la_sesion(self):
+        datos = {'nombre': 'Ana', 'edad': 30, 'sintomas': 'dolor de pecho', 'paciente_id': self.paciente_id,
+                 'contexto': {'paciente_id': self.paciente_id}}
+        anonima = self.client.post(reverse('atender_paciente'), data=json.dumps(datos), content_type='application/json').json()
+        self.assertNotIn('paciente_id', self.almacen.obtener(anonima['conversacion_id'])['paciente'])
+
+        sesion = self.client.session
+        sesion['paciente_id'] = self.paciente_id
+        sesion.save()
+        propia = self.client.post(reverse('atender_paciente'), data=json.dumps(datos), content_type='application/json').json()
+        conversacion_id = propia['conversacion_id']
+        self.assertEqual(self.almacen.obtener(conversacion_id)['paciente']['paciente_id'], self.paciente_id)
+        # Con la sesión de otro paciente la conversación no se puede continuar
+        otro_id = self.base.registrar_paciente('Luis', 'Gil', 'luis@correo.com', None, 40, 'clave')
+        sesion['paciente_id'] = otro_id
+        sesion.save()
+        ajena = self.client.post(reverse('atender_paciente'), content_type='application/json', data=json.dumps(
+            {'conversacion_id': conversacion_id, 'respuesta_usuario': 'sí', 'paciente_id': otro_id}))
+        self.assertEqual(ajena.status_code, 404)
+
+    def test_transiciones_y_version(self):
+        conversacion_id = self.almacen.crear({'nombre': 'Ana', 'edad': 30}, 'sugerir_cita', {'urgencia': 'ALTA', 'hora': None})
+        conversacion = self.almacen.obtener(conversacion_id)
+        self.assertEqual(conversacion['contexto'], {'urgencia': 'ALTA'})
+        with self.assertRaises(TransicionInvalida):
+            self.almacen.avanzar(conversacion, 'triaje')
+        self.almacen.avanzar(conversacion, 'finalizado')
+        # Otra petición con la misma versión llega tarde
+        with self.assertRaises(ConflictoConversacion):
+            self.almacen.avanzar(conversacion, 'confirmar_cita')
+        self.assertEqual(self.almacen.estadisticas()['conflictos'], 1)
+
+    def test_otro_worker_avanza_la_conversacion(self):
+        ruta = os.path.join(self.directorio.name, 'compartida.db')
+        worker_a, worker_b = AlmacenConversaciones(ruta), AlmacenConversaciones(ruta)
+        conversacion_id = worker_a.crear({'nombre': 'Ana', 'edad': 30}, 'sugerir_cita', {'urgencia': 'ALTA'})
+        self.assertEqual(worker_a.obtener(conversacion_id)['etapa'], 'sugerir_cita')
+        worker_b.avanzar(worker_b.obtener(conversacion_id), 'confirmar_cita', {'urgencia': 'ALTA', 'fecha': '2030-01-07'})
+        conversacion = worker_a.obtener(conversacion_id)
+        self.assertEqual((conversacion['etapa'], conversacion['version']), ('confirmar_cita', 2))
+        self.assertEqual(conversacion['contexto']['fecha'], '2030-01-07')
+        worker_a.avanzar(conversacion, 'finalizado')
+        self.assertEqual(worker_b.obtener(conversacion_id)['etapa'], 'finalizado')
+
+    def test_desalojo_de_memoria_y_caducidad(self):
+        ruta = os.path.join(self.directorio.name, 'pequeno.db')
+        almacen = AlmacenConversaciones(ruta, ttl_segundos=60, max_memoria=1)
+        primera = almacen.crear({'nombre': 'Ana', 'edad': 30}, 'sugerir_cita', sintomas='tos')
+        almacen.crear({'nombre': 'Luis', 'edad': 40}, 'sugerir_cita', sintomas='fiebre')
+        self.assertEqual(almacen.estadisticas()['en_memoria'], 1)
+        # Desalojada de memoria pero guardada en SQLite (también la ve otro proceso)
+        self.assertEqual(almacen.obtener(primera)['sintomas'], 'tos')
+        self.assertEqual(AlmacenConversaciones(ruta).obtener(primera)['paciente']['nombre'], 'Ana')
+        with mock.patch('backend_asistente_medico.conversaciones.time.time', return_value=time.time() + 61):
+            with self.assertRaises(ConversacionNoEncontrada):
+                almacen.obtener(primera)
+            self.assertEqual(almacen.purgar(), 2)
+
+
+class MetricasTests(TestCase):
+    def test_histograma_en_formato_prometheus(self):
+        histograma = Histograma('prueba_segundos', 'Prueba', ('etapa',), buckets=(0.1, 1))
+        for valor in (0.05, 0.5, 3):
+            histograma.observar(valor, etapa='triaje')
+        lineas = histograma.exponer()
+        self.assertIn('prueba_segundos_bucket{etapa="triaje",le="0.1"} 1', lineas)
+        self.assertIn('prueba_segundos_bucket{etapa="triaje",le="1"} 2', lineas)
+        self.assertIn('prueba_segundos_bucket{etapa="triaje",le="+Inf"} 3', lineas)
+        self.assertIn('prueba_segundos_sum{etapa="triaje"} 3.550000', lineas)
+        self.assertIn('prueba_segundos_count{etapa="triaje"} 3', lineas)
+
+    def test_la_etapa_y_el_desglose_viajan_al_hilo_del_limite_llm(self):
+        limite = LimiteLLM(maximo=1)
+
+        async def peticion():
+            etapa_actual.set('negociar_fecha')
+            with metricas.desglose() as desglose:
+                await limite.ejecutar(metricas.medir('crew')(time.sleep), 0.01)
+            return desglose
+
+        desglose = asyncio.run(peticion())
+        self.assertEqual(desglose['crew'][1], 1)
+        self.assertGreaterEqual(desglose['crew'][0], 0.01)
+        self.assertIn(('negociar_fecha',), metricas.histogramas['crew'].series())
+
+    def test_herramientas_medidas_conservan_su_esquema(self):
+        from agentes.herramientas import BuscarProximosHuecosTool
+        herramienta = BuscarProximosHuecosTool()
+        self.assertIn('doctor_id', herramienta.args_schema.model_fields)
+        herramienta.run(doctor_id=3, cantidad=1)
+        self.assertIn('buscar_proximos_huecos', {herramienta for herramienta, _ in metricas.histogramas['herramienta'].series()})
+
+    def test_server_timing_y_endpoint_metrics(self):
+        respuesta = self.client.post(reverse('atender_paciente'), data=json.dumps(
+            {'nombre': 'Ana', 'edad': 60, 'sintomas': 'me falta el aire'}), content_type='application/json')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertIn('sqlite;desc=', respuesta['Server-Timing'])
+
+        texto = self.client.get(reverse('metricas')).content.decode()
+        self.assertIn('asistente_peticion_segundos_count{vista="atender_paciente",etapa="triaje"}', texto)
+        self.assertIn('# TYPE asistente_sqlite_segundos histogram', texto)
+        self.assertIn('asistente_cola_trabajos{estado="pendiente"}', texto)
+        with self.settings(METRICAS_TOKEN='secreto'):
+            self.assertEqual(self.client.get(reverse('metricas')).status_code, 401)
+            for cabecera in ['Bearer secretO', 'Bearer señal']:
+                self.assertEqual(self.client.get(reverse('metricas'), HTTP_AUTHORIZATION=cabecera).status_code, 401)
+            autorizada = self.client.get(reverse('metricas'), HTTP_AUTHORIZATION='Bearer secreto')
+            self.assertEqual(autorizada.status_code, 200)
+
+
+class BackendsSimuladosTests(TestCase):
+    def setUp(self):
+        from agentes.agentes import RegistroAgentes, crear_agentes
+        self.llm = crear_llm('simulado')
+        # Sin atajos locales: la etapa la resuelve la crew completa con el LLM simulado
+        for objetivo, valor in [('backend_asistente_medico.views.registro_agentes',
+                                 RegistroAgentes(lambda: crear_agentes(self.llm))),
+                                ('backend_asistente_medico.views.triaje_sin_llm', lambda datos: None),
+                                ('backend_asistente_medico.views.etapa_sin_llm', lambda *args: None)]:
+            parche = mock.patch(objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+        uso_tokens.reiniciar()
+
+    def atender(self, **datos):
+        return asyncio.run(procesar_atencion({'nombre': 'Ana', 'edad': 30, 'sintomas': 'dolor de pecho', **datos}))
+
+    def test_crew_completa_con_llamada_a_herramienta(self):
+        cuerpo, codigo = self.atender(stage='sugerir_cita', respuesta_usuario='sí', contexto={
+            'doctor_id': 3, 'doctor_nombre': 'Miguel Martínez', 'urgencia': 'MEDIA'})
+        self.assertEqual((codigo, cuerpo['stage']), (200, 'confirmar_cita'))
+        self.assertEqual(cuerpo['contexto']['doctor_id'], 3)
+        self.assertRegex(cuerpo['contexto']['hora'], r'^\d{2}:\d{2}$')
+        self.assertIn('La cita más próxima disponible', cuerpo['resultado']['respuesta_completa'])
+        # Una llamada con la acción y otra con la respuesta final tras la observación
+        self.assertEqual(self.llm.guion.llamadas, 2)
+        # Contadores propios de la petición: dos llamadas de un solo agente
+        self.assertEqual(uso_tokens.resumen()['sugerir_cita']['successful_requests'], 2)
+        self.assertGreater(uso_tokens.resumen()['sugerir_cita']['completion_tokens'], 0)
+
+    def test_triaje_y_reglas_del_archivo_de_guion(self):
+        cuerpo, _ = self.atender(stage='triaje')
+        self.assertEqual(cuerpo['stage'], 'sugerir_cita')
+        self.assertTrue(cuerpo['contexto']['doctor_id'])
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False, encoding='utf-8') as archivo:
+            archivo.write(json.dumps({'contiene': 'sintomas: me pica la piel',
+                                      'respuesta': 'Final Answer: Respuesta del guion'}) + '\n')
+        self.addCleanup(os.unlink, archivo.name)
+        guion = GuionLLM(archivo.name)
+        self.assertEqual(guion.responder([{'role': 'user', 'content': 'DATOS:\nsintomas: me pica la piel'}]),
+                         'Final Answer: Respuesta del guion')
+
+    def test_audio_simulado(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        cliente = ClienteAudioSimulado(texto='Me duele la cabeza')
+        with mock.patch('backend_asistente_medico.views.client', cliente):
+            texto = self.client.post(reverse('transcribir_audio'), {'audio': SimpleUploadedFile(
+                'consulta.wav', 'Tengo tos seca'.encode(), content_type='audio/wav')}).json()
+            binario = self.client.post(reverse('transcribir_audio'), {'audio': SimpleUploadedFile(
+                'consulta.wav', bytes([0xff, 0xfe, 0x00]), content_type='audio/wav')}).json()
+            audio = self.client.post(reverse('generar_audio'), data=json.dumps({'texto': 'Hola'}),
+                                     content_type='application/json')
+        self.assertEqual((texto['transcription'], binario['transcription']), ('Tengo tos seca', 'Me duele la cabeza'))
+        self.assertEqual(audio['Content-Type'], 'audio/mpeg')
+        self.assertTrue(audio.content.startswith(bytes.fromhex('fffb')))
+
+
+class PruebaCargaTests(LiveServerTestCase):
+    def setUp(self):
+        from agentes.agentes import RegistroAgentes, crear_agentes
+        from agentes.bd import db
+        self.directorio = tempfile.TemporaryDirectory()
+        self.base = BaseDatosMedica(os.path.join(self.directorio.name, 'carga.db'))
+        # El servidor de pruebas usa la instancia global db: se apunta a la base temporal
+        for parche in [mock.patch.dict(db.__dict__, self.base.__dict__),
+                       mock.patch('backend_asistente_medico.views.registro_agentes',
+                                  RegistroAgentes(lambda: crear_agentes(crear_llm('simulado')))),
+                       mock.patch('backend_asistente_medico.views.cache_triaje', CacheTriaje(None)),
+                       mock.patch('backend_asistente_medico.views.conversaciones', AlmacenConversaciones(None))]:
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def tearDown(self):
+        self.base.conexiones.cerrar_todas()
+        self.directorio.cleanup()
+
+    def test_sesiones_completas_sin_dobles_reservas(self):
+        salida = io.StringIO()
+        informe = os.path.join(self.directorio.name, 'informe.json')
+        call_command('prueba_carga', url=self.live_server_url, sesiones=6, concurrencia=3, semilla=7, negociar=0.5,
+                     base=self.base.db_path, max_tasa_error=0, salida=informe, stdout=salida)
+        with open(informe, encoding='utf-8') as archivo:
+            resultado = json.load(archivo)
+        self.assertEqual((resultado['sesiones_completas'], resultado['citas']), (6, 6))
+        self.assertEqual((resultado['dobles_reservas'], resultado['dobles_reservas_base']), (0, 0))
+        self.assertEqual(resultado['etapas']['mis_citas']['peticiones'], 6)
+        self.assertGreater(resultado['etapas']['triaje']['p95_ms'], 0)
+        self.assertIn('Sin dobles reservas', salida.getvalue())
+        filas = self.base.conexion().execute("SELECT COUNT(*) FROM citas").fetchone()[0]
+        self.assertEqual(filas, 6)
+
+    def test_arrancar_migra_una_base_de_django_temporal(self):
+        from django.conf import settings
+        from authentication.management.commands.prueba_carga import servidor_local
+        propia = settings.BASE_DIR / 'db.sqlite3'
+        antes = propia.stat().st_mtime_ns if propia.exists() else None
+        with servidor_local(workers=1, latencia_llm=0) as (_, ruta):
+            temporal = sqlite3.connect(os.path.join(os.path.dirname(ruta), 'db.sqlite3'))
+            tablas = {fila[0] for fila in temporal.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            temporal.close()
+        self.assertIn('django_session', tablas)
+        self.assertEqual(propia.stat().st_mtime_ns if propia.exists() else None, antes)
+
+
+class ServidorOpenAIFalso:
+    """Servidor HTTP local con la forma de la API de audio de OpenAI; cada petición consume un (latencia, código, texto) del guion"""
+
+    def __init__(self, guion):
+        self.guion = list(guion)
+        self.peticiones = 0
+        self._lock = threading.Lock()
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with servidor._lock:
+                    servidor.peticiones += 1
+                    latencia, codigo, texto = servidor.guion.pop(0) if servidor.guion else (0, 200, 'ok')
+                time.sleep(latencia)
+                cuerpo = json.dumps({'text': texto} if codigo == 200 else {'error': {'message': texto}}).encode()
+                try:
+                    self.send_response(codigo)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(cuerpo)))
+                    self.end_headers()
+                    self.wfile.write(cuerpo)
+                except OSError:
+                    # El cliente cerró la conexión al agotar su timeout
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), Manejador)
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.http.server_address[1]}/v1'
+
+    def cerrar(self):
+        self.http.shutdown()
+        self.http.server_close()
+
+
+class ServidorChatFalso:
+    """Servidor HTTP local con la forma de /chat/completions de OpenAI; contesta con GuionLLM, en SSE si se pide stream"""
+
+    def __init__(self):
+        self.guion = GuionLLM()
+        self.peticiones = []
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            def do_POST(self):
+                peticion = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                servidor.peticiones.append(peticion)
+                texto = servidor.guion.responder(peticion['messages'])
+                if 'response_format' in peticion:
+                    # Salida estructurada: el modelo contesta solo con el JSON del esquema
+                    texto = texto.split('Final Answer:', 1)[-1].strip()
+                base = {'id': 'chatcmpl-falso', 'created': 0, 'model': peticion['model']}
+                uso = {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}
+                if peticion.get('stream'):
+                    eventos = [{**base, 'object': 'chat.completion.chunk', 'choices': [
+                        {'index': 0, 'delta': {'role': 'assistant', 'content': fragmento}, 'finish_reason': None}]}
+                        for fragmento in servidor.guion.fragmentos(texto)]
+                    eventos.append({**base, 'object': 'chat.completion.chunk',
+                                    'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+                    eventos.append({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': uso})
+                    cuerpo = ''.join(f'data: {json.dumps(evento)}\n\n' for evento in eventos) + 'data: [DONE]\n\n'
+                    tipo = 'text/event-stream'
+                else:
+                    cuerpo = json.dumps({**base, 'object': 'chat.completion', 'usage': uso, 'choices': [{
+                        'index': 0, 'message': {'role': 'assistant', 'content': texto}, 'finish_reason': 'stop'}]})
+                    tipo = 'application/json'
+                cuerpo = cuerpo.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', tipo)
+                self.send_header('Content-Length', str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args):
+                pass
+
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), Manejador)
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.http.server_address[1]}/v1'
+
+    def cerrar(self):
+        self.http.shutdown()
+        self.http.server_close()
+
+
+class LLMOpenAITests(TestCase):
+    """La crew con el LLM que crea crear_llm para OpenAI, contra un servidor local con su API de chat"""
+
+    def setUp(self):
+        from crewai.events.event_bus import crewai_event_bus
+        self.servidor = ServidorChatFalso()
+        self.addCleanup(self.servidor.cerrar)
+        directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(directorio.cleanup)
+        self.ruta = os.path.join(directorio.name, 'guion.jsonl')
+        # Los manejadores que registre el test (el grabador) se quitan del bus de eventos al terminar
+        self.enterContext(crewai_event_bus.scoped_handlers())
+        self.enterContext(mock.patch.dict(os.environ, {'LLM_SIMULADO_GUION': self.ruta}))
+
+    def atender(self, llm, **datos):
+        from agentes.agentes import RegistroAgentes, crear_agentes
+        with mock.patch('backend_asistente_medico.views.registro_agentes', RegistroAgentes(lambda: crear_agentes(llm))), \
+                mock.patch('backend_asistente_medico.views.triaje_sin_llm', lambda datos: None):
+            return asyncio.run(procesar_atencion({'nombre': 'Ana', 'edad': 30, 'sintomas': 'dolor de pecho', **datos}))
+
+    def test_grabar_guarda_cada_prompt_de_la_crew_para_reproducirlo(self):
+        from crewai.events.event_bus import crewai_event_bus
+        llm = crear_llm('grabar', model='gpt-4o-mini', api_key='x', base_url=self.servidor.url)
+        self.assertEqual((llm.timeout, llm.max_retries), (60, 2))
+        self.servidor.guion.reglas.append(('dolor de pecho', None, 'Final Answer: ' + json.dumps({
+            'respuesta': 'Respuesta grabada', 'urgencia': 'ALTA', 'especialidad': 'Cardiología',
+            'doctor_id': 3, 'doctor_nombre': 'Miguel Martínez'})))
+        cuerpo, codigo = self.atender(llm)
+        crewai_event_bus.flush()
+        self.assertEqual((codigo, cuerpo['stage']), (200, 'sugerir_cita'))
+        with open(self.ruta, encoding='utf-8') as archivo:
+            grabadas = [json.loads(linea) for linea in archivo]
+        self.assertEqual([grabada['clave'] for grabada in grabadas],
+                         [clave_prompt(texto_mensajes(peticion['messages'])) for peticion in self.servidor.peticiones])
+        # El backend simulado lee el archivo grabado y contesta lo mismo que el modelo
+        cuerpo, _ = self.atender(crear_llm('simulado'))
+        self.assertIn('Respuesta grabada', cuerpo['resultado']['respuesta_completa'])
+
+    def test_flujo_retransmite_los_fragmentos_del_llm_nativo(self):
+        from agentes.agentes import RegistroAgentes, crear_agentes
+        llm = crear_llm('openai', model='gpt-4o-mini', api_key='x', base_url=self.servidor.url)
+
+        async def leer():
+            respuesta = await AsyncClient().post(reverse('atender_paciente_flujo'), content_type='application/json',
+                                                 data=json.dumps({'nombre': 'Ana', 'edad': 30, 'sintomas': 'dolor de pecho'}))
+            return [fragmento.decode() async for fragmento in respuesta.streaming_content]
+
+        with mock.patch('backend_asistente_medico.views.llm', llm), \
+                mock.patch('backend_asistente_medico.views.registro_agentes', RegistroAgentes(lambda: crear_agentes(llm))), \
+                mock.patch('backend_asistente_medico.views.triaje_sin_llm', lambda datos: None):
+            eventos = [evento.strip().split('\n', 1) for evento in asyncio.run(leer())]
+        tokens = [json.loads(datos[len('data: '):])['texto'] for nombre, datos in eventos if nombre == 'event: token']
+        cuerpo = json.loads(eventos[-1][1][len('data: '):])
+        # La petición al modelo va en streaming y cada fragmento llega por separado al cliente
+        self.assertTrue(self.servidor.peticiones[0]['stream'])
+        self.assertGreater(len(tokens), 5)
+        self.assertEqual(''.join(tokens), cuerpo['resultado']['respuesta_completa'])
+
+
+class ClienteResilienteTests(TestCase):
+    def cliente(self, guion, **politica):
+        from openai import OpenAI
+        self.servidor = ServidorOpenAIFalso(guion)
+        self.addCleanup(self.servidor.cerrar)
+        opciones = {'plazo': 5, 'reintentos': 2, 'cobertura': 0, 'espera_base': 0.01, **politica}
+        resiliente = ClienteResiliente({'transcripcion': Politica(**opciones)}, umbral_fallos=2, enfriamiento=60)
+        sdk = OpenAI(api_key='x', base_url=self.servidor.url, max_retries=0)
+        return resiliente, lambda: resiliente.llamar('transcripcion', sdk.audio.transcriptions.create,
+                                                     model='whisper-1', file=('audio.wav', b'RIFF'))
+
+    def test_reintenta_errores_transitorios_pero_no_los_de_la_peticion(self):
+        resiliente, transcribir = self.cliente([(0, 503, 'caído'), (0, 200, 'hola'), (0, 400, 'formato no válido')])
+        self.assertEqual(transcribir().text, 'hola')
+        with self.assertRaises(Exception) as error:
+            transcribir()
+        self.assertNotIsInstance(error.exception, PlazoAgotado)
+        self.assertEqual(self.servidor.peticiones, 3)
+        resumen = resiliente.resumen()['transcripcion']
+        self.assertEqual((resumen['reintentos'], resumen['fallos'], resumen['circuito']), (1, 1, 'cerrado'))
+
+    def test_plazo_total_y_cobertura(self):
+        _, lenta = self.cliente([(1.5, 200, 'tarde')], plazo=0.3, reintentos=0)
+        inicio = time.monotonic()
+        with self.assertRaises(PlazoAgotado):
+            lenta()
+        self.assertLess(time.monotonic() - inicio, 1.0)
+
+        resiliente, cubierta = self.cliente([(1.0, 200, 'lenta'), (0, 200, 'rápida')], cobertura=0.1)
+        self.assertEqual(cubierta().text, 'rápida')
+        self.assertEqual(resiliente.resumen()['transcripcion']['coberturas_ganadas'], 1)
+
+    def test_cortacircuitos_falla_al_instante_y_responde_503(self):
+        resiliente, transcribir = self.cliente([(0, 500, 'error')] * 10, reintentos=0)
+        for _ in range(2):
+            with self.assertRaises(PlazoAgotado):
+                transcribir()
+        with self.assertRaises(CircuitoAbierto):
+            transcribir()
+        self.assertEqual(self.servidor.peticiones, 2)
+        self.assertEqual(resiliente.resumen()['transcripcion']['circuito'], 'abierto')
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        with mock.patch('backend_asistente_medico.views.cliente_openai', resiliente):
+            respuesta = self.client.post(reverse('transcribir_audio'), {'audio': SimpleUploadedFile(
+                'consulta.wav', b'RIFF', content_type='audio/wav')})
+        self.assertEqual(respuesta.status_code, 503)
+        self.assertIn('Retry-After', respuesta)
+        self.assertIn('asistente_openai_circuito{operacion="transcripcion"}',
+                      self.client.get(reverse('metricas')).content.decode())
+
+    def test_circuito_semiabierto_deja_pasar_una_sola_prueba(self):
+        ahora = [0.0]
+        circuito = Circuito(umbral=1, enfriamiento=10, reloj=lambda: ahora[0])
+        circuito.fallo()
+        self.assertEqual((circuito.estado, circuito.permitir()), ('abierto', 10))
+        ahora[0] = 10
+        self.assertIsNone(circuito.permitir())
+        self.assertIsNotNone(circuito.permitir())
+        circuito.fallo()
+        self.assertEqual((circuito.estado, circuito.aperturas), ('abierto', 2))
+        ahora[0] = 20
+        self.assertIsNone(circuito.permitir())
+        circuito.exito()
+        self.assertEqual(circuito.estado, 'cerrado')
+
+    def test_errores_envueltos_y_cadenas_con_ciclos(self):
+        import openai
+        envuelto = RuntimeError('crew')
+        envuelto.__cause__ = openai.APIConnectionError(request=None)
+        self.assertTrue(error_transitorio(envuelto))
+        # Los conversores de CrewAI pueden dejar una excepción en el contexto de sí misma
+        primero, segundo = ValueError('uno'), ValueError('dos')
+        primero.__context__, segundo.__context__ = segundo, primero
+        self.assertFalse(error_transitorio(primero))
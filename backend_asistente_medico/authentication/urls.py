@@ -7,4 +7,7 @@ urlpatterns = [
     path('auth/check-auth/', views.check_auth, name='check_auth'),
     # path('auth/protected/', views.protected_view, name='protected'),
     path('auth/register/', views.register_view, name='register'),
+    path('medico/disponibilidad/', views.proximos_huecos, name='proximos_huecos'),
+    path('medico/estadisticas/', views.estadisticas, name='estadisticas'),
+    path('medico/mis-citas/', views.mis_citas, name='mis_citas'),
 ]
\ No newline at end of file
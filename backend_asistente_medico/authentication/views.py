@@ -1,16 +1,18 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.sessions.models import Session
 from django.utils import timezone
+import base64
+import itertools
 import json
 import hashlib
-import sqlite3
 from datetime import datetime
 import uuid
 
 # Importar la base de datos médica
-from agentes.bd import db
+from agentes.bd import db, ErrorReserva
+from agentes.disponibilidad import motor_disponibilidad
 
 def hash_password(password):
     """Función para hashear contraseñas"""
@@ -18,8 +20,7 @@ def hash_password(password):
 
 def verificar_credenciales(correo_electronico, contraseña):
     """Verificar las credenciales del paciente"""
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
+    cursor = db.conexion().cursor()
     
     contraseña_hash = hash_password(contraseña)
     
@@ -30,7 +31,6 @@ def verificar_credenciales(correo_electronico, contraseña):
     ''', (correo_electronico, contraseña_hash))
     
     paciente = cursor.fetchone()
-    conn.close()
     
     if paciente:
         return {
@@ -232,8 +232,7 @@ def perfil_paciente(request):
     try:
         paciente_id = request.session.get('paciente_id')
         
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
+        cursor = db.conexion().cursor()
         
         cursor.execute('''
             SELECT id, nombres, apellidos, correo_electronico, numero_telefono, edad, fecha_registro
@@ -242,7 +241,6 @@ def perfil_paciente(request):
         ''', (paciente_id,))
         
         paciente = cursor.fetchone()
-        conn.close()
         
         if paciente:
             return JsonResponse({
@@ -312,6 +310,72 @@ def obtener_doctores(request):
             'message': f'Error del servidor: {str(e)}'
         }, status=500)
 
+@require_http_methods(["GET"])
+def proximos_huecos(request):
+    """Obtener los próximos huecos libres de un doctor o de una especialidad"""
+    try:
+        doctor_id = request.GET.get('doctor_id')
+        especialidad = request.GET.get('especialidad')
+        desde = request.GET.get('desde')
+        
+        if not doctor_id and not especialidad:
+            return JsonResponse({
+                'success': False,
+                'message': 'Se requiere doctor_id o especialidad'
+            }, status=400)
+        
+        try:
+            cantidad = int(request.GET.get('cantidad', 5))
+            doctor_id = int(doctor_id) if doctor_id else None
+        except ValueError:
+            return JsonResponse({
+                'success': False,
+                'message': 'doctor_id y cantidad deben ser números enteros'
+            }, status=400)
+        
+        if cantidad < 1 or cantidad > 50:
+            return JsonResponse({
+                'success': False,
+                'message': 'La cantidad debe estar entre 1 y 50'
+            }, status=400)
+        
+        try:
+            huecos = motor_disponibilidad.proximos_huecos(
+                doctor_id=doctor_id,
+                especialidad=especialidad,
+                desde=desde,
+                cantidad=cantidad
+            )
+        except ValueError:
+            return JsonResponse({
+                'success': False,
+                'message': 'La fecha desde debe tener formato YYYY-MM-DD'
+            }, status=400)
+        
+        return JsonResponse({
+            'success': True,
+            'huecos': huecos
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': f'Error del servidor: {str(e)}'
+        }, status=500)
+
+@require_http_methods(["GET"])
+def estadisticas(request):
+    """Obtener los contadores agregados del sistema (pacientes, citas y doctores)"""
+    try:
+        return JsonResponse({
+            'success': True,
+            'estadisticas': db.estadisticas()
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': f'Error del servidor: {str(e)}'
+        }, status=500)
+
 @login_required_paciente
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -333,20 +397,34 @@ def crear_cita(request):
         
         paciente_id = request.session.get('paciente_id')
         
-        # Crear la cita usando la función de la base de datos
-        cita_id = db.crear_cita(
-            paciente_id=paciente_id,
-            doctor_id=doctor_id,
-            fecha=fecha,
-            hora=hora,
-            motivo=motivo,
-            urgencia=urgencia
-        )
+        # Reserva atómica: rechaza la franja si otro paciente ya la tomó
+        try:
+            cita = db.reservar_cita(
+                paciente_id=paciente_id,
+                doctor_id=doctor_id,
+                fecha=fecha,
+                hora=hora,
+                motivo=motivo,
+                urgencia=urgencia
+            )
+        except ErrorReserva as e:
+            status = {
+                ErrorReserva.DATOS_INVALIDOS: 400,
+                ErrorReserva.PACIENTE_INEXISTENTE: 404,
+                ErrorReserva.DOCTOR_NO_DISPONIBLE: 404,
+                ErrorReserva.HORARIO_OCUPADO: 409,
+                ErrorReserva.FUERA_DE_HORARIO: 400,
+                ErrorReserva.FECHA_PASADA: 400,
+            }[e.motivo]
+            return JsonResponse({
+                'success': False,
+                'message': str(e)
+            }, status=status)
         
         return JsonResponse({
             'success': True,
             'message': 'Cita creada exitosamente',
-            'cita_id': cita_id
+            'cita_id': cita['id']
         })
         
     except json.JSONDecodeError:
@@ -360,49 +438,85 @@ def crear_cita(request):
             'message': f'Error del servidor: {str(e)}'
         }, status=500)
 
+def codificar_cursor(cita):
+    """Cursor opaco con la clave (fecha, hora, id) de la última cita entregada"""
+    clave = json.dumps([cita['fecha'], cita['hora'], cita['id']])
+    return base64.urlsafe_b64encode(clave.encode()).decode().rstrip('=')
+
+def decodificar_cursor(cursor):
+    """Recuperar la clave (fecha, hora, id) de un cursor; ValueError si no es válido"""
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        clave = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+    except Exception:
+        raise ValueError('Cursor inválido')
+    if not isinstance(clave, list) or len(clave) != 3 or not all(isinstance(v, str) for v in clave):
+        raise ValueError('Cursor inválido')
+    return clave
+
+def exportar_citas_json(citas):
+    """Generador del JSON de exportación, escrito cita a cita"""
+    yield '{"success": true, "citas": ['
+    for indice, cita in enumerate(citas):
+        yield (',' if indice else '') + json.dumps(cita, ensure_ascii=False)
+    yield ']}'
+
 @login_required_paciente
 @require_http_methods(["GET"])
 def mis_citas(request):
-    """Obtener todas las citas del paciente autenticado"""
+    """
+    Obtener las citas del paciente autenticado, paginadas por cursor.
+    Parámetros: periodo (todas|proximas|pasadas), estado, limite (1-100), cursor,
+    formato=exportar para recibir todas las citas en streaming.
+    """
     try:
         paciente_id = request.session.get('paciente_id')
+        periodo = request.GET.get('periodo', 'todas')
+        estado = request.GET.get('estado') or None
         
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
+        if periodo not in ('todas', 'proximas', 'pasadas'):
+            return JsonResponse({
+                'success': False,
+                'message': 'El periodo debe ser todas, proximas o pasadas'
+            }, status=400)
         
-        cursor.execute('''
-            SELECT c.id, c.fecha, c.hora, c.motivo, c.urgencia, c.estado, 
-                   d.nombre, d.especialidad, c.fecha_creacion
-            FROM citas c
-            JOIN doctores d ON c.doctor_id = d.id
-            WHERE c.paciente_id = ?
-            ORDER BY c.fecha DESC, c.hora DESC
-        ''', (paciente_id,))
+        if request.GET.get('formato') == 'exportar':
+            citas = db.citas_paciente(paciente_id, periodo=periodo, estado=estado)
+            return StreamingHttpResponse(exportar_citas_json(citas), content_type='application/json')
+        
+        try:
+            limite = int(request.GET.get('limite', 20))
+            despues_de = decodificar_cursor(request.GET['cursor']) if request.GET.get('cursor') else None
+        except ValueError:
+            return JsonResponse({
+                'success': False,
+                'message': 'limite debe ser un número entero y cursor un valor devuelto por esta API'
+            }, status=400)
+        
+        if limite < 1 or limite > 100:
+            return JsonResponse({
+                'success': False,
+                'message': 'El límite debe estar entre 1 y 100'
+            }, status=400)
         
-        citas = cursor.fetchall()
-        conn.close()
+        # Se pide una cita de más para saber si hay otra página sin contar el total
+        iterador = db.citas_paciente(paciente_id, periodo=periodo, estado=estado,
+                                     despues_de=despues_de, lote=limite + 1)
+        citas_data = list(itertools.islice(iterador, limite + 1))
+        iterador.close()
         
-        citas_data = []
-        for cita in citas:
-            citas_data.append({
-                'id': cita[0],
-                'fecha': cita[1],
-                'hora': cita[2],
-                'motivo': cita[3],
-                'urgencia': cita[4],
-                'estado': cita[5],
-                'doctor_nombre': cita[6],
-                'doctor_especialidad': cita[7],
-                'fecha_creacion': cita[8]
-            })
+        tiene_mas = len(citas_data) > limite
+        citas_data = citas_data[:limite]
         
         return JsonResponse({
             'success': True,
-            'citas': citas_data
+            'citas': citas_data,
+            'tiene_mas': tiene_mas,
+            'siguiente_cursor': codificar_cursor(citas_data[-1]) if tiene_mas else None
         })
         
     except Exception as e:
         return JsonResponse({
             'success': False,
             'message': f'Error del servidor: {str(e)}'
-        }, status=500)
\ No newline at end of file
+        }, status=500)
@@ -0,0 +1,49 @@
+import time
+from types import SimpleNamespace
+
+# Trama MP3 de silencio (MPEG-1 Layer III, 128 kbps, 44,1 kHz: 417 bytes, ~26 ms)
+TRAMA_SILENCIO = bytes.fromhex('fffb9064') + bytes(413)
+# Caracteres de texto por trama de silencio, para que la duración crezca con el texto
+CARACTERES_POR_TRAMA = 4
+
+
+class _Transcripciones:
+    def __init__(self, cliente):
+        self.cliente = cliente
+
+    def create(self, model=None, file=None, language=None, **kwargs):
+        """
+        Si el "audio" subido es texto UTF-8 se devuelve tal cual como transcripción (útil en
+        pruebas de carga para variar los síntomas); si no, el texto configurado
+        """
+        # Como el SDK: archivo abierto o tupla (nombre, contenido)
+        contenido = file[1] if isinstance(file, tuple) else file.read()
+        try:
+            texto = contenido.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            texto = ''
+        time.sleep(self.cliente.latencia)
+        return SimpleNamespace(text=texto or self.cliente.texto)
+
+
+class _Voz:
+    def __init__(self, cliente):
+        self.cliente = cliente
+
+    def create(self, model=None, voice=None, input='', response_format='mp3', **kwargs):
+        tramas = max(1, len(input or '') // CARACTERES_POR_TRAMA)
+        time.sleep(self.cliente.latencia)
+        return SimpleNamespace(content=TRAMA_SILENCIO * tramas)
+
+
+class ClienteAudioSimulado:
+    """
+    Sustituto del cliente de OpenAI para Whisper y TTS (solo client.audio), sin red:
+    transcriptions.create devuelve un objeto con .text y speech.create uno con .content
+    (MP3 de silencio), cada uno tras la latencia configurada
+    """
+
+    def __init__(self, texto='', latencia=0.0):
+        self.texto = texto
+        self.latencia = latencia
+        self.audio = SimpleNamespace(transcriptions=_Transcripciones(self), speech=_Voz(self))
@@ -0,0 +1,265 @@
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from agentes.bd import GestorConexiones
+from agentes.identificadores import generador_ids
+
+ESTADOS_FINALES = ('completado', 'error', 'cancelado')
+PRIORIDAD_URGENCIA = {'ALTA': 2, 'MEDIA': 1, 'BAJA': 0}
+
+logger = logging.getLogger(__name__)
+
+
+class ColaLlena(Exception):
+    """La cola alcanzó el máximo de trabajos pendientes"""
+
+    def __init__(self, reintentar_en):
+        super().__init__('Hay demasiadas consultas en espera; inténtalo de nuevo en unos segundos.')
+        self.reintentar_en = reintentar_en
+
+
+class ColaTrabajos:
+    """
+    Cola de trabajos en SQLite para ejecutar etapas del asistente fuera de la petición HTTP.
+    Cada proceso arranca un pool de hilos que reclaman el siguiente trabajo pendiente por
+    prioridad (urgencia) y antigüedad con un único UPDATE ... RETURNING, así varios workers
+    de gunicorn/uvicorn comparten la cola sin broker externo. Los trabajos en curso de un
+    proceso que murió vuelven a la cola pasado `limite_en_curso`.
+    """
+
+    def __init__(self, ruta, hilos=4, max_pendientes=200, reintentar_en=10,
+                 limite_en_curso=600, retencion=24 * 3600, intervalo=0.5):
+        self.ruta = ruta
+        self.hilos = hilos
+        self.max_pendientes = max_pendientes
+        self.reintentar_en = reintentar_en
+        self.limite_en_curso = limite_en_curso
+        self.retencion = retencion
+        self.intervalo = intervalo
+        self.conexiones = GestorConexiones(ruta)
+        self._procesar = None
+        self._workers = []
+        self._pid = None
+        self._hay_trabajo = threading.Event()
+        self._detener = threading.Event()
+        self._lock = threading.Lock()
+        self._crear_tablas()
+
+    def _crear_tablas(self):
+        with self.conexiones.obtener() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS trabajos (
+                    id TEXT PRIMARY KEY,
+                    estado TEXT NOT NULL DEFAULT 'pendiente',
+                    prioridad INTEGER NOT NULL DEFAULT 0,
+                    datos TEXT NOT NULL,
+                    resultado TEXT,
+                    codigo_http INTEGER,
+                    cancelar INTEGER NOT NULL DEFAULT 0,
+                    creado REAL NOT NULL,
+                    iniciado REAL,
+                    terminado REAL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_trabajos_pendientes
+                ON trabajos(prioridad DESC, creado) WHERE estado = 'pendiente'
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_trabajos_estado_terminado ON trabajos(estado, terminado)
+            ''')
+
+    def iniciar(self, procesar):
+        """
+        Arrancar (una vez por proceso) los hilos que ejecutan `procesar(datos)`,
+        que debe devolver (cuerpo, codigo_http). Llamadas posteriores solo reponen los
+        hilos que hayan terminado.
+        """
+        with self._lock:
+            self._procesar = procesar
+            if self._pid != os.getpid():
+                # Tras un fork los hilos del proceso padre no existen en el hijo
+                self._pid = os.getpid()
+                self._workers = []
+            self._detener.clear()
+            huecos = self._workers + [None] * (self.hilos - len(self._workers))
+            self._workers = []
+            for i, worker in enumerate(huecos[:self.hilos]):
+                if worker is None or not worker.is_alive():
+                    worker = threading.Thread(target=self._bucle, name=f'cola-trabajos-{i}', daemon=True)
+                    worker.start()
+                self._workers.append(worker)
+
+    def detener(self, espera=5):
+        self._detener.set()
+        self._hay_trabajo.set()
+        for worker in self._workers:
+            worker.join(espera)
+        self._workers = []
+
+    def encolar(self, datos, prioridad=0):
+        """Guardar un trabajo pendiente y devolver su ID; lanza ColaLlena si se supera la profundidad máxima"""
+        # Sufijo aleatorio: el ID es la única credencial para leer el resultado
+        trabajo_id = generador_ids.nuevo('TRB') + secrets.token_hex(8)
+        conn = self.conexiones.obtener()
+        # BEGIN IMMEDIATE: el conteo y la inserción no se intercalan con otros procesos
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            pendientes = conn.execute("SELECT COUNT(*) FROM trabajos WHERE estado = 'pendiente'").fetchone()[0]
+            if pendientes >= self.max_pendientes:
+                raise ColaLlena(self.reintentar_en)
+            conn.execute(
+                "INSERT INTO trabajos (id, prioridad, datos, creado) VALUES (?, ?, ?, ?)",
+                (trabajo_id, prioridad, json.dumps(datos, ensure_ascii=False), time.time())
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._hay_trabajo.set()
+        return trabajo_id
+
+    def _reclamar(self):
+        with self.conexiones.obtener() as conn:
+            filas = conn.execute('''
+                UPDATE trabajos SET estado = 'en_curso', iniciado = ?
+                WHERE id = (
+                    SELECT id FROM trabajos WHERE estado = 'pendiente'
+                    ORDER BY prioridad DESC, creado LIMIT 1
+                )
+                RETURNING id, datos
+            ''', (time.time(),)).fetchall()
+        return filas[0] if filas else None
+
+    def _terminar(self, trabajo_id, estado, cuerpo, codigo_http):
+        with self.conexiones.obtener() as conn:
+            # Si se pidió cancelar mientras corría, el resultado se descarta
+            conn.execute('''
+                UPDATE trabajos
+                SET estado = CASE WHEN cancelar THEN 'cancelado' ELSE ? END,
+                    resultado = CASE WHEN cancelar THEN NULL ELSE ? END,
+                    codigo_http = CASE WHEN cancelar THEN NULL ELSE ? END,
+                    terminado = ?
+                WHERE id = ? AND estado = 'en_curso'
+            ''', (estado, json.dumps(cuerpo, ensure_ascii=False), codigo_http, time.time(), trabajo_id))
+
+    def _mantenimiento(self):
+        """Devolver a la cola los trabajos huérfanos y borrar los terminados antiguos"""
+        ahora = time.time()
+        with self.conexiones.obtener() as conn:
+            conn.execute(
+                "UPDATE trabajos SET estado = 'pendiente', iniciado = NULL WHERE estado = 'en_curso' AND iniciado < ?",
+                (ahora - self.limite_en_curso,)
+            )
+            conn.execute(
+                "DELETE FROM trabajos WHERE estado IN ('completado', 'error', 'cancelado') AND terminado < ?",
+                (ahora - self.retencion,)
+            )
+
+    def _ejecutar_siguiente(self, reintentos_terminar=3):
+        """Reclamar y ejecutar un trabajo; False si no había ninguno pendiente"""
+        fila = self._reclamar()
+        if fila is None:
+            return False
+        trabajo_id, datos = fila
+        try:
+            cuerpo, codigo_http = self._procesar(json.loads(datos))
+            estado = 'completado'
+        except Exception as e:
+            cuerpo, codigo_http = {'success': False, 'message': f'Error en el asistente médico: {str(e)}'}, 500
+            estado = 'error'
+        # El trabajo ya se ejecutó: si la base está ocupada se insiste antes de dejarlo en curso
+        for intento in range(reintentos_terminar):
+            try:
+                self._terminar(trabajo_id, estado, cuerpo, codigo_http)
+                return True
+            except sqlite3.OperationalError:
+                if intento == reintentos_terminar - 1:
+                    raise
+                time.sleep(self.intervalo)
+
+    def _bucle(self):
+        ultimo_mantenimiento = float('-inf')
+        while not self._detener.is_set():
+            try:
+                if time.monotonic() - ultimo_mantenimiento > 60:
+                    ultimo_mantenimiento = time.monotonic()
+                    self._mantenimiento()
+                if not self._ejecutar_siguiente():
+                    self._hay_trabajo.wait(self.intervalo)
+                    self._hay_trabajo.clear()
+            except Exception:
+                # Un error de SQLite (p. ej. base ocupada más allá de busy_timeout) no debe terminar el hilo
+                logger.exception('Error en el hilo %s de la cola de trabajos', threading.current_thread().name)
+                self._detener.wait(self.intervalo)
+
+    def cancelar(self, trabajo_id):
+        """
+        Cancelar un trabajo: si está pendiente no llega a ejecutarse; si está en curso
+        su resultado se descarta al terminar. Devuelve False si no existe o ya terminó.
+        """
+        ahora = time.time()
+        with self.conexiones.obtener() as conn:
+            cancelado = conn.execute(
+                "UPDATE trabajos SET estado = 'cancelado', terminado = ? WHERE id = ? AND estado = 'pendiente'",
+                (ahora, trabajo_id)
+            ).rowcount
+            if not cancelado:
+                cancelado = conn.execute(
+                    "UPDATE trabajos SET cancelar = 1 WHERE id = ? AND estado = 'en_curso'", (trabajo_id,)
+                ).rowcount
+        return bool(cancelado)
+
+    def conteo_por_estado(self):
+        """Número de trabajos en cada estado (para las métricas de la cola)"""
+        return dict(self.conexiones.obtener().execute("SELECT estado, COUNT(*) FROM trabajos GROUP BY estado"))
+
+    def consultar(self, trabajo_id):
+        """Estado del trabajo (con su posición en la cola o su resultado), o None si no existe"""
+        conn = self.conexiones.obtener()
+        fila = conn.execute(
+            "SELECT estado, prioridad, resultado, codigo_http, cancelar, creado, iniciado, terminado "
+            "FROM trabajos WHERE id = ?", (trabajo_id,)
+        ).fetchone()
+        if fila is None:
+            return None
+        estado, prioridad, resultado, codigo_http, cancelar, creado, iniciado, terminado = fila
+        trabajo = {
+            'trabajo_id': trabajo_id,
+            'estado': estado,
+            'prioridad': prioridad,
+            'creado': creado,
+            'iniciado': iniciado,
+            'terminado': terminado,
+        }
+        if estado == 'pendiente':
+            trabajo['posicion'] = conn.execute(
+                "SELECT COUNT(*) FROM trabajos WHERE estado = 'pendiente' "
+                "AND (prioridad > ? OR (prioridad = ? AND creado < ?))",
+                (prioridad, prioridad, creado)
+            ).fetchone()[0] + 1
+        elif estado == 'en_curso':
+            trabajo['cancelacion_solicitada'] = bool(cancelar)
+        elif resultado is not None:
+            trabajo['resultado'] = json.loads(resultado)
+            trabajo['codigo_http'] = codigo_http
+        return trabajo
+
+
+def prioridad_urgencia(urgencia):
+    return PRIORIDAD_URGENCIA.get((urgencia or '').upper(), 0)
+
+
+# Instancia global; los hilos se arrancan al encolar el primer trabajo o al iniciar el servidor
+cola_trabajos = ColaTrabajos(
+    settings.COLA_TRABAJOS_DB,
+    hilos=settings.COLA_TRABAJOS_HILOS,
+    max_pendientes=settings.COLA_TRABAJOS_MAX_PENDIENTES,
+)
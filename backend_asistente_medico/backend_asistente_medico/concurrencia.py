@@ -0,0 +1,116 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.http import JsonResponse
+
+
+class SobrecargaLLM(Exception):
+    """No hay hueco para otra llamada a OpenAI dentro de la espera máxima"""
+
+    def __init__(self, reintentar_en):
+        super().__init__('El asistente está atendiendo a demasiados pacientes; inténtalo de nuevo en unos segundos.')
+        self.reintentar_en = reintentar_en
+
+
+class LimiteLLM:
+    """
+    Limita las llamadas bloqueantes a OpenAI (crew.kickoff, Whisper, TTS) de un proceso.
+    Un semáforo acotado fija cuántas pueden estar en curso y un pool de hilos del mismo
+    tamaño las ejecuta, así el bucle de eventos de ASGI nunca se bloquea. Si no se libera
+    un hueco dentro de `espera_maxima` se lanza SobrecargaLLM en lugar de encolar sin límite.
+    El semáforo es de threading (no de asyncio) para funcionar también con WSGI, donde
+    cada petición asíncrona corre en su propio bucle de eventos.
+    """
+
+    def __init__(self, maximo=8, espera_maxima=2.0, reintentar_en=5, intervalo=0.05):
+        self.maximo = maximo
+        self.espera_maxima = espera_maxima
+        self.reintentar_en = reintentar_en
+        self.intervalo = intervalo
+        self._semaforo = threading.BoundedSemaphore(maximo)
+        self._executor = ThreadPoolExecutor(max_workers=maximo, thread_name_prefix='llm')
+        self._lock = threading.Lock()
+        self.en_curso = 0
+        self.rechazadas = 0
+
+    async def _adquirir(self):
+        limite = time.monotonic() + self.espera_maxima
+        while not self._semaforo.acquire(blocking=False):
+            if time.monotonic() >= limite:
+                with self._lock:
+                    self.rechazadas += 1
+                raise SobrecargaLLM(self.reintentar_en)
+            await asyncio.sleep(self.intervalo)
+        with self._lock:
+            self.en_curso += 1
+
+    def _liberar(self):
+        with self._lock:
+            self.en_curso -= 1
+        self._semaforo.release()
+
+    def _llamar(self, funcion):
+        # El hueco se libera al terminar el hilo, aunque el cliente se haya desconectado antes
+        try:
+            return funcion()
+        finally:
+            self._liberar()
+
+    def llamar(self, funcion, *args, **kwargs):
+        """Versión bloqueante para hilos en segundo plano: espera hueco sin límite y ejecuta en el hilo actual"""
+        self._semaforo.acquire()
+        with self._lock:
+            self.en_curso += 1
+        return self._llamar(functools.partial(funcion, *args, **kwargs))
+
+    async def ejecutar(self, funcion, *args, **kwargs):
+        """Ejecutar una llamada bloqueante en el pool cuando haya hueco; lanza SobrecargaLLM si no lo hay"""
+        await self._adquirir()
+        try:
+            # El hilo hereda el contexto (etapa en curso y desglose de la petición para las métricas)
+            futuro = self._executor.submit(
+                contextvars.copy_context().run, self._llamar, functools.partial(funcion, *args, **kwargs)
+            )
+        except BaseException:
+            self._liberar()
+            raise
+        # Si la petición se cancela con la llamada aún en cola, _llamar nunca corre: se libera aquí
+        futuro.add_done_callback(lambda f: f.cancelled() and self._liberar())
+        return await asyncio.wrap_future(futuro)
+
+
+async def ejecutar_bd(funcion, *args, **kwargs):
+    """
+    Ejecutar en el pool de base de datos una función que usa SQLite (puede esperar un
+    busy_timeout o reintentos con sleep) sin bloquear el bucle de eventos ni ocupar
+    plazas de limite_llm. El hilo hereda el contexto de la petición.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor_bd, contextvars.copy_context().run, functools.partial(funcion, *args, **kwargs)
+    )
+
+
+def respuesta_sobrecarga(error):
+    """503 inmediato con Retry-After (error.reintentar_en) para que el frontend reintente más tarde"""
+    respuesta = JsonResponse({
+        'success': False,
+        'message': str(error)
+    }, status=503)
+    respuesta['Retry-After'] = str(error.reintentar_en)
+    return respuesta
+
+
+# Pool por proceso para ejecutar_bd; las conexiones SQLite son por hilo (GestorConexiones)
+_executor_bd = ThreadPoolExecutor(max_workers=settings.BD_MAX_HILOS, thread_name_prefix='bd')
+
+# Instancia global por proceso, dimensionada desde settings
+limite_llm = LimiteLLM(
+    maximo=settings.LLM_MAX_CONCURRENTES,
+    espera_maxima=settings.LLM_ESPERA_MAXIMA,
+    reintentar_en=settings.LLM_REINTENTAR_EN,
+)
@@ -0,0 +1,222 @@
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from agentes.bd import GestorConexiones
+from agentes.identificadores import generador_ids
+from agentes.salidas import CAMPOS_CONTEXTO as CAMPOS_SALIDA
+
+# Etapas a las que puede pasar una conversación desde cada etapa guardada. Desde
+# 'finalizado' solo se admite una consulta nueva (otro triaje, que lleva a sugerir_cita)
+TRANSICIONES = {
+    'triaje': ('sugerir_cita',),
+    'sugerir_cita': ('confirmar_cita', 'finalizado'),
+    'confirmar_cita': ('confirmar_cita', 'finalizado'),
+    'negociar_fecha': ('confirmar_cita', 'finalizado'),
+    'finalizado': ('sugerir_cita',),
+}
+# Lo único que se guarda: datos del paciente y campos de contexto que usan las etapas siguientes
+CAMPOS_PACIENTE = ('nombre', 'edad', 'telefono', 'paciente_id')
+CAMPOS_CONTEXTO = CAMPOS_SALIDA + ('fecha_deseada', 'hora_deseada', 'cita_id')
+CONTADORES = ('creadas', 'avances', 'conflictos', 'transiciones_invalidas', 'no_encontradas')
+
+
+class ConversacionNoEncontrada(Exception):
+    def __init__(self):
+        super().__init__('La conversación no existe o caducó; describe de nuevo tus síntomas para empezar otra.')
+
+
+class TransicionInvalida(Exception):
+    """La petición no corresponde a la etapa guardada (o la etapa resultante no está permitida)"""
+
+    def __init__(self, etapa, mensaje=None):
+        super().__init__(mensaje or f'La conversación está en la etapa {etapa}.')
+        self.etapa = etapa
+
+
+class ConflictoConversacion(TransicionInvalida):
+    """Otra petición avanzó la misma conversación mientras se atendía esta"""
+
+
+def _compactar(campos, valores):
+    return {campo: valores[campo] for campo in campos if valores.get(campo) is not None}
+
+
+class AlmacenConversaciones:
+    """
+    Estado de cada conversación del asistente en el servidor, identificado por un ID que es
+    lo único que el cliente reenvía. Una LRU en memoria por proceso delante de SQLite: cada
+    cambio se escribe también en SQLite, de modo que la conversación sobrevive a su desalojo
+    de memoria y cualquier worker puede continuarla (cada lectura comprueba la versión en
+    SQLite y solo reutiliza la copia en memoria si sigue vigente). Cada avance comprueba la versión
+    (concurrencia optimista) y que la transición de etapa esté permitida. Caducan
+    `ttl_segundos` después del último avance.
+    """
+
+    def __init__(self, ruta=None, ttl_segundos=1800, max_memoria=2048, purgar_cada=500):
+        self.ruta = ruta
+        self.ttl_segundos = ttl_segundos
+        self.max_memoria = max_memoria
+        self.purgar_cada = purgar_cada
+        self._memoria = OrderedDict()
+        self._contadores = dict.fromkeys(CONTADORES, 0)
+        self._escrituras = 0
+        self._lock = threading.Lock()
+        self.conexiones = GestorConexiones(ruta) if ruta else None
+        if self.conexiones:
+            self._crear_tablas()
+
+    def _crear_tablas(self):
+        with self.conexiones.obtener() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversaciones (
+                    id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    estado TEXT NOT NULL,
+                    expira REAL NOT NULL
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_conversaciones_expira ON conversaciones(expira)")
+
+    def _contar(self, contador):
+        with self._lock:
+            self._contadores[contador] += 1
+
+    def _recordar(self, conversacion_id, version, estado, expira):
+        with self._lock:
+            self._memoria[conversacion_id] = (version, estado, expira)
+            self._memoria.move_to_end(conversacion_id)
+            while len(self._memoria) > self.max_memoria:
+                self._memoria.popitem(last=False)
+
+    def descartar(self, conversacion_id):
+        """Quitar la copia en memoria (la próxima lectura vuelve a SQLite)"""
+        with self._lock:
+            self._memoria.pop(conversacion_id, None)
+
+    def _escribir(self, conn, conversacion_id, version, estado, expira):
+        """INSERT (versión 1) o UPDATE condicionado a la versión anterior; False si otra petición se adelantó"""
+        texto = json.dumps(estado, ensure_ascii=False, separators=(',', ':'))
+        if version == 1:
+            conn.execute("INSERT INTO conversaciones (id, version, estado, expira) VALUES (?, 1, ?, ?)",
+                         (conversacion_id, texto, expira))
+            return True
+        return conn.execute(
+            "UPDATE conversaciones SET version = ?, estado = ?, expira = ? WHERE id = ? AND version = ?",
+            (version, texto, expira, conversacion_id, version - 1)
+        ).rowcount == 1
+
+    def _guardar(self, conversacion_id, version, estado):
+        expira = time.time() + self.ttl_segundos
+        if self.conexiones:
+            with self.conexiones.obtener() as conn:
+                if not self._escribir(conn, conversacion_id, version, estado, expira):
+                    self.descartar(conversacion_id)
+                    self._contar('conflictos')
+                    raise ConflictoConversacion(estado['etapa'], 'La conversación cambió mientras se atendía esta petición.')
+        else:
+            with self._lock:
+                actual = self._memoria.get(conversacion_id)
+                if version > 1 and (actual is None or actual[0] != version - 1):
+                    self._contadores['conflictos'] += 1
+                    raise ConflictoConversacion(estado['etapa'], 'La conversación cambió mientras se atendía esta petición.')
+        self._recordar(conversacion_id, version, estado, expira)
+        self._escrituras += 1
+        if self.purgar_cada and self._escrituras % self.purgar_cada == 0:
+            self.purgar()
+
+    def crear(self, paciente, etapa, contexto=None, sintomas=None):
+        """Guardar una conversación nueva tras su primer triaje y devolver su ID"""
+        if etapa not in TRANSICIONES['triaje']:
+            self._contar('transiciones_invalidas')
+            raise TransicionInvalida('triaje', f'Transición no permitida: triaje -> {etapa}')
+        # Sufijo aleatorio: el ID es la única credencial para continuar la conversación
+        conversacion_id = generador_ids.nuevo('CNV') + secrets.token_hex(8)
+        estado = {
+            'etapa': etapa,
+            'paciente': _compactar(CAMPOS_PACIENTE, paciente),
+            'sintomas': sintomas,
+            'contexto': _compactar(CAMPOS_CONTEXTO, contexto or {}),
+        }
+        self._guardar(conversacion_id, 1, estado)
+        self._contar('creadas')
+        return conversacion_id
+
+    def obtener(self, conversacion_id):
+        """
+        {'id', 'version', 'etapa', 'paciente', 'sintomas', 'contexto'}; lanza ConversacionNoEncontrada.
+        Con SQLite cada lectura compara la versión guardada (lectura por clave primaria): la copia
+        en memoria solo se usa si sigue vigente, por si otro worker avanzó la conversación.
+        """
+        ahora = time.time()
+        with self._lock:
+            entrada = self._memoria.get(conversacion_id)
+        if self.conexiones:
+            with self.conexiones.obtener() as conn:
+                fila = conn.execute(
+                    "SELECT version, expira FROM conversaciones WHERE id = ? AND expira > ?",
+                    (conversacion_id, ahora)
+                ).fetchone()
+                if fila is None:
+                    entrada = None
+                elif entrada is None or entrada[0] != fila[0]:
+                    estado = conn.execute("SELECT estado FROM conversaciones WHERE id = ?",
+                                          (conversacion_id,)).fetchone()[0]
+                    entrada = (fila[0], json.loads(estado), fila[1])
+                else:
+                    entrada = (entrada[0], entrada[1], fila[1])
+        elif entrada and entrada[2] <= ahora:
+            entrada = None
+        if entrada is None:
+            self.descartar(conversacion_id)
+            self._contar('no_encontradas')
+            raise ConversacionNoEncontrada()
+        self._recordar(conversacion_id, *entrada)
+        version, estado, _ = entrada
+        return {
+            'id': conversacion_id, 'version': version, 'etapa': estado['etapa'],
+            'paciente': dict(estado['paciente']), 'sintomas': estado.get('sintomas'),
+            'contexto': dict(estado['contexto']),
+        }
+
+    def avanzar(self, conversacion, etapa, contexto=None, sintomas=None, paciente=None):
+        """Guardar la etapa y el contexto resultantes de atender `conversacion` (la leída con obtener)"""
+        if etapa not in TRANSICIONES.get(conversacion['etapa'], ()):
+            self.descartar(conversacion['id'])
+            self._contar('transiciones_invalidas')
+            raise TransicionInvalida(conversacion['etapa'], f"Transición no permitida: {conversacion['etapa']} -> {etapa}")
+        estado = {
+            'etapa': etapa,
+            'paciente': {**conversacion['paciente'], **_compactar(CAMPOS_PACIENTE, paciente or {})},
+            'sintomas': sintomas or conversacion['sintomas'],
+            'contexto': _compactar(CAMPOS_CONTEXTO, contexto or {}),
+        }
+        self._guardar(conversacion['id'], conversacion['version'] + 1, estado)
+        self._contar('avances')
+
+    def purgar(self):
+        """Eliminar las conversaciones caducadas (memoria y SQLite)"""
+        ahora = time.time()
+        with self._lock:
+            for conversacion_id in [c for c, (_, _, expira) in self._memoria.items() if expira <= ahora]:
+                del self._memoria[conversacion_id]
+        if self.conexiones:
+            with self.conexiones.obtener() as conn:
+                return conn.execute("DELETE FROM conversaciones WHERE expira <= ?", (ahora,)).rowcount
+        return 0
+
+    def estadisticas(self):
+        with self._lock:
+            return {**self._contadores, 'en_memoria': len(self._memoria)}
+
+
+# Instancia global; CONVERSACIONES_DB vacío deja las conversaciones solo en la memoria de cada proceso
+conversaciones = AlmacenConversaciones(
+    settings.CONVERSACIONES_DB or None,
+    ttl_segundos=settings.CONVERSACIONES_TTL,
+    max_memoria=settings.CONVERSACIONES_MAX_MEMORIA,
+)
@@ -0,0 +1,92 @@
+import functools
+import time
+
+from agentes.cache_triaje import cache_triaje
+from agentes.cliente_openai import CONTADORES, ESTADOS_CIRCUITO, cliente_openai
+from agentes.metricas import etapa_actual, metricas
+from agentes.salidas import MetricasSalidas, metricas_salidas
+from agentes.uso_tokens import uso_tokens
+from backend_asistente_medico.cola_trabajos import ESTADOS_FINALES, cola_trabajos
+from backend_asistente_medico.concurrencia import limite_llm
+from backend_asistente_medico.conversaciones import CONTADORES as EVENTOS_CONVERSACION, conversaciones
+
+
+def server_timing(desglose):
+    """Cabecera Server-Timing con el desglose de la petición (visible en las herramientas del navegador)"""
+    return ', '.join(
+        f'{tramo};desc="{llamadas} llamadas";dur={segundos * 1000:.1f}'
+        for tramo, (segundos, llamadas) in sorted(desglose.items(), key=lambda item: -item[1][0])
+    )
+
+
+def instrumentar(vista):
+    """
+    Decorador para vistas asíncronas: mide la petición completa, acumula el tiempo de
+    Whisper, crew, herramientas, SQLite y TTS que se gasta dentro de ella y lo devuelve
+    en la cabecera Server-Timing
+    """
+    @functools.wraps(vista)
+    async def envoltura(request, *args, **kwargs):
+        # Con WSGI, async_to_sync devuelve el contexto al hilo: la etapa no debe pasar a la siguiente petición
+        token = etapa_actual.set('')
+        try:
+            with metricas.desglose() as desglose:
+                inicio = time.perf_counter()
+                respuesta = await vista(request, *args, **kwargs)
+                metricas.observar('peticion', time.perf_counter() - inicio, vista=vista.__name__)
+        finally:
+            etapa_actual.reset(token)
+        # 'peticion' abarca todo lo demás y no se incluye en el desglose
+        desglose.pop('peticion', None)
+        if desglose:
+            respuesta['Server-Timing'] = server_timing(desglose)
+        return respuesta
+    return envoltura
+
+
+def metricas_componentes():
+    """Contadores de la cola, la caché de triaje, las conversaciones, el límite LLM, el cliente de OpenAI, las salidas y los tokens"""
+    conteo = cola_trabajos.conteo_por_estado()
+    yield ('asistente_cola_trabajos', 'gauge', 'Trabajos en la cola por estado',
+           [({'estado': estado}, conteo.get(estado, 0)) for estado in ('pendiente', 'en_curso') + ESTADOS_FINALES])
+
+    cache = cache_triaje.estadisticas()
+    yield ('asistente_cache_triaje_consultas_total', 'counter', 'Consultas a la caché de triaje por resultado',
+           [({'resultado': resultado}, cache[resultado]) for resultado in ('aciertos_memoria', 'aciertos_disco', 'fallos')])
+    yield ('asistente_cache_triaje_entradas', 'gauge', 'Entradas vigentes en la caché de triaje',
+           [({}, cache['entradas'])])
+
+    estado_conversaciones = conversaciones.estadisticas()
+    yield ('asistente_conversaciones_eventos_total', 'counter', 'Conversaciones creadas, avances, conflictos, transiciones inválidas y no encontradas',
+           [({'evento': evento}, estado_conversaciones[evento]) for evento in EVENTOS_CONVERSACION])
+    yield ('asistente_conversaciones_en_memoria', 'gauge', 'Conversaciones en la memoria de este proceso',
+           [({}, estado_conversaciones['en_memoria'])])
+
+    yield ('asistente_llm_en_curso', 'gauge', 'Llamadas a OpenAI en curso en este proceso',
+           [({}, limite_llm.en_curso)])
+    yield ('asistente_llm_rechazadas_total', 'counter', 'Peticiones rechazadas con 503 por el límite LLM',
+           [({}, limite_llm.rechazadas)])
+
+    llamadas_openai = cliente_openai.resumen()
+    yield ('asistente_openai_circuito', 'gauge', 'Estado del cortacircuitos por operación (0 cerrado, 1 semiabierto, 2 abierto)',
+           [({'operacion': operacion}, ESTADOS_CIRCUITO[contadores['circuito']]) for operacion, contadores in llamadas_openai.items()])
+    yield ('asistente_openai_circuito_aperturas_total', 'counter', 'Veces que se abrió el cortacircuitos',
+           [({'operacion': operacion}, contadores['aperturas']) for operacion, contadores in llamadas_openai.items()])
+    yield ('asistente_openai_eventos_total', 'counter', 'Llamadas a OpenAI, reintentos, coberturas, fallos, plazos agotados y rechazos',
+           [({'operacion': operacion, 'evento': evento}, contadores[evento])
+            for operacion, contadores in llamadas_openai.items() for evento in CONTADORES])
+
+    salidas = metricas_salidas.resumen()
+    yield ('asistente_salidas_agentes_total', 'counter', 'Origen del contexto de cada etapa (estructurada, texto o fallida)',
+           [({'etapa': etapa, 'origen': origen}, contadores[origen])
+            for etapa, contadores in salidas.items() for origen in MetricasSalidas.ORIGENES])
+
+    tokens = uso_tokens.resumen()
+    yield ('asistente_tokens_total', 'counter', 'Tokens consumidos por etapa y tipo',
+           [({'etapa': etapa, 'tipo': tipo}, contadores[tipo])
+            for etapa, contadores in tokens.items() for tipo in ('prompt_tokens', 'cached_prompt_tokens', 'completion_tokens')])
+    yield ('asistente_presupuesto_tokens_excedido_total', 'counter', 'Tareas cuyo prompt estimado superó el presupuesto de la etapa',
+           [({'etapa': etapa}, contadores['presupuesto_excedido']) for etapa, contadores in tokens.items()])
+
+
+metricas.registrar_colector(metricas_componentes)
@@ -94,7 +94,8 @@ WSGI_APPLICATION = 'backend_asistente_medico.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        # Configurable para que la prueba de carga no migre ni escriba en la base del desarrollador
+        'NAME': os.getenv('DJANGO_DB', str(BASE_DIR / 'db.sqlite3')),
     }
 }
 
@@ -139,3 +140,39 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Concurrencia de las llamadas a OpenAI (agentes, Whisper y TTS) por proceso.
+# Al superar LLM_MAX_CONCURRENTES se espera como mucho LLM_ESPERA_MAXIMA segundos
+# y después se responde 503 con Retry-After: LLM_REINTENTAR_EN
+LLM_MAX_CONCURRENTES = int(os.getenv('LLM_MAX_CONCURRENTES', 8))
+LLM_ESPERA_MAXIMA = float(os.getenv('LLM_ESPERA_MAXIMA', 2))
+LLM_REINTENTAR_EN = int(os.getenv('LLM_REINTENTAR_EN', 5))
+# Hilos por proceso para el acceso bloqueante a SQLite de las vistas asíncronas
+# (conversaciones, caché de triaje, reservas y cola), aparte de los del límite LLM
+BD_MAX_HILOS = int(os.getenv('BD_MAX_HILOS', 16))
+
+# Plazos, reintentos, coberturas y cortacircuitos de las llamadas a OpenAI: los lee
+# agentes/cliente_openai.py del entorno (OPENAI_PLAZO_<OPERACION>, OPENAI_REINTENTOS_<OPERACION>,
+# OPENAI_COBERTURA_<OPERACION>, OPENAI_CIRCUITO_FALLOS y OPENAI_CIRCUITO_ENFRIAMIENTO)
+
+# Cola de trabajos en SQLite para atender etapas en segundo plano ("asincrono": true)
+COLA_TRABAJOS_DB = os.getenv('COLA_TRABAJOS_DB', str(BASE_DIR / 'trabajos.db'))
+COLA_TRABAJOS_HILOS = int(os.getenv('COLA_TRABAJOS_HILOS', 4))
+COLA_TRABAJOS_MAX_PENDIENTES = int(os.getenv('COLA_TRABAJOS_MAX_PENDIENTES', 200))
+
+# Estado de las conversaciones del asistente (el cliente solo reenvía conversacion_id): LRU en
+# memoria por proceso escrita también en SQLite; CONVERSACIONES_DB vacío las deja solo en memoria.
+# Caducan CONVERSACIONES_TTL segundos después del último avance
+CONVERSACIONES_DB = os.getenv('CONVERSACIONES_DB', str(BASE_DIR / 'conversaciones.db'))
+CONVERSACIONES_TTL = int(os.getenv('CONVERSACIONES_TTL', 1800))
+CONVERSACIONES_MAX_MEMORIA = int(os.getenv('CONVERSACIONES_MAX_MEMORIA', 2048))
+
+# Si se define, /metrics exige la cabecera "Authorization: Bearer <METRICAS_TOKEN>"
+METRICAS_TOKEN = os.getenv('METRICAS_TOKEN', '')
+
+# Backends simulados para pruebas de carga y CI sin red. El LLM de los agentes lo elige
+# agentes/llm_simulado.py con variables de entorno: BACKEND_LLM (openai, simulado o grabar),
+# LLM_SIMULADO_GUION, LLM_SIMULADO_LATENCIA y LLM_SIMULADO_LATENCIA_TOKEN
+BACKEND_AUDIO = os.getenv('BACKEND_AUDIO', 'openai')
+AUDIO_SIMULADO_TEXTO = os.getenv('AUDIO_SIMULADO_TEXTO', 'Tengo dolor de cabeza y fiebre desde ayer')
+AUDIO_SIMULADO_LATENCIA = float(os.getenv('AUDIO_SIMULADO_LATENCIA', 0))
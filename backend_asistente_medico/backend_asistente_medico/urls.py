@@ -6,7 +6,11 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('authentication.urls')),
     path('asistente/atender/', views.atender_paciente, name='atender_paciente'),
+    path('asistente/atender/flujo/', views.atender_paciente_flujo, name='atender_paciente_flujo'),
+    path('asistente/trabajos/<str:trabajo_id>/', views.trabajo, name='trabajo'),
+    path('asistente/trabajos/<str:trabajo_id>/eventos/', views.eventos_trabajo, name='eventos_trabajo'),
     path('transcribir-audio/', views.transcribir_audio, name='transcribir_audio'),
     path('procesar-consulta-voz/', views.procesar_consulta_voz, name='procesar_consulta_voz'),
     path('generar-audio/', views.generar_audio_respuesta, name='generar_audio'),
+    path('metrics', views.metricas_prometheus, name='metricas'),
 ]
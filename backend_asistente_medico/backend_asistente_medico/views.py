@@ -1,19 +1,44 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.http import HttpResponse
+from django.conf import settings
+import asyncio
+import contextlib
+import hmac
 import json
+import time
 from datetime import datetime
-from agentes.agentes import crear_agentes, crear_tareas, extraer_contexto_triaje
-from crewai import Crew, Process
+from agentes.agentes import llm, registro_agentes, crear_crew, crear_tareas, extraer_contexto
+from agentes.flujo_respuesta import FlujoRespuestaFinal
+from agentes.salidas import datos_salida
+from agentes.uso_tokens import uso_tokens
+from agentes.triaje_reglas import clasificar_sintomas, triaje_local
+from agentes.cache_triaje import cache_triaje
+from agentes.etapas_locales import etapa_local
+from agentes.metricas import etapa_actual, metricas
+from agentes.cliente_openai import OpenAINoDisponible, cliente_openai
+from backend_asistente_medico.cola_trabajos import ESTADOS_FINALES, ColaLlena, cola_trabajos, prioridad_urgencia
+from backend_asistente_medico.conversaciones import ConversacionNoEncontrada, TransicionInvalida, conversaciones
+from backend_asistente_medico.concurrencia import SobrecargaLLM, ejecutar_bd, limite_llm, respuesta_sobrecarga
+from backend_asistente_medico.instrumentacion import instrumentar
+from backend_asistente_medico.audio_simulado import ClienteAudioSimulado
 from openai import OpenAI
 import os
-import tempfile
 
-# Configuración de OpenAI
-client = OpenAI(
-    api_key=os.getenv('OPENAI_API_KEY')
-)
+# Configuración de OpenAI (Whisper y TTS), o cliente simulado sin red con BACKEND_AUDIO=simulado
+if settings.BACKEND_AUDIO == 'simulado':
+    client = ClienteAudioSimulado(
+        texto=settings.AUDIO_SIMULADO_TEXTO,
+        latencia=settings.AUDIO_SIMULADO_LATENCIA
+    )
+else:
+    # Sin reintentos propios del SDK: plazos, reintentos y cortacircuitos los aplica cliente_openai
+    client = OpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        max_retries=0
+    )
 
 
 def serializar_resultado_crew(resultado):
@@ -33,12 +58,19 @@ def serializar_resultado_crew(resultado):
             resultado_final['tareas'] = []
             
             for i, task in enumerate(resultado.tasks_output):
+                # Con salida estructurada, el texto para el paciente es su campo 'respuesta'
+                estructurada = datos_salida(task)
+                respuesta_estructurada = (estructurada or {}).get('respuesta')
                 tarea_info = {
                     'numero_tarea': i + 1,
                     'descripcion': getattr(task, 'description', 'Sin descripción'),
                     'agente': getattr(task, 'agent', 'Agente desconocido'),
-                    'output_completo': str(getattr(task, 'output', task))
+                    'output_completo': respuesta_estructurada or str(getattr(task, 'output', task))
                 }
+                if estructurada:
+                    tarea_info['salida_estructurada'] = estructurada
+                    if respuesta_estructurada and i == len(resultado.tasks_output) - 1:
+                        resultado_final['respuesta_completa'] = respuesta_estructurada
                 
                 # Extraer información específica del output del agente
                 output_str = str(getattr(task, 'output', ''))
@@ -188,6 +220,70 @@ def extraer_info_medica(output_str):
     
     return info_medica
 
+def transcribir(audio_file):
+    """Transcribir con Whisper un archivo subido (bloqueante: se ejecuta en el pool del límite LLM)"""
+    # En memoria y no como archivo abierto: cada reintento o cobertura reenvía el contenido
+    contenido = b''.join(audio_file.chunks())
+    with metricas.medir('whisper'):
+        return cliente_openai.llamar(
+            'transcripcion',
+            client.audio.transcriptions.create,
+            model="whisper-1",
+            file=('audio.wav', contenido),
+            language="es"  # Español
+        )
+
+def resultado_local(respuesta, tipo_agente, **extra):
+    """Resultado con la misma forma que serializar_resultado_crew para respuestas generadas sin LLM"""
+    agente = 'Especialista en Triaje Médico' if tipo_agente == 'triaje' else 'Administrador de Base de Datos Médica'
+    return {
+        'respuesta_completa': respuesta,
+        'tareas': [{
+            'numero_tarea': 1,
+            'descripcion': 'Respuesta generada localmente',
+            'agente': agente,
+            'output_completo': respuesta,
+            'respuesta_final': respuesta,
+            'tipo_agente': tipo_agente
+        }],
+        'timestamp': str(datetime.now()),
+        'total_tareas': 1,
+        'origen': 'local',
+        **extra
+    }
+
+def triaje_sin_llm(datos_paciente):
+    """
+    Resolver el triaje sin agentes: primero las reglas de señales de alarma y después la
+    caché de triajes previos con síntomas equivalentes. Devuelve (respuesta, contexto, extra) o None.
+    """
+    local = triaje_local(datos_paciente)
+    if local:
+        respuesta, contexto, triaje = local
+        return respuesta, contexto, {'triaje_local': triaje.a_dict()}
+    cacheado = cache_triaje.obtener(datos_paciente.get('sintomas'), datos_paciente.get('edad'))
+    if cacheado:
+        respuesta, contexto = cacheado
+        return respuesta, contexto, {'cache_triaje': True}
+    return None
+
+def etapa_sin_llm(etapa, datos_paciente, contexto, paciente_id=None):
+    """Etapas deterministas sin agentes; devuelve (respuesta, contexto, siguiente_etapa) o None"""
+    if etapa == 'triaje':
+        return None
+    return etapa_local(etapa, datos_paciente, contexto, paciente_id)
+
+async def paciente_sesion(request):
+    """ID del paciente con sesión iniciada, o None. Un paciente_id en el cuerpo de la petición no se usa"""
+    return await request.session.aget('paciente_id')
+
+def contexto_sin_paciente(contexto, paciente_id):
+    """Contexto del cliente con el paciente de la sesión en lugar del que pudiera traer"""
+    contexto = {k: v for k, v in (contexto or {}).items() if k != 'paciente_id'}
+    if paciente_id:
+        contexto['paciente_id'] = paciente_id
+    return contexto
+
 def merge_contextos(contexto, nuevo_contexto):
     combinado = contexto.copy()
     for k, v in nuevo_contexto.items():
@@ -195,168 +291,359 @@ def merge_contextos(contexto, nuevo_contexto):
             combinado[k] = v
     return combinado
 
-# Vista usando la función helper
-@csrf_exempt
-@require_http_methods(["POST"])
-def atender_paciente(request):
+def retomar_conversacion(data):
+    """
+    Con conversacion_id, completar la petición con el estado guardado en el servidor
+    (paciente, etapa, contexto y síntomas originales), de modo que el cliente solo envía
+    el ID y su respuesta. Devuelve (conversacion o None, data).
+    """
+    conversacion_id = data.get('conversacion_id')
+    if not conversacion_id:
+        return None, data
+    conversacion = conversaciones.obtener(conversacion_id)
+    # El paciente se fija al crear la conversación; otro paciente con sesión no puede continuarla
+    paciente_id = conversacion['paciente'].get('paciente_id')
+    if paciente_id and data.get('paciente_id') not in (None, paciente_id):
+        raise ConversacionNoEncontrada()
+    # Una conversación finalizada solo admite una consulta nueva: otro triaje del mismo paciente
+    etapa = 'triaje' if conversacion['etapa'] == 'finalizado' else conversacion['etapa']
+    if data.get('stage', etapa) != etapa:
+        conversaciones.descartar(conversacion_id)
+        raise TransicionInvalida(etapa)
+    datos = dict(data, **conversacion['paciente'], stage=etapa)
+    if etapa == 'triaje':
+        datos['contexto'] = {}
+    else:
+        datos['contexto'] = conversacion['contexto']
+        datos['sintomas'] = conversacion['sintomas']
+    return conversacion, datos
+
+def guardar_conversacion(conversacion, data, cuerpo):
+    """
+    Guardar la etapa y el contexto resultantes y devolver el ID de la conversación. Sin
+    conversación previa solo se crea una a partir de un triaje (peticiones sin ID).
+    data['paciente_id'] es el de la sesión (lo fija la vista) o el ya guardado.
+    """
+    contexto = cuerpo.get('contexto') or {}
+    triaje = data.get('stage', 'triaje') == 'triaje'
+    paciente = {
+        'nombre': data.get('nombre'),
+        'edad': data.get('edad'),
+        'telefono': data.get('telefono'),
+        'paciente_id': data.get('paciente_id'),
+    }
+    sintomas = data.get('sintomas') if triaje else None
+    if conversacion is None:
+        return conversaciones.crear(paciente, cuerpo['stage'], contexto, sintomas) if triaje else None
+    conversaciones.avanzar(conversacion, cuerpo['stage'], contexto, sintomas, paciente)
+    return conversacion['id']
+
+async def procesar_atencion(data, ejecutar=None, en_segundo_plano=False, flujo=None):
+    """
+    Atender una etapa y devolver (cuerpo, codigo_http). Con conversacion_id el estado sale
+    del almacén de conversaciones (404 si caducó, 409 si la etapa enviada no es la guardada)
+    y el resultado se guarda en él; sin ID se usan los datos y el contexto de la petición.
+    """
     try:
-        data = json.loads(request.body)
-        print(data)
-        stage = data.get('stage', 'triaje')
-        nombre = data.get('nombre')
-        edad = data.get('edad')
-        sintomas = data.get('sintomas')
-        telefono = data.get('telefono', None)
-        respuesta_usuario = data.get('respuesta_usuario')
-        contexto = data.get('contexto', {})
-        fecha_deseada = data.get('fecha_deseada')
-        hora_deseada = data.get('hora_deseada')
+        conversacion, data = await ejecutar_bd(retomar_conversacion, data)
+        cuerpo, codigo_http = await ejecutar_etapa(data, ejecutar, en_segundo_plano, flujo)
+        if codigo_http == 200 and cuerpo.get('success') and cuerpo.get('stage'):
+            conversacion_id = await ejecutar_bd(guardar_conversacion, conversacion, data, cuerpo)
+        else:
+            conversacion_id = conversacion and conversacion['id']
+    except ConversacionNoEncontrada as e:
+        return {'success': False, 'message': str(e)}, 404
+    except TransicionInvalida as e:
+        return {'success': False, 'message': str(e), 'stage': e.etapa}, 409
+    if conversacion_id:
+        cuerpo['conversacion_id'] = conversacion_id
+    return cuerpo, codigo_http
 
-        if not nombre or not edad:
-            return JsonResponse({
-                'success': False,
-                'message': 'Faltan datos obligatorios: nombre o edad.'
-            }, status=400)
+async def ejecutar_etapa(data, ejecutar=None, en_segundo_plano=False, flujo=None):
+    """
+    Ejecutar una etapa de la conversación y devolver (cuerpo, codigo_http).
+    `ejecutar` corre las llamadas bloqueantes al LLM (por defecto, el límite global
+    de concurrencia); con `en_segundo_plano` las etapas que necesitan agentes se
+    encolan y se devuelve el ID del trabajo. Con `flujo` (FlujoRespuestaFinal) los
+    agentes usan su LLM y los tokens de la respuesta final se publican mientras se generan.
+    """
+    ejecutar = ejecutar or limite_llm.ejecutar
+    stage = data.get('stage', 'triaje')
+    etapa_actual.set(stage)
+    nombre = data.get('nombre')
+    edad = data.get('edad')
+    sintomas = data.get('sintomas')
+    telefono = data.get('telefono', None)
+    respuesta_usuario = data.get('respuesta_usuario')
+    # data['paciente_id'] lo fija la vista a partir de la sesión
+    contexto = contexto_sin_paciente(data.get('contexto'), data.get('paciente_id'))
+    fecha_deseada = data.get('fecha_deseada')
+    hora_deseada = data.get('hora_deseada')
 
-        datos_paciente = {
-            'nombre': nombre,
-            'edad': edad,
-            'sintomas': sintomas,
-            'telefono': telefono
-        }
+    if not nombre or not edad:
+        return {
+            'success': False,
+            'message': 'Faltan datos obligatorios: nombre o edad.'
+        }, 400
 
-        agente_triaje, agente_bd = crear_agentes()
-        tareas = []
-        next_stage = stage
-        next_contexto = contexto.copy() if contexto else {}
-        # Flujo por etapas
-        if stage == 'triaje':
-            tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'triaje')
-            crew = Crew(
-                agents=[agente_triaje, agente_bd],
-                tasks=tareas,
-                process=Process.sequential,
-                verbose=False
-            )
-            resultado = crew.kickoff()
-            resultado_serializable = limpiar_dict_para_json(serializar_resultado_crew(resultado))
-            # Extraer contexto del output del agente de triaje
-            output = None
-            if resultado_serializable.get('tareas') and len(resultado_serializable['tareas']) > 0:
-                output = resultado_serializable['tareas'][0].get('output_completo')
-            elif resultado_serializable.get('respuesta_completa'):
-                output = resultado_serializable['respuesta_completa']
-            else:
-                output = ''
-            nuevo_contexto = extraer_contexto_triaje(output)
-            next_contexto = merge_contextos(contexto, nuevo_contexto)
-            return JsonResponse({
-                'success': True,
-                'stage': 'sugerir_cita',
-                'contexto': next_contexto,
-                'resultado': resultado_serializable
-            })
-        elif stage == 'sugerir_cita':
-            # Se espera que contexto tenga especialidad, doctor_id, doctor_nombre, urgencia
-            if respuesta_usuario and respuesta_usuario.lower() in ['si', 'sí', 'ok', 'acepto', 'quiero', 'confirmo']:
-                tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'sugerir_cita', contexto)
-                next_stage = 'confirmar_cita'  # Espera confirmación de la fecha sugerida
-
-                crew = Crew(
-                    agents=[agente_triaje, agente_bd],
-                    tasks=tareas,
-                    process=Process.sequential,
-                    verbose=False
-                )
-                resultado = crew.kickoff()
-                resultado_serializable = limpiar_dict_para_json(serializar_resultado_crew(resultado))
-
-                # Extraer output del agente de BD (última tarea)
-                output = None
-                if resultado_serializable.get('tareas') and len(resultado_serializable['tareas']) > 0:
-                    output = resultado_serializable['tareas'][-1].get('output_completo')
-                elif resultado_serializable.get('respuesta_completa'):
-                    output = resultado_serializable['respuesta_completa']
-                else:
-                    output = ''
+    datos_paciente = {
+        'nombre': nombre,
+        'edad': edad,
+        'sintomas': sintomas,
+        'telefono': telefono
+    }
 
-                # ACTUALIZA el contexto combinando el anterior y el nuevo
-                nuevo_contexto = extraer_contexto_triaje(output)
-                next_contexto = merge_contextos(contexto, nuevo_contexto)
-                return JsonResponse({
-                    'success': True,
-                    'stage': next_stage,
-                    'contexto': next_contexto,
-                    'resultado': resultado_serializable
-                })
-            else:
-                return JsonResponse({
-                    'success': True,
-                    'stage': 'finalizado',
-                    'message': 'No se agenda cita. Si necesitas otra recomendación, vuelve a describir tus síntomas.'
-                })
-        elif stage == 'confirmar_cita':
-            # Validar que el contexto tenga doctor_id, doctor_nombre, fecha, hora
-            required_fields = ['doctor_id', 'doctor_nombre', 'fecha', 'hora']
-            missing = [f for f in required_fields if not contexto.get(f)]
-            if missing:
-                return JsonResponse({
-                    'success': False,
-                    'message': f'Faltan datos en el contexto para confirmar la cita: {", ".join(missing)}. Por favor, vuelve a la etapa anterior.'
-                }, status=400)
-            if respuesta_usuario and respuesta_usuario.lower() in ['si', 'sí', 'ok', 'acepto', 'confirmo']:
-                tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'confirmar_cita', contexto)
-                next_stage = 'finalizado'
-            elif respuesta_usuario and (fecha_deseada or hora_deseada):
-                # Usuario pide otra fecha
-                next_contexto['fecha_deseada'] = fecha_deseada
-                next_contexto['hora_deseada'] = hora_deseada
-                tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'negociar_fecha', next_contexto)
-                next_stage = 'confirmar_cita'
-            else:
-                return JsonResponse({
-                    'success': True,
-                    'stage': 'finalizado',
-                    'message': 'No se agenda cita. Si necesitas otra recomendación, vuelve a describir tus síntomas.'
-                })
-        elif stage == 'negociar_fecha':
-            # Se espera que contexto tenga doctor_id, doctor_nombre, fecha_deseada, hora_deseada
-            tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'negociar_fecha', contexto)
-            next_stage = 'confirmar_cita'
+    # Señales de alarma evidentes o síntomas ya triados: se resuelven sin agentes ni LLM
+    local = await ejecutar_bd(triaje_sin_llm, datos_paciente) if stage == 'triaje' else None
+    if local:
+        respuesta, nuevo_contexto, extra = local
+        return {
+            'success': True,
+            'stage': 'sugerir_cita',
+            'contexto': merge_contextos(contexto, nuevo_contexto),
+            'resultado': resultado_local(respuesta, 'triaje', **extra)
+        }, 200
+
+    next_stage = stage
+    next_contexto = contexto.copy() if contexto else {}
+    # Flujo por etapas: qué tarea toca según la etapa y la respuesta del paciente
+    if stage == 'triaje':
+        etapa_tareas = 'triaje'
+        next_stage = 'sugerir_cita'
+    elif stage == 'sugerir_cita':
+        # Se espera que contexto tenga especialidad, doctor_id, doctor_nombre, urgencia
+        if respuesta_usuario and respuesta_usuario.lower() in ['si', 'sí', 'ok', 'acepto', 'quiero', 'confirmo']:
+            etapa_tareas = 'sugerir_cita'
+            next_stage = 'confirmar_cita'  # Espera confirmación de la fecha sugerida
         else:
-            return JsonResponse({
+            return {
+                'success': True,
+                'stage': 'finalizado',
+                'message': 'No se agenda cita. Si necesitas otra recomendación, vuelve a describir tus síntomas.'
+            }, 200
+    elif stage == 'confirmar_cita':
+        # Validar que el contexto tenga doctor_id, doctor_nombre, fecha, hora
+        required_fields = ['doctor_id', 'doctor_nombre', 'fecha', 'hora']
+        missing = [f for f in required_fields if not contexto.get(f)]
+        if missing:
+            return {
                 'success': False,
-                'message': f'Etapa desconocida: {stage}'
-            }, status=400)
+                'message': f'Faltan datos en el contexto para confirmar la cita: {", ".join(missing)}. Por favor, vuelve a la etapa anterior.'
+            }, 400
+        if respuesta_usuario and respuesta_usuario.lower() in ['si', 'sí', 'ok', 'acepto', 'confirmo']:
+            etapa_tareas = 'confirmar_cita'
+            next_stage = 'finalizado'
+        elif respuesta_usuario and (fecha_deseada or hora_deseada):
+            # Usuario pide otra fecha
+            next_contexto['fecha_deseada'] = fecha_deseada
+            next_contexto['hora_deseada'] = hora_deseada
+            etapa_tareas = 'negociar_fecha'
+            next_stage = 'confirmar_cita'
+        else:
+            return {
+                'success': True,
+                'stage': 'finalizado',
+                'message': 'No se agenda cita. Si necesitas otra recomendación, vuelve a describir tus síntomas.'
+            }, 200
+    elif stage == 'negociar_fecha':
+        # Se espera que contexto tenga doctor_id, doctor_nombre, fecha_deseada, hora_deseada
+        etapa_tareas = 'negociar_fecha'
+        next_stage = 'confirmar_cita'
+    else:
+        return {
+            'success': False,
+            'message': f'Etapa desconocida: {stage}'
+        }, 400
 
-        crew = Crew(
-            agents=[agente_triaje, agente_bd],
-            tasks=tareas,
-            process=Process.sequential,
-            verbose=False
-        )
-        resultado = crew.kickoff()
-        resultado_serializable = limpiar_dict_para_json(serializar_resultado_crew(resultado))
-        return JsonResponse({
+    etapa_actual.set(etapa_tareas)
+    # Reserva o disponibilidad con parámetros conocidos: directamente contra la base de datos
+    local = await ejecutar_bd(etapa_sin_llm, etapa_tareas, datos_paciente, next_contexto, data.get('paciente_id'))
+    if local:
+        respuesta, nuevo_contexto, next_stage = local
+        return {
             'success': True,
             'stage': next_stage,
-            'contexto': next_contexto,
-            'resultado': resultado_serializable
-        })
+            'contexto': merge_contextos(next_contexto, nuevo_contexto),
+            'resultado': resultado_local(respuesta, 'base_datos', etapa_local=etapa_tareas)
+        }, 200
+
+    if en_segundo_plano:
+        # La etapa necesita agentes: se encola con prioridad según la urgencia conocida o estimada
+        urgencia = (contexto or {}).get('urgencia') or clasificar_sintomas(sintomas, edad).urgencia
+        trabajo_id = await ejecutar_bd(cola_trabajos.encolar, dict(data, asincrono=False), prioridad_urgencia(urgencia))
+        cola_trabajos.iniciar(procesar_trabajo)
+        return {
+            'success': True,
+            'trabajo_id': trabajo_id,
+            'estado': 'pendiente',
+            'url_estado': reverse('trabajo', args=[trabajo_id]),
+            'url_eventos': reverse('eventos_trabajo', args=[trabajo_id])
+        }, 202
+
+    agente_triaje, agente_bd = registro_agentes.agentes(flujo.llm if flujo else None)
+    if etapa_tareas == 'triaje':
+        tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'triaje')
+    else:
+        tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, etapa_tareas, next_contexto)
+    uso_tokens.verificar(etapa_tareas, tareas)
+    crew = crear_crew(agente_triaje, agente_bd, tareas, flujo)
+    with flujo.escuchar() if flujo else contextlib.nullcontext():
+        resultado = await ejecutar(metricas.medir('crew')(cliente_openai.proteger('chat')(crew.kickoff)))
+    uso_tokens.registrar(etapa_tareas, resultado)
+    resultado_serializable = limpiar_dict_para_json(serializar_resultado_crew(resultado))
+    # Triaje, fecha y hora propuestas (sugerencia y negociación) o agendadas (confirmación)
+    nuevo_contexto = extraer_contexto(resultado, etapa_tareas)
+    if etapa_tareas == 'triaje':
+        await ejecutar_bd(cache_triaje.guardar, sintomas, edad, nuevo_contexto)
+    return {
+        'success': True,
+        'stage': next_stage,
+        'contexto': merge_contextos(next_contexto, nuevo_contexto),
+        'resultado': resultado_serializable
+    }, 200
+
+async def _ejecutar_en_hilo(funcion):
+    # Los hilos de la cola pueden bloquearse: esperan hueco en el límite LLM en lugar de rechazar
+    return limite_llm.llamar(funcion)
+
+def procesar_trabajo(data):
+    """Ejecutar en un hilo de la cola una etapa encolada por atender_paciente"""
+    return asyncio.run(procesar_atencion(data, ejecutar=_ejecutar_en_hilo))
+
+def evento_sse(nombre, datos):
+    return f"event: {nombre}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+async def flujo_eventos_trabajo(trabajo_id, intervalo=0.5, latido=15, duracion_maxima=300):
+    """Eventos SSE de un trabajo: 'estado' en cada cambio y 'resultado' cuando termina"""
+    anterior = None
+    inicio = ultimo_envio = time.monotonic()
+    while time.monotonic() - inicio < duracion_maxima:
+        trabajo = await ejecutar_bd(cola_trabajos.consultar, trabajo_id)
+        if trabajo is None:
+            yield evento_sse('error', {'success': False, 'message': 'Trabajo no encontrado'})
+            return
+        if trabajo['estado'] in ESTADOS_FINALES:
+            yield evento_sse('resultado', trabajo)
+            return
+        if (trabajo['estado'], trabajo.get('posicion')) != anterior:
+            anterior = (trabajo['estado'], trabajo.get('posicion'))
+            ultimo_envio = time.monotonic()
+            yield evento_sse('estado', trabajo)
+        elif time.monotonic() - ultimo_envio > latido:
+            # Comentario SSE para que proxies y navegador no cierren la conexión inactiva
+            ultimo_envio = time.monotonic()
+            yield ': latido\n\n'
+        await asyncio.sleep(intervalo)
+
+async def flujo_atencion(data):
+    """
+    Eventos SSE de una etapa: 'token' con cada fragmento de la respuesta final según lo
+    genera el LLM y, al terminar, 'contexto' con el mismo cuerpo que devuelve atender_paciente.
+    Si el cliente se desconecta, crew.kickoff() no se puede interrumpir: la crew sigue en su
+    hilo, ocupando su plaza de limite_llm hasta terminar, y sus tokens se descartan.
+    """
+    flujo = FlujoRespuestaFinal(llm)
+    tarea = asyncio.ensure_future(procesar_atencion(data, flujo=flujo))
+    try:
+        yield evento_sse('inicio', {'stage': data.get('stage', 'triaje')})
+        while True:
+            siguiente = asyncio.ensure_future(flujo.cola.get())
+            await asyncio.wait({siguiente, tarea}, return_when=asyncio.FIRST_COMPLETED)
+            if not siguiente.done():
+                siguiente.cancel()
+                break
+            yield evento_sse('token', {'texto': siguiente.result()})
+        while not flujo.cola.empty():
+            yield evento_sse('token', {'texto': flujo.cola.get_nowait()})
+
+        try:
+            cuerpo, codigo_http = tarea.result()
+        except (SobrecargaLLM, ColaLlena, OpenAINoDisponible) as e:
+            cuerpo, codigo_http = {'success': False, 'message': str(e), 'reintentar_en': e.reintentar_en}, 503
+        except Exception as e:
+            cuerpo, codigo_http = {'success': False, 'message': f'Error en el asistente médico: {str(e)}'}, 500
+        if not flujo.emitidos and cuerpo.get('resultado'):
+            # Respuesta local o sin marca de respuesta final: se envía completa de una vez
+            yield evento_sse('token', {'texto': cuerpo['resultado'].get('respuesta_completa') or ''})
+        yield evento_sse('contexto', {**cuerpo, 'codigo_http': codigo_http})
+    finally:
+        # Cliente desconectado (o flujo terminado): se dejan de publicar tokens. La crew que
+        # siga en marcha conserva su plaza de limite_llm hasta que termine
+        flujo.cancelar()
+        tarea.cancel()
+
+# Vista usando la función helper
+@csrf_exempt
+@require_http_methods(["POST"])
+@instrumentar
+async def atender_paciente(request):
+    try:
+        data = dict(json.loads(request.body), paciente_id=await paciente_sesion(request))
+        cuerpo, codigo_http = await procesar_atencion(data, en_segundo_plano=bool(data.get('asincrono')))
+        return JsonResponse(cuerpo, status=codigo_http)
     except json.JSONDecodeError:
         return JsonResponse({
             'success': False,
             'message': 'Error: El cuerpo de la petición no es un JSON válido.'
         }, status=400)
+    except (SobrecargaLLM, ColaLlena, OpenAINoDisponible) as e:
+        return respuesta_sobrecarga(e)
     except Exception as e:
         return JsonResponse({
             'success': False,
             'message': f'Error en el asistente médico: {str(e)}'
         }, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def atender_paciente_flujo(request):
+    """Variante de atender_paciente que retransmite la respuesta final token a token (SSE)"""
+    try:
+        data = dict(json.loads(request.body), paciente_id=await paciente_sesion(request))
+    except json.JSONDecodeError:
+        return JsonResponse({
+            'success': False,
+            'message': 'Error: El cuerpo de la petición no es un JSON válido.'
+        }, status=400)
+    respuesta = StreamingHttpResponse(flujo_atencion(data), content_type='text/event-stream')
+    respuesta['Cache-Control'] = 'no-cache'
+    respuesta['X-Accel-Buffering'] = 'no'
+    return respuesta
+
+@csrf_exempt
+@require_http_methods(["GET", "DELETE"])
+async def trabajo(request, trabajo_id):
+    """
+    GET: estado de un trabajo encolado con "asincrono": true (posición en la cola o resultado).
+    DELETE: cancelarlo.
+    """
+    if request.method == 'DELETE':
+        if not await ejecutar_bd(cola_trabajos.cancelar, trabajo_id):
+            return JsonResponse({
+                'success': False,
+                'message': 'El trabajo no existe o ya terminó'
+            }, status=409)
+        return JsonResponse({'success': True, 'message': 'Trabajo cancelado'})
+    estado = await ejecutar_bd(cola_trabajos.consultar, trabajo_id)
+    if estado is None:
+        return JsonResponse({
+            'success': False,
+            'message': 'Trabajo no encontrado'
+        }, status=404)
+    return JsonResponse({'success': True, **estado})
+
+@require_http_methods(["GET"])
+async def eventos_trabajo(request, trabajo_id):
+    """Server-Sent Events con el progreso y el resultado de un trabajo encolado"""
+    respuesta = StreamingHttpResponse(flujo_eventos_trabajo(trabajo_id), content_type='text/event-stream')
+    respuesta['Cache-Control'] = 'no-cache'
+    respuesta['X-Accel-Buffering'] = 'no'
+    return respuesta
         
 @csrf_exempt
 @require_http_methods(["POST"])
-def transcribir_audio(request):
+@instrumentar
+async def transcribir_audio(request):
     """
     Vista para transcribir audio usando Whisper de OpenAI
     """
@@ -378,29 +665,16 @@ def transcribir_audio(request):
                 'message': f'Tipo de archivo no soportado: {audio_file.content_type}'
             }, status=400)
         
-        # Crear archivo temporal para Whisper
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-            for chunk in audio_file.chunks():
-                temp_file.write(chunk)
-            temp_file_path = temp_file.name
-        
-        # Transcribir con Whisper
-        with open(temp_file_path, 'rb') as audio:
-            transcription = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio,
-                language="es"  # Español
-            )
-        
-        # Limpiar archivo temporal
-        import os
-        os.unlink(temp_file_path)
+        # Transcribir con Whisper fuera del bucle de eventos
+        transcription = await limite_llm.ejecutar(transcribir, audio_file)
         
         return JsonResponse({
             'success': True,
             'transcription': transcription.text
         })
         
+    except (SobrecargaLLM, OpenAINoDisponible) as e:
+        return respuesta_sobrecarga(e)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -410,7 +684,8 @@ def transcribir_audio(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def procesar_consulta_voz(request):
+@instrumentar
+async def procesar_consulta_voz(request):
     """
     Vista integrada que recibe audio, lo transcribe y procesa la consulta médica
     """
@@ -424,18 +699,25 @@ def procesar_consulta_voz(request):
         
         audio_file = request.FILES['audio']
         
-        # Obtener datos adicionales del formulario
-        nombre = request.POST.get('nombre')
-        edad = request.POST.get('edad')
-        telefono = request.POST.get('telefono')
-        stage = request.POST.get('stage', 'triaje')
-        contexto_str = request.POST.get('contexto', '{}')
-        respuesta_usuario = request.POST.get('respuesta_usuario')
+        # Obtener datos adicionales del formulario (o del servidor si llega conversacion_id)
+        conversacion, datos = await ejecutar_bd(
+            retomar_conversacion, dict(request.POST.dict(), paciente_id=await paciente_sesion(request)))
+        nombre = datos.get('nombre')
+        edad = datos.get('edad')
+        telefono = datos.get('telefono')
+        stage = datos.get('stage', 'triaje')
+        etapa_actual.set(stage)
+        contexto = datos.get('contexto', '{}')
+        respuesta_usuario = datos.get('respuesta_usuario')
         
-        try:
-            contexto = json.loads(contexto_str)
-        except Exception:
-            contexto = {}
+        if isinstance(contexto, str):
+            try:
+                contexto = json.loads(contexto)
+            except Exception:
+                contexto = {}
+        contexto = contexto_sin_paciente(contexto, datos.get('paciente_id'))
+        if conversacion and stage != 'triaje':
+            contexto['sintomas_originales'] = datos['sintomas']
 
         if not nombre or not edad:
             return JsonResponse({
@@ -444,20 +726,7 @@ def procesar_consulta_voz(request):
             }, status=400)
 
         # Transcribir audio
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-            for chunk in audio_file.chunks():
-                temp_file.write(chunk)
-            temp_file_path = temp_file.name
-
-        with open(temp_file_path, 'rb') as audio:
-            transcription = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio,
-                language="es"
-            )
-
-        import os
-        os.unlink(temp_file_path)
+        transcription = await limite_llm.ejecutar(transcribir, audio_file)
 
         # CORRECCIÓN: Construir datos_paciente correctamente según la etapa
         if stage == 'triaje':
@@ -480,80 +749,43 @@ def procesar_consulta_voz(request):
             # Usar la transcripción como respuesta del usuario
             respuesta_usuario = transcription.text
 
-        agente_triaje, agente_bd = crear_agentes()
-        tareas = []
-        next_stage = stage
-        next_contexto = contexto.copy() if contexto else {}
+        async def responder(cuerpo):
+            """Guardar el avance en la conversación y responder con su ID"""
+            conversacion_id = await ejecutar_bd(
+                guardar_conversacion, conversacion, dict(datos, stage=stage, sintomas=datos_paciente['sintomas'], contexto=contexto), cuerpo)
+            if conversacion_id:
+                cuerpo['conversacion_id'] = conversacion_id
+            return JsonResponse(cuerpo)
 
-        # FLUJO DE ETAPAS CORREGIDO
-        if stage == 'triaje':
-            tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'triaje')
-            crew = Crew(
-                agents=[agente_triaje, agente_bd],
-                tasks=tareas,
-                process=Process.sequential,
-                verbose=False
-            )
-            resultado = crew.kickoff()
-            resultado_serializable = limpiar_dict_para_json(serializar_resultado_crew(resultado))
-            
-            # Extraer contexto del output del agente de triaje
-            output = None
-            if resultado_serializable.get('tareas') and len(resultado_serializable['tareas']) > 0:
-                output = resultado_serializable['tareas'][0].get('output_completo')
-            elif resultado_serializable.get('respuesta_completa'):
-                output = resultado_serializable['respuesta_completa']
-            else:
-                output = ''
-            
-            nuevo_contexto = extraer_contexto_triaje(output)
+        # Señales de alarma evidentes o síntomas ya triados: se resuelven sin agentes ni LLM
+        local = await ejecutar_bd(triaje_sin_llm, datos_paciente) if stage == 'triaje' else None
+        if local:
+            respuesta, nuevo_contexto, extra = local
             next_contexto = merge_contextos(contexto, nuevo_contexto)
-            # CORRECCIÓN: Guardar los síntomas originales para las siguientes etapas
             next_contexto['sintomas_originales'] = transcription.text
-            
-            return JsonResponse({
+            return await responder({
                 'success': True,
                 'stage': 'sugerir_cita',
                 'contexto': next_contexto,
-                'resultado': resultado_serializable,
+                'resultado': resultado_local(respuesta, 'triaje', **extra),
                 'transcription': transcription.text
             })
+
+        next_stage = stage
+        next_contexto = contexto.copy() if contexto else {}
+
+        # FLUJO DE ETAPAS CORREGIDO
+        if stage == 'triaje':
+            etapa_tareas = 'triaje'
+            next_stage = 'sugerir_cita'
             
         elif stage == 'sugerir_cita':
             confirm_words = ['si', 'sí', 'ok', 'acepto', 'quiero', 'confirmo', 'está bien', 'perfecto']
             if respuesta_usuario and any(word in respuesta_usuario.lower() for word in confirm_words):
-                tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'sugerir_cita', contexto)
+                etapa_tareas = 'sugerir_cita'
                 next_stage = 'confirmar_cita'
-                
-                crew = Crew(
-                    agents=[agente_triaje, agente_bd],
-                    tasks=tareas,
-                    process=Process.sequential,
-                    verbose=False
-                )
-                resultado = crew.kickoff()
-                resultado_serializable = limpiar_dict_para_json(serializar_resultado_crew(resultado))
-                
-                output = None
-                if resultado_serializable.get('tareas') and len(resultado_serializable['tareas']) > 0:
-                    output = resultado_serializable['tareas'][-1].get('output_completo')
-                elif resultado_serializable.get('respuesta_completa'):
-                    output = resultado_serializable['respuesta_completa']
-                else:
-                    output = ''
-                
-                nuevo_contexto = extraer_contexto_triaje(output)
-                next_contexto = merge_contextos(contexto, nuevo_contexto)
-                
-                return JsonResponse({
-                    'success': True,
-                    'stage': next_stage,
-                    'contexto': next_contexto,
-                    'resultado': resultado_serializable,
-                    'transcription': transcription.text
-                })
             else:
-                return JsonResponse({
+                return await responder({
                     'success': True,
                     'stage': 'finalizado',
                     'message': 'No se agenda cita. Si necesitas otra recomendación, vuelve a describir tus síntomas.',
@@ -572,43 +804,70 @@ def procesar_consulta_voz(request):
                 
             confirm_words = ['si', 'sí', 'ok', 'acepto', 'confirmo', 'está bien', 'perfecto']
             if respuesta_usuario and any(word in respuesta_usuario.lower() for word in confirm_words):
-                tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'confirmar_cita', contexto)
+                etapa_tareas = 'confirmar_cita'
                 next_stage = 'finalizado'
             elif respuesta_usuario:
                 # Usuario pide otra fecha
-                tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'negociar_fecha', contexto)
+                etapa_tareas = 'negociar_fecha'
                 next_stage = 'confirmar_cita'
             else:
-                return JsonResponse({
+                return await responder({
                     'success': True,
                     'stage': 'finalizado',
                     'message': 'No se agenda cita. Si necesitas otra recomendación, vuelve a describir tus síntomas.',
                     'transcription': transcription.text
                 })
-                
-            crew = Crew(
-                agents=[agente_triaje, agente_bd],
-                tasks=tareas,
-                process=Process.sequential,
-                verbose=False
-            )
-            resultado = crew.kickoff()
-            resultado_serializable = limpiar_dict_para_json(serializar_resultado_crew(resultado))
-            
-            return JsonResponse({
-                'success': True,
-                'stage': next_stage,
-                'contexto': next_contexto,
-                'resultado': resultado_serializable,
-                'transcription': transcription.text
-            })
         else:
             return JsonResponse({
                 'success': False,
                 'message': f'Etapa desconocida: {stage}',
                 'transcription': transcription.text
             }, status=400)
+
+        etapa_actual.set(etapa_tareas)
+        # Reserva o disponibilidad con parámetros conocidos: directamente contra la base de datos
+        local = await ejecutar_bd(etapa_sin_llm, etapa_tareas, datos_paciente, next_contexto, datos.get('paciente_id'))
+        if local:
+            respuesta, nuevo_contexto, next_stage = local
+            return await responder({
+                'success': True,
+                'stage': next_stage,
+                'contexto': merge_contextos(next_contexto, nuevo_contexto),
+                'resultado': resultado_local(respuesta, 'base_datos', etapa_local=etapa_tareas),
+                'transcription': transcription.text
+            })
+
+        agente_triaje, agente_bd = registro_agentes.agentes()
+        if etapa_tareas == 'triaje':
+            tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, 'triaje')
+        else:
+            tareas = crear_tareas(agente_triaje, agente_bd, datos_paciente, etapa_tareas, next_contexto)
+        uso_tokens.verificar(etapa_tareas, tareas)
+        crew = crear_crew(agente_triaje, agente_bd, tareas)
+        resultado = await limite_llm.ejecutar(metricas.medir('crew')(cliente_openai.proteger('chat')(crew.kickoff)))
+        uso_tokens.registrar(etapa_tareas, resultado)
+        resultado_serializable = limpiar_dict_para_json(serializar_resultado_crew(resultado))
+        nuevo_contexto = extraer_contexto(resultado, etapa_tareas)
+        next_contexto = merge_contextos(next_contexto, nuevo_contexto)
+        if etapa_tareas == 'triaje':
+            await ejecutar_bd(cache_triaje.guardar, datos_paciente['sintomas'], datos_paciente['edad'], nuevo_contexto)
+            # CORRECCIÓN: Guardar los síntomas originales para las siguientes etapas
+            next_contexto['sintomas_originales'] = transcription.text
+        
+        return await responder({
+            'success': True,
+            'stage': next_stage,
+            'contexto': next_contexto,
+            'resultado': resultado_serializable,
+            'transcription': transcription.text
+        })
             
+    except ConversacionNoEncontrada as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=404)
+    except TransicionInvalida as e:
+        return JsonResponse({'success': False, 'message': str(e), 'stage': e.etapa}, status=409)
+    except (SobrecargaLLM, OpenAINoDisponible) as e:
+        return respuesta_sobrecarga(e)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -618,7 +877,8 @@ def procesar_consulta_voz(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-def generar_audio_respuesta(request):
+@instrumentar
+async def generar_audio_respuesta(request):
     """
     Vista para convertir texto a audio usando TTS de OpenAI
     """
@@ -633,7 +893,10 @@ def generar_audio_respuesta(request):
             }, status=400)
         
         # Generar audio con TTS
-        response = client.audio.speech.create(
+        response = await limite_llm.ejecutar(
+            metricas.medir('tts')(cliente_openai.llamar),
+            'voz',
+            client.audio.speech.create,
             model="gpt-4o-mini-tts",
             voice="nova",  # Opciones: alloy, echo, fable, onyx, nova, shimmer
             input=texto,
@@ -654,8 +917,19 @@ def generar_audio_respuesta(request):
             'success': False,
             'message': 'Error: El cuerpo de la petición no es un JSON válido.'
         }, status=400)
+    except (SobrecargaLLM, OpenAINoDisponible) as e:
+        return respuesta_sobrecarga(e)
     except Exception as e:
         return JsonResponse({
             'success': False,
             'message': f'Error en generación de audio: {str(e)}'
-        }, status=500)
\ No newline at end of file
+        }, status=500)
+
+@require_http_methods(["GET"])
+def metricas_prometheus(request):
+    """Histogramas de latencia y contadores del proceso en formato de Prometheus"""
+    token = settings.METRICAS_TOKEN
+    # Comparación en tiempo constante: no revela cuántos caracteres del token coinciden
+    if token and not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return HttpResponse(status=401)
+    return HttpResponse(metricas.exponer(), content_type='text/plain; version=0.0.4; charset=utf-8')
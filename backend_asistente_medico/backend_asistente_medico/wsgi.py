@@ -14,3 +14,14 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend_asistente_medico.settings')
 
 application = get_wsgi_application()
+
+# Construir los agentes una vez por worker, antes de la primera petición
+from agentes.agentes import registro_agentes  # noqa: E402
+
+registro_agentes.precalentar()
+
+# Hilos de la cola de trabajos en segundo plano (etapas con "asincrono": true)
+from backend_asistente_medico.cola_trabajos import cola_trabajos  # noqa: E402
+from backend_asistente_medico.views import procesar_trabajo  # noqa: E402
+
+cola_trabajos.iniciar(procesar_trabajo)
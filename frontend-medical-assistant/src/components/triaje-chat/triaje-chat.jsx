@@ -26,6 +26,7 @@ export default function TriajeChat({ onBack }) {
   const [isTyping, setIsTyping] = useState(false)
   const [stage, setStage] = useState('triaje')
   const [contexto, setContexto] = useState({})
+  const [conversacionId, setConversacionId] = useState(null)
   const [sintomas, setSintomas] = useState("")
   const [inputDisabled, setInputDisabled] = useState(false)
   const scrollAreaRef = useRef(null)
@@ -103,8 +104,14 @@ export default function TriajeChat({ onBack }) {
       paciente_id: paciente?.id || pacienteId,
     }
 
-    // Construir el payload según la etapa
-    let payload = {
+    // Construir el payload según la etapa: tras el triaje el estado queda en el servidor
+    // y basta con el id de la conversación y la respuesta del usuario
+    let payload = conversacionId ? {
+      conversacion_id: conversacionId,
+      stage,
+      sintomas: stage === 'triaje' ? inputMessage : undefined,
+      respuesta_usuario: stage !== 'triaje' ? inputMessage : undefined,
+    } : {
       stage,
       nombre: nombres,
       edad: edad,
@@ -123,6 +130,7 @@ export default function TriajeChat({ onBack }) {
     try {
       const response = await fetch("http://localhost:8000/asistente/atender/", {
         method: "POST",
+        credentials: "include", // La cita se agenda para el paciente de la sesión
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify(payload),
       })
@@ -154,6 +162,7 @@ export default function TriajeChat({ onBack }) {
       // Actualizar stage y contexto
       if (data.stage) setStage(data.stage)
       if (data.contexto) setContexto(data.contexto)
+      if (data.conversacion_id) setConversacionId(data.conversacion_id)
       // Guardar los síntomas originales para las siguientes etapas
       if (stage === 'triaje') setSintomas(inputMessage)
       // Si la conversación terminó, deshabilitar input
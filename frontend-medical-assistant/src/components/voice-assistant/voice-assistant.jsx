@@ -18,6 +18,7 @@ const VoiceAssistant = () => {
   // REFS PARA MANTENER VALORES ACTUALES
   const stageRef = useRef(stage);
   const contextoRef = useRef(contexto);
+  const conversacionIdRef = useRef(null);
 
   const mediaRecorderRef = useRef(null);
   const audioChunksRef = useRef([]);
@@ -133,11 +134,16 @@ const VoiceAssistant = () => {
       
       const formData = new FormData();
       formData.append('audio', audioBlob, 'recording.webm');
-      formData.append('nombre', nombres);
-      formData.append('edad', edad);
-      formData.append('telefono', numeroTelefono || '');
       formData.append('stage', currentStage);
-      formData.append('contexto', JSON.stringify(contextoConId));
+      if (conversacionIdRef.current) {
+        // El servidor guarda paciente, contexto y síntomas: solo se envía el id de la conversación
+        formData.append('conversacion_id', conversacionIdRef.current);
+      } else {
+        formData.append('nombre', nombres);
+        formData.append('edad', edad);
+        formData.append('telefono', numeroTelefono || '');
+        formData.append('contexto', JSON.stringify(contextoConId));
+      }
       
       // USAR LA NUEVA TRANSCRIPCIÓN COMO RESPUESTA_USUARIO
       if (currentStage !== 'triaje') {
@@ -152,6 +158,7 @@ const VoiceAssistant = () => {
 
       const response = await fetch('http://localhost:8000/procesar-consulta-voz/', {
         method: 'POST',
+        credentials: 'include', // La cita se agenda para el paciente de la sesión
         body: formData,
       });
 
@@ -166,6 +173,9 @@ const VoiceAssistant = () => {
         if (data.contexto) {
           setContexto(data.contexto);
         }
+        if (data.conversacion_id) {
+          conversacionIdRef.current = data.conversacion_id;
+        }
         
         setTranscription(data.transcription);
         setResponse(data.resultado.respuesta_completa);
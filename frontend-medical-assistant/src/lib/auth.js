@@ -187,18 +187,29 @@ export const medicoAPI = {
 
   async obtenerMisCitas() {
     try {
-      const response = await fetch(`${API_BASE_URL}/medico/mis-citas/`, {
-        method: 'GET',
-        credentials: 'include',
-      });
-      
-      const data = await response.json();
-      
-      if (!response.ok) {
-        throw new Error(data.message || 'Error obteniendo citas');
-      }
-      
-      return data;
+      // La API pagina por cursor: se siguen las páginas hasta tener todas las citas
+      const citas = [];
+      let cursor = null;
+      let data;
+      do {
+        const parametros = new URLSearchParams({ limite: '100' });
+        if (cursor) parametros.set('cursor', cursor);
+        const response = await fetch(`${API_BASE_URL}/medico/mis-citas/?${parametros}`, {
+          method: 'GET',
+          credentials: 'include',
+        });
+        
+        data = await response.json();
+        
+        if (!response.ok) {
+          throw new Error(data.message || 'Error obteniendo citas');
+        }
+        
+        citas.push(...data.citas);
+        cursor = data.tiene_mas ? data.siguiente_cursor : null;
+      } while (cursor);
+      
+      return { ...data, citas, tiene_mas: false, siguiente_cursor: null };
     } catch (error) {
       console.error('Error obteniendo citas:', error);
       throw error;